@@ -17,6 +17,7 @@
 
 #include <vector>
 #include <string>
+#include <stdint.h>
 
 #include "Cell.h"
 #include "Field.h"
@@ -26,9 +27,101 @@
 template <int D1, int D2>
 struct XiData;
 
+// When processing many realizations of the k or g values at the same positions, or several
+// correlations of the same catalogs at once, the pairs of cells that would be accumulated
+// into xi are recorded instead, so they can be applied to each set of values afterwards.
+// The cells are stored as void* since the coordinate system is not a template parameter of
+// BinnedCorr2.
+template <int D1, int D2>
+struct PairRecord  // This works for NN, KK
+{
+    const void* c1;
+    const void* c2;
+    int k;
+    int k2;
+};
+
+template <>
+struct PairRecord<GData, GData>
+{
+    const void* c1;
+    const void* c2;
+    int k;
+    int k2;
+    // The projection factors to apply to g1 conj(g2) and g1 g2 respectively.
+    std::complex<double> projp;
+    std::complex<double> projm;
+};
+
+// The parameters of another binning to be filled during the same traversal as the main one.
+// cf. BinnedCorr2::addBinning.
+struct ExtraBinning
+{
+    ExtraBinning(int bin_type, double minsep, double maxsep, int nbins, double binsize,
+                 double b);
+
+    int bin_type;
+    double minsep;
+    double maxsep;
+    int nbins;
+    double binsize;
+    double b;
+    double logminsep;
+    double minsepsq;
+    double maxsepsq;
+    double bsq;
+    double fullmaxsep;
+    double fullmaxsepsq;
+};
+
+// The interface that BinnedCorr2 uses to fill the results for other binnings, whose bin type
+// is only known at run time.  cf. BinnedCorr2::addBinning.
+template <int D1, int D2>
+class ExtraCorr2
+{
+public:
+    virtual ~ExtraCorr2() {}
+
+    virtual ExtraBinning getBinning() const = 0;
+
+    // Make a new object with the same binning whose results are all 0, e.g. for each thread.
+    virtual ExtraCorr2<D1,D2>* duplicate() const = 0;
+    // Add the results of rhs, which was made by duplicate, to this one.
+    virtual void addResults(const ExtraCorr2<D1,D2>& rhs) = 0;
+
+    // Accumulate the pair of cells, if rsq is in the range of this binning.
+    // k, r, logr are as calculated by BinTypeHelper::singleBin for this binning.
+    virtual void processPair(const Cell<D1,Flat>& c1, const Cell<D2,Flat>& c2, double rsq,
+                             bool auto_corr, int k, double r, double logr) = 0;
+    virtual void processPair(const Cell<D1,Sphere>& c1, const Cell<D2,Sphere>& c2, double rsq,
+                             bool auto_corr, int k, double r, double logr) = 0;
+    virtual void processPair(const Cell<D1,ThreeD>& c1, const Cell<D2,ThreeD>& c2, double rsq,
+                             bool auto_corr, int k, double r, double logr) = 0;
+};
+
+// The interface that BinnedCorr2 uses to apply recorded pairs of cells to one set of values
+// for the cells (cf. BinnedCorr2::addRecordTarget).  The recorded pairs are applied in batches
+// during the traversal, so only a limited number of them are held in memory at any time.
+template <int D1, int D2>
+class RecordTarget
+{
+public:
+    virtual ~RecordTarget() {}
+
+    // Make a new object with the same values whose sums are all 0, e.g. for each thread.
+    virtual RecordTarget<D1,D2>* duplicate() const = 0;
+    // Add the sums of rhs, which was made by duplicate, to this one.
+    virtual void addResults(const RecordTarget<D1,D2>& rhs) = 0;
+
+    // Accumulate the sums for a batch of recorded pairs.
+    virtual void apply(const std::vector<PairRecord<D1,D2> >& records) = 0;
+    // Add the sums into the output arrays, and reset them to 0.
+    virtual void finish() = 0;
+};
+
 // BinnedCorr2 encapsulates a binned correlation function.
 template <int D1, int D2, int B>
-class BinnedCorr2
+class BinnedCorr2 : public ExtraCorr2<D1,D2>
 {
 
 public:
@@ -58,10 +151,72 @@ public:
     void process11(const Cell<D1,C>& c1, const Cell<D2,C>& c2, const MetricHelper<M>& m,
                    bool do_reverse);
 
+    // The version of process11 used when there are extra binnings.  active is a bit mask of
+    // which binnings still need to be filled from these cells or their children.
+    template <int C, int M>
+    void processMulti11(const Cell<D1,C>& c1, const Cell<D2,C>& c2, const MetricHelper<M>& m,
+                        bool do_reverse, uint64_t active);
+
+    template <int C, int M>
+    void processLeaves(const Cell<D1,C>& c1, const Cell<D2,C>& c2, const MetricHelper<M>& m,
+                       bool do_reverse);
+
     template <int C>
     void directProcess11(const Cell<D1,C>& c1, const Cell<D2,C>& c2, const double dsq,
                          bool do_reverse, int k=-1, double r=0., double logr=0.);
 
+    // Start (or stop) recording the pairs of cells, rather than accumulating xi.
+    // Either way, any current records and record targets are cleared.
+    void setRecordPairs(bool record);
+    // The total number of pairs recorded so far, including the ones already applied.
+    long getNRecords() const { return _nrecords + long(_records.size()); }
+
+    // While recording, also accumulate xi for each of nreal realizations of the values.
+    // This needs to be called before the traversal, since the recorded pairs are applied to
+    // each target in batches as they are found.
+    // values1, values2 are the values of the cells in field1, field2 for each realization
+    // as calculated by Field::getCellValues, and xi0..xi3 have shape (nreal, nbins).
+    // V1, V2 give the kind of values (KData for scalars, GData for shears), which need not
+    // be the same as D1, D2.  mode says how to apply each recorded pair (c1,c2):
+    //   0: into bin k, and also k2 if it is set.  This is for auto-correlations, where k2 is
+    //      the bin of the reversed pair for TwoD binning.
+    //   1: into bin k only.  This is for cross-correlations.
+    //   2: reversed, i.e. as the pair (c2,c1), into bin k2 if it is set or else k.
+    //      In this case, field1 and values1 are for the c2 cells, and field2, values2 for c1.
+    template <int V1, int V2, int C>
+    void addRecordTarget(const Field<D1,C>& field1, const Field<D2,C>& field2,
+                         const double* values1, const double* values2, int nreal, int mode,
+                         double* xi0, double* xi1, double* xi2, double* xi3);
+    // Apply the current batch of records to all the targets.
+    void flushRecords();
+    // Apply any remaining records, and add the results of each target into its xi arrays.
+    // This is called after the traversal is done.
+    void finishRecords();
+
+    // Also fill another correlation with a different binning during the traversal.
+    // The cells are split as needed for the finest of the binnings, and each pair of cells
+    // that is small enough for all of them is accumulated into each one whose range includes
+    // that separation.  clearBinnings removes them again.
+    void addBinning(ExtraCorr2<D1,D2>* corr);
+    void clearBinnings();
+
+    // The ExtraCorr2 interface, so this can be the extra binning of another BinnedCorr2.
+    ExtraBinning getBinning() const;
+    ExtraCorr2<D1,D2>* duplicate() const;
+    void addResults(const ExtraCorr2<D1,D2>& rhs);
+    void processPair(const Cell<D1,Flat>& c1, const Cell<D2,Flat>& c2, double rsq,
+                     bool auto_corr, int k, double r, double logr)
+    { processPair1(c1, c2, rsq, auto_corr, k, r, logr); }
+    void processPair(const Cell<D1,Sphere>& c1, const Cell<D2,Sphere>& c2, double rsq,
+                     bool auto_corr, int k, double r, double logr)
+    { processPair1(c1, c2, rsq, auto_corr, k, r, logr); }
+    void processPair(const Cell<D1,ThreeD>& c1, const Cell<D2,ThreeD>& c2, double rsq,
+                     bool auto_corr, int k, double r, double logr)
+    { processPair1(c1, c2, rsq, auto_corr, k, r, logr); }
+    template <int C>
+    void processPair1(const Cell<D1,C>& c1, const Cell<D2,C>& c2, double rsq, bool auto_corr,
+                      int k, double r, double logr);
+
     // Note: op= only copies _data.  Not all the params.
     void operator=(const BinnedCorr2<D1,D2,B>& rhs);
     void operator+=(const BinnedCorr2<D1,D2,B>& rhs);
@@ -96,6 +251,20 @@ protected:
     double _fullmaxsep;
     double _fullmaxsepsq;
     int _coords; // Stores the kind of coordinates being used for the analysis.
+    bool _brute; // Whether the trees for both fields were built with brute=True.
+    bool _record; // Whether to record the pairs of cells rather than accumulate xi.
+    std::vector<PairRecord<D1,D2> > _records;
+    std::vector<RecordTarget<D1,D2>*> _record_targets;  // Each copy owns its targets.
+    long _nrecords;  // The number of records that have already been applied.
+
+    // Work space for processLeaves, which holds the leaves of the two cells being processed.
+    std::vector<const void*> _leaves1;
+    std::vector<const void*> _leaves2;
+
+    // The other binnings to fill, if any.  The thread-local copies own their extra corrs.
+    std::vector<ExtraBinning> _extra;
+    std::vector<ExtraCorr2<D1,D2>*> _extra_corrs;
+    bool _auto_corr; // Whether the current traversal is an auto-correlation.
 
     // These are usually allocated in the python layer and just built up here.
     // So all we have here is a bare pointer for each of them.
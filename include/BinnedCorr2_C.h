@@ -29,6 +29,17 @@ extern void ProcessCross2(void* corr, void* field1, void* field2, int dots,
 extern void ProcessPair(void* corr, void* field1, void* field2, int dots,
                         int d1, int d2, int coord, int bin_type, int metric);
 
+extern void SetRecordPairs(void* corr, int record, int d, int bin_type);
+extern long GetNRecordedPairs(void* corr, int d, int bin_type);
+extern void FinishRecordedPairs(void* corr, int d, int bin_type);
+extern void AddRecordTarget(void* corr, void* field1, void* field2,
+                            double* values1, double* values2, int nreal, int mode,
+                            double* xi0, double* xi1, double* xi2, double* xi3,
+                            int d, int v1, int v2, int coords, int bin_type);
+
+extern void AddBinning(void* corr, void* other, int d1, int d2, int bin_type, int other_bin_type);
+extern void ClearBinnings(void* corr, int d1, int d2, int bin_type);
+
 extern int SetOMPThreads(int num_threads);
 extern int GetOMPThreads();
 
@@ -52,6 +52,13 @@ public:
     template <int C, int M>
     void process(const Field<DC1, C>& field1, const Field<DC2, C>& field2,
                  const Field<DC3, C>& field3, bool dots);
+    // Process the triangles with points in several fields of the same type, sorting each
+    // triangle so it lands in its natural bin regardless of which field each point came from.
+    // If field3 is null, this does the triangles with two points in field1 and one in field2.
+    // Otherwise, it does the triangles with one point in each field.
+    template <int C, int M>
+    void processSym(const Field<DC1, C>& field1, const Field<DC1, C>& field2,
+                    const Field<DC1, C>* field3, bool dots);
 
     // Main worker functions for calculating the result
     template <int C, int M>
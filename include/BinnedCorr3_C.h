@@ -30,3 +30,10 @@ extern void ProcessAuto3(void* corr, void* field, int dots,
 
 extern void ProcessCross3(void* corr, void* field1, void* field2, void* field3, int dots,
                           int d1, int d2, int d3, int coord, int bin_type, int metric);
+
+extern void ProcessSym3(void* corr, void* field1, void* field2, void* field3, int dots,
+                        int d, int coord, int bin_type, int metric);
+
+extern void ProcessMultipole3(void* field, int dots, int d, int coords,
+                              double* redges, int nr, int k2min, int maxn, double b,
+                              double* zeta, double* sumw, double* sumwr, double* sumwlogr);
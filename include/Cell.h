@@ -19,6 +19,8 @@
 #include <algorithm>
 #include <complex>
 #include <vector>
+#include <stdint.h>
+#include <stddef.h>
 
 #include "Position.h"
 #include "dbg.h"
@@ -39,6 +41,11 @@ enum DataType { NData=1 , KData=2 , GData=3 };
 // Return a random number between 0 and 1.
 double urand();
 
+// Return a seed for the random numbers used by split_method = random when building a tree.
+// The random split of each cell is then a function of this seed and the range of objects
+// in the cell, so the tree doesn't depend on the order in which the cells are built.
+uint64_t SplitSeed();
+
 // This is usually what we store in the leaf cells. It has size 4, which is always <= the
 // size of a pointer on modern machines, so it never adds any space to the memory needed.
 // (Since it is in a union with the _right pointer.)
@@ -55,9 +62,10 @@ struct WPosLeafInfo : public LeafInfo
 };
 
 // When we decide we're at a leaf, but we have >1 index to include, we use this instead.
+// indices is an array of N indices, which the Cell takes ownership of.
 struct ListLeafInfo
 {
-    std::vector<long>* indices;
+    long* indices;
 };
 
 
@@ -199,32 +207,38 @@ public:
     // the galaxies which are used in the correlation function calculations.
 
     Cell(CellData<D,C>* data, const LeafInfo& info) :
-        _data(data), _size(0.), _sizesq(0.), _left(0), _info(info) {}
+        _data(offsetTo(data)), _size(0.), _sizesq(0.), _left(0), _info(info) {}
 
     Cell(CellData<D,C>* data, const ListLeafInfo& listinfo) :
-        _data(data), _size(0.), _sizesq(0.), _left(0), _listinfo(listinfo) {}
+        _data(offsetTo(data)), _size(0.), _sizesq(0.), _left(0),
+        _indices(offsetTo(listinfo.indices)) {}
 
     Cell(CellData<D,C>* data, double size, double sizesq, Cell<D,C>* l, Cell<D,C>* r) :
-        _data(data), _size(size), _sizesq(sizesq), _left(l), _right(r) {}
+        _data(offsetTo(data)), _size(size), _sizesq(sizesq), _left(offsetTo(l)),
+        _right(offsetTo(r)) {}
+
+    // The links are relative to the address of the Cell, so a Cell cannot be copied.
+    Cell(const Cell<D,C>& rhs) = delete;
+    Cell<D,C>& operator=(const Cell<D,C>& rhs) = delete;
 
     ~Cell()
     {
         if (_left) {
             Assert(_right);
-            delete _left;
-            delete _right;
-        } else if (_data && _data->getN() > 1) {
-            delete _listinfo.indices;
+            delete atOffset<Cell<D,C> >(_left);
+            delete atOffset<Cell<D,C> >(_right);
+        } else if (_data && getN() > 1) {
+            delete [] atOffset<long>(_indices);
         } // if !left and N==1, then _info, which doesn't need anything to be deleted.
         if (_data) {
-            delete (_data);
+            delete atOffset<CellData<D,C> >(_data);
         }
     }
 
-    const CellData<D,C>& getData() const { return *_data; }
-    const Position<C>& getPos() const { return _data->getPos(); }
-    double getW() const { return _data->getW(); }
-    long getN() const { return _data->getN(); }
+    const CellData<D,C>& getData() const { return *atOffset<CellData<D,C> >(_data); }
+    const Position<C>& getPos() const { return getData().getPos(); }
+    double getW() const { return getData().getW(); }
+    long getN() const { return getData().getN(); }
 
     double getSize() const { return _size; }
     double getSizeSq() const { return _sizesq; }
@@ -232,10 +246,12 @@ public:
     double getAllSize() const { return _size; }
     double calculateInertia() const;
 
-    const Cell<D,C>* getLeft() const { return _left; }
-    const Cell<D,C>* getRight() const { return _left ? _right : 0; }
+    const Cell<D,C>* getLeft() const { return atOffset<Cell<D,C> >(_left); }
+    const Cell<D,C>* getRight() const { return _left ? atOffset<Cell<D,C> >(_right) : 0; }
     const LeafInfo& getInfo() const { Assert(!_left && getN()==1); return _info; }
-    const ListLeafInfo& getListInfo() const { Assert(!_left && getN()!=1); return _listinfo; }
+    // The N indices of a leaf with N > 1.
+    const long* getLeafIndices() const
+    { Assert(!_left && getN()!=1); return atOffset<long>(_indices); }
 
     // These are mostly used for debugging purposes.
     long countLeaves() const;
@@ -249,15 +265,28 @@ public:
 
 protected:
 
-    CellData<D,C>* _data;
+    // The data, the daughter cells and the leaf indices are stored as offsets in bytes from
+    // the Cell itself rather than as pointers.  Then a block of CellNodes (see below) doesn't
+    // depend on where it is in memory, so a tree file written by Field::writeTree can be
+    // used directly from a memory map of the file in each process that reads it.
+    // An offset of 0 means a null pointer, since none of these can point to the Cell itself.
+    template <class T>
+    ptrdiff_t offsetTo(const T* p) const
+    { return p ? reinterpret_cast<intptr_t>(p) - reinterpret_cast<intptr_t>(this) : 0; }
+
+    template <class T>
+    T* atOffset(ptrdiff_t offset) const
+    { return offset ? reinterpret_cast<T*>(reinterpret_cast<intptr_t>(this) + offset) : 0; }
+
+    ptrdiff_t _data;
     float _size;
     float _sizesq;
 
-    Cell<D,C>* _left;
+    ptrdiff_t _left;
     union {
-        Cell<D,C>* _right;      // Use this when _left != 0
+        ptrdiff_t _right;       // Use this when _left != 0
         LeafInfo _info;         // Use this when _left == 0 and N == 1
-        ListLeafInfo _listinfo; // Use this when _left == 0 and N > 1
+        ptrdiff_t _indices;     // Use this when _left == 0 and N > 1
     };
 };
 
@@ -269,13 +298,45 @@ double CalculateSizeSq(
 template <int D, int C, int SM>
 size_t SplitData(
     std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata,
-    size_t start, size_t end, const Position<C>& meanpos);
+    size_t start, size_t end, const Position<C>& meanpos, uint64_t seed);
+
+// The factor exp(2i beta) by which a shear at pos needs to be rotated to parallel transport it
+// to center.  This is only needed for ThreeD and Sphere coordinates.
+template <int C>
+std::complex<double> ParallelTransportFactor(const Position<C>& center, const Position<C>& pos);
+
+// When building the tree in parallel, ranges with fewer than this many objects are built
+// by a single task.  Smaller ones are not worth the overhead of making a new task.
+const size_t BUILD_TASK_MIN = 10000;
 
 template <int D, int C, int SM>
 Cell<D,C>* BuildCell(std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata,
-                     double minsizesq, bool brute, size_t start, size_t end,
+                     double minsizesq, bool brute, size_t start, size_t end, uint64_t seed,
                      CellData<D,C>* ave=0, double sizesq=0.);
 
+// Once a tree is built, each top-level cell and all of its descendants are copied into a
+// single block of CellNodes in depth-first order.  Each cell is right next to its data, and
+// a cell's left daughter is always the next node.  This avoids the memory overhead of
+// allocating every Cell and CellData separately, and it is much more cache friendly
+// when traversing the tree.  The indices of the leaves with N > 1 follow the nodes at the
+// end of the block, so the block is self-contained.
+// Note: These Cells must not be deleted individually.  Use DestroyCellNodes instead.
+template <int D, int C>
+struct CellNode
+{
+    Cell<D,C> cell;
+    CellData<D,C> data;
+};
+
+// Copy the tree starting at cell into a new block of CellNodes.  The original tree is
+// left unchanged.  Returns the new block, and sets n to the number of nodes in it and
+// nbytes to the total size of the block, including the leaf indices.
+template <int D, int C>
+CellNode<D,C>* FlattenCell(const Cell<D,C>* cell, long& n, long& nbytes);
+
+template <int D, int C>
+void DestroyCellNodes(CellNode<D,C>* nodes);
+
 template <int D, int C>
 inline std::ostream& operator<<(std::ostream& os, const Cell<D,C>& c)
 { c.Write(os); return os; }
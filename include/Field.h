@@ -15,6 +15,9 @@
 #ifndef TreeCorr_Field_H
 #define TreeCorr_Field_H
 
+#include <mutex>
+#include <atomic>
+#include <stdint.h>
 #include "Cell.h"
 
 // Most of the functionality for building Cells and doing the correlation functions is the
@@ -43,17 +46,42 @@ public:
           double* w, double* wpos, long nobj,
           double minsize, double maxsize,
           SplitMethod sm, bool brute, int mintop, int maxtop);
+    // Make a Field from the blocks written by writeTree.  The blocks are used in place
+    // rather than copied, so they need to stay valid for the life of the Field.
+    Field(char* blocks, const int64_t* blocksizes, long ntop, long nobj, const double* center,
+          double minsize, double maxsize,
+          SplitMethod sm, bool brute, int mintop, int maxtop);
     ~Field();
 
     long getNObj() const { return _nobj; }
     double getSizeSq() const { return _sizesq; }
     Position<C> getCenter() const { return _center; }
     double getSize() const { return std::sqrt(_sizesq); }
+    bool getBrute() const { return _brute; }
     long getNTopLevel() const { BuildCells(); return long(_cells.size()); }
     const std::vector<Cell<D,C>*>& getCells() const { BuildCells(); return _cells; }
     long countNear(double x, double y, double z, double sep) const;
     void getNear(double x, double y, double z, double sep, long* indices, long n) const;
 
+    // Write the tree structure to a buffer that can be saved to a file.
+    // getTreeSize gives the number of cells, the number of indices in the leaves with
+    // more than one object, and the total number of bytes needed for the blocks.
+    // blocksizes needs room for 2 values per top-level cell.
+    void getTreeSize(long& ncells, long& nindices, long& nbytes) const;
+    void writeTree(int64_t* blocksizes, char* blocks, double* center) const;
+
+    // The number of cells in each top-level tree.  The cells in the writeTree order are the
+    // cells of each top-level tree in turn, each in the order of its block of CellNodes.
+    const std::vector<long>& getNCells() const { BuildCells(); return _nnodes; }
+
+    // Calculate the values of all the cells (in the writeTree order) for a different set of
+    // k or g values at the same positions as were used to build the tree.  v has nv values
+    // for each object, which are multiplied by w and summed for each cell, so values needs
+    // to have room for nv values per cell.  If shear is true, v is taken to be nv/2 complex
+    // shear values, which are parallel transported to the cell centers when C != Flat.
+    void getCellValues(const double* x, const double* y, const double* z, const double* w,
+                       const double* v, int nv, bool shear, double* values) const;
+
 private:
 
     long _nobj;
@@ -67,12 +95,30 @@ private:
     double _sizesq;
     mutable std::vector<Cell<D,C>*> _cells;
 
+    // The blocks of memory holding each of the top-level cells and their descendants,
+    // and the number of cells in each.  (cf. CellNode in Cell.h)
+    // _nbytes is the size of each block, including the indices of its leaves.
+    // If _owns_nodes is false, the blocks are part of a tree file that was memory mapped by
+    // the caller, so they are not deleted with the Field.
+    mutable std::vector<CellNode<D,C>*> _nodes;
+    mutable std::vector<long> _nnodes;
+    mutable std::vector<long> _nbytes;
+    bool _owns_nodes;
+
     // This is set at the start, but once we finish making all the cells, we don't need it anymore.
     mutable std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> > _celldata;
 
+    // Several threads may be processing different pairs of patches that share this field,
+    // so make sure only one of them builds the cells.  Once _built is set, getCells doesn't
+    // need to take the lock any more.
+    mutable std::mutex _build_mutex;
+    mutable std::atomic<bool> _built;
+
     // This finishes the work of the Field constructor.
     void BuildCells() const;
     template <int SM> void DoBuildCells() const;
+    // Replace the top-level cell i with a flattened copy (and delete the original).
+    void flattenCell(long i) const;
 
 };
 
@@ -36,6 +36,16 @@ extern long FieldCountNear(void* field, double x, double y, double z, double sep
                            int d, int coords);
 extern void FieldGetNear(void* field, double x, double y, double z, double sep,
                          int d, int coords, long* indices, long n);
+extern void FieldGetTreeSize(void* field, int d, int coords, long* sizes);
+extern void FieldWriteTree(void* field, int d, int coords,
+                           int64_t* blocksizes, char* blocks, double* center);
+extern void FieldGetCellValues(void* field, int d, int coords,
+                               double* x, double* y, double* z, double* w,
+                               double* v, int nv, int shear, double* values);
+extern void* ReadField(char* blocks, int64_t* blocksizes, long ntop, long nobj, double* center,
+                       double minsize, double maxsize,
+                       int sm_int, int brute, int mintop, int maxtop, int d, int coords);
+extern long CellNodeSize(int d, int coords);
 
 extern void* BuildGSimpleField(double* x, double* y, double* z, double* g1, double* g2,
                                double* w, double* wpos, long nobj, int coords);
@@ -33,6 +33,15 @@ struct ProjectHelper<Flat>
         g2 = c2.getData().getWG() * expm2iarg;
     }
 
+    static void ProjectionFactors(
+        const Position<Flat>& p1, const Position<Flat>& p2,
+        std::complex<double>& e1, std::complex<double>& e2)
+    {
+        // The factors that ProjectShears multiplies the two shears by.
+        std::complex<double> cr(p2 - p1);
+        e1 = e2 = conj(cr*cr)/std::norm(cr);
+    }
+
     static void ProjectShears(
         const Cell<GData,Flat>& c1, const Cell<GData,Flat>& c2,
         std::complex<double>& g1, std::complex<double>& g2)
@@ -155,6 +164,15 @@ struct ProjectHelper<Sphere>
         ProjectShear2(p1,p2,g2);
     }
 
+    static void ProjectionFactors(
+        const Position<Sphere>& p1, const Position<Sphere>& p2,
+        std::complex<double>& e1, std::complex<double>& e2)
+    {
+        e1 = e2 = 1.;
+        ProjectShear2(p2,p1,e1);
+        ProjectShear2(p1,p2,e2);
+    }
+
     static void ProjectShears(
         const Cell<GData,Sphere>& c1, const Cell<GData,Sphere>& c2,
         std::complex<double>& g1, std::complex<double>& g2)
@@ -202,6 +220,15 @@ struct ProjectHelper<ThreeD>
         ProjectHelper<Sphere>::ProjectShear2(sp1,sp2,g2);
     }
 
+    static void ProjectionFactors(
+        const Position<ThreeD>& p1, const Position<ThreeD>& p2,
+        std::complex<double>& e1, std::complex<double>& e2)
+    {
+        Position<Sphere> sp1(p1);
+        Position<Sphere> sp2(p2);
+        ProjectHelper<Sphere>::ProjectionFactors(sp1,sp2,e1,e2);
+    }
+
     static void ProjectShears(
         const Cell<GData,ThreeD>& c1, const Cell<GData,ThreeD>& c2,
         std::complex<double>& g1, std::complex<double>& g2)
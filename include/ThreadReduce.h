@@ -0,0 +1,54 @@
+/* Copyright (c) 2003-2019 by Mike Jarvis
+ *
+ * TreeCorr is free software: redistribution and use in source and binary forms,
+ * with or without modification, are permitted provided that the following
+ * conditions are met:
+ *
+ * 1. Redistributions of source code must retain the above copyright notice, this
+ *    list of conditions, and the disclaimer given in the accompanying LICENSE
+ *    file.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions, and the disclaimer given in the documentation
+ *    and/or other materials provided with the distribution.
+ */
+
+#ifndef TreeCorr_ThreadReduce_H
+#define TreeCorr_ThreadReduce_H
+
+#include <vector>
+
+#ifdef _OPENMP
+#include "omp.h"
+
+// Sum the per-thread copies of a correlation object into target.
+//
+// This must be called by every thread in the enclosing omp parallel region.  copies is a
+// shared vector with at least omp_get_num_threads() entries, which is used to let the
+// threads find each other's local copies.
+//
+// Rather than have every thread add its copy into target one at a time inside a critical
+// section, the copies are summed pairwise in log2(nthreads) rounds, with the additions in
+// each round done concurrently.  For large bin arrays (e.g. TwoD binning or three-point
+// correlations with fine u,v binning) this keeps the merge from becoming a serial
+// bottleneck at the end of the calculation.
+template <typename T>
+void ThreadReduce(T& target, T& local, std::vector<T*>& copies)
+{
+    const int nthreads = omp_get_num_threads();
+    const int ithread = omp_get_thread_num();
+    copies[ithread] = &local;
+#pragma omp barrier
+    for (int step=1; step<nthreads; step*=2) {
+        if (ithread % (2*step) == 0 && ithread + step < nthreads) {
+            *copies[ithread] += *copies[ithread+step];
+        }
+        // Everyone must wait here, since the next round reads the results of this one,
+        // and a thread's local copy must not go out of scope until it has been added.
+#pragma omp barrier
+    }
+    if (ithread == 0) target += local;
+}
+
+#endif
+
+#endif
@@ -46,12 +46,14 @@ sources = glob.glob(os.path.join('src','*.cpp'))
 headers = glob.glob(os.path.join('include','*.h'))
 
 copt =  {
-    'gcc' : ['-fopenmp','-O3','-ffast-math'],
-    'icc' : ['-openmp','-O3'],
-    'clang' : ['-O3','-ffast-math', '-stdlib=libc++'],
-    'clang w/ OpenMP' : ['-fopenmp','-O3','-ffast-math', '-stdlib=libc++'],
-    'clang w/ Intel OpenMP' : ['-Xpreprocessor','-fopenmp','-O3','-ffast-math', '-stdlib=libc++'],
-    'clang w/ manual OpenMP' : ['-Xpreprocessor','-fopenmp','-O3','-ffast-math', '-stdlib=libc++'],
+    'gcc' : ['-fopenmp','-O3','-ffast-math','-std=c++11'],
+    'icc' : ['-openmp','-O3','-std=c++11'],
+    'clang' : ['-O3','-ffast-math', '-stdlib=libc++','-std=c++11'],
+    'clang w/ OpenMP' : ['-fopenmp','-O3','-ffast-math', '-stdlib=libc++','-std=c++11'],
+    'clang w/ Intel OpenMP' : ['-Xpreprocessor','-fopenmp','-O3','-ffast-math', '-stdlib=libc++',
+                               '-std=c++11'],
+    'clang w/ manual OpenMP' : ['-Xpreprocessor','-fopenmp','-O3','-ffast-math', '-stdlib=libc++',
+                                '-std=c++11'],
     'unknown' : [],
 }
 lopt =  {
@@ -560,6 +562,9 @@ ext=Extension("treecorr._treecorr",
               undef_macros = undef_macros)
 
 dependencies = ['numpy', 'cffi', 'pyyaml', 'LSSTDESC.Coord>=1.1']
+# Python 2 needs the backport of concurrent.futures, which is used for num_patch_threads.
+if sys.version_info < (3,):
+    dependencies.append('futures')
 
 with open('README.rst') as file:
     long_description = file.read()
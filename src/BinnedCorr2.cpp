@@ -19,11 +19,15 @@
 #include <vector>
 #include <set>
 #include <map>
+#include <algorithm>
+#include <functional>
+#include <limits>
 
 #include "dbg.h"
 #include "BinnedCorr2.h"
 #include "Split.h"
 #include "ProjectHelper.h"
+#include "ThreadReduce.h"
 #include "Metric.h"
 
 #ifdef _OPENMP
@@ -42,7 +46,8 @@ BinnedCorr2<D1,D2,B>::BinnedCorr2(
     double* meanr, double* meanlogr, double* weight, double* npairs) :
     _minsep(minsep), _maxsep(maxsep), _nbins(nbins), _binsize(binsize), _b(b),
     _minrpar(minrpar), _maxrpar(maxrpar), _xp(xp), _yp(yp), _zp(zp),
-    _coords(-1), _owns_data(false),
+    _coords(-1), _brute(false), _record(false), _nrecords(0), _auto_corr(false),
+    _owns_data(false),
     _xi(xi0,xi1,xi2,xi3), _meanr(meanr), _meanlogr(meanlogr), _weight(weight), _npairs(npairs)
 {
     dbg<<"BinnedCorr2 constructor\n";
@@ -71,7 +76,8 @@ BinnedCorr2<D1,D2,B>::BinnedCorr2(const BinnedCorr2<D1,D2,B>& rhs, bool copy_dat
     _logminsep(rhs._logminsep), _halfminsep(rhs._halfminsep),
     _minsepsq(rhs._minsepsq), _maxsepsq(rhs._maxsepsq), _bsq(rhs._bsq),
     _fullmaxsep(rhs._fullmaxsep), _fullmaxsepsq(rhs._fullmaxsepsq),
-    _coords(rhs._coords), _owns_data(true),
+    _coords(rhs._coords), _brute(rhs._brute), _record(rhs._record), _nrecords(0),
+    _extra(rhs._extra), _auto_corr(rhs._auto_corr), _owns_data(true),
     _xi(0,0,0,0), _weight(0)
 {
     dbg<<"BinnedCorr2 copy constructor\n";
@@ -80,6 +86,11 @@ BinnedCorr2<D1,D2,B>::BinnedCorr2(const BinnedCorr2<D1,D2,B>& rhs, bool copy_dat
     _meanlogr = new double[_nbins];
     _weight = new double[_nbins];
     _npairs = new double[_nbins];
+    // The extra binnings need their own (empty) copies as well.
+    for (size_t i=0; i<rhs._extra_corrs.size(); ++i)
+        _extra_corrs.push_back(rhs._extra_corrs[i]->duplicate());
+    for (size_t i=0; i<rhs._record_targets.size(); ++i)
+        _record_targets.push_back(rhs._record_targets[i]->duplicate());
 
     if (copy_data) *this = rhs;
     else clear();
@@ -95,7 +106,9 @@ BinnedCorr2<D1,D2,B>::~BinnedCorr2()
         delete [] _meanlogr; _meanlogr = 0;
         delete [] _weight; _weight = 0;
         delete [] _npairs; _npairs = 0;
+        for (size_t i=0; i<_extra_corrs.size(); ++i) delete _extra_corrs[i];
     }
+    for (size_t i=0; i<_record_targets.size(); ++i) delete _record_targets[i];
 }
 
 // BinnedCorr2::process2 is invalid if D1 != D2, so this helper struct lets us only call
@@ -113,6 +126,144 @@ struct ProcessHelper<D,D,B,C,M>
     { b.template process2<C,M>(c12, m); }
 };
 
+ExtraBinning::ExtraBinning(int _bin_type, double _minsep, double _maxsep, int _nbins,
+                           double _binsize, double _b) :
+    bin_type(_bin_type), minsep(_minsep), maxsep(_maxsep), nbins(_nbins),
+    binsize(_binsize), b(_b)
+{
+    logminsep = log(minsep);
+    minsepsq = minsep*minsep;
+    maxsepsq = maxsep*maxsep;
+    bsq = b*b;
+    switch (bin_type) {
+      case Log:
+           fullmaxsep = BinTypeHelper<Log>::calculateFullMaxSep(minsep, maxsep, nbins, binsize);
+           break;
+      case Linear:
+           fullmaxsep = BinTypeHelper<Linear>::calculateFullMaxSep(minsep, maxsep, nbins,
+                                                                   binsize);
+           break;
+      case TwoD:
+           fullmaxsep = BinTypeHelper<TwoD>::calculateFullMaxSep(minsep, maxsep, nbins, binsize);
+           break;
+      default:
+           Assert(false);
+    }
+    fullmaxsepsq = fullmaxsep*fullmaxsep;
+}
+
+// Check if all possible pairs for two cells are necessarily too close or too far apart to be
+// accumulated with the given binning.
+template <int B, int C, int M>
+inline bool OutsideRange(const MetricHelper<M>& metric, const Position<C>& p1,
+                         const Position<C>& p2, double rsq, double rpar, double s1ps2,
+                         double minsep, double minsepsq, double maxsep, double maxsepsq,
+                         double fullmaxsep, double fullmaxsepsq)
+{
+    return (BinTypeHelper<B>::tooSmallDist(rsq, s1ps2, minsep, minsepsq) &&
+            metric.tooSmallDist(p1, p2, rsq, rpar, s1ps2, minsep, minsepsq)) ||
+        (BinTypeHelper<B>::tooLargeDist(rsq, s1ps2, maxsep, maxsepsq) &&
+         metric.tooLargeDist(p1, p2, rsq, rpar, s1ps2, fullmaxsep, fullmaxsepsq));
+}
+
+// The possible results of ExtraBinningHelper::check.
+enum { ExtraSplit, ExtraOutside, ExtraSingle };
+
+// The same checks as process11 makes for its own binning, but for an ExtraBinning, whose
+// bin type is only known at run time.
+template <int B>
+struct ExtraBinningHelper
+{
+    template <int C, int M>
+    static bool outsideRange(const ExtraBinning& eb, const MetricHelper<M>& metric,
+                             const Position<C>& p1, const Position<C>& p2,
+                             double rsq, double rpar, double s1ps2)
+    {
+        return OutsideRange<B>(metric, p1, p2, rsq, rpar, s1ps2, eb.minsep, eb.minsepsq,
+                               eb.maxsep, eb.maxsepsq, eb.fullmaxsep, eb.fullmaxsepsq);
+    }
+
+    template <int C>
+    static bool singleBin(const ExtraBinning& eb, const Position<C>& p1, const Position<C>& p2,
+                          double rsq, double s1ps2, int& k, double& r, double& logr)
+    {
+        return BinTypeHelper<B>::singleBin(rsq, s1ps2, p1, p2, eb.binsize, eb.b, eb.bsq,
+                                           eb.minsep, eb.maxsep, eb.logminsep, k, r, logr);
+    }
+
+    static double getEffectiveBSq(const ExtraBinning& eb, double rsq)
+    { return BinTypeHelper<B>::getEffectiveBSq(rsq, eb.bsq); }
+
+    // Check whether the pair of cells is outside the range of the binning, small enough to
+    // drop into a single bin, or neither.  In the last case, lower bsq_eff to what is required
+    // for this binning.  In the single bin case, k, r, logr may be set as in process11.
+    template <int C, int M>
+    static int check(const ExtraBinning& eb, const MetricHelper<M>& metric,
+                     const Position<C>& p1, const Position<C>& p2,
+                     double rsq, double rpar, double s1ps2, bool rpar_inside, double& bsq_eff,
+                     int& k, double& r, double& logr)
+    {
+        if (outsideRange(eb, metric, p1, p2, rsq, rpar, s1ps2)) return ExtraOutside;
+        if (rpar_inside && singleBin(eb, p1, p2, rsq, s1ps2, k, r, logr)) return ExtraSingle;
+        bsq_eff = std::min(bsq_eff, getEffectiveBSq(eb, rsq));
+        return ExtraSplit;
+    }
+};
+
+template <int C, int M>
+inline int CheckExtraBinning(const ExtraBinning& eb, const MetricHelper<M>& metric,
+                             const Position<C>& p1, const Position<C>& p2,
+                             double rsq, double rpar, double s1ps2, bool rpar_inside,
+                             double& bsq_eff, int& k, double& r, double& logr)
+{
+    switch (eb.bin_type) {
+      case Log:
+           return ExtraBinningHelper<Log>::check(eb, metric, p1, p2, rsq, rpar, s1ps2,
+                                                 rpar_inside, bsq_eff, k, r, logr);
+      case Linear:
+           return ExtraBinningHelper<Linear>::check(eb, metric, p1, p2, rsq, rpar, s1ps2,
+                                                    rpar_inside, bsq_eff, k, r, logr);
+      case TwoD:
+           return ExtraBinningHelper<TwoD>::check(eb, metric, p1, p2, rsq, rpar, s1ps2,
+                                                  rpar_inside, bsq_eff, k, r, logr);
+      default:
+           Assert(false);
+           return ExtraOutside;
+    }
+}
+
+template <int C, int M>
+inline bool ExtraOutsideRange(const ExtraBinning& eb, const MetricHelper<M>& metric,
+                              const Position<C>& p1, const Position<C>& p2,
+                              double rsq, double rpar, double s1ps2)
+{
+    switch (eb.bin_type) {
+      case Log:
+           return ExtraBinningHelper<Log>::outsideRange(eb, metric, p1, p2, rsq, rpar, s1ps2);
+      case Linear:
+           return ExtraBinningHelper<Linear>::outsideRange(eb, metric, p1, p2, rsq, rpar, s1ps2);
+      case TwoD:
+           return ExtraBinningHelper<TwoD>::outsideRange(eb, metric, p1, p2, rsq, rpar, s1ps2);
+      default:
+           Assert(false);
+           return false;
+    }
+}
+
+// Check if the pair of cells is outside the range of this binning (given as outside) and also
+// all the extra ones.
+template <int C, int M>
+inline bool OutsideAllRanges(const std::vector<ExtraBinning>& extra,
+                             const MetricHelper<M>& metric,
+                             const Position<C>& p1, const Position<C>& p2,
+                             double rsq, double rpar, double s1ps2, bool outside)
+{
+    for (size_t i=0; outside && i<extra.size(); ++i) {
+        outside = ExtraOutsideRange(extra[i], metric, p1, p2, rsq, rpar, s1ps2);
+    }
+    return outside;
+}
+
 template <int D1, int D2, int B>
 void BinnedCorr2<D1,D2,B>::clear()
 {
@@ -131,11 +282,14 @@ void BinnedCorr2<D1,D2,B>::process(const Field<D1,C>& field, bool dots)
     Assert(D1 == D2);
     Assert(_coords == -1 || _coords == C);
     _coords = C;
+    _brute = field.getBrute();
+    _auto_corr = true;
     const long n1 = field.getNTopLevel();
     dbg<<"field has "<<n1<<" top level nodes\n";
     Assert(n1 > 0);
 
 #ifdef _OPENMP
+    std::vector<BinnedCorr2<D1,D2,B>*> copies(omp_get_max_threads());
 #pragma omp parallel
     {
         // Give each thread their own copy of the data vector to fill in.
@@ -151,15 +305,15 @@ void BinnedCorr2<D1,D2,B>::process(const Field<D1,C>& field, bool dots)
 #pragma omp for schedule(dynamic)
 #endif
         for (long i=0;i<n1;++i) {
-#ifdef _OPENMP
+            // Writing single characters to std::cout is thread safe, so the progress dots
+            // don't need a critical section.
+            if (dots) std::cout<<'.'<<std::flush;
+#if defined(_OPENMP) && defined(DEBUGLOGGING)
 #pragma omp critical
-#endif
             {
-#ifdef _OPENMP
                 xdbg<<omp_get_thread_num()<<" "<<i<<std::endl;
-#endif
-                if (dots) std::cout<<'.'<<std::flush;
             }
+#endif
             const Cell<D1,C>& c1 = *field.getCells()[i];
             ProcessHelper<D1,D2,B,C,M>::process2(bc2, c1, metric);
             for (long j=i+1;j<n1;++j) {
@@ -169,10 +323,7 @@ void BinnedCorr2<D1,D2,B>::process(const Field<D1,C>& field, bool dots)
         }
 #ifdef _OPENMP
         // Accumulate the results
-#pragma omp critical
-        {
-            *this += bc2;
-        }
+        ThreadReduce(*this, bc2, copies);
     }
 #endif
     if (dots) std::cout<<std::endl;
@@ -185,6 +336,8 @@ void BinnedCorr2<D1,D2,B>::process(const Field<D1,C>& field1, const Field<D2,C>&
     xdbg<<"Start process (cross): M,C = "<<M<<"  "<<C<<std::endl;
     Assert(_coords == -1 || _coords == C);
     _coords = C;
+    _brute = field1.getBrute() && field2.getBrute();
+    _auto_corr = false;
 
     // Before possibly triggering a call to BuildCells, check if we can early exit.
     MetricHelper<M> metric1(_minrpar, _maxrpar, _xp, _yp, _zp);
@@ -196,10 +349,10 @@ void BinnedCorr2<D1,D2,B>::process(const Field<D1,C>& field1, const Field<D2,C>&
     double s1ps2 = s1 + s2;
     double rpar = 0; // Gets set to correct value by isRParOutsideRange if appropriate
     if (metric1.isRParOutsideRange(p1, p2, s1ps2, rpar) ||
-        (BinTypeHelper<B>::tooSmallDist(rsq, s1ps2, _minsep, _minsepsq) &&
-         metric1.tooSmallDist(p1, p2, rsq, rpar, s1ps2, _minsep, _minsepsq)) ||
-        (BinTypeHelper<B>::tooLargeDist(rsq, s1ps2, _maxsep, _maxsepsq) &&
-         metric1.tooLargeDist(p1, p2, rsq, rpar, s1ps2, _fullmaxsep, _fullmaxsepsq))) {
+        OutsideAllRanges(_extra, metric1, p1, p2, rsq, rpar, s1ps2,
+                         OutsideRange<B>(metric1, p1, p2, rsq, rpar, s1ps2,
+                                         _minsep, _minsepsq, _maxsep, _maxsepsq,
+                                         _fullmaxsep, _fullmaxsepsq))) {
         dbg<<"Fields have no relevant coverage.  Early exit.\n";
         return;
     }
@@ -212,6 +365,7 @@ void BinnedCorr2<D1,D2,B>::process(const Field<D1,C>& field1, const Field<D2,C>&
     Assert(n2 > 0);
 
 #ifdef _OPENMP
+    std::vector<BinnedCorr2<D1,D2,B>*> copies(omp_get_max_threads());
 #pragma omp parallel
     {
         // Give each thread their own copy of the data vector to fill in.
@@ -222,31 +376,32 @@ void BinnedCorr2<D1,D2,B>::process(const Field<D1,C>& field1, const Field<D2,C>&
 
         MetricHelper<M> metric(_minrpar, _maxrpar, _xp, _yp, _zp);
 
+        // Parallelize over all pairs of top-level cells, rather than just the cells in
+        // field1.  Otherwise, if field1 is small, it may have fewer top-level cells than
+        // there are threads, leaving most of them idle.
+        const long n12 = n1 * n2;
 #ifdef _OPENMP
 #pragma omp for schedule(dynamic)
 #endif
-        for (long i=0;i<n1;++i) {
-#ifdef _OPENMP
+        for (long k=0;k<n12;++k) {
+            const long i = k / n2;
+            const long j = k % n2;
+            if (j == 0) {
+                if (dots) std::cout<<'.'<<std::flush;
+#if defined(_OPENMP) && defined(DEBUGLOGGING)
 #pragma omp critical
+                {
+                    xdbg<<omp_get_thread_num()<<" "<<i<<std::endl;
+                }
 #endif
-            {
-#ifdef _OPENMP
-                xdbg<<omp_get_thread_num()<<" "<<i<<std::endl;
-#endif
-                if (dots) std::cout<<'.'<<std::flush;
             }
             const Cell<D1,C>& c1 = *field1.getCells()[i];
-            for (long j=0;j<n2;++j) {
-                const Cell<D2,C>& c2 = *field2.getCells()[j];
-                bc2.process11<C,M>(c1, c2, metric, false);
-            }
+            const Cell<D2,C>& c2 = *field2.getCells()[j];
+            bc2.process11<C,M>(c1, c2, metric, false);
         }
 #ifdef _OPENMP
         // Accumulate the results
-#pragma omp critical
-        {
-            *this += bc2;
-        }
+        ThreadReduce(*this, bc2, copies);
     }
 #endif
     if (dots) std::cout<<std::endl;
@@ -268,6 +423,7 @@ void BinnedCorr2<D1,D2,B>::processPairwise(
     const long sqrtn = long(sqrt(double(nobj)));
 
 #ifdef _OPENMP
+    std::vector<BinnedCorr2<D1,D2,B>*> copies(omp_get_max_threads());
 #pragma omp parallel
     {
         // Give each thread their own copy of the data vector to fill in.
@@ -284,15 +440,13 @@ void BinnedCorr2<D1,D2,B>::processPairwise(
         for (long i=0;i<nobj;++i) {
             // Let the progress dots happen every sqrt(n) iterations.
             if (dots && (i % sqrtn == 0)) {
-#ifdef _OPENMP
+                std::cout<<'.'<<std::flush;
+#if defined(_OPENMP) && defined(DEBUGLOGGING)
 #pragma omp critical
-#endif
                 {
-#ifdef _OPENMP
                     xdbg<<omp_get_thread_num()<<" "<<i<<std::endl;
-#endif
-                    std::cout<<'.'<<std::flush;
                 }
+#endif
             }
             const Cell<D1,C>& c1 = *field1.getCells()[i];
             const Cell<D2,C>& c2 = *field2.getCells()[i];
@@ -307,10 +461,7 @@ void BinnedCorr2<D1,D2,B>::processPairwise(
         }
 #ifdef _OPENMP
         // Accumulate the results
-#pragma omp critical
-        {
-            *this += bc2;
-        }
+        ThreadReduce(*this, bc2, copies);
     }
 #endif
     if (dots) std::cout<<std::endl;
@@ -329,6 +480,154 @@ void BinnedCorr2<D1,D2,B>::process2(const Cell<D1,C>& c12, const MetricHelper<M>
     process11<C,M>(*c12.getLeft(), *c12.getRight(), metric, BinTypeHelper<B>::doReverse());
 }
 
+// Collect the leaves under a cell.  Subtrees with w == 0 are skipped, just as they are in
+// process11.
+// The leaves are stored as void pointers so that the list can be kept in the BinnedCorr2
+// object, which isn't templated on the coordinate system.
+template <int D, int C>
+void GatherLeaves(const Cell<D,C>& c, std::vector<const void*>& leaves)
+{
+    if (c.getW() == 0.) return;
+    if (c.getLeft()) {
+        GatherLeaves(*c.getLeft(), leaves);
+        GatherLeaves(*c.getRight(), leaves);
+    } else {
+        leaves.push_back(&c);
+    }
+}
+
+inline double GetZ(const Position<Flat>& p) { return 0.; }
+inline double GetZ(const Position<ThreeD>& p) { return p.getZ(); }
+
+// Calculate the distances from p1 to n leaves, whose positions have also been copied into
+// the contiguous arrays x,y,z.  The generic version just uses the metric for each pair.
+template <int M, int C>
+struct LeafDistHelper
+{
+    template <int D>
+    static void DistSq(const MetricHelper<M>& metric, const Position<C>& p1,
+                       const Cell<D,C>* const* leaves, long n,
+                       const double* x, const double* y, const double* z, double* rsq)
+    {
+        for (long j=0; j<n; ++j) {
+            double s=0.;
+            rsq[j] = metric.DistSq(p1, leaves[j]->getPos(), s, s);
+        }
+    }
+};
+
+// For Euclidean distances, work directly from the arrays, which lets the compiler vectorize
+// the loop.
+template <int C>
+struct LeafDistHelper<Euclidean,C>
+{
+    template <int D>
+    static void DistSq(const MetricHelper<Euclidean>& metric, const Position<C>& p1,
+                       const Cell<D,C>* const* leaves, long n,
+                       const double* x, const double* y, const double* z, double* rsq)
+    {
+        const double x1 = p1.getX();
+        const double y1 = p1.getY();
+        if (C == Flat) {
+            for (long j=0; j<n; ++j) {
+                const double dx = x1 - x[j];
+                const double dy = y1 - y[j];
+                rsq[j] = dx*dx + dy*dy;
+            }
+        } else {
+            const double z1 = GetZ(p1);
+            for (long j=0; j<n; ++j) {
+                const double dx = x1 - x[j];
+                const double dy = y1 - y[j];
+                const double dz = z1 - z[j];
+                rsq[j] = dx*dx + dy*dy + dz*dz;
+            }
+        }
+    }
+};
+
+// The leaves of c2 are processed in blocks of this many at a time, so the work arrays stay
+// in the L1 cache while all the leaves of c1 are run past them.
+const long LEAF_BLOCK_SIZE = 256;
+
+template <int D1, int D2, int B> template <int C, int M>
+void BinnedCorr2<D1,D2,B>::processLeaves(const Cell<D1,C>& c1, const Cell<D2,C>& c2,
+                                         const MetricHelper<M>& metric, bool do_reverse)
+{
+    // Process all pairs of leaves under c1 and c2 directly.  This is only valid if process11
+    // would have recursed all the way down to these leaves, i.e. for brute force trees.
+    // Rather than binning one pair at a time at the bottom of the recursion, the distances,
+    // bin indices and so forth are calculated for a whole block of pairs at a time in simple
+    // loops that the compiler can vectorize.  Then the pairs are accumulated into the bins.
+    xdbg<<"Start processLeaves for "<<c1.getPos()<<",  "<<c2.getPos()<<std::endl;
+    // With many small top-level cells, this gets called a lot, so reuse the leaf lists
+    // rather than allocating new ones each time.  Each OpenMP thread has its own copy of
+    // this object, so the lists aren't shared between threads.
+    std::vector<const void*>& leaves1 = _leaves1;
+    std::vector<const void*>& leaves2 = _leaves2;
+    leaves1.clear();
+    leaves2.clear();
+    GatherLeaves(c1, leaves1);
+    GatherLeaves(c2, leaves2);
+    const long n1 = leaves1.size();
+    const long n2 = leaves2.size();
+    xdbg<<"n1, n2 = "<<n1<<", "<<n2<<std::endl;
+    if (n1 == 0 || n2 == 0) return;
+
+    double x2[LEAF_BLOCK_SIZE], y2[LEAF_BLOCK_SIZE], z2[LEAF_BLOCK_SIZE];
+    double rsq[LEAF_BLOCK_SIZE], rsq_sel[LEAF_BLOCK_SIZE], r[LEAF_BLOCK_SIZE];
+    double logr[LEAF_BLOCK_SIZE];
+    long sel[LEAF_BLOCK_SIZE];
+    int k[LEAF_BLOCK_SIZE];
+    const Cell<D2,C>* block[LEAF_BLOCK_SIZE];
+
+    for (long j0=0; j0<n2; j0+=LEAF_BLOCK_SIZE) {
+        const long n = std::min(LEAF_BLOCK_SIZE, n2-j0);
+        for (long j=0; j<n; ++j) {
+            block[j] = static_cast<const Cell<D2,C>*>(leaves2[j0+j]);
+            const Position<C>& p2 = block[j]->getPos();
+            x2[j] = p2.getX();
+            y2[j] = p2.getY();
+            z2[j] = GetZ(p2);
+        }
+
+        for (long i=0; i<n1; ++i) {
+            const Cell<D1,C>& leaf1 = *static_cast<const Cell<D1,C>*>(leaves1[i]);
+            const Position<C>& p1 = leaf1.getPos();
+
+            LeafDistHelper<M,C>::DistSq(metric, p1, block, n, x2, y2, z2, rsq);
+
+            // Select the pairs that would be accumulated.  For a pair of leaves, process11
+            // only needs the checks on rpar and whether rsq is in the range of the binning.
+            long m=0;
+            for (long j=0; j<n; ++j) {
+                const Position<C>& p2 = block[j]->getPos();
+                double rpar = 0.;
+                bool use = (!metric.isRParOutsideRange(p1, p2, 0., rpar) &&
+                            metric.isRParInsideRange(p1, p2, 0., rpar) &&
+                            BinTypeHelper<B>::isRSqInRange(rsq[j], p1, p2, _minsep, _minsepsq,
+                                                           _maxsep, _maxsepsq));
+                sel[m] = j;
+                rsq_sel[m] = rsq[j];
+                m += use;
+            }
+
+            for (long q=0; q<m; ++q) {
+                r[q] = sqrt(rsq_sel[q]);
+                logr[q] = log(r[q]);
+            }
+            for (long q=0; q<m; ++q) {
+                k[q] = BinTypeHelper<B>::calculateBinK(p1, block[sel[q]]->getPos(), r[q], logr[q],
+                                                       _binsize, _minsep, _maxsep, _logminsep);
+            }
+            for (long q=0; q<m; ++q) {
+                directProcess11(leaf1, *block[sel[q]], rsq_sel[q], do_reverse,
+                                k[q], r[q], logr[q]);
+            }
+        }
+    }
+}
+
 template <int D1, int D2, int B> template <int C, int M>
 void BinnedCorr2<D1,D2,B>::process11(const Cell<D1,C>& c1, const Cell<D2,C>& c2,
                                      const MetricHelper<M>& metric, bool do_reverse)
@@ -338,6 +637,20 @@ void BinnedCorr2<D1,D2,B>::process11(const Cell<D1,C>& c1, const Cell<D2,C>& c2,
     xdbg<<"w = "<<c1.getW()<<", "<<c2.getW()<<std::endl;
     if (c1.getW() == 0. || c2.getW() == 0.) return;
 
+    if (!_extra.empty()) {
+        // Start with all the binnings active.
+        const uint64_t active = (uint64_t(2) << _extra.size()) - 1;
+        processMulti11<C,M>(c1, c2, metric, do_reverse, active);
+        return;
+    }
+
+    // If both trees were built with brute=True, the recursion below would just end up
+    // processing every pair of leaves directly.  Do that in batches instead.
+    if (_brute && (c1.getLeft() || c2.getLeft())) {
+        processLeaves<C,M>(c1, c2, metric, do_reverse);
+        return;
+    }
+
     const Position<C>& p1 = c1.getPos();
     const Position<C>& p2 = c2.getPos();
     double s1 = c1.getSize(); // May be modified by DistSq function.
@@ -412,6 +725,111 @@ void BinnedCorr2<D1,D2,B>::process11(const Cell<D1,C>& c1, const Cell<D2,C>& c2,
     }
 }
 
+// Add the binning with the given bit to the set of binnings that want the same split of
+// a pair of cells as CalcSplitSq gives for its bsq_eff.
+inline void AddSplit(uint64_t bit, double s1, double s2, double s1ps2, double bsq_eff,
+                     uint64_t& split_both, uint64_t& split_only1, uint64_t& split_only2)
+{
+    bool split1=false, split2=false;
+    CalcSplitSq(split1,split2,s1,s2,s1ps2,bsq_eff);
+    if (split1 && split2) split_both |= bit;
+    else if (split1) split_only1 |= bit;
+    else split_only2 |= bit;
+}
+
+template <int D1, int D2, int B> template <int C, int M>
+void BinnedCorr2<D1,D2,B>::processMulti11(const Cell<D1,C>& c1, const Cell<D2,C>& c2,
+                                          const MetricHelper<M>& metric, bool do_reverse,
+                                          uint64_t active)
+{
+    // This is the same as process11, but also for the extra binnings.  Bit 0 of active is
+    // for this binning, and bit i+1 is for _extra[i].  Once a pair of cells is either outside
+    // the range of a binning or has been accumulated into it, that binning is finished for
+    // all the sub-cells, so its bit is turned off.  The other binnings split the cells the
+    // way they would if they were processed on their own.  Usually they all want the same
+    // split, but if not, each kind of split is done separately for the binnings that want it.
+    // So each binning only sees the same pairs of cells as process11 would.
+    xdbg<<"Start processMulti11 for "<<c1.getPos()<<",  "<<c2.getPos()<<"   ";
+    xdbg<<"active = "<<active<<std::endl;
+    if (c1.getW() == 0. || c2.getW() == 0.) return;
+
+    const Position<C>& p1 = c1.getPos();
+    const Position<C>& p2 = c2.getPos();
+    double s1 = c1.getSize(); // May be modified by DistSq function.
+    double s2 = c2.getSize(); // "
+    const double rsq = metric.DistSq(p1,p2,s1,s2);
+    const double s1ps2 = s1+s2;
+
+    double rpar = 0; // Gets set to correct value by this function if appropriate
+    if (metric.isRParOutsideRange(p1, p2, s1ps2, rpar)) {
+        return;
+    }
+    const bool rpar_inside = metric.isRParInsideRange(p1, p2, s1ps2, rpar);
+
+    // The binnings that want to split both cells, only c1, or only c2.
+    uint64_t split_both=0, split_only1=0, split_only2=0;
+    if (active & 1) {
+        int k=-1;
+        double r=0,logr=0;
+        if (OutsideRange<B>(metric, p1, p2, rsq, rpar, s1ps2, _minsep, _minsepsq,
+                            _maxsep, _maxsepsq, _fullmaxsep, _fullmaxsepsq)) {
+            // Nothing more to do for this binning.
+        } else if (rpar_inside &&
+                   BinTypeHelper<B>::singleBin(rsq, s1ps2, p1, p2, _binsize, _b, _bsq,
+                                               _minsep, _maxsep, _logminsep, k, r, logr)) {
+            if (BinTypeHelper<B>::isRSqInRange(rsq, p1, p2, _minsep, _minsepsq,
+                                               _maxsep, _maxsepsq)) {
+                directProcess11(c1,c2,rsq,do_reverse,k,r,logr);
+            }
+        } else {
+            const double bsq_eff = BinTypeHelper<B>::getEffectiveBSq(rsq,_bsq);
+            AddSplit(1, s1, s2, s1ps2, bsq_eff, split_both, split_only1, split_only2);
+        }
+    }
+    for (size_t i=0; i<_extra.size(); ++i) {
+        const uint64_t bit = uint64_t(2) << i;
+        if (!(active & bit)) continue;
+        int k=-1;
+        double r=0,logr=0;
+        double bsq_eff = std::numeric_limits<double>::max();
+        switch (CheckExtraBinning(_extra[i], metric, p1, p2, rsq, rpar, s1ps2, rpar_inside,
+                                  bsq_eff, k, r, logr)) {
+          case ExtraSingle:
+               _extra_corrs[i]->processPair(c1,c2,rsq,_auto_corr,k,r,logr);
+               break;
+          case ExtraSplit:
+               AddSplit(bit, s1, s2, s1ps2, bsq_eff, split_both, split_only1, split_only2);
+               break;
+          default:
+               break;
+        }
+    }
+    xdbg<<"split = "<<split_both<<','<<split_only1<<','<<split_only2<<std::endl;
+
+    if (split_both) {
+        Assert(c1.getLeft());
+        Assert(c1.getRight());
+        Assert(c2.getLeft());
+        Assert(c2.getRight());
+        processMulti11<C,M>(*c1.getLeft(),*c2.getLeft(),metric,do_reverse,split_both);
+        processMulti11<C,M>(*c1.getLeft(),*c2.getRight(),metric,do_reverse,split_both);
+        processMulti11<C,M>(*c1.getRight(),*c2.getLeft(),metric,do_reverse,split_both);
+        processMulti11<C,M>(*c1.getRight(),*c2.getRight(),metric,do_reverse,split_both);
+    }
+    if (split_only1) {
+        Assert(c1.getLeft());
+        Assert(c1.getRight());
+        processMulti11<C,M>(*c1.getLeft(),c2,metric,do_reverse,split_only1);
+        processMulti11<C,M>(*c1.getRight(),c2,metric,do_reverse,split_only1);
+    }
+    if (split_only2) {
+        Assert(c2.getLeft());
+        Assert(c2.getRight());
+        processMulti11<C,M>(c1,*c2.getLeft(),metric,do_reverse,split_only2);
+        processMulti11<C,M>(c1,*c2.getRight(),metric,do_reverse,split_only2);
+    }
+}
+
 
 // We also set up a helper class for doing the direct processing
 template <int D1, int D2>
@@ -519,6 +937,38 @@ struct DirectHelper<GData,GData>
     }
 };
 
+// The recorded pairs are applied to the record targets in batches of this many, so the
+// memory for the records stays small however many pairs there are in total.
+const long RECORD_BATCH_SIZE = 1<<16;
+
+template <int D1, int D2>
+struct RecordHelper // This works for KK
+{
+    template <int C>
+    static void record(const Cell<D1,C>& c1, const Cell<D2,C>& c2, int k, int k2,
+                       std::vector<PairRecord<D1,D2> >& records)
+    {
+        PairRecord<D1,D2> rec = { &c1, &c2, k, k2 };
+        records.push_back(rec);
+    }
+};
+
+template <>
+struct RecordHelper<GData,GData>
+{
+    template <int C>
+    static void record(const Cell<GData,C>& c1, const Cell<GData,C>& c2, int k, int k2,
+                       std::vector<PairRecord<GData,GData> >& records)
+    {
+        // Save the projection factors, so the shears of each realization can be projected
+        // the same way as in DirectHelper<GData,GData>.
+        std::complex<double> e1, e2;
+        ProjectHelper<C>::ProjectionFactors(c1.getPos(), c2.getPos(), e1, e2);
+        PairRecord<GData,GData> rec = { &c1, &c2, k, k2, e1 * conj(e2), e1 * e2 };
+        records.push_back(rec);
+    }
+};
+
 template <int D1, int D2, int B> template <int C>
 void BinnedCorr2<D1,D2,B>::directProcess11(
     const Cell<D1,C>& c1, const Cell<D2,C>& c2, const double rsq, bool do_reverse,
@@ -568,42 +1018,467 @@ void BinnedCorr2<D1,D2,B>::directProcess11(
     _weight[k] += ww;
     xdbg<<"n,w = "<<nn<<','<<ww<<" ==>  "<<_npairs[k]<<','<<_weight[k]<<std::endl;
 
-    int k2 = -1;
-    if (do_reverse) {
-        k2 = BinTypeHelper<B>::calculateBinK(p2, p1, r, logr, _binsize,
-                                             _minsep, _maxsep, _logminsep);
-        if (k == _nbins) --k;  // As before, this can (rarely) happen.
-        Assert(k2 >= 0);
-        Assert(k2 < _nbins);
-        _npairs[k2] += nn;
-        _meanr[k2] += ww * r;
-        _meanlogr[k2] += ww * logr;
-        _weight[k2] += ww;
+    int k2 = -1;
+    if (do_reverse) {
+        k2 = BinTypeHelper<B>::calculateBinK(p2, p1, r, logr, _binsize,
+                                             _minsep, _maxsep, _logminsep);
+        if (k == _nbins) --k;  // As before, this can (rarely) happen.
+        Assert(k2 >= 0);
+        Assert(k2 < _nbins);
+        _npairs[k2] += nn;
+        _meanr[k2] += ww * r;
+        _meanlogr[k2] += ww * logr;
+        _weight[k2] += ww;
+    }
+
+    if (_record) {
+        // For TwoD binning, the bin of the reversed pair is recorded even for cross
+        // correlations, since the pairs may be applied in reverse.  cf. addRecordTarget.
+        if (k2 == -1 && BinTypeHelper<B>::doReverse()) {
+            k2 = BinTypeHelper<B>::calculateBinK(p2, p1, r, logr, _binsize,
+                                                 _minsep, _maxsep, _logminsep);
+            if (k2 == _nbins) --k2;
+        }
+        RecordHelper<D1,D2>::record(c1,c2,k,k2,_records);
+        if (long(_records.size()) >= RECORD_BATCH_SIZE) flushRecords();
+    } else {
+        DirectHelper<D1,D2>::template ProcessXi<C>(c1,c2,rsq,_xi,k,k2);
+    }
+}
+
+template <int D1, int D2, int B>
+void BinnedCorr2<D1,D2,B>::operator=(const BinnedCorr2<D1,D2,B>& rhs)
+{
+    Assert(rhs._nbins == _nbins);
+    _xi.copy(rhs._xi,_nbins);
+    for (int i=0; i<_nbins; ++i) _meanr[i] = rhs._meanr[i];
+    for (int i=0; i<_nbins; ++i) _meanlogr[i] = rhs._meanlogr[i];
+    for (int i=0; i<_nbins; ++i) _weight[i] = rhs._weight[i];
+    for (int i=0; i<_nbins; ++i) _npairs[i] = rhs._npairs[i];
+}
+
+template <int D1, int D2, int B>
+void BinnedCorr2<D1,D2,B>::operator+=(const BinnedCorr2<D1,D2,B>& rhs)
+{
+    Assert(rhs._nbins == _nbins);
+    _xi.add(rhs._xi,_nbins);
+    for (int i=0; i<_nbins; ++i) _meanr[i] += rhs._meanr[i];
+    for (int i=0; i<_nbins; ++i) _meanlogr[i] += rhs._meanlogr[i];
+    for (int i=0; i<_nbins; ++i) _weight[i] += rhs._weight[i];
+    for (int i=0; i<_nbins; ++i) _npairs[i] += rhs._npairs[i];
+    Assert(rhs._extra_corrs.size() == _extra_corrs.size());
+    for (size_t i=0; i<_extra_corrs.size(); ++i)
+        _extra_corrs[i]->addResults(*rhs._extra_corrs[i]);
+    // Each thread has at most one batch of records left, which haven't been applied yet.
+    Assert(rhs._record_targets.size() == _record_targets.size());
+    for (size_t i=0; i<_record_targets.size(); ++i)
+        _record_targets[i]->addResults(*rhs._record_targets[i]);
+    _nrecords += rhs._nrecords;
+    _records.insert(_records.end(), rhs._records.begin(), rhs._records.end());
+    if (long(_records.size()) >= RECORD_BATCH_SIZE) flushRecords();
+}
+
+template <int D1, int D2, int B>
+void BinnedCorr2<D1,D2,B>::setRecordPairs(bool record)
+{
+    _record = record;
+    _nrecords = 0;
+    std::vector<PairRecord<D1,D2> >().swap(_records);
+    for (size_t i=0; i<_record_targets.size(); ++i) delete _record_targets[i];
+    _record_targets.clear();
+}
+
+template <int D1, int D2, int B>
+void BinnedCorr2<D1,D2,B>::flushRecords()
+{
+    xdbg<<"flushRecords: "<<_records.size()<<" pairs to "<<_record_targets.size()<<" targets\n";
+    for (size_t i=0; i<_record_targets.size(); ++i)
+        _record_targets[i]->apply(_records);
+    _nrecords += long(_records.size());
+    // Keep the memory for the next batch.
+    _records.clear();
+}
+
+template <int D1, int D2, int B>
+void BinnedCorr2<D1,D2,B>::finishRecords()
+{
+    dbg<<"finishRecords: "<<getNRecords()<<" pairs in total\n";
+    flushRecords();
+    for (size_t i=0; i<_record_targets.size(); ++i)
+        _record_targets[i]->finish();
+}
+
+template <int D1, int D2, int B>
+void BinnedCorr2<D1,D2,B>::addBinning(ExtraCorr2<D1,D2>* corr)
+{
+    _extra.push_back(corr->getBinning());
+    _extra_corrs.push_back(corr);
+    // process2 can stop once the cells are too small for any of the binnings.
+    _halfminsep = std::min(_halfminsep, 0.5*_extra.back().minsep);
+}
+
+template <int D1, int D2, int B>
+void BinnedCorr2<D1,D2,B>::clearBinnings()
+{
+    _extra.clear();
+    _extra_corrs.clear();
+    _halfminsep = 0.5*_minsep;
+}
+
+template <int D1, int D2, int B>
+ExtraBinning BinnedCorr2<D1,D2,B>::getBinning() const
+{ return ExtraBinning(B, _minsep, _maxsep, _nbins, _binsize, _b); }
+
+template <int D1, int D2, int B>
+ExtraCorr2<D1,D2>* BinnedCorr2<D1,D2,B>::duplicate() const
+{ return new BinnedCorr2<D1,D2,B>(*this, false); }
+
+template <int D1, int D2, int B>
+void BinnedCorr2<D1,D2,B>::addResults(const ExtraCorr2<D1,D2>& rhs)
+{ *this += static_cast<const BinnedCorr2<D1,D2,B>&>(rhs); }
+
+template <int D1, int D2, int B> template <int C>
+void BinnedCorr2<D1,D2,B>::processPair1(const Cell<D1,C>& c1, const Cell<D2,C>& c2, double rsq,
+                                        bool auto_corr, int k, double r, double logr)
+{
+    if (BinTypeHelper<B>::isRSqInRange(rsq, c1.getPos(), c2.getPos(),
+                                       _minsep, _minsepsq, _maxsep, _maxsepsq)) {
+        directProcess11(c1, c2, rsq, auto_corr && BinTypeHelper<B>::doReverse(), k, r, logr);
+    }
+}
+
+// Find the index of a cell in the writeTree order of all the cells in a field from its address.
+template <int D, int C>
+class CellIndexer
+{
+public:
+    CellIndexer(const Field<D,C>& field)
+    {
+        const std::vector<Cell<D,C>*>& cells = field.getCells();
+        const std::vector<long>& ncells = field.getNCells();
+        long offset = 0;
+        for (size_t i=0; i<cells.size(); ++i) {
+            // Each top-level cell is the first cell in its block of CellNodes.
+            _blocks.push_back(Block(reinterpret_cast<const CellNode<D,C>*>(cells[i]), offset));
+            offset += ncells[i];
+        }
+        std::sort(_blocks.begin(), _blocks.end(), blockLess);
+    }
+
+    long operator()(const void* cell) const
+    {
+        // The cell is in the last block that starts at or before its address.
+        const CellNode<D,C>* node = static_cast<const CellNode<D,C>*>(cell);
+        typename std::vector<Block>::const_iterator it =
+            std::upper_bound(_blocks.begin(), _blocks.end(), node, nodeLess);
+        Assert(it != _blocks.begin());
+        --it;
+        return it->second + (node - it->first);
+    }
+
+private:
+    typedef std::pair<const CellNode<D,C>*, long> Block;
+
+    static bool blockLess(const Block& b1, const Block& b2)
+    { return std::less<const CellNode<D,C>*>()(b1.first, b2.first); }
+    static bool nodeLess(const CellNode<D,C>* node, const Block& b)
+    { return std::less<const CellNode<D,C>*>()(node, b.first); }
+
+    std::vector<Block> _blocks;
+};
+
+// The projection factors, as calculated by ProjectionFactors, for a recorded pair of cells.
+template <int C, int D1, int D2>
+inline void RecordProjections(const PairRecord<D1,D2>& rec,
+                              std::complex<double>& e1, std::complex<double>& e2)
+{
+    ProjectHelper<C>::ProjectionFactors(static_cast<const Cell<D1,C>*>(rec.c1)->getPos(),
+                                        static_cast<const Cell<D2,C>*>(rec.c2)->getPos(),
+                                        e1, e2);
+}
+
+// The factors to apply to g1 conj(g2) and g1 g2 for a recorded pair of cells.
+template <int C, int D1, int D2>
+inline void RecordShearProjections(const PairRecord<D1,D2>& rec,
+                                   std::complex<double>& projp, std::complex<double>& projm)
+{
+    std::complex<double> e1, e2;
+    RecordProjections<C>(rec, e1, e2);
+    projp = e1 * conj(e2);
+    projm = e1 * e2;
+}
+
+// For GG, these were already calculated when the pair was recorded.
+template <int C>
+inline void RecordShearProjections(const PairRecord<GData,GData>& rec,
+                                   std::complex<double>& projp, std::complex<double>& projm)
+{
+    projp = rec.projp;
+    projm = rec.projm;
+}
+
+// The cells and bins to use for a recorded pair according to the mode of addRecordTarget.
+template <class R>
+inline void ApplyOrder(const R& rec, int mode,
+                       const void*& c1, const void*& c2, int& k, int& k2)
+{
+    if (mode == 2) {
+        c1 = rec.c2;
+        c2 = rec.c1;
+        k = rec.k2 == -1 ? rec.k : rec.k2;
+        k2 = -1;
+    } else {
+        c1 = rec.c1;
+        c2 = rec.c2;
+        k = rec.k;
+        k2 = mode == 0 ? rec.k2 : -1;
+    }
+}
+
+// Each thread accumulates into a local array with the realizations varying fastest, so the
+// inner loops are over contiguous memory.  Then these are added to xi, which has shape
+// (nreal, nbins).
+inline void AddRealizationSums(const std::vector<double>& sum, int nbins, int nreal, double* xi)
+{
+    for (int k=0; k<nbins; ++k)
+        for (int r=0; r<nreal; ++r)
+            xi[long(r)*nbins+k] += sum[long(k)*nreal+r];
+}
+
+inline void AddRealizationSums(const std::vector<std::complex<double> >& sum,
+                               int nbins, int nreal, double* xi, double* xi_im)
+{
+    for (int k=0; k<nbins; ++k) {
+        for (int r=0; r<nreal; ++r) {
+            const std::complex<double>& s = sum[long(k)*nreal+r];
+            xi[long(r)*nbins+k] += real(s);
+            xi_im[long(r)*nbins+k] += imag(s);
+        }
+    }
+}
+
+template <int V1, int V2>
+struct ApplyHelper;
+
+// Products of two scalars.  This is used for KK, and also for NK, where the values of the
+// N cells are just their weights.
+template <>
+struct ApplyHelper<KData,KData>
+{
+    template <int C, class R, class I1, class I2>
+    static void apply(const std::vector<R>& records, const I1& index1, const I2& index2,
+                      const double* values1, const double* values2, int nreal, int nbins,
+                      int mode, double* xi, double* , double* , double* )
+    {
+        const long n = records.size();
+#ifdef _OPENMP
+#pragma omp parallel
+#endif
+        {
+            std::vector<double> sum(long(nbins)*nreal, 0.);
+#ifdef _OPENMP
+#pragma omp for schedule(static)
+#endif
+            for (long q=0; q<n; ++q) {
+                const void *c1, *c2;
+                int k, k2;
+                ApplyOrder(records[q], mode, c1, c2, k, k2);
+                const double* wk1 = values1 + index1(c1)*nreal;
+                const double* wk2 = values2 + index2(c2)*nreal;
+                double* s = &sum[long(k)*nreal];
+                for (int r=0; r<nreal; ++r) s[r] += wk1[r] * wk2[r];
+                if (k2 != -1) {
+                    double* s2 = &sum[long(k2)*nreal];
+                    for (int r=0; r<nreal; ++r) s2[r] += wk1[r] * wk2[r];
+                }
+            }
+#ifdef _OPENMP
+#pragma omp critical
+#endif
+            {
+                AddRealizationSums(sum, nbins, nreal, xi);
+            }
+        }
+    }
+};
+
+// A scalar times a shear, which is used for NG and KG.
+template <>
+struct ApplyHelper<KData,GData>
+{
+    template <int C, class R, class I1, class I2>
+    static void apply(const std::vector<R>& records, const I1& index1, const I2& index2,
+                      const double* values1, const double* values2, int nreal, int nbins,
+                      int mode, double* xi, double* xi_im, double* , double* )
+    {
+        typedef std::complex<double> complex;
+        const complex* v2 = reinterpret_cast<const complex*>(values2);
+        const long n = records.size();
+#ifdef _OPENMP
+#pragma omp parallel
+#endif
+        {
+            std::vector<complex> sum(long(nbins)*nreal, 0.);
+#ifdef _OPENMP
+#pragma omp for schedule(static)
+#endif
+            for (long q=0; q<n; ++q) {
+                const void *c1, *c2;
+                int k, k2;
+                ApplyOrder(records[q], mode, c1, c2, k, k2);
+                complex e1, e2;
+                RecordProjections<C>(records[q], e1, e2);
+                // If the pair is reversed, the shear is at the recorded c1.
+                // The minus sign is to accumulate tangential shear, as in DirectHelper.
+                const complex e = mode == 2 ? -e1 : -e2;
+                const double* wk1 = values1 + index1(c1)*nreal;
+                const complex* wg2 = v2 + index2(c2)*nreal;
+                complex* s = &sum[long(k)*nreal];
+                for (int r=0; r<nreal; ++r) s[r] += wk1[r] * wg2[r] * e;
+                if (k2 != -1) {
+                    complex* s2 = &sum[long(k2)*nreal];
+                    for (int r=0; r<nreal; ++r) s2[r] += wk1[r] * wg2[r] * e;
+                }
+            }
+#ifdef _OPENMP
+#pragma omp critical
+#endif
+            {
+                AddRealizationSums(sum, nbins, nreal, xi, xi_im);
+            }
+        }
+    }
+};
+
+template <>
+struct ApplyHelper<GData,GData>
+{
+    template <int C, class R, class I1, class I2>
+    static void apply(const std::vector<R>& records, const I1& index1, const I2& index2,
+                      const double* values1, const double* values2, int nreal, int nbins,
+                      int mode, double* xip, double* xip_im, double* xim, double* xim_im)
+    {
+        typedef std::complex<double> complex;
+        const complex* v1 = reinterpret_cast<const complex*>(values1);
+        const complex* v2 = reinterpret_cast<const complex*>(values2);
+        const long n = records.size();
+#ifdef _OPENMP
+#pragma omp parallel
+#endif
+        {
+            std::vector<complex> sump(long(nbins)*nreal, 0.);
+            std::vector<complex> summ(long(nbins)*nreal, 0.);
+#ifdef _OPENMP
+#pragma omp for schedule(static)
+#endif
+            for (long q=0; q<n; ++q) {
+                const void *c1, *c2;
+                int k, k2;
+                ApplyOrder(records[q], mode, c1, c2, k, k2);
+                complex projp, projm;
+                RecordShearProjections<C>(records[q], projp, projm);
+                // Reversing the pair swaps the two projection factors.
+                if (mode == 2) projp = conj(projp);
+                const complex* wg1 = v1 + index1(c1)*nreal;
+                const complex* wg2 = v2 + index2(c2)*nreal;
+                complex* sp = &sump[long(k)*nreal];
+                complex* sm = &summ[long(k)*nreal];
+                for (int r=0; r<nreal; ++r) {
+                    sp[r] += wg1[r] * conj(wg2[r]) * projp;
+                    sm[r] += wg1[r] * wg2[r] * projm;
+                }
+                if (k2 != -1) {
+                    complex* sp2 = &sump[long(k2)*nreal];
+                    complex* sm2 = &summ[long(k2)*nreal];
+                    for (int r=0; r<nreal; ++r) {
+                        sp2[r] += wg1[r] * conj(wg2[r]) * projp;
+                        sm2[r] += wg1[r] * wg2[r] * projm;
+                    }
+                }
+            }
+#ifdef _OPENMP
+#pragma omp critical
+#endif
+            {
+                AddRealizationSums(sump, nbins, nreal, xip, xip_im);
+                AddRealizationSums(summ, nbins, nreal, xim, xim_im);
+            }
+        }
+    }
+};
+
+// The RecordTarget for a particular kind of values and coordinate system.
+template <int D1, int D2, int V1, int V2, int C>
+class RecordTargetImpl : public RecordTarget<D1,D2>
+{
+public:
+    RecordTargetImpl(const Field<D1,C>& field1, const Field<D2,C>& field2,
+                     const double* values1, const double* values2, int nreal, int nbins,
+                     int mode, double* xi0, double* xi1, double* xi2, double* xi3) :
+        _index1(field1), _index2(field2), _values1(values1), _values2(values2),
+        _nreal(nreal), _nbins(nbins), _mode(mode)
+    {
+        Assert(mode >= 0 && mode <= 2);
+        _xi[0] = xi0; _xi[1] = xi1; _xi[2] = xi2; _xi[3] = xi3;
+        for (int i=0; i<4; ++i)
+            if (_xi[i]) _sums[i].resize(long(nreal)*nbins, 0.);
+    }
+
+    RecordTarget<D1,D2>* duplicate() const
+    {
+        RecordTargetImpl<D1,D2,V1,V2,C>* ret = new RecordTargetImpl<D1,D2,V1,V2,C>(*this);
+        for (int i=0; i<4; ++i) std::fill(ret->_sums[i].begin(), ret->_sums[i].end(), 0.);
+        return ret;
     }
 
-    DirectHelper<D1,D2>::template ProcessXi<C>(c1,c2,rsq,_xi,k,k2);
-}
+    void addResults(const RecordTarget<D1,D2>& rhs)
+    {
+        const RecordTargetImpl<D1,D2,V1,V2,C>& other =
+            static_cast<const RecordTargetImpl<D1,D2,V1,V2,C>&>(rhs);
+        for (int i=0; i<4; ++i)
+            for (size_t j=0; j<_sums[i].size(); ++j) _sums[i][j] += other._sums[i][j];
+    }
 
-template <int D1, int D2, int B>
-void BinnedCorr2<D1,D2,B>::operator=(const BinnedCorr2<D1,D2,B>& rhs)
-{
-    Assert(rhs._nbins == _nbins);
-    _xi.copy(rhs._xi,_nbins);
-    for (int i=0; i<_nbins; ++i) _meanr[i] = rhs._meanr[i];
-    for (int i=0; i<_nbins; ++i) _meanlogr[i] = rhs._meanlogr[i];
-    for (int i=0; i<_nbins; ++i) _weight[i] = rhs._weight[i];
-    for (int i=0; i<_nbins; ++i) _npairs[i] = rhs._npairs[i];
-}
+    void apply(const std::vector<PairRecord<D1,D2> >& records)
+    {
+        ApplyHelper<V1,V2>::template apply<C>(records, _index1, _index2, _values1, _values2,
+                                              _nreal, _nbins, _mode,
+                                              sumPtr(0), sumPtr(1), sumPtr(2), sumPtr(3));
+    }
 
-template <int D1, int D2, int B>
-void BinnedCorr2<D1,D2,B>::operator+=(const BinnedCorr2<D1,D2,B>& rhs)
+    void finish()
+    {
+        for (int i=0; i<4; ++i) {
+            for (size_t j=0; j<_sums[i].size(); ++j) _xi[i][j] += _sums[i][j];
+            std::fill(_sums[i].begin(), _sums[i].end(), 0.);
+        }
+    }
+
+private:
+    double* sumPtr(int i) { return _sums[i].empty() ? 0 : &_sums[i][0]; }
+
+    CellIndexer<D1,C> _index1;
+    CellIndexer<D2,C> _index2;
+    const double* _values1;
+    const double* _values2;
+    int _nreal;
+    int _nbins;
+    int _mode;
+    double* _xi[4];
+    // The sums for this thread, which have the same shape as xi, (nreal, nbins).
+    std::vector<double> _sums[4];
+};
+
+template <int D1, int D2, int B> template <int V1, int V2, int C>
+void BinnedCorr2<D1,D2,B>::addRecordTarget(
+    const Field<D1,C>& field1, const Field<D2,C>& field2,
+    const double* values1, const double* values2, int nreal, int mode,
+    double* xi0, double* xi1, double* xi2, double* xi3)
 {
-    Assert(rhs._nbins == _nbins);
-    _xi.add(rhs._xi,_nbins);
-    for (int i=0; i<_nbins; ++i) _meanr[i] += rhs._meanr[i];
-    for (int i=0; i<_nbins; ++i) _meanlogr[i] += rhs._meanlogr[i];
-    for (int i=0; i<_nbins; ++i) _weight[i] += rhs._weight[i];
-    for (int i=0; i<_nbins; ++i) _npairs[i] += rhs._npairs[i];
+    dbg<<"Start addRecordTarget: nreal = "<<nreal<<", mode = "<<mode<<std::endl;
+    Assert(_record);
+    _record_targets.push_back(new RecordTargetImpl<D1,D2,V1,V2,C>(
+            field1, field2, values1, values2, nreal, _nbins, mode, xi0, xi1, xi2, xi3));
 }
 
 template <int D1, int D2, int B> template <int C, int M>
@@ -833,13 +1708,13 @@ void BinnedCorr2<D1,D2,B>::sampleFrom(
             for (long q1=0; q1<nn1; ++q1) {
                 long index1;
                 if (nn1 == 1) index1 = leaf1[p1]->getInfo().index;
-                else index1 = (*leaf1[p1]->getListInfo().indices)[q1];
+                else index1 = leaf1[p1]->getLeafIndices()[q1];
                 for (size_t p2=0; p2<leaf2.size(); ++p2) {
                     long nn2 = leaf2[p2]->getN();
                     for (long q2=0; q2<nn2; ++q2) {
                         long index2;
                         if (nn2 == 1) index2 = leaf2[p2]->getInfo().index;
-                        else index2 = (*leaf2[p2]->getListInfo().indices)[q2];
+                        else index2 = leaf2[p2]->getLeafIndices()[q2];
                         i1[k] = index1;
                         i2[k] = index2;
                         sep[k] = r;
@@ -856,13 +1731,13 @@ void BinnedCorr2<D1,D2,B>::sampleFrom(
             for (long q1=0; q1<nn1; ++q1) {
                 long index1;
                 if (nn1 == 1) index1 = leaf1[p1]->getInfo().index;
-                else index1 = (*leaf1[p1]->getListInfo().indices)[q1];
+                else index1 = leaf1[p1]->getLeafIndices()[q1];
                 for (size_t p2=0; p2<leaf2.size(); ++p2) {
                     long nn2 = leaf2[p2]->getN();
                     for (long q2=0; q2<nn2; ++q2) {
                         long index2;
                         if (nn2 == 1) index2 = leaf2[p2]->getInfo().index;
-                        else index2 = (*leaf2[p2]->getListInfo().indices)[q2];
+                        else index2 = leaf2[p2]->getLeafIndices()[q2];
                         long j = k;  // j is where in the lists we will place this
                         if (k >= n) {
                             double urd = urand(); // 0 < urd < 1
@@ -916,7 +1791,7 @@ void BinnedCorr2<D1,D2,B>::sampleFrom(
                 }
                 long index1;
                 if (nn1 == 1) index1 = leaf1[p1]->getInfo().index;
-                else index1 = (*leaf1[p1]->getListInfo().indices)[q1];
+                else index1 = leaf1[p1]->getLeafIndices()[q1];
                 for (size_t p2=0; p2<leaf2.size(); ++p2) {
                     long nn2 = leaf2[p2]->getN();
                     for (long q2=0; q2<nn2; ++q2,++i) {
@@ -924,7 +1799,7 @@ void BinnedCorr2<D1,D2,B>::sampleFrom(
                             xdbg<<"Use i = "<<i<<std::endl;
                             long index2;
                             if (nn2 == 1) index2 = leaf2[p2]->getInfo().index;
-                            else index2 = (*leaf2[p2]->getListInfo().indices)[q2];
+                            else index2 = leaf2[p2]->getLeafIndices()[q2];
                             long j = next->second;
                             i1[j] = index1;
                             i2[j] = index2;
@@ -1614,3 +2489,338 @@ long SamplePairs(void* corr, void* field1, void* field2, double minsep, double m
     }
     return 0;
 }
+
+template <int D>
+void SetRecordPairs1(void* corr, int record, int bin_type)
+{
+    switch(bin_type) {
+      case Log:
+           static_cast<BinnedCorr2<D,D,Log>*>(corr)->setRecordPairs(record);
+           break;
+      case Linear:
+           static_cast<BinnedCorr2<D,D,Linear>*>(corr)->setRecordPairs(record);
+           break;
+      case TwoD:
+           static_cast<BinnedCorr2<D,D,TwoD>*>(corr)->setRecordPairs(record);
+           break;
+      default:
+           Assert(false);
+    }
+}
+
+void SetRecordPairs(void* corr, int record, int d, int bin_type)
+{
+    switch(d) {
+      case NData:
+           SetRecordPairs1<NData>(corr, record, bin_type);
+           break;
+      case KData:
+           SetRecordPairs1<KData>(corr, record, bin_type);
+           break;
+      case GData:
+           SetRecordPairs1<GData>(corr, record, bin_type);
+           break;
+      default:
+           Assert(false);
+    }
+}
+
+template <int D>
+void FinishRecordedPairs1(void* corr, int bin_type)
+{
+    switch(bin_type) {
+      case Log:
+           static_cast<BinnedCorr2<D,D,Log>*>(corr)->finishRecords();
+           break;
+      case Linear:
+           static_cast<BinnedCorr2<D,D,Linear>*>(corr)->finishRecords();
+           break;
+      case TwoD:
+           static_cast<BinnedCorr2<D,D,TwoD>*>(corr)->finishRecords();
+           break;
+      default:
+           Assert(false);
+    }
+}
+
+void FinishRecordedPairs(void* corr, int d, int bin_type)
+{
+    switch(d) {
+      case NData:
+           FinishRecordedPairs1<NData>(corr, bin_type);
+           break;
+      case KData:
+           FinishRecordedPairs1<KData>(corr, bin_type);
+           break;
+      case GData:
+           FinishRecordedPairs1<GData>(corr, bin_type);
+           break;
+      default:
+           Assert(false);
+    }
+}
+
+template <int D>
+long GetNRecordedPairs1(void* corr, int bin_type)
+{
+    switch(bin_type) {
+      case Log:
+           return static_cast<BinnedCorr2<D,D,Log>*>(corr)->getNRecords();
+      case Linear:
+           return static_cast<BinnedCorr2<D,D,Linear>*>(corr)->getNRecords();
+      case TwoD:
+           return static_cast<BinnedCorr2<D,D,TwoD>*>(corr)->getNRecords();
+      default:
+           Assert(false);
+    }
+    return 0;
+}
+
+long GetNRecordedPairs(void* corr, int d, int bin_type)
+{
+    switch(d) {
+      case NData:
+           return GetNRecordedPairs1<NData>(corr, bin_type);
+      case KData:
+           return GetNRecordedPairs1<KData>(corr, bin_type);
+      case GData:
+           return GetNRecordedPairs1<GData>(corr, bin_type);
+      default:
+           Assert(false);
+    }
+    return 0;
+}
+
+template <int V1, int V2, int D, int B>
+void AddRecordTarget3(BinnedCorr2<D,D,B>* corr, void* field1, void* field2,
+                      double* values1, double* values2, int nreal, int mode,
+                      double* xi0, double* xi1, double* xi2, double* xi3, int coords)
+{
+    switch(coords) {
+      case Flat:
+           corr->template addRecordTarget<V1,V2>(*static_cast<Field<D,Flat>*>(field1),
+                                                  *static_cast<Field<D,Flat>*>(field2),
+                                                  values1, values2, nreal, mode,
+                                                  xi0, xi1, xi2, xi3);
+           break;
+      case Sphere:
+           corr->template addRecordTarget<V1,V2>(*static_cast<Field<D,Sphere>*>(field1),
+                                                  *static_cast<Field<D,Sphere>*>(field2),
+                                                  values1, values2, nreal, mode,
+                                                  xi0, xi1, xi2, xi3);
+           break;
+      case ThreeD:
+           corr->template addRecordTarget<V1,V2>(*static_cast<Field<D,ThreeD>*>(field1),
+                                                  *static_cast<Field<D,ThreeD>*>(field2),
+                                                  values1, values2, nreal, mode,
+                                                  xi0, xi1, xi2, xi3);
+           break;
+      default:
+           Assert(false);
+    }
+}
+
+template <int V1, int V2, int D>
+void AddRecordTarget2(void* corr, void* field1, void* field2,
+                      double* values1, double* values2, int nreal, int mode,
+                      double* xi0, double* xi1, double* xi2, double* xi3,
+                      int coords, int bin_type)
+{
+    switch(bin_type) {
+      case Log:
+           AddRecordTarget3<V1,V2>(static_cast<BinnedCorr2<D,D,Log>*>(corr),
+                                   field1, field2, values1, values2, nreal, mode,
+                                   xi0, xi1, xi2, xi3, coords);
+           break;
+      case Linear:
+           AddRecordTarget3<V1,V2>(static_cast<BinnedCorr2<D,D,Linear>*>(corr),
+                                   field1, field2, values1, values2, nreal, mode,
+                                   xi0, xi1, xi2, xi3, coords);
+           break;
+      case TwoD:
+           AddRecordTarget3<V1,V2>(static_cast<BinnedCorr2<D,D,TwoD>*>(corr),
+                                   field1, field2, values1, values2, nreal, mode,
+                                   xi0, xi1, xi2, xi3, coords);
+           break;
+      default:
+           Assert(false);
+    }
+}
+
+template <int D>
+void AddRecordTarget1(void* corr, void* field1, void* field2,
+                      double* values1, double* values2, int nreal, int mode,
+                      double* xi0, double* xi1, double* xi2, double* xi3,
+                      int v1, int v2, int coords, int bin_type)
+{
+    // The values of N cells are their weights, so they are treated as scalars.
+    if (v1 == NData) v1 = KData;
+    if (v2 == NData) v2 = KData;
+    if (v1 == KData && v2 == KData)
+        AddRecordTarget2<KData,KData,D>(corr, field1, field2, values1, values2, nreal, mode,
+                                        xi0, xi1, xi2, xi3, coords, bin_type);
+    else if (v1 == KData && v2 == GData)
+        AddRecordTarget2<KData,GData,D>(corr, field1, field2, values1, values2, nreal, mode,
+                                        xi0, xi1, xi2, xi3, coords, bin_type);
+    else if (v1 == GData && v2 == GData)
+        AddRecordTarget2<GData,GData,D>(corr, field1, field2, values1, values2, nreal, mode,
+                                        xi0, xi1, xi2, xi3, coords, bin_type);
+    else
+        Assert(false);
+}
+
+void AddRecordTarget(void* corr, void* field1, void* field2,
+                     double* values1, double* values2, int nreal, int mode,
+                     double* xi0, double* xi1, double* xi2, double* xi3,
+                     int d, int v1, int v2, int coords, int bin_type)
+{
+    dbg<<"Start AddRecordTarget: "<<d<<" "<<v1<<" "<<v2<<" "<<coords<<" "<<bin_type<<" ";
+    dbg<<nreal<<std::endl;
+    switch(d) {
+      case NData:
+           // Pairs recorded from an NN correlation may be applied to any kind of values.
+           AddRecordTarget1<NData>(corr, field1, field2, values1, values2, nreal, mode,
+                                   xi0, xi1, xi2, xi3, v1, v2, coords, bin_type);
+           break;
+      case KData:
+           Assert(v1 == KData && v2 == KData);
+           AddRecordTarget2<KData,KData,KData>(corr, field1, field2, values1, values2,
+                                            nreal, mode, xi0, xi1, xi2, xi3,
+                                            coords, bin_type);
+           break;
+      case GData:
+           Assert(v1 == GData && v2 == GData);
+           AddRecordTarget2<GData,GData,GData>(corr, field1, field2, values1, values2,
+                                            nreal, mode, xi0, xi1, xi2, xi3,
+                                            coords, bin_type);
+           break;
+      default:
+           Assert(false);
+    }
+}
+
+template <int D1, int D2, int B>
+void AddBinning3(void* corr, void* other, int other_bin_type)
+{
+    BinnedCorr2<D1,D2,B>* corr2 = static_cast<BinnedCorr2<D1,D2,B>*>(corr);
+    switch(other_bin_type) {
+      case Log:
+           corr2->addBinning(static_cast<BinnedCorr2<D1,D2,Log>*>(other));
+           break;
+      case Linear:
+           corr2->addBinning(static_cast<BinnedCorr2<D1,D2,Linear>*>(other));
+           break;
+      case TwoD:
+           corr2->addBinning(static_cast<BinnedCorr2<D1,D2,TwoD>*>(other));
+           break;
+      default:
+           Assert(false);
+    }
+}
+
+template <int D1, int D2>
+void AddBinning2(void* corr, void* other, int bin_type, int other_bin_type)
+{
+    switch(bin_type) {
+      case Log:
+           AddBinning3<D1,D2,Log>(corr, other, other_bin_type);
+           break;
+      case Linear:
+           AddBinning3<D1,D2,Linear>(corr, other, other_bin_type);
+           break;
+      case TwoD:
+           AddBinning3<D1,D2,TwoD>(corr, other, other_bin_type);
+           break;
+      default:
+           Assert(false);
+    }
+}
+
+template <int D1>
+void AddBinning1(void* corr, void* other, int d2, int bin_type, int other_bin_type)
+{
+    switch(d2) {
+      case NData:
+           AddBinning2<D1,MAX(D1,NData)>(corr, other, bin_type, other_bin_type);
+           break;
+      case KData:
+           AddBinning2<D1,MAX(D1,KData)>(corr, other, bin_type, other_bin_type);
+           break;
+      case GData:
+           AddBinning2<D1,MAX(D1,GData)>(corr, other, bin_type, other_bin_type);
+           break;
+      default:
+           Assert(false);
+    }
+}
+
+void AddBinning(void* corr, void* other, int d1, int d2, int bin_type, int other_bin_type)
+{
+    dbg<<"Start AddBinning: "<<d1<<" "<<d2<<" "<<bin_type<<" "<<other_bin_type<<std::endl;
+    switch(d1) {
+      case NData:
+           AddBinning1<NData>(corr, other, d2, bin_type, other_bin_type);
+           break;
+      case KData:
+           AddBinning1<KData>(corr, other, d2, bin_type, other_bin_type);
+           break;
+      case GData:
+           AddBinning1<GData>(corr, other, d2, bin_type, other_bin_type);
+           break;
+      default:
+           Assert(false);
+    }
+}
+
+template <int D1, int D2>
+void ClearBinnings2(void* corr, int bin_type)
+{
+    switch(bin_type) {
+      case Log:
+           static_cast<BinnedCorr2<D1,D2,Log>*>(corr)->clearBinnings();
+           break;
+      case Linear:
+           static_cast<BinnedCorr2<D1,D2,Linear>*>(corr)->clearBinnings();
+           break;
+      case TwoD:
+           static_cast<BinnedCorr2<D1,D2,TwoD>*>(corr)->clearBinnings();
+           break;
+      default:
+           Assert(false);
+    }
+}
+
+template <int D1>
+void ClearBinnings1(void* corr, int d2, int bin_type)
+{
+    switch(d2) {
+      case NData:
+           ClearBinnings2<D1,MAX(D1,NData)>(corr, bin_type);
+           break;
+      case KData:
+           ClearBinnings2<D1,MAX(D1,KData)>(corr, bin_type);
+           break;
+      case GData:
+           ClearBinnings2<D1,MAX(D1,GData)>(corr, bin_type);
+           break;
+      default:
+           Assert(false);
+    }
+}
+
+void ClearBinnings(void* corr, int d1, int d2, int bin_type)
+{
+    switch(d1) {
+      case NData:
+           ClearBinnings1<NData>(corr, d2, bin_type);
+           break;
+      case KData:
+           ClearBinnings1<KData>(corr, d2, bin_type);
+           break;
+      case GData:
+           ClearBinnings1<GData>(corr, d2, bin_type);
+           break;
+      default:
+           Assert(false);
+    }
+}
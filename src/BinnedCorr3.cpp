@@ -18,6 +18,7 @@
 #include "BinnedCorr3.h"
 #include "Split.h"
 #include "ProjectHelper.h"
+#include "ThreadReduce.h"
 
 #ifdef _OPENMP
 #include "omp.h"
@@ -180,6 +181,7 @@ void BinnedCorr3<D1,D2,D3,B>::process(const Field<D1,C>& field, bool dots)
     MetricHelper<M> metric(_minrpar, _maxrpar, _xp, _yp, _zp);
 
 #ifdef _OPENMP
+    std::vector<BinnedCorr3<D1,D2,D3,B>*> copies(omp_get_max_threads());
 #pragma omp parallel
     {
         // Give each thread their own copy of the data vector to fill in.
@@ -193,19 +195,21 @@ void BinnedCorr3<D1,D2,D3,B>::process(const Field<D1,C>& field, bool dots)
 #endif
         for (long i=0;i<n1;++i) {
             const Cell<D1,C>* c1 = field.getCells()[i];
+            // Writing single characters to std::cout is thread safe, so the progress dots
+            // don't need a critical section.
+            if (dots) std::cout<<'.'<<std::flush;
+#ifdef DEBUGLOGGING
 #ifdef _OPENMP
 #pragma omp critical
 #endif
             {
-                if (dots) std::cout<<'.'<<std::flush;
 #ifdef _OPENMP
                 dbg<<omp_get_thread_num()<<" "<<i<<std::endl;
 #endif
                 xdbg<<"field = \n";
-#ifdef DEBUGLOGGING
                 if (verbose_level >= 2) c1->WriteTree(get_dbgout());
-#endif
             }
+#endif
             ProcessHelper<D1,D2,D3,B,C,M>::process3(bc3,c1, metric);
             for (long j=i+1;j<n1;++j) {
                 const Cell<D1,C>* c2 = field.getCells()[j];
@@ -219,10 +223,7 @@ void BinnedCorr3<D1,D2,D3,B>::process(const Field<D1,C>& field, bool dots)
         }
 #ifdef _OPENMP
         // Accumulate the results
-#pragma omp critical
-        {
-            *this += bc3;
-        }
+        ThreadReduce(*this, bc3, copies);
     }
 #endif
     if (dots) std::cout<<std::endl;
@@ -273,6 +274,7 @@ void BinnedCorr3<D1,D2,D3,B>::process(const Field<D1,C>& field1, const Field<D2,
 #endif
 
 #ifdef _OPENMP
+    std::vector<BinnedCorr3<D1,D2,D3,B>*> copies(omp_get_max_threads());
 #pragma omp parallel
     {
         // Give each thread their own copy of the data vector to fill in.
@@ -285,15 +287,13 @@ void BinnedCorr3<D1,D2,D3,B>::process(const Field<D1,C>& field1, const Field<D2,
 #pragma omp for schedule(dynamic)
 #endif
         for (long i=0;i<n1;++i) {
-#ifdef _OPENMP
+            if (dots) std::cout<<'.'<<std::flush;
+#if defined(_OPENMP) && defined(DEBUGLOGGING)
 #pragma omp critical
-#endif
             {
-                if (dots) std::cout<<'.'<<std::flush;
-#ifdef _OPENMP
                 dbg<<omp_get_thread_num()<<" "<<i<<std::endl;
-#endif
             }
+#endif
             const Cell<D1,C>* c1 = field1.getCells()[i];
             for (long j=0;j<n2;++j) {
                 const Cell<D2,C>* c2 = field2.getCells()[j];
@@ -305,10 +305,68 @@ void BinnedCorr3<D1,D2,D3,B>::process(const Field<D1,C>& field1, const Field<D2,
         }
 #ifdef _OPENMP
         // Accumulate the results
-#pragma omp critical
-        {
-            *this += bc3;
+        ThreadReduce(*this, bc3, copies);
+    }
+#endif
+    if (dots) std::cout<<std::endl;
+}
+
+template <int D1, int D2, int D3, int B> template <int C, int M>
+void BinnedCorr3<D1,D2,D3,B>::processSym(const Field<D1,C>& field1, const Field<D1,C>& field2,
+                                         const Field<D1,C>* field3, bool dots)
+{
+    Assert(D1 == D2);
+    Assert(D1 == D3);
+    Assert(_coords == -1 || _coords == C);
+    _coords = C;
+    const long n1 = field1.getNTopLevel();
+    const long n2 = field2.getNTopLevel();
+    const long n3 = field3 ? field3->getNTopLevel() : 0;
+    xdbg<<"field1 has "<<n1<<" top level nodes\n";
+    xdbg<<"field2 has "<<n2<<" top level nodes\n";
+    xdbg<<"field3 has "<<n3<<" top level nodes\n";
+    Assert(n1 > 0);
+    Assert(n2 > 0);
+    Assert(!field3 || n3 > 0);
+
+    MetricHelper<M> metric(_minrpar, _maxrpar, _xp, _yp, _zp);
+
+#ifdef _OPENMP
+    std::vector<BinnedCorr3<D1,D2,D3,B>*> copies(omp_get_max_threads());
+#pragma omp parallel
+    {
+        // Give each thread their own copy of the data vector to fill in.
+        BinnedCorr3<D1,D2,D3,B> bc3(*this,false);
+#else
+        BinnedCorr3<D1,D2,D3,B>& bc3 = *this;
+#endif
+
+#ifdef _OPENMP
+#pragma omp for schedule(dynamic)
+#endif
+        for (long i=0;i<n1;++i) {
+            if (dots) std::cout<<'.'<<std::flush;
+            const Cell<D1,C>* c1 = field1.getCells()[i];
+            for (long j=0;j<n2;++j) {
+                const Cell<D1,C>* c2 = field2.getCells()[j];
+                if (field3) {
+                    for (long k=0;k<n3;++k) {
+                        const Cell<D1,C>* c3 = field3->getCells()[k];
+                        ProcessHelper<D1,D2,D3,B,C,M>::process111(bc3,c1,c2,c3, metric);
+                    }
+                } else {
+                    // Two points in field1: either both in c1 or one in a later top-level cell.
+                    ProcessHelper<D1,D2,D3,B,C,M>::process21(bc3,c1,c2, metric);
+                    for (long k=i+1;k<n1;++k) {
+                        const Cell<D1,C>* c1b = field1.getCells()[k];
+                        ProcessHelper<D1,D2,D3,B,C,M>::process111(bc3,c1,c1b,c2, metric);
+                    }
+                }
+            }
         }
+#ifdef _OPENMP
+        // Accumulate the results
+        ThreadReduce(*this, bc3, copies);
     }
 #endif
     if (dots) std::cout<<std::endl;
@@ -1433,6 +1491,85 @@ void ProcessCross3c(void* corr, void* field1, void* field2, void* field3, int do
                    coords, metric);
 }
 
+template <int M, int D, int B>
+void ProcessSym3e(BinnedCorr3<D,D,D,B>* corr, void* field1, void* field2, void* field3,
+                  int dots, int coords)
+{
+    switch(coords) {
+      case Flat:
+           Assert(MetricHelper<M>::_Flat == int(Flat));
+           corr->template processSym<MetricHelper<M>::_Flat,M>(
+               *static_cast<Field<D,MetricHelper<M>::_Flat>*>(field1),
+               *static_cast<Field<D,MetricHelper<M>::_Flat>*>(field2),
+               static_cast<Field<D,MetricHelper<M>::_Flat>*>(field3), dots);
+           break;
+      case Sphere:
+           Assert(MetricHelper<M>::_Sphere == int(Sphere));
+           corr->template processSym<MetricHelper<M>::_Sphere,M>(
+               *static_cast<Field<D,MetricHelper<M>::_Sphere>*>(field1),
+               *static_cast<Field<D,MetricHelper<M>::_Sphere>*>(field2),
+               static_cast<Field<D,MetricHelper<M>::_Sphere>*>(field3), dots);
+           break;
+      case ThreeD:
+           Assert(MetricHelper<M>::_ThreeD == int(ThreeD));
+           corr->template processSym<MetricHelper<M>::_ThreeD,M>(
+               *static_cast<Field<D,MetricHelper<M>::_ThreeD>*>(field1),
+               *static_cast<Field<D,MetricHelper<M>::_ThreeD>*>(field2),
+               static_cast<Field<D,MetricHelper<M>::_ThreeD>*>(field3), dots);
+           break;
+      default:
+           Assert(false);
+    }
+}
+
+template <int D, int B>
+void ProcessSym3d(BinnedCorr3<D,D,D,B>* corr, void* field1, void* field2, void* field3,
+                  int dots, int coords, int metric)
+{
+    switch(metric) {
+      case Euclidean:
+           ProcessSym3e<Euclidean>(corr, field1, field2, field3, dots, coords);
+           break;
+      case Arc:
+           ProcessSym3e<Arc>(corr, field1, field2, field3, dots, coords);
+           break;
+      case Periodic:
+           ProcessSym3e<Periodic>(corr, field1, field2, field3, dots, coords);
+           break;
+      default:
+           Assert(false);
+    }
+}
+
+template <int D>
+void ProcessSym3c(void* corr, void* field1, void* field2, void* field3, int dots,
+                  int coords, int bin_type, int metric)
+{
+    Assert(bin_type == Log);
+    ProcessSym3d(static_cast<BinnedCorr3<D,D,D,Log>*>(corr), field1, field2, field3, dots,
+                 coords, metric);
+}
+
+void ProcessSym3(void* corr, void* field1, void* field2, void* field3, int dots,
+                 int d, int coords, int bin_type, int metric)
+{
+    dbg<<"Start ProcessSym3 "<<d<<" "<<coords<<" "<<bin_type<<" "<<metric<<std::endl;
+
+    switch(d) {
+      case NData:
+           ProcessSym3c<NData>(corr, field1, field2, field3, dots, coords, bin_type, metric);
+           break;
+      case KData:
+           ProcessSym3c<KData>(corr, field1, field2, field3, dots, coords, bin_type, metric);
+           break;
+      case GData:
+           ProcessSym3c<GData>(corr, field1, field2, field3, dots, coords, bin_type, metric);
+           break;
+      default:
+           Assert(false);
+    }
+}
+
 void ProcessCross3(void* corr, void* field1, void* field2, void* field3, int dots,
                    int d1, int d2, int d3, int coords, int bin_type, int metric)
 {
@@ -65,6 +65,24 @@ double urand()
     return r;
 }
 
+uint64_t SplitSeed()
+{
+    // rand() only gives 31 random bits, so use two of them.
+    return (uint64_t(urand() * 2147483647.) << 32) ^ uint64_t(urand() * 2147483647.);
+}
+
+// Return a pseudo-random number between 0 and 1, which is a function of the seed and the
+// range of objects being split.  (This is the splitmix64 mixing function.)
+inline double split_urand(uint64_t seed, size_t start, size_t end)
+{
+    uint64_t z = seed + 0x9e3779b97f4a7c15ULL * (uint64_t(start) + 1);
+    z ^= uint64_t(end) * 0xc2b2ae3d27d4eb4fULL;
+    z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+    z ^= z >> 31;
+    return double(z >> 11) / double(1ULL << 53);
+}
+
 
 //
 // CellData
@@ -189,6 +207,46 @@ void CellData<GData,Flat>::finishAverages(
     _wg = dwg;
 }
 
+template <int C>
+std::complex<double> ParallelTransportFactor(const Position<C>& center, const Position<C>& pos)
+{
+    // This is a lot like the ProjectShear function in BinCorr2.cpp
+    // The difference is that here, we just rotate the single shear by
+    // (Pi-A-B).  See the comments in ProjectShear2 for understanding
+    // the initial bit where we calculate A,B.
+    double x1 = center.getX();
+    double y1 = center.getY();
+    double z1 = center.getZ();
+    double x2 = pos.getX();
+    double y2 = pos.getY();
+    double z2 = pos.getZ();
+    double temp = x1*x2+y1*y2;
+    double cosA = z1*(1.-z2*z2) - z2*temp;
+    double sinA = y1*x2 - x1*y2;
+    double normAsq = sinA*sinA + cosA*cosA;
+    double cosB = z2*(1.-z1*z1) - z1*temp;
+    double sinB = sinA;
+    double normBsq = sinB*sinB + cosB*cosB;
+    xxdbg<<"A = atan("<<sinA<<"/"<<cosA<<") = "<<atan2(sinA,cosA)*180./M_PI<<std::endl;
+    xxdbg<<"B = atan("<<sinB<<"/"<<cosB<<") = "<<atan2(sinB,cosB)*180./M_PI<<std::endl;
+    if (normAsq == 0. || normBsq == 0.) {
+        // Then this point is at the center, no need to project.
+        return 1.;
+    } else {
+        // The angle we need to rotate the shear by is (Pi-A-B)
+        // cos(beta) = -cos(A+B)
+        // sin(beta) = sin(A+B)
+        double cosbeta = -cosA * cosB + sinA * sinB;
+        double sinbeta = sinA * cosB + cosA * sinB;
+        xxdbg<<"beta = "<<atan2(sinbeta,cosbeta)*180/M_PI<<std::endl;
+        std::complex<double> expibeta(cosbeta,-sinbeta);
+        xxdbg<<"expibeta = "<<expibeta/sqrt(normAsq*normBsq)<<std::endl;
+        std::complex<double> exp2ibeta = (expibeta * expibeta) / (normAsq*normBsq);
+        xxdbg<<"exp2ibeta = "<<exp2ibeta<<std::endl;
+        return exp2ibeta;
+    }
+}
+
 template <int C>
 std::complex<double> ParallelTransportShift(
     const std::vector<std::pair<CellData<GData,C>*,WPosLeafInfo> >& vdata,
@@ -201,41 +259,8 @@ std::complex<double> ParallelTransportShift(
     for(size_t i=start;i<end;++i) {
         xxdbg<<"Project shear "<<(vdata[i].first->getWG()/vdata[i].first->getW())<<
             " at point "<<vdata[i].first->getPos()<<std::endl;
-        // This is a lot like the ProjectShear function in BinCorr2.cpp
-        // The difference is that here, we just rotate the single shear by
-        // (Pi-A-B).  See the comments in ProjectShear2 for understanding
-        // the initial bit where we calculate A,B.
-        double x1 = center.getX();
-        double y1 = center.getY();
-        double z1 = center.getZ();
-        double x2 = vdata[i].first->getPos().getX();
-        double y2 = vdata[i].first->getPos().getY();
-        double z2 = vdata[i].first->getPos().getZ();
-        double temp = x1*x2+y1*y2;
-        double cosA = z1*(1.-z2*z2) - z2*temp;
-        double sinA = y1*x2 - x1*y2;
-        double normAsq = sinA*sinA + cosA*cosA;
-        double cosB = z2*(1.-z1*z1) - z1*temp;
-        double sinB = sinA;
-        double normBsq = sinB*sinB + cosB*cosB;
-        xxdbg<<"A = atan("<<sinA<<"/"<<cosA<<") = "<<atan2(sinA,cosA)*180./M_PI<<std::endl;
-        xxdbg<<"B = atan("<<sinB<<"/"<<cosB<<") = "<<atan2(sinB,cosB)*180./M_PI<<std::endl;
-        if (normAsq == 0. || normBsq == 0.) {
-            // Then this point is at the center, no need to project.
-            dwg += vdata[i].first->getWG();
-        } else {
-            // The angle we need to rotate the shear by is (Pi-A-B)
-            // cos(beta) = -cos(A+B)
-            // sin(beta) = sin(A+B)
-            double cosbeta = -cosA * cosB + sinA * sinB;
-            double sinbeta = sinA * cosB + cosA * sinB;
-            xxdbg<<"beta = "<<atan2(sinbeta,cosbeta)*180/M_PI<<std::endl;
-            std::complex<double> expibeta(cosbeta,-sinbeta);
-            xxdbg<<"expibeta = "<<expibeta/sqrt(normAsq*normBsq)<<std::endl;
-            std::complex<double> exp2ibeta = (expibeta * expibeta) / (normAsq*normBsq);
-            xxdbg<<"exp2ibeta = "<<exp2ibeta<<std::endl;
-            dwg += vdata[i].first->getWG() * exp2ibeta;
-        }
+        const Position<C>& pos = vdata[i].first->getPos();
+        dwg += vdata[i].first->getWG() * ParallelTransportFactor(center, pos);
     }
     return dwg;
 }
@@ -281,13 +306,11 @@ struct DataCompareToValue
     { return cd.first->getPos().get(split) < splitvalue; }
 };
 
-size_t select_random(size_t lo, size_t hi)
+size_t select_random(size_t lo, size_t hi, double r)
 {
     if (lo == hi) {
         return lo;
     } else {
-        // Get a random number between 0 and 1
-        double r = urand();
         size_t mid = size_t(r * (hi-lo+1)) + lo;
         if (mid > hi) mid = hi;  // Just in case
         return mid;
@@ -305,7 +328,7 @@ struct SplitDataCore<D, C, MIDDLE>
     // Middle is the average of the min and max value of x or y
     static size_t run(std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata,
                       size_t start, size_t end, const Position<C>& meanpos,
-                      const Bounds<C>& b, int split)
+                      const Bounds<C>& b, int split, uint64_t seed)
     {
         double splitvalue = b.getMiddle(split);
         DataCompareToValue<D,C> comp(split,splitvalue);
@@ -321,7 +344,7 @@ struct SplitDataCore<D, C, MEDIAN>
     // Median is the point which divides the group into equal numbers
     static size_t run(std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata,
                       size_t start, size_t end, const Position<C>& meanpos,
-                      const Bounds<C>& b, int split)
+                      const Bounds<C>& b, int split, uint64_t seed)
     {
         DataCompare<D,C> comp(split);
         size_t mid = (start+end)/2;
@@ -338,7 +361,7 @@ struct SplitDataCore<D, C, MEAN>
     // Mean is the weighted average value of x or y
     static size_t run(std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata,
                       size_t start, size_t end, const Position<C>& meanpos,
-                      const Bounds<C>& b, int split)
+                      const Bounds<C>& b, int split, uint64_t seed)
     {
         double splitvalue = meanpos.get(split);
         DataCompareToValue<D,C> comp(split,splitvalue);
@@ -354,7 +377,7 @@ struct SplitDataCore<D, C, RANDOM>
     // Random is a random point from the first quartile to the third quartile
     static size_t run(std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata,
                       size_t start, size_t end, const Position<C>& meanpos,
-                      const Bounds<C>& b, int split)
+                      const Bounds<C>& b, int split, uint64_t seed)
     {
         DataCompare<D,C> comp(split);
 
@@ -362,7 +385,8 @@ struct SplitDataCore<D, C, RANDOM>
         // Note: The lo and hi values are slightly subtle.  We want to make sure if there
         // are only two values, we actually split.  So if start=1, end=3, the only possible
         // result should be mid=2.  Otherwise, we want roughly 2/5 and 3/5 of the span.
-        size_t mid = select_random(end-3*(end-start)/5,start+3*(end-start)/5);
+        size_t mid = select_random(end-3*(end-start)/5,start+3*(end-start)/5,
+                                   split_urand(seed,start,end));
 
         typename std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >::iterator middle =
             vdata.begin()+mid;
@@ -374,7 +398,7 @@ struct SplitDataCore<D, C, RANDOM>
 template <int D, int C, int SM>
 size_t SplitData(
     std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata,
-    size_t start, size_t end, const Position<C>& meanpos)
+    size_t start, size_t end, const Position<C>& meanpos, uint64_t seed)
 {
     Assert(end-start > 1);
 
@@ -382,7 +406,7 @@ size_t SplitData(
     for(size_t i=start;i<end;++i) b += vdata[i].first->getPos();
     int split = b.getSplit();
 
-    size_t mid = SplitDataCore<D,C,SM>::run(vdata, start, end, meanpos, b, split);
+    size_t mid = SplitDataCore<D,C,SM>::run(vdata, start, end, meanpos, b, split, seed);
 
     if (mid == start || mid == end) {
         xdbg<<"Found mid not in middle.  Probably duplicate entries.\n";
@@ -400,7 +424,7 @@ size_t SplitData(
         // But just to be safe, re-call this function with sm = MEDIAN to
         // make sure.
         Assert(SM != MEDIAN);
-        return SplitData<D,C,MEDIAN>(vdata,start,end,meanpos);
+        return SplitData<D,C,MEDIAN>(vdata,start,end,meanpos,seed);
     }
     Assert(mid > start);
     Assert(mid < end);
@@ -409,7 +433,7 @@ size_t SplitData(
 
 template <int D, int C, int SM>
 Cell<D,C>* BuildCell(std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata,
-                     double minsizesq, bool brute, size_t start, size_t end,
+                     double minsizesq, bool brute, size_t start, size_t end, uint64_t seed,
                      CellData<D,C>* data, double sizesq)
 {
     xdbg<<"Build "<<minsizesq<<" "<<brute<<" "<<start<<" "<<end<<" "<<data<<" "<<sizesq<<std::endl;
@@ -447,20 +471,35 @@ Cell<D,C>* BuildCell(std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata
         double size = brute ? std::numeric_limits<double>::infinity() : sqrt(sizesq);
         if (brute) sizesq = std::numeric_limits<double>::infinity();
         xdbg<<"size,sizesq = "<<size<<","<<sizesq<<std::endl;
-        size_t mid = SplitData<D,C,SM>(vdata,start,end,data->getPos());
-        Cell<D,C>* l = BuildCell<D,C,SM>(vdata,minsizesq,brute,start,mid);
-        xdbg<<"Made left"<<std::endl;
-        Cell<D,C>* r = BuildCell<D,C,SM>(vdata,minsizesq,brute,mid,end);
-        xdbg<<"Made right"<<std::endl;
+        size_t mid = SplitData<D,C,SM>(vdata,start,end,data->getPos(),seed);
+        Cell<D,C>* l;
+        Cell<D,C>* r;
+        if (end - start > BUILD_TASK_MIN) {
+            // The two halves use disjoint ranges of vdata, so they can be built in parallel.
+            // (If we are not in a parallel region, the task just runs right away.)
+#ifdef _OPENMP
+#pragma omp task shared(vdata, l)
+#endif
+            l = BuildCell<D,C,SM>(vdata,minsizesq,brute,start,mid,seed);
+            r = BuildCell<D,C,SM>(vdata,minsizesq,brute,mid,end,seed);
+#ifdef _OPENMP
+#pragma omp taskwait
+#endif
+        } else {
+            l = BuildCell<D,C,SM>(vdata,minsizesq,brute,start,mid,seed);
+            xdbg<<"Made left"<<std::endl;
+            r = BuildCell<D,C,SM>(vdata,minsizesq,brute,mid,end,seed);
+            xdbg<<"Made right"<<std::endl;
+        }
         xdbg<<data<<"  "<<size<<"  "<<sizesq<<"  "<<l<<"  "<<r<<std::endl;
         return new Cell<D,C>(data, size, sizesq, l, r);
     } else {
         // Too small, so stop here anyway.
         ListLeafInfo info;
-        info.indices = new std::vector<long>(end-start);
+        info.indices = new long[end-start];
         for (size_t i=start; i<end; ++i) {
             xdbg<<"Set indices["<<i-start<<"] = "<<vdata[i].second.index<<std::endl;
-            (*info.indices)[i-start] = vdata[i].second.index;
+            info.indices[i-start] = vdata[i].second.index;
         }
         xdbg<<"Made indices"<<std::endl;
         return new Cell<D,C>(data, info);
@@ -472,7 +511,7 @@ long Cell<D,C>::countLeaves() const
 {
     if (_left) {
         Assert(_right);
-        return _left->countLeaves() + _right->countLeaves();
+        return getLeft()->countLeaves() + getRight()->countLeaves();
     } else return 1;
 }
 
@@ -480,12 +519,12 @@ template <int D, int C>
 bool Cell<D,C>::includesIndex(long index) const
 {
     if (_left) {
-        return _left->includesIndex(index) || _right->includesIndex(index);
+        return getLeft()->includesIndex(index) || getRight()->includesIndex(index);
     } else if (getN() == 1) {
         return _info.index == index;
     } else {
-        const std::vector<long>& indices = *_listinfo.indices;
-        return std::find(indices.begin(), indices.end(), index) != indices.end();
+        const long* indices = getLeafIndices();
+        return std::find(indices, indices + getN(), index) != indices + getN();
     }
 }
 
@@ -494,10 +533,10 @@ std::vector<const Cell<D,C>*> Cell<D,C>::getAllLeaves() const
 {
     std::vector<const Cell<D,C>*> ret;
     if (_left) {
-        std::vector<const Cell<D,C>*> temp = _left->getAllLeaves();
+        std::vector<const Cell<D,C>*> temp = getLeft()->getAllLeaves();
         ret.insert(ret.end(),temp.begin(),temp.end());
         Assert(_right);
-        temp = _right->getAllLeaves();
+        temp = getRight()->getAllLeaves();
         ret.insert(ret.end(),temp.begin(),temp.end());
     } else {
         ret.push_back(this);
@@ -510,16 +549,16 @@ std::vector<long> Cell<D,C>::getAllIndices() const
 {
     std::vector<long> ret;
     if (_left) {
-        std::vector<long> temp = _left->getAllIndices();
+        std::vector<long> temp = getLeft()->getAllIndices();
         ret.insert(ret.end(),temp.begin(),temp.end());
         Assert(_right);
-        temp = _right->getAllIndices();
+        temp = getRight()->getAllIndices();
         ret.insert(ret.end(),temp.begin(),temp.end());
     } else if (getN() == 1) {
         ret.push_back(_info.index);
     } else {
-        const std::vector<long>& indices = *_listinfo.indices;
-        ret.insert(ret.end(),indices.begin(),indices.end());
+        const long* indices = getLeafIndices();
+        ret.insert(ret.end(),indices,indices+getN());
     }
     return ret;
 }
@@ -528,10 +567,10 @@ template <int D, int C>
 const Cell<D,C>* Cell<D,C>::getLeafNumber(long i) const
 {
     if (_left) {
-        if (i < _left->getN())
-            return _left->getLeafNumber(i);
+        if (i < getLeft()->getN())
+            return getLeft()->getLeafNumber(i);
         else
-            return _right->getLeafNumber(i-_left->getN());
+            return getRight()->getLeafNumber(i-getLeft()->getN());
     } else {
         return this;
     }
@@ -553,6 +592,77 @@ void Cell<D,C>::WriteTree(std::ostream& os, int indent) const
     }
 }
 
+template <int D, int C>
+long CopyToNodes(const Cell<D,C>* cell, CellNode<D,C>* nodes, long i, long*& indices)
+{
+    // Copy cell into nodes[i] and its descendants into the following nodes.
+    // The indices of any leaves with N > 1 are copied to indices, which is advanced past them.
+    // Returns the index of the next unused node.
+    CellNode<D,C>& node = nodes[i];
+    new (&node.data) CellData<D,C>(cell->getData());
+    // Fill in the cached norm of the position now, so a block that is shared by several
+    // processes doesn't get written to during the traversal.
+    node.data.getPos().norm();
+    if (cell->getLeft()) {
+        long j = CopyToNodes(cell->getLeft(), nodes, i+1, indices);
+        long k = CopyToNodes(cell->getRight(), nodes, j, indices);
+        new (&node.cell) Cell<D,C>(&node.data, cell->getSize(), cell->getSizeSq(),
+                                   &nodes[i+1].cell, &nodes[j].cell);
+        return k;
+    } else if (cell->getN() == 1) {
+        new (&node.cell) Cell<D,C>(&node.data, cell->getInfo());
+    } else {
+        ListLeafInfo info;
+        info.indices = indices;
+        std::copy(cell->getLeafIndices(), cell->getLeafIndices() + cell->getN(), indices);
+        indices += cell->getN();
+        new (&node.cell) Cell<D,C>(&node.data, info);
+    }
+    return i+1;
+}
+
+template <int D, int C>
+void CountNodes(const Cell<D,C>* cell, long& n, long& nindices)
+{
+    ++n;
+    if (cell->getLeft()) {
+        CountNodes(cell->getLeft(), n, nindices);
+        CountNodes(cell->getRight(), n, nindices);
+    } else if (cell->getN() > 1) {
+        nindices += cell->getN();
+    }
+}
+
+template <int D, int C>
+CellNode<D,C>* FlattenCell(const Cell<D,C>* cell, long& n, long& nbytes)
+{
+    n = 0;
+    long nindices = 0;
+    CountNodes(cell, n, nindices);
+    nbytes = n * sizeof(CellNode<D,C>) + nindices * sizeof(long);
+    // Pad the end to the alignment of a CellNode, so blocks can be placed one after another.
+    const long align = alignof(CellNode<D,C>);
+    nbytes = (nbytes + align - 1) / align * align;
+    // Get raw memory, since the Cells are constructed in place by CopyToNodes.
+    // Zero it first, so the padding bytes are the same every time the block is written.
+    char* block = static_cast<char*>(::operator new(nbytes));
+    std::fill(block, block + nbytes, 0);
+    CellNode<D,C>* nodes = reinterpret_cast<CellNode<D,C>*>(block);
+    long* indices = reinterpret_cast<long*>(block + n * sizeof(CellNode<D,C>));
+    long n2 = CopyToNodes(cell, nodes, 0, indices);
+    Assert(n2 == n);
+    Assert(reinterpret_cast<char*>(indices) <= block + nbytes);
+    return nodes;
+}
+
+template <int D, int C>
+void DestroyCellNodes(CellNode<D,C>* nodes)
+{
+    // The Cell destructor would try to delete the daughter cells, data and leaf indices,
+    // which are all part of this block.  So just delete the block itself.
+    ::operator delete(nodes);
+}
+
 #define Inst(D,C)\
     template class CellData<D,C>; \
     template class Cell<D,C>; \
@@ -560,22 +670,41 @@ void Cell<D,C>::WriteTree(std::ostream& os, int indent) const
         const Position<C>& cen, \
         const std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata, \
         size_t start, size_t end); \
+    template size_t SplitData<D,C,MIDDLE>( \
+        std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata, \
+        size_t start, size_t end, const Position<C>& meanpos, uint64_t seed); \
+    template size_t SplitData<D,C,MEDIAN>( \
+        std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata, \
+        size_t start, size_t end, const Position<C>& meanpos, uint64_t seed); \
+    template size_t SplitData<D,C,MEAN>( \
+        std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata, \
+        size_t start, size_t end, const Position<C>& meanpos, uint64_t seed); \
+    template size_t SplitData<D,C,RANDOM>( \
+        std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata, \
+        size_t start, size_t end, const Position<C>& meanpos, uint64_t seed); \
     template Cell<D,C>* BuildCell<D,C,MIDDLE>( \
         std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata, \
-        double minsizesq, bool brute, size_t start, size_t end, \
+        double minsizesq, bool brute, size_t start, size_t end, uint64_t seed, \
         CellData<D,C>* data, double sizesq); \
     template Cell<D,C>* BuildCell<D,C,MEDIAN>( \
         std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata, \
-        double minsizesq, bool brute, size_t start, size_t end, \
+        double minsizesq, bool brute, size_t start, size_t end, uint64_t seed, \
         CellData<D,C>* data, double sizesq); \
     template Cell<D,C>* BuildCell<D,C,MEAN>( \
         std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata, \
-        double minsizesq, bool brute, size_t start, size_t end, \
+        double minsizesq, bool brute, size_t start, size_t end, uint64_t seed, \
         CellData<D,C>* data, double sizesq); \
     template Cell<D,C>* BuildCell<D,C,RANDOM>( \
         std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& vdata, \
-        double minsizesq, bool brute, size_t start, size_t end, \
+        double minsizesq, bool brute, size_t start, size_t end, uint64_t seed, \
         CellData<D,C>* data, double sizesq); \
+    template CellNode<D,C>* FlattenCell(const Cell<D,C>* cell, long& n, long& nbytes); \
+    template void DestroyCellNodes(CellNode<D,C>* nodes); \
+
+template std::complex<double> ParallelTransportFactor(
+    const Position<ThreeD>& center, const Position<ThreeD>& pos);
+template std::complex<double> ParallelTransportFactor(
+    const Position<Sphere>& center, const Position<Sphere>& pos);
 
 Inst(NData,Flat);
 Inst(NData,ThreeD);
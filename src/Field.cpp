@@ -25,7 +25,7 @@
 template <int D, int C, int SM>
 double SetupTopLevelCells(
     std::vector<std::pair<CellData<D,C>*,WPosLeafInfo> >& celldata,
-    double maxsizesq, size_t start, size_t end, int mintop, int maxtop,
+    double maxsizesq, size_t start, size_t end, int mintop, int maxtop, uint64_t seed,
     std::vector<CellData<D,C>*>& top_data,
     std::vector<double>& top_sizesq,
     std::vector<size_t>& top_start, std::vector<size_t>& top_end)
@@ -68,12 +68,36 @@ double SetupTopLevelCells(
         top_start.push_back(start);
         top_end.push_back(end);
     } else {
-        size_t mid = SplitData<D,C,SM>(celldata,start,end,ave->getPos());
+        size_t mid = SplitData<D,C,SM>(celldata,start,end,ave->getPos(),seed);
         xdbg<<"Too big.  Recurse with mid = "<<mid<<std::endl;
-        SetupTopLevelCells<D,C,SM>(celldata, maxsizesq, start, mid, mintop-1, maxtop-1,
-                                   top_data, top_sizesq, top_start, top_end);
-        SetupTopLevelCells<D,C,SM>(celldata, maxsizesq, mid, end, mintop-1, maxtop-1,
-                                   top_data, top_sizesq, top_start, top_end);
+        if (end - start > BUILD_TASK_MIN) {
+            // Do the left half as a separate task, which appends to the given vectors,
+            // while this thread does the right half into its own vectors.  Then append
+            // those after the left half is done, so the order is the same as in serial.
+            std::vector<CellData<D,C>*> right_data;
+            std::vector<double> right_sizesq;
+            std::vector<size_t> right_start;
+            std::vector<size_t> right_end;
+#ifdef _OPENMP
+#pragma omp task shared(celldata, top_data, top_sizesq, top_start, top_end)
+#endif
+            SetupTopLevelCells<D,C,SM>(celldata, maxsizesq, start, mid, mintop-1, maxtop-1, seed,
+                                       top_data, top_sizesq, top_start, top_end);
+            SetupTopLevelCells<D,C,SM>(celldata, maxsizesq, mid, end, mintop-1, maxtop-1, seed,
+                                       right_data, right_sizesq, right_start, right_end);
+#ifdef _OPENMP
+#pragma omp taskwait
+#endif
+            top_data.insert(top_data.end(), right_data.begin(), right_data.end());
+            top_sizesq.insert(top_sizesq.end(), right_sizesq.begin(), right_sizesq.end());
+            top_start.insert(top_start.end(), right_start.begin(), right_start.end());
+            top_end.insert(top_end.end(), right_end.begin(), right_end.end());
+        } else {
+            SetupTopLevelCells<D,C,SM>(celldata, maxsizesq, start, mid, mintop-1, maxtop-1, seed,
+                                       top_data, top_sizesq, top_start, top_end);
+            SetupTopLevelCells<D,C,SM>(celldata, maxsizesq, mid, end, mintop-1, maxtop-1, seed,
+                                       top_data, top_sizesq, top_start, top_end);
+        }
     }
     return sizesq;
 }
@@ -166,7 +190,7 @@ Field<D,C>::Field(double* x, double* y, double* z, double* g1, double* g2, doubl
                   double minsize, double maxsize,
                   SplitMethod sm, bool brute, int mintop, int maxtop) :
     _nobj(nobj), _minsize(minsize), _maxsize(maxsize), _sm(sm),
-    _brute(brute), _mintop(mintop), _maxtop(maxtop)
+    _brute(brute), _mintop(mintop), _maxtop(maxtop), _owns_nodes(true), _built(false)
 {
     //set_verbose(2);
     dbg<<"Starting to Build Field with "<<nobj<<" objects\n";
@@ -176,21 +200,27 @@ Field<D,C>::Field(double* x, double* y, double* z, double* g1, double* g2, doubl
         xdbg<<x[i]<<"  "<<y[i]<<"  "<<(z?z[i]:0)<<"  "<<g1[i]<<"  "<<g2[i]<<"  "<<k[i]<<"  "<<w[i]<<"  "<<(wpos?wpos[i]:0)<<std::endl;
     }
 
-    _celldata.reserve(nobj);
+    _celldata.resize(nobj);
     if (z) {
+#ifdef _OPENMP
+#pragma omp parallel for
+#endif
         for(long i=0;i<nobj;++i) {
             WPosLeafInfo wp = get_wpos(wpos,w,i);
-            _celldata.push_back(std::make_pair(
+            _celldata[i] = std::make_pair(
                     CellDataHelper<D,C>::build(x[i],y[i],z[i],g1[i],g2[i],k[i],w[i]),
-                    wp));
+                    wp);
         }
     } else {
         Assert(C == Flat);
+#ifdef _OPENMP
+#pragma omp parallel for
+#endif
         for(long i=0;i<nobj;++i) {
             WPosLeafInfo wp = get_wpos(wpos,w,i);
-            _celldata.push_back(std::make_pair(
+            _celldata[i] = std::make_pair(
                     CellDataHelper<D,C>::build(x[i],y[i],0.,g1[i],g2[i],k[i],w[i]),
-                    wp));
+                    wp);
         }
     }
     dbg<<"Built celldata with "<<_celldata.size()<<" entries\n";
@@ -205,8 +235,16 @@ Field<D,C>::Field(double* x, double* y, double* z, double* g1, double* g2, doubl
 template <int D, int C>
 void Field<D,C>::BuildCells() const
 {
+    // The fast path, which is taken by every getCells call after the first one.
+    if (_built.load(std::memory_order_acquire)) return;
+
+    std::lock_guard<std::mutex> lock(_build_mutex);
+
     // Signal that we already built the cells.
-    if (_celldata.size() == 0) return;
+    if (_celldata.size() == 0) {
+        _built.store(true, std::memory_order_release);
+        return;
+    }
 
     switch (_sm) {
       case MIDDLE:
@@ -248,34 +286,66 @@ void Field<D,C>::DoBuildCells() const
     std::vector<size_t> top_start;
     std::vector<size_t> top_end;
 
-    SetupTopLevelCells<D,C,SM>(_celldata, maxsizesq, 0, _celldata.size(), _mintop, _maxtop,
-                               top_data, top_sizesq, top_start, top_end);
-    const ptrdiff_t n = top_data.size();
+    // With split_method = random, the random split of each cell is a function of this seed and
+    // the range of objects in the cell, so the tree is the same for any number of threads.
+    const uint64_t seed = SM == RANDOM ? SplitSeed() : 0;
 
-    // Now build the lower cells in parallel
-    dbg<<"Field has "<<n<<" top-level nodes.  Building lower nodes...\n";
-    _cells.resize(n);
+    // Both parts split the work recursively into OpenMP tasks, so all the threads are kept
+    // busy even when there are fewer top-level cells than threads, or when some of them
+    // are much larger than others.
 #ifdef _OPENMP
-#pragma omp parallel for
+#pragma omp parallel
+#pragma omp single
+#endif
+    {
+        SetupTopLevelCells<D,C,SM>(_celldata, maxsizesq, 0, _celldata.size(), _mintop, _maxtop,
+                                   seed, top_data, top_sizesq, top_start, top_end);
+        const ptrdiff_t n = top_data.size();
+
+        // Now build the lower cells in parallel
+        dbg<<"Field has "<<n<<" top-level nodes.  Building lower nodes...\n";
+        _cells.resize(n);
+        _nodes.resize(n);
+        _nnodes.resize(n);
+        _nbytes.resize(n);
+        for(ptrdiff_t i=0;i<n;++i) {
+#ifdef _OPENMP
+#pragma omp task
 #endif
-    for(ptrdiff_t i=0;i<n;++i) {
-        _cells[i] = BuildCell<D,C,SM>(_celldata, minsizesq, _brute,
-                                      top_start[i], top_end[i],
-                                      top_data[i], top_sizesq[i]);
-        xdbg<<i<<": "<<_cells[i]->getN()<<"  "<<_cells[i]->getW()<<"  "<<
-            _cells[i]->getPos()<<"  "<<_cells[i]->getSize()<<"  "<<_cells[i]->getSizeSq()<<std::endl;
+            {
+                _cells[i] = BuildCell<D,C,SM>(_celldata, minsizesq, _brute,
+                                              top_start[i], top_end[i], seed,
+                                              top_data[i], top_sizesq[i]);
+                flattenCell(i);
+                xdbg<<i<<": "<<_cells[i]->getN()<<"  "<<_cells[i]->getW()<<"  "<<
+                    _cells[i]->getPos()<<"  "<<_cells[i]->getSize()<<"  "<<
+                    _cells[i]->getSizeSq()<<std::endl;
+            }
+        }
+        // The implicit barrier at the end of the parallel region waits for all the tasks.
     }
 
     // delete any CellData elements that didn't get kept in the _cells object.
     for (size_t i=0;i<_celldata.size();++i) if (_celldata[i].first) delete _celldata[i].first;
     //set_verbose(1);
     _celldata.clear();
+    _built.store(true, std::memory_order_release);
+}
+
+template <int D, int C>
+void Field<D,C>::flattenCell(long i) const
+{
+    CellNode<D,C>* nodes = FlattenCell(_cells[i], _nnodes[i], _nbytes[i]);
+    delete _cells[i];
+    _nodes[i] = nodes;
+    _cells[i] = &nodes[0].cell;
 }
 
 template <int D, int C>
 Field<D,C>::~Field()
 {
-    for (size_t i=0; i<_cells.size(); ++i) delete _cells[i];
+    if (_owns_nodes)
+        for (size_t i=0; i<_nodes.size(); ++i) DestroyCellNodes(_nodes[i]);
     // If this is still around, need to delete those too.
     for (size_t i=0; i<_celldata.size(); ++i) if (_celldata[i].first) delete _celldata[i].first;
 }
@@ -362,10 +432,9 @@ void GetNear(const Cell<D,C>* cell, const Position<C>& pos, double sep, double s
                 indices[k++] = cell->getInfo().index;
             } else {
                 dbg<<"N > 1 case: "<<n1<<std::endl;
-                std::vector<long>* leaf_indices = cell->getListInfo().indices;
-                Assert(long(leaf_indices->size()) == n1);
+                const long* leaf_indices = cell->getLeafIndices();
                 for (long m=0; m<n1; ++m)
-                    indices[k++] = (*leaf_indices)[m];
+                    indices[k++] = leaf_indices[m];
             }
             Assert(k <= n);
         } else {
@@ -403,6 +472,244 @@ void Field<D,C>::getNear(double x, double y, double z, double sep, long* indices
     }
 }
 
+// When writing a tree to a file, the block of CellNodes for each top-level cell (including
+// the indices of its leaves) is written as raw bytes, one block after the other.  The links
+// between the cells are offsets rather than pointers (cf. Cell in Cell.h), so the blocks can
+// be used directly from a memory map of the file.  blocksizes has the number of nodes and
+// the number of bytes of each block.  The center and sizesq of the field are written
+// separately.  Of course, the file can only be read back by a build of TreeCorr with the
+// same layout of a CellNode (cf. CellNodeSize).
+
+template <int C>
+struct PositionIO;
+
+template <>
+struct PositionIO<Flat>
+{
+    static void write(const Position<Flat>& pos, double* out)
+    { out[0] = pos.getX(); out[1] = pos.getY(); out[2] = 0.; }
+    static Position<Flat> read(const double* in)
+    { return Position<Flat>(in[0], in[1]); }
+};
+
+template <>
+struct PositionIO<ThreeD>
+{
+    static void write(const Position<ThreeD>& pos, double* out)
+    { out[0] = pos.getX(); out[1] = pos.getY(); out[2] = pos.getZ(); }
+    static Position<ThreeD> read(const double* in)
+    { return Position<ThreeD>(in[0], in[1], in[2]); }
+};
+
+template <>
+struct PositionIO<Sphere>
+{
+    static void write(const Position<Sphere>& pos, double* out)
+    { out[0] = pos.getX(); out[1] = pos.getY(); out[2] = pos.getZ(); }
+    static Position<Sphere> read(const double* in)
+    {
+        // Don't use the (x,y,z) constructor, since that renormalizes the position, which
+        // might change the last bits of the values.
+        Position<Sphere> pos;
+        pos += Position<ThreeD>(in[0], in[1], in[2]);
+        return pos;
+    }
+};
+
+template <int D, int C>
+void Field<D,C>::getTreeSize(long& ncells, long& nindices, long& nbytes) const
+{
+    BuildCells();  // Make sure this is done.
+    ncells = 0;
+    nindices = 0;
+    nbytes = 0;
+    for (size_t i=0; i<_nodes.size(); ++i) {
+        ncells += _nnodes[i];
+        nbytes += _nbytes[i];
+        for (long c=0; c<_nnodes[i]; ++c) {
+            const Cell<D,C>& cell = _nodes[i][c].cell;
+            if (!cell.getLeft() && cell.getN() > 1) nindices += cell.getN();
+        }
+    }
+}
+
+template <int D, int C>
+void Field<D,C>::writeTree(int64_t* blocksizes, char* blocks, double* center) const
+{
+    BuildCells();  // Make sure this is done.
+    for (size_t i=0; i<_nodes.size(); ++i) {
+        blocksizes[2*i] = _nnodes[i];
+        blocksizes[2*i+1] = _nbytes[i];
+        const char* block = reinterpret_cast<const char*>(_nodes[i]);
+        std::copy(block, block + _nbytes[i], blocks);
+        blocks += _nbytes[i];
+    }
+    PositionIO<C>::write(_center, center);
+    center[3] = _sizesq;
+}
+
+// The index of a cell within its block of CellNodes.
+template <int D, int C>
+inline long NodeIndex(const CellNode<D,C>* nodes, const Cell<D,C>* cell)
+{ return reinterpret_cast<const CellNode<D,C>*>(cell) - nodes; }
+
+// Calculate the values of the cells in a single block of n CellNodes.
+// The objects in the leaves under cell c are objs[start[c]:end[c]], and each object has
+// nv values in v.
+template <int D, int C>
+struct SumCellValueHelper
+{
+    // For kappa, and for shear in flat coordinates, the value of a cell is just the sum of
+    // the values of its two daughters.
+    static void calculate(const CellNode<D,C>* nodes, long n, const long* objs,
+                          const long* start, const long* end,
+                          const double* , const double* , const double* , const double* w,
+                          const double* v, int nv, double* values)
+    {
+        for (long c=n-1; c>=0; --c) {
+            const Cell<D,C>& cell = nodes[c].cell;
+            double* vc = values + c*nv;
+            if (cell.getLeft()) {
+                const double* vl = values + NodeIndex(nodes, cell.getLeft())*nv;
+                const double* vr = values + NodeIndex(nodes, cell.getRight())*nv;
+                for (int r=0; r<nv; ++r) vc[r] = vl[r] + vr[r];
+            } else {
+                for (int r=0; r<nv; ++r) vc[r] = 0.;
+                for (long q=start[c]; q<end[c]; ++q) {
+                    const long i = objs[q];
+                    const double* vi = v + i*nv;
+                    for (int r=0; r<nv; ++r) vc[r] += w[i] * vi[r];
+                }
+            }
+        }
+    }
+};
+
+// For shear on the sphere (or in 3D), each shear needs to be parallel transported to the
+// center of the cell, just as in CellData<GData,C>::finishAverages.
+template <int D, int C>
+struct TransportCellValueHelper
+{
+    static void calculate(const CellNode<D,C>* nodes, long n, const long* objs,
+                          const long* start, const long* end,
+                          const double* x, const double* y, const double* z, const double* w,
+                          const double* v, int nv, double* values)
+    {
+        const int nreal = nv/2;
+        for (long c=0; c<n; ++c) {
+            const Position<C>& center = nodes[c].cell.getPos();
+            std::complex<double>* vc = reinterpret_cast<std::complex<double>*>(values + c*nv);
+            for (int r=0; r<nreal; ++r) vc[r] = 0.;
+            for (long q=start[c]; q<end[c]; ++q) {
+                const long i = objs[q];
+                const std::complex<double>* vi =
+                    reinterpret_cast<const std::complex<double>*>(v + i*nv);
+                const std::complex<double> f =
+                    w[i] * ParallelTransportFactor(center, Position<C>(x[i],y[i],z[i]));
+                for (int r=0; r<nreal; ++r) vc[r] += f * vi[r];
+            }
+        }
+    }
+};
+
+template <int D, int C>
+struct CellValueHelper
+{
+    static void calculate(const CellNode<D,C>* nodes, long n, const long* objs,
+                          const long* start, const long* end,
+                          const double* x, const double* y, const double* z, const double* w,
+                          const double* v, int nv, bool shear, double* values)
+    {
+        if (shear)
+            TransportCellValueHelper<D,C>::calculate(nodes, n, objs, start, end,
+                                                     x, y, z, w, v, nv, values);
+        else
+            SumCellValueHelper<D,C>::calculate(nodes, n, objs, start, end,
+                                               x, y, z, w, v, nv, values);
+    }
+};
+
+template <int D>
+struct CellValueHelper<D,Flat>
+{
+    static void calculate(const CellNode<D,Flat>* nodes, long n, const long* objs,
+                          const long* start, const long* end,
+                          const double* x, const double* y, const double* z, const double* w,
+                          const double* v, int nv, bool , double* values)
+    {
+        SumCellValueHelper<D,Flat>::calculate(nodes, n, objs, start, end,
+                                              x, y, z, w, v, nv, values);
+    }
+};
+
+template <int D, int C>
+void Field<D,C>::getCellValues(const double* x, const double* y, const double* z,
+                               const double* w, const double* v, int nv, bool shear,
+                               double* values) const
+{
+    BuildCells();  // Make sure this is done.
+    const long ntop = _cells.size();
+    std::vector<long> offset(ntop+1, 0);
+    for (long i=0; i<ntop; ++i) offset[i+1] = offset[i] + _nnodes[i];
+
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic)
+#endif
+    for (long i=0; i<ntop; ++i) {
+        const CellNode<D,C>* nodes = _nodes[i];
+        const long n = _nnodes[i];
+
+        // The leaves are in depth-first order, so the objects under each cell form a
+        // contiguous range in the list of all the leaves' objects.
+        std::vector<long> objs;
+        std::vector<long> start(n), end(n);
+        for (long c=0; c<n; ++c) {
+            const Cell<D,C>& cell = nodes[c].cell;
+            start[c] = objs.size();
+            if (cell.getLeft()) continue;
+            if (cell.getN() == 1) {
+                objs.push_back(cell.getInfo().index);
+            } else {
+                const long* leaf_indices = cell.getLeafIndices();
+                objs.insert(objs.end(), leaf_indices, leaf_indices + cell.getN());
+            }
+            end[c] = objs.size();
+        }
+        // A cell's range ends where its right daughter's range does.
+        for (long c=n-1; c>=0; --c) {
+            const Cell<D,C>& cell = nodes[c].cell;
+            if (cell.getLeft()) end[c] = end[NodeIndex(nodes, cell.getRight())];
+        }
+        CellValueHelper<D,C>::calculate(nodes, n, &objs[0], &start[0], &end[0],
+                                        x, y, z, w, v, nv, shear, values + offset[i]*nv);
+    }
+}
+
+template <int D, int C>
+Field<D,C>::Field(char* blocks, const int64_t* blocksizes, long ntop, long nobj,
+                  const double* center, double minsize, double maxsize,
+                  SplitMethod sm, bool brute, int mintop, int maxtop) :
+    _nobj(nobj), _minsize(minsize), _maxsize(maxsize), _sm(sm),
+    _brute(brute), _mintop(mintop), _maxtop(maxtop), _owns_nodes(false), _built(true)
+{
+    dbg<<"Starting to Read Field with "<<ntop<<" top-level cells\n";
+    _center = PositionIO<C>::read(center);
+    _sizesq = center[3];
+
+    // The blocks are used in place, so there is nothing to build or copy.
+    _cells.resize(ntop);
+    _nodes.resize(ntop);
+    _nnodes.resize(ntop);
+    _nbytes.resize(ntop);
+    for(long i=0; i<ntop; ++i) {
+        _nodes[i] = reinterpret_cast<CellNode<D,C>*>(blocks);
+        _nnodes[i] = blocksizes[2*i];
+        _nbytes[i] = blocksizes[2*i+1];
+        _cells[i] = &_nodes[i][0].cell;
+        blocks += _nbytes[i];
+    }
+}
+
 template <int D, int C>
 SimpleField<D,C>::SimpleField(
     double* x, double* y, double* z, double* g1, double* g2, double* k,
@@ -648,6 +955,180 @@ void FieldGetNear(void* field, double x, double y, double z, double sep, int d,
     }
 }
 
+template <int D>
+void FieldGetTreeSize1(void* field, int coords, long* sizes)
+{
+    switch(coords) {
+      case Flat:
+           static_cast<Field<D,Flat>*>(field)->getTreeSize(sizes[0], sizes[1], sizes[2]);
+           break;
+      case Sphere:
+           static_cast<Field<D,Sphere>*>(field)->getTreeSize(sizes[0], sizes[1], sizes[2]);
+           break;
+      case ThreeD:
+           static_cast<Field<D,ThreeD>*>(field)->getTreeSize(sizes[0], sizes[1], sizes[2]);
+           break;
+    }
+}
+
+void FieldGetTreeSize(void* field, int d, int coords, long* sizes)
+{
+    switch(d) {
+      case NData:
+           FieldGetTreeSize1<NData>(field, coords, sizes);
+           break;
+      case KData:
+           FieldGetTreeSize1<KData>(field, coords, sizes);
+           break;
+      case GData:
+           FieldGetTreeSize1<GData>(field, coords, sizes);
+           break;
+    }
+}
+
+template <int D>
+void FieldWriteTree1(void* field, int coords, int64_t* blocksizes, char* blocks, double* center)
+{
+    switch(coords) {
+      case Flat:
+           static_cast<Field<D,Flat>*>(field)->writeTree(blocksizes, blocks, center);
+           break;
+      case Sphere:
+           static_cast<Field<D,Sphere>*>(field)->writeTree(blocksizes, blocks, center);
+           break;
+      case ThreeD:
+           static_cast<Field<D,ThreeD>*>(field)->writeTree(blocksizes, blocks, center);
+           break;
+    }
+}
+
+void FieldWriteTree(void* field, int d, int coords,
+                    int64_t* blocksizes, char* blocks, double* center)
+{
+    switch(d) {
+      case NData:
+           FieldWriteTree1<NData>(field, coords, blocksizes, blocks, center);
+           break;
+      case KData:
+           FieldWriteTree1<KData>(field, coords, blocksizes, blocks, center);
+           break;
+      case GData:
+           FieldWriteTree1<GData>(field, coords, blocksizes, blocks, center);
+           break;
+    }
+}
+
+template <int D>
+void FieldGetCellValues1(void* field, int coords, double* x, double* y, double* z, double* w,
+                         double* v, int nv, int shear, double* values)
+{
+    switch(coords) {
+      case Flat:
+           static_cast<Field<D,Flat>*>(field)->getCellValues(x,y,z,w,v,nv,shear,values);
+           break;
+      case Sphere:
+           static_cast<Field<D,Sphere>*>(field)->getCellValues(x,y,z,w,v,nv,shear,values);
+           break;
+      case ThreeD:
+           static_cast<Field<D,ThreeD>*>(field)->getCellValues(x,y,z,w,v,nv,shear,values);
+           break;
+    }
+}
+
+void FieldGetCellValues(void* field, int d, int coords,
+                        double* x, double* y, double* z, double* w,
+                        double* v, int nv, int shear, double* values)
+{
+    switch(d) {
+      case NData:
+           FieldGetCellValues1<NData>(field, coords, x, y, z, w, v, nv, shear, values);
+           break;
+      case KData:
+           FieldGetCellValues1<KData>(field, coords, x, y, z, w, v, nv, shear, values);
+           break;
+      case GData:
+           FieldGetCellValues1<GData>(field, coords, x, y, z, w, v, nv, shear, values);
+           break;
+    }
+}
+
+template <int D>
+void* ReadField1(char* blocks, int64_t* blocksizes, long ntop, long nobj, double* center,
+                 double minsize, double maxsize,
+                 int sm_int, int brute, int mintop, int maxtop, int coords)
+{
+    dbg<<"Start ReadField "<<D<<"  "<<coords<<std::endl;
+    void* field=0;
+    SplitMethod sm = static_cast<SplitMethod>(sm_int);
+    switch(coords) {
+      case Flat:
+           field = static_cast<void*>(new Field<D,Flat>(blocks, blocksizes,
+                                                        ntop, nobj, center,
+                                                        minsize, maxsize,
+                                                        sm, bool(brute), mintop, maxtop));
+           break;
+      case Sphere:
+           field = static_cast<void*>(new Field<D,Sphere>(blocks, blocksizes,
+                                                          ntop, nobj, center,
+                                                          minsize, maxsize,
+                                                          sm, bool(brute), mintop, maxtop));
+           break;
+      case ThreeD:
+           field = static_cast<void*>(new Field<D,ThreeD>(blocks, blocksizes,
+                                                          ntop, nobj, center,
+                                                          minsize, maxsize,
+                                                          sm, bool(brute), mintop, maxtop));
+           break;
+    }
+    xdbg<<"field = "<<field<<std::endl;
+    return field;
+}
+
+void* ReadField(char* blocks, int64_t* blocksizes, long ntop, long nobj, double* center,
+                double minsize, double maxsize,
+                int sm_int, int brute, int mintop, int maxtop, int d, int coords)
+{
+    switch(d) {
+      case NData:
+           return ReadField1<NData>(blocks, blocksizes, ntop, nobj, center,
+                                    minsize, maxsize, sm_int, brute, mintop, maxtop, coords);
+      case KData:
+           return ReadField1<KData>(blocks, blocksizes, ntop, nobj, center,
+                                    minsize, maxsize, sm_int, brute, mintop, maxtop, coords);
+      case GData:
+           return ReadField1<GData>(blocks, blocksizes, ntop, nobj, center,
+                                    minsize, maxsize, sm_int, brute, mintop, maxtop, coords);
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
+template <int D>
+long CellNodeSize1(int coords)
+{
+    switch(coords) {
+      case Flat:
+           return sizeof(CellNode<D,Flat>);
+      case Sphere:
+           return sizeof(CellNode<D,Sphere>);
+      case ThreeD:
+           return sizeof(CellNode<D,ThreeD>);
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
+long CellNodeSize(int d, int coords)
+{
+    switch(d) {
+      case NData:
+           return CellNodeSize1<NData>(coords);
+      case KData:
+           return CellNodeSize1<KData>(coords);
+      case GData:
+           return CellNodeSize1<GData>(coords);
+    }
+    return 0;  // Can't get here, but saves a compiler warning
+}
+
 template <int D>
 void* BuildSimpleField(double* x, double* y, double* z, double* g1, double* g2, double* k,
                        double* w, double* wpos, long nobj, int coords)
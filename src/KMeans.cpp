@@ -487,10 +487,10 @@ struct AssignPatches
             inertia[patch_num] += (cell->getPos() - centers[patch_num]).normSq() * cell->getW();
 #endif
         } else {
-            std::vector<long>* indices = cell->getListInfo().indices;
-            xdbg<<"Leaf with N>1.  "<<indices->size()<<" indices\n";
-            for (size_t j=0; j<indices->size(); ++j) {
-                long index = (*indices)[j];
+            const long* indices = cell->getLeafIndices();
+            xdbg<<"Leaf with N>1.  "<<cell->getN()<<" indices\n";
+            for (long j=0; j<cell->getN(); ++j) {
+                long index = indices[j];
                 xdbg<<"    index = "<<index<<std::endl;
                 Assert(index < n);
                 patches[index] = patch_num;
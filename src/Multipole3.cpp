@@ -0,0 +1,600 @@
+/* Copyright (c) 2003-2019 by Mike Jarvis
+ *
+ * TreeCorr is free software: redistribution and use in source and binary forms,
+ * with or without modification, are permitted provided that the following
+ * conditions are met:
+ *
+ * 1. Redistributions of source code must retain the above copyright notice, this
+ *    list of conditions, and the disclaimer given in the accompanying LICENSE
+ *    file.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions, and the disclaimer given in the documentation
+ *    and/or other materials provided with the distribution.
+ */
+
+//#define DEBUGLOGGING
+
+#include <vector>
+#include <complex>
+#include <algorithm>
+#include <cmath>
+
+#include "dbg.h"
+#include "Cell.h"
+#include "Field.h"
+#include "ThreadReduce.h"
+
+#ifdef _OPENMP
+#include "omp.h"
+#endif
+
+// This file implements the multipole algorithm for three-point auto-correlations.
+//
+// Rather than finding each triangle, we use every point in turn as vertex 1 of the triangles
+// (the vertex between sides d2 and d3).  For each such center, we accumulate the Fourier
+// components in the position angle phi of its neighbors in each of a set of fine radial bins:
+//
+//     G_m(b) = Sum_j w_j x_j exp(-i m phi_j)
+//
+// where x_j is 1, kappa or gamma, depending on the kind of data.  The products of these for
+// pairs of radial bins, summed over the centers, are the Fourier components of the distribution
+// of triangles with respect to the opening angle between the sides d2 and d3:
+//
+//     Z_n(b2,b3) = Sum_i w_i x_i G_{-n}(b2) G_{n+q}(b3)
+//
+// where point 3 (at distance d2) is in bin b2 and point 2 (at distance d3) is in bin b3.
+// For shear, q accounts for the rotation of the shears to a frame where point 2 is along
+// the x axis.  The python layer converts these to the usual r,u,v binning.
+//
+// When b2 == b3, the product would include each pair twice, once in each order, as well as
+// the terms with j == k.  So for these, we instead sort the neighbors in the bin by distance
+// and accumulate the products of each one with the running sum of the closer ones.
+// Then every pair is counted once with d3 <= d2, which keeps the orientation of the
+// triangles straight even when d2 and d3 are nearly equal.
+//
+// The cost of this is O(Ncen (Nneighbor nmax + nbins^2 nmax)), rather than the
+// O(Ncen Nneighbor^2) of finding all the triangles.
+
+// The local frame around each center.
+template <int C>
+struct MultipoleFrame;
+
+template <>
+struct MultipoleFrame<Flat>
+{
+    MultipoleFrame(const Position<Flat>& cen) : _cen(cen) {}
+
+    // Return the distance from the center to pos, and set x,y to the offset of pos in the frame.
+    double offset(const Position<Flat>& pos, double& x, double& y) const
+    {
+        x = pos.getX() - _cen.getX();
+        y = pos.getY() - _cen.getY();
+        return sqrt(x*x + y*y);
+    }
+
+    // The factor by which to multiply a shear at pos to put it in the frame of the center.
+    std::complex<double> transport(const Position<Flat>& ) const { return 1.; }
+
+    const Position<Flat>& _cen;
+};
+
+template <>
+struct MultipoleFrame<Sphere>
+{
+    // For spherical coordinates, we use the tangent plane at the center with x pointing west
+    // and y pointing north.  This matches the orientation used by the CCW function in Metric.h
+    // and the convention for the shear projections in ProjectHelper.h.
+    MultipoleFrame(const Position<Sphere>& cen) : _cen(cen)
+    {
+        double x = cen.getX();
+        double y = cen.getY();
+        double z = cen.getZ();
+        double rxy = sqrt(x*x + y*y);
+        // East = (-y,x,0)/rxy.  At the poles, any direction will do.
+        if (rxy > 0.) {
+            _ex = -y/rxy;
+            _ey = x/rxy;
+        } else {
+            _ex = 0.;
+            _ey = 1.;
+        }
+        // North = cen x East
+        _nx = -z*_ey;
+        _ny = z*_ex;
+        _nz = x*_ey - y*_ex;
+    }
+
+    double offset(const Position<Sphere>& pos, double& x, double& y) const
+    {
+        double dx = pos.getX() - _cen.getX();
+        double dy = pos.getY() - _cen.getY();
+        double dz = pos.getZ() - _cen.getZ();
+        x = -(dx*_ex + dy*_ey);
+        y = dx*_nx + dy*_ny + dz*_nz;
+        return sqrt(dx*dx + dy*dy + dz*dz);
+    }
+
+    std::complex<double> transport(const Position<Sphere>& pos) const
+    { return ParallelTransportFactor(_cen, pos); }
+
+    const Position<Sphere>& _cen;
+    double _ex, _ey, _nx, _ny, _nz;
+};
+
+// The differences between the kinds of data.
+// nval is the number of values accumulated for each neighbor: w, n, and w*k or w*g.
+// nzeta is the number of outputs.  For N and K, these are weight, ntri, and zeta.
+// For G, they are weight, ntri, gam0, gam1, gam2, gam3.
+// mlo, mhi give the range of m for G_m, and nlo the lowest n for Z_n.  For N and K, Z_{-n}
+// is the conjugate of Z_n, so only n >= 0 are computed.  The highest n is always maxn.
+template <int D>
+struct MultipoleData;
+
+template <>
+struct MultipoleData<NData>
+{
+    enum { nval=2, nzeta=2 };
+    static int mlo(int ) { return 0; }
+    static int mhi(int maxn) { return maxn; }
+    static int nlo(int ) { return 0; }
+
+    template <int C>
+    static void getValues(const Cell<NData,C>& c, const MultipoleFrame<C>& ,
+                          std::complex<double>* v)
+    {
+        v[0] = c.getW();
+        v[1] = double(c.getN());
+    }
+
+    static void addZeta(const std::complex<double>* cen, std::complex<double>** g2,
+                        std::complex<double>** g3, std::complex<double>** z, int maxn)
+    {
+        for (int q=0; q<nval; ++q)
+            for (int n=0; n<=maxn; ++n)
+                z[q][n] += cen[q] * std::conj(g2[q][n]) * g3[q][n];
+    }
+};
+
+template <>
+struct MultipoleData<KData>
+{
+    enum { nval=3, nzeta=3 };
+    static int mlo(int ) { return 0; }
+    static int mhi(int maxn) { return maxn; }
+    static int nlo(int ) { return 0; }
+
+    template <int C>
+    static void getValues(const Cell<KData,C>& c, const MultipoleFrame<C>& ,
+                          std::complex<double>* v)
+    {
+        v[0] = c.getW();
+        v[1] = double(c.getN());
+        v[2] = c.getData().getWK();
+    }
+
+    static void addZeta(const std::complex<double>* cen, std::complex<double>** g2,
+                        std::complex<double>** g3, std::complex<double>** z, int maxn)
+    {
+        for (int q=0; q<nval; ++q)
+            for (int n=0; n<=maxn; ++n)
+                z[q][n] += cen[q] * std::conj(g2[q][n]) * g3[q][n];
+    }
+};
+
+template <>
+struct MultipoleData<GData>
+{
+    enum { nval=3, nzeta=6 };
+    // gam0 needs G_m for m = n+6, and gam2 needs m = -n-2.
+    static int mlo(int maxn) { return -maxn-2; }
+    static int mhi(int maxn) { return maxn+6; }
+    static int nlo(int maxn) { return -maxn; }
+
+    template <int C>
+    static void getValues(const Cell<GData,C>& c, const MultipoleFrame<C>& frame,
+                          std::complex<double>* v)
+    {
+        v[0] = c.getW();
+        v[1] = double(c.getN());
+        v[2] = c.getData().getWG() * frame.transport(c.getPos());
+    }
+
+    // Here g2 and g3 point to the m=0 element, so negative m are valid indices.
+    // Likewise z points to the n=0 element.
+    static void addZeta(const std::complex<double>* cen, std::complex<double>** g2,
+                        std::complex<double>** g3, std::complex<double>** z, int maxn)
+    {
+        for (int q=0; q<2; ++q)
+            for (int n=-maxn; n<=maxn; ++n)
+                z[q][n] += cen[q] * std::conj(g2[q][n]) * g3[q][n];
+
+        const std::complex<double> cg = cen[2];
+        const std::complex<double> cgc = std::conj(cen[2]);
+        const std::complex<double>* gg2 = g2[2];
+        const std::complex<double>* gg3 = g3[2];
+        for (int n=-maxn; n<=maxn; ++n) {
+            // gam0 = g1 g2 g3
+            z[2][n] += cg * gg2[-n] * gg3[n+6];
+            // gam1 = g1* g2 g3
+            z[3][n] += cgc * gg2[-n] * gg3[n+2];
+            // gam2 = g1 g2* g3
+            z[4][n] += cg * gg2[-n] * std::conj(gg3[-n-2]);
+            // gam3 = g1 g2 g3*
+            z[5][n] += cg * std::conj(gg2[n]) * gg3[n+2];
+        }
+    }
+};
+
+template <int D>
+class MultipoleCorr3
+{
+public:
+
+    MultipoleCorr3(const double* redges, int nr, int k2min, int maxn, double b,
+                   std::complex<double>* zeta, double* sumw, double* sumwr, double* sumwlogr) :
+        _redges(redges), _nr(nr), _k2min(k2min), _maxn(maxn), _b(b), _owns_data(false),
+        _zeta(zeta), _sumw(sumw), _sumwr(sumwr), _sumwlogr(sumwlogr)
+    {
+        _mlo = MultipoleData<D>::mlo(maxn);
+        _nm = MultipoleData<D>::mhi(maxn) - _mlo + 1;
+        _nlo = MultipoleData<D>::nlo(maxn);
+        _nn = maxn - _nlo + 1;
+        _nzeta1 = long(_nr - _k2min) * _nr * _nn;
+        _ntot = MultipoleData<D>::nzeta * _nzeta1;
+    }
+
+    MultipoleCorr3(const MultipoleCorr3<D>& rhs, bool copy_data) :
+        _redges(rhs._redges), _nr(rhs._nr), _k2min(rhs._k2min), _maxn(rhs._maxn), _b(rhs._b),
+        _mlo(rhs._mlo), _nm(rhs._nm), _nlo(rhs._nlo), _nn(rhs._nn),
+        _nzeta1(rhs._nzeta1), _ntot(rhs._ntot), _owns_data(true)
+    {
+        _zeta = new std::complex<double>[_ntot];
+        _sumw = new double[_nr];
+        _sumwr = new double[_nr];
+        _sumwlogr = new double[_nr];
+        if (copy_data) *this = rhs;
+        else clear();
+    }
+
+    ~MultipoleCorr3()
+    {
+        if (_owns_data) {
+            delete [] _zeta;
+            delete [] _sumw;
+            delete [] _sumwr;
+            delete [] _sumwlogr;
+        }
+    }
+
+    void clear()
+    {
+        for (long i=0; i<_ntot; ++i) _zeta[i] = 0.;
+        for (int k=0; k<_nr; ++k) _sumw[k] = 0.;
+        for (int k=0; k<_nr; ++k) _sumwr[k] = 0.;
+        for (int k=0; k<_nr; ++k) _sumwlogr[k] = 0.;
+    }
+
+    void operator=(const MultipoleCorr3<D>& rhs)
+    {
+        Assert(rhs._ntot == _ntot);
+        for (long i=0; i<_ntot; ++i) _zeta[i] = rhs._zeta[i];
+        for (int k=0; k<_nr; ++k) _sumw[k] = rhs._sumw[k];
+        for (int k=0; k<_nr; ++k) _sumwr[k] = rhs._sumwr[k];
+        for (int k=0; k<_nr; ++k) _sumwlogr[k] = rhs._sumwlogr[k];
+    }
+
+    void operator+=(const MultipoleCorr3<D>& rhs)
+    {
+        Assert(rhs._ntot == _ntot);
+        for (long i=0; i<_ntot; ++i) _zeta[i] += rhs._zeta[i];
+        for (int k=0; k<_nr; ++k) _sumw[k] += rhs._sumw[k];
+        for (int k=0; k<_nr; ++k) _sumwr[k] += rhs._sumwr[k];
+        for (int k=0; k<_nr; ++k) _sumwlogr[k] += rhs._sumwlogr[k];
+    }
+
+    template <int C>
+    void process(const Field<D,C>& field, bool dots);
+
+protected:
+
+    // A neighbor in one of the bins b >= k2min, which we need to keep for the b2 == b3 terms.
+    struct Neighbor
+    {
+        double r;
+        std::complex<double> expmiphi;
+        std::complex<double> v[MultipoleData<D>::nval];
+        bool operator<(const Neighbor& rhs) const { return r < rhs.r; }
+    };
+
+    // The per-center work space.  Only the bins that have any neighbors are touched, and
+    // only those are reset after each center.
+    struct Work
+    {
+        Work(int nr, int nm) :
+            g(MultipoleData<D>::nval * nr * nm), gj(MultipoleData<D>::nval * nm),
+            cum(MultipoleData<D>::nval * nm), nbrs(nr),
+            sw(nr), swr(nr), swlogr(nr), touched(nr, false)
+        { bins.reserve(nr); }
+
+        std::vector<std::complex<double> > g;
+        std::vector<std::complex<double> > gj;
+        std::vector<std::complex<double> > cum;
+        std::vector<std::vector<Neighbor> > nbrs;
+        std::vector<double> sw;
+        std::vector<double> swr;
+        std::vector<double> swlogr;
+        std::vector<bool> touched;
+        std::vector<int> bins;
+    };
+
+    // Set g[q*nm + m] = v[q] exp(-i (m+mlo) phi)
+    void calculateG(const std::complex<double>* v, const std::complex<double>& expmiphi,
+                    std::complex<double>* g, long gstep);
+
+    template <int C>
+    void processCenter(const Cell<D,C>& c1, const std::vector<Cell<D,C>*>& top, Work& work);
+
+    template <int C>
+    void collect(const Cell<D,C>* c, const MultipoleFrame<C>& frame, Work& work);
+
+    const double* _redges;
+    int _nr;
+    int _k2min;
+    int _maxn;
+    double _b;
+    int _mlo;
+    int _nm;
+    int _nlo;
+    int _nn;
+    long _nzeta1;
+    long _ntot;
+    bool _owns_data;
+
+    // zeta has shape (nzeta, nr-k2min, nr, nn).  The others have shape (nr).
+    std::complex<double>* _zeta;
+    double* _sumw;
+    double* _sumwr;
+    double* _sumwlogr;
+};
+
+template <int D, int C>
+void GetLeaves(const Cell<D,C>* c, std::vector<const Cell<D,C>*>& leaves)
+{
+    if (c->getLeft()) {
+        GetLeaves(c->getLeft(), leaves);
+        GetLeaves(c->getRight(), leaves);
+    } else {
+        leaves.push_back(c);
+    }
+}
+
+template <int D> template <int C>
+void MultipoleCorr3<D>::process(const Field<D,C>& field, bool dots)
+{
+    const std::vector<Cell<D,C>*>& top = field.getCells();
+    const long n1 = top.size();
+    dbg<<"Start multipole process with "<<n1<<" top level cells\n";
+
+#ifdef _OPENMP
+    std::vector<MultipoleCorr3<D>*> copies(omp_get_max_threads());
+#pragma omp parallel
+    {
+        // Give each thread their own copy of the data vector to fill in.
+        MultipoleCorr3<D> mp(*this,false);
+#else
+        MultipoleCorr3<D>& mp = *this;
+#endif
+        Work work(_nr, _nm);
+        std::vector<const Cell<D,C>*> leaves;
+
+#ifdef _OPENMP
+#pragma omp for schedule(dynamic)
+#endif
+        for (long i=0;i<n1;++i) {
+            if (dots) std::cout<<'.'<<std::flush;
+            leaves.clear();
+            GetLeaves(top[i], leaves);
+            for (size_t k=0; k<leaves.size(); ++k) {
+                mp.processCenter(*leaves[k], top, work);
+            }
+        }
+#ifdef _OPENMP
+        // Accumulate the results
+        ThreadReduce(*this, mp, copies);
+    }
+#endif
+    if (dots) std::cout<<std::endl;
+}
+
+template <int D>
+void MultipoleCorr3<D>::calculateG(const std::complex<double>* v,
+                                   const std::complex<double>& expmiphi,
+                                   std::complex<double>* g, long gstep)
+{
+    // exp(-i mlo phi)
+    std::complex<double> pw = 1.;
+    const std::complex<double> step = _mlo < 0 ? std::conj(expmiphi) : expmiphi;
+    for (int m=0; m<std::abs(_mlo); ++m) pw *= step;
+
+    for (int m=0; m<_nm; ++m) {
+        for (int q=0; q<MultipoleData<D>::nval; ++q) g[q*gstep + m] = v[q] * pw;
+        pw *= expmiphi;
+    }
+}
+
+template <int D> template <int C>
+void MultipoleCorr3<D>::collect(const Cell<D,C>* c, const MultipoleFrame<C>& frame, Work& work)
+{
+    double x, y;
+    const double r = frame.offset(c->getPos(), x, y);
+    const double s = c->getSize();
+    if (r + s < _redges[0] || r - s >= _redges[_nr]) return;
+    if (c->getLeft() && s > _b * r) {
+        collect(c->getLeft(), frame, work);
+        collect(c->getRight(), frame, work);
+        return;
+    }
+    if (r < _redges[0] || r >= _redges[_nr]) return;
+    const double rt = sqrt(x*x + y*y);
+    if (rt == 0.) return;  // This is the center itself (or a duplicate of it).
+
+    const int k = int(std::upper_bound(_redges, _redges+_nr+1, r) - _redges) - 1;
+    Assert(k >= 0 && k < _nr);
+    const std::complex<double> expmiphi(x/rt, -y/rt);
+
+    std::complex<double> v[MultipoleData<D>::nval];
+    MultipoleData<D>::getValues(*c, frame, v);
+
+    std::complex<double>* gj = &work.gj[0];
+    calculateG(v, expmiphi, gj, _nm);
+    std::complex<double>* g = &work.g[long(k) * _nm];
+    const long gstep = long(_nr) * _nm;
+    for (int q=0; q<MultipoleData<D>::nval; ++q)
+        for (int m=0; m<_nm; ++m) g[q*gstep + m] += gj[q*_nm + m];
+
+    if (k >= _k2min) {
+        Neighbor nbr;
+        nbr.r = r;
+        nbr.expmiphi = expmiphi;
+        for (int q=0; q<MultipoleData<D>::nval; ++q) nbr.v[q] = v[q];
+        work.nbrs[k].push_back(nbr);
+    }
+
+    const double w = c->getW();
+    work.sw[k] += w;
+    work.swr[k] += w * r;
+    work.swlogr[k] += w * log(r);
+    if (!work.touched[k]) {
+        work.touched[k] = true;
+        work.bins.push_back(k);
+    }
+}
+
+template <int D> template <int C>
+void MultipoleCorr3<D>::processCenter(const Cell<D,C>& c1, const std::vector<Cell<D,C>*>& top,
+                                      Work& work)
+{
+    MultipoleFrame<C> frame(c1.getPos());
+    for (size_t i=0; i<top.size(); ++i) collect(top[i], frame, work);
+    if (work.bins.empty()) return;
+    std::sort(work.bins.begin(), work.bins.end());
+
+    // The values for the center.  No need to transport these.
+    std::complex<double> cen[MultipoleData<D>::nval];
+    MultipoleData<D>::getValues(c1, frame, cen);
+
+    const int nval = MultipoleData<D>::nval;
+    const int nzeta = MultipoleData<D>::nzeta;
+    const long gstep = long(_nr) * _nm;
+    std::complex<double>* g2[nval];
+    std::complex<double>* g3[nval];
+    std::complex<double>* z[nzeta];
+
+    const int nb = work.bins.size();
+    for (int i2=0; i2<nb; ++i2) {
+        const int b2 = work.bins[i2];
+        if (b2 < _k2min) continue;
+        for (int q=0; q<nval; ++q) g2[q] = &work.g[q*gstep + long(b2)*_nm - _mlo];
+        for (int i3=0; i3<i2; ++i3) {
+            const int b3 = work.bins[i3];
+            for (int q=0; q<nval; ++q) g3[q] = &work.g[q*gstep + long(b3)*_nm - _mlo];
+            for (int q=0; q<nzeta; ++q)
+                z[q] = &_zeta[q*_nzeta1 + (long(b2-_k2min)*_nr + b3)*_nn - _nlo];
+            MultipoleData<D>::addZeta(cen, g2, g3, z, _maxn);
+        }
+
+        // For b3 == b2, pair each neighbor with the running sum of the closer ones.
+        for (int q=0; q<nzeta; ++q)
+            z[q] = &_zeta[q*_nzeta1 + (long(b2-_k2min)*_nr + b2)*_nn - _nlo];
+        for (int q=0; q<nval; ++q) g2[q] = &work.gj[q*_nm - _mlo];
+        for (int q=0; q<nval; ++q) g3[q] = &work.cum[q*_nm - _mlo];
+        std::vector<Neighbor>& nbrs = work.nbrs[b2];
+        std::sort(nbrs.begin(), nbrs.end());
+        std::fill(work.cum.begin(), work.cum.end(), 0.);
+        for (size_t j=0; j<nbrs.size(); ++j) {
+            calculateG(nbrs[j].v, nbrs[j].expmiphi, &work.gj[0], _nm);
+            if (j > 0) MultipoleData<D>::addZeta(cen, g2, g3, z, _maxn);
+            for (int m=0; m<nval*_nm; ++m) work.cum[m] += work.gj[m];
+        }
+        nbrs.clear();
+    }
+
+    const double w1 = c1.getW();
+    for (int i=0; i<nb; ++i) {
+        const int k = work.bins[i];
+        _sumw[k] += w1 * work.sw[k];
+        _sumwr[k] += w1 * work.swr[k];
+        _sumwlogr[k] += w1 * work.swlogr[k];
+
+        // Reset the work space for the next center.
+        for (int q=0; q<nval; ++q)
+            for (int m=0; m<_nm; ++m) work.g[q*gstep + long(k)*_nm + m] = 0.;
+        work.nbrs[k].clear();
+        work.sw[k] = work.swr[k] = work.swlogr[k] = 0.;
+        work.touched[k] = false;
+    }
+    work.bins.clear();
+}
+
+//
+//
+// The C interface for python
+//
+//
+
+extern "C" {
+#include "BinnedCorr3_C.h"
+}
+
+template <int D, int C>
+void ProcessMultipole3c(void* field, int dots, double* redges, int nr, int k2min, int maxn,
+                        double b, double* zeta, double* sumw, double* sumwr, double* sumwlogr)
+{
+    MultipoleCorr3<D> corr(redges, nr, k2min, maxn, b,
+                           reinterpret_cast<std::complex<double>*>(zeta),
+                           sumw, sumwr, sumwlogr);
+    corr.process(*static_cast<Field<D,C>*>(field), dots);
+}
+
+template <int D>
+void ProcessMultipole3d(void* field, int dots, int coords, double* redges, int nr, int k2min,
+                        int maxn, double b, double* zeta,
+                        double* sumw, double* sumwr, double* sumwlogr)
+{
+    switch(coords) {
+      case Flat:
+           ProcessMultipole3c<D,Flat>(field, dots, redges, nr, k2min, maxn, b,
+                                      zeta, sumw, sumwr, sumwlogr);
+           break;
+      case Sphere:
+           ProcessMultipole3c<D,Sphere>(field, dots, redges, nr, k2min, maxn, b,
+                                        zeta, sumw, sumwr, sumwlogr);
+           break;
+      default:
+           Assert(false);
+    }
+}
+
+void ProcessMultipole3(void* field, int dots, int d, int coords,
+                       double* redges, int nr, int k2min, int maxn, double b,
+                       double* zeta, double* sumw, double* sumwr, double* sumwlogr)
+{
+    dbg<<"Start ProcessMultipole3 "<<d<<" "<<coords<<" "<<nr<<" "<<maxn<<std::endl;
+
+    switch(d) {
+      case NData:
+           ProcessMultipole3d<NData>(field, dots, coords, redges, nr, k2min, maxn, b,
+                                     zeta, sumw, sumwr, sumwlogr);
+           break;
+      case KData:
+           ProcessMultipole3d<KData>(field, dots, coords, redges, nr, k2min, maxn, b,
+                                     zeta, sumw, sumwr, sumwlogr);
+           break;
+      case GData:
+           ProcessMultipole3d<GData>(field, dots, coords, redges, nr, k2min, maxn, b,
+                                     zeta, sumw, sumwr, sumwlogr);
+           break;
+      default:
+           Assert(false);
+    }
+}
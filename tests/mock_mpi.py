@@ -75,8 +75,15 @@ class MockComm(object):
         else:
             self.msg = msg
 
+    # mpi4py has this as MPI.ANY_SOURCE.  Put it here, since we don't have an MPI module.
+    ANY_SOURCE = -1
+
     def recv(self, source):
-        if source != self.rank:
+        if source == self.ANY_SOURCE:
+            from multiprocessing.connection import wait
+            # Just take the first one that is ready.
+            msg = wait(list(self.pipes.values()))[0].recv()
+        elif source != self.rank:
             msg = self.pipes[source].recv()
         else:
             msg = self.msg
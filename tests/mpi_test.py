@@ -172,6 +172,109 @@ def do_mpi_corr2(comm, Correlation, attr, output=True):
         for a in attr:
             np.testing.assert_allclose(getattr(corr0,a), getattr(corr1,a))
 
+def do_mpi_dynamic(comm, output=True):
+    # Test the master/worker mpi_mode.  This doesn't need the Aardvark file, so just make
+    # a random catalog that is the same on all processes.
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    if rank == 0 and output:
+        print('Start do_mpi_dynamic',flush=True)
+
+    rng = np.random.RandomState(8675309)
+    ngal = 5000
+    x = rng.exponential(10, (ngal,) )
+    y = rng.uniform(-20,20, (ngal,) )
+    g1 = rng.normal(0,0.2, (ngal,) )
+    g2 = rng.normal(0,0.2, (ngal,) )
+    k = rng.normal(0,1, (ngal,) )
+    xr = rng.uniform(0,50, (2*ngal,) )
+    yr = rng.uniform(-20,20, (2*ngal,) )
+    # Use the same patches on all processes.
+    cen = rng.uniform(-10,30, (8,2))
+    cat = treecorr.Catalog(x=x, y=y, g1=g1, g2=g2, k=k, patch_centers=cen)
+    rcat = treecorr.Catalog(x=xr, y=yr, patch_centers=cen)
+
+    for Correlation, attr, cats in [
+            (treecorr.GGCorrelation, ['xip', 'xim', 'npairs'], [cat]),
+            (treecorr.NKCorrelation, ['xi', 'npairs'], [rcat, cat]),
+            (treecorr.NNCorrelation, ['npairs', 'tot'], [cat, rcat]) ]:
+        if rank == 0:
+            corr0 = Correlation(bin_size=0.3, min_sep=1., max_sep=10.)
+            corr0.process(*cats)
+        for schedule in ['index', 'cost']:
+            corr1 = Correlation(bin_size=0.3, min_sep=1., max_sep=10., mpi_mode='dynamic',
+                                patch_schedule=schedule)
+            corr1.process(*cats, comm=comm)
+            if rank == 0:
+                if output:
+                    print(Correlation.__name__, schedule, attr[0], getattr(corr1,attr[0]),
+                          flush=True)
+                for a in attr:
+                    np.testing.assert_allclose(getattr(corr0,a), getattr(corr1,a))
+                assert sorted(corr0.results.keys()) == sorted(corr1.results.keys())
+                if Correlation is not treecorr.NNCorrelation:
+                    np.testing.assert_allclose(corr1.estimate_cov('jackknife'),
+                                               corr0.estimate_cov('jackknife'))
+        comm.Barrier()
+
+        # With a checkpoint, a second run can resume from the completed results.
+        # In dynamic mode, only rank 0 writes the checkpoint.  In static mode, each rank
+        # writes its own file.
+        for mode in ['dynamic', 'static']:
+            ckpt_file = os.path.join('output','mpi_checkpoint_%d_%s.pkl'%(size,mode))
+            corr1 = Correlation(bin_size=0.3, min_sep=1., max_sep=10., mpi_mode=mode,
+                                checkpoint=ckpt_file)
+            corr1.process(*cats, comm=comm)
+            corr2 = Correlation(bin_size=0.3, min_sep=1., max_sep=10., mpi_mode=mode,
+                                checkpoint=ckpt_file, resume=True)
+            corr2._process_patch_pair = None  # Would fail if called.
+            corr2.process(*cats, comm=comm)
+            if rank == 0:
+                for a in attr:
+                    np.testing.assert_allclose(getattr(corr0,a), getattr(corr2,a))
+                assert sorted(corr0.results.keys()) == sorted(corr2.results.keys())
+            comm.Barrier()
+
+def do_mpi_3pt(comm, output=True):
+    # Test the 3-point correlations with MPI.  Like do_mpi_dynamic, this uses a random
+    # catalog that is the same on all processes.
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    if rank == 0 and output:
+        print('Start do_mpi_3pt',flush=True)
+
+    rng = np.random.RandomState(8675309)
+    ngal = 1000
+    x = rng.uniform(-30,30, (ngal,) )
+    y = rng.uniform(-30,30, (ngal,) )
+    g1 = rng.normal(0,0.2, (ngal,) )
+    g2 = rng.normal(0,0.2, (ngal,) )
+    k = rng.normal(0,1, (ngal,) )
+    cen = rng.uniform(-30,30, (8,2))
+    cat = treecorr.Catalog(x=x, y=y, g1=g1, g2=g2, k=k, patch_centers=cen)
+    kwargs = dict(min_sep=2., max_sep=8., nbins=3, nubins=2, nvbins=2)
+
+    for Correlation, attr in [
+            (treecorr.KKKCorrelation, ['zeta', 'ntri', 'meand1']),
+            (treecorr.GGGCorrelation, ['gam0', 'gam1', 'gam2', 'gam3', 'ntri']),
+            (treecorr.NNNCorrelation, ['weight', 'tot', 'meanu']) ]:
+        for cats in [[cat], [cat, cat, cat]]:
+            if rank == 0:
+                corr0 = Correlation(var_method='jackknife', **kwargs)
+                corr0.process(*cats)
+            corr1 = Correlation(var_method='jackknife', **kwargs)
+            corr1.process(*cats, comm=comm)
+            if rank == 0:
+                if output:
+                    print(Correlation.__name__, len(cats), attr[0], getattr(corr1,attr[0]),
+                          flush=True)
+                for a in attr:
+                    np.testing.assert_allclose(getattr(corr1,a), getattr(corr0,a))
+                assert sorted(corr0.results.keys()) == sorted(corr1.results.keys())
+                if Correlation is not treecorr.NNNCorrelation:
+                    np.testing.assert_allclose(corr1.cov, corr0.cov)
+            comm.Barrier()
+
 def do_mpi_gg(comm, output=True):
     do_mpi_corr(comm, treecorr.GGCorrelation, True, ['xip', 'xim', 'npairs'], output)
 
@@ -207,3 +310,5 @@ if __name__ == '__main__':
     do_mpi_nn(comm)
     do_mpi_kg(comm)
     do_mpi_kk(comm)
+    do_mpi_dynamic(comm)
+    do_mpi_3pt(comm)
@@ -20,6 +20,7 @@ import warnings
 import gc
 import copy
 import pickle
+import shutil
 from numpy import pi
 import treecorr
 
@@ -1631,6 +1632,211 @@ def test_field():
     assert_raises(NotImplementedError, treecorr.SimpleField)
 
 
+@timer
+def test_save_tree():
+    # Check that fields can be written to and read from save_tree_dir.
+    np.random.seed(123)
+    ngal = 2000
+    x = np.random.uniform(0, 100, ngal)
+    y = np.random.uniform(0, 100, ngal)
+    z = np.random.uniform(0, 100, ngal)
+    w = np.random.uniform(0.5, 1, ngal)
+    k = np.random.normal(0, 0.1, ngal)
+    g1 = np.random.normal(0, 0.2, ngal)
+    g2 = np.random.normal(0, 0.2, ngal)
+    ra = np.random.uniform(0, 0.3, ngal)
+    dec = np.random.uniform(-0.15, 0.15, ngal)
+
+    tree_dir = os.path.join('output', 'trees')
+    if os.path.exists(tree_dir):
+        shutil.rmtree(tree_dir)
+    os.makedirs(tree_dir)
+
+    def count_trees():
+        # There are also .lock files in this directory, which we don't count.
+        return len([f for f in os.listdir(tree_dir) if f.endswith('.npy')])
+
+    for pos in [dict(x=x, y=y), dict(x=x, y=y, z=z),
+                dict(ra=ra, dec=dec, ra_units='rad', dec_units='rad')]:
+        cat0 = treecorr.Catalog(w=w, k=k, g1=g1, g2=g2, **pos)
+        c = (cat0.x[17], cat0.y[17], cat0.z[17] if cat0.z is not None else 0.)
+        scale = 0.01 if cat0.coords == 'spherical' else 1.
+        for get in ['getNField', 'getKField', 'getGField']:
+            field0 = getattr(cat0, get)(min_size=0.5, max_size=30)
+            ntrees = count_trees()
+
+            # The first time, the tree is built and written.
+            cat1 = treecorr.Catalog(w=w, k=k, g1=g1, g2=g2, save_tree_dir=tree_dir, **pos)
+            with CaptureLog() as cl:
+                field1 = getattr(cat1, get)(min_size=0.5, max_size=30, logger=cl.logger)
+            assert 'Reading tree' not in cl.output
+            assert count_trees() == ntrees + 1
+
+            # The second time, it is read back in.
+            cat2 = treecorr.Catalog(w=w, k=k, g1=g1, g2=g2, save_tree_dir=tree_dir, **pos)
+            with CaptureLog() as cl:
+                field2 = getattr(cat2, get)(min_size=0.5, max_size=30, logger=cl.logger)
+            assert 'Reading tree' in cl.output
+            assert count_trees() == ntrees + 1
+
+            assert field2.nTopLevelNodes == field0.nTopLevelNodes
+            for sep in [1, 5, 20]:
+                sep *= scale
+                np.testing.assert_array_equal(np.sort(field2._get_near(*c, sep)),
+                                              np.sort(field0._get_near(*c, sep)))
+                assert field2._count_near(*c, sep) == field0._count_near(*c, sep)
+            cen = field0.kmeans_initialize_centers(10)
+            np.testing.assert_array_equal(field2.kmeans_assign_patches(cen),
+                                          field0.kmeans_assign_patches(cen))
+
+            # Different parameters or values use a different file.
+            getattr(cat2, get)(min_size=1.0, max_size=30)
+            assert count_trees() == ntrees + 2
+            cat3 = treecorr.Catalog(w=w**2, k=k, g1=g1, g2=g2, save_tree_dir=tree_dir, **pos)
+            getattr(cat3, get)(min_size=0.5, max_size=30)
+            assert count_trees() == ntrees + 3
+
+        # The correlation functions are identical using the saved trees.
+        gg0 = treecorr.GGCorrelation(min_sep=scale, max_sep=30*scale, nbins=10)
+        gg0.process(cat0)
+        gg2 = treecorr.GGCorrelation(min_sep=scale, max_sep=30*scale, nbins=10)
+        gg2.process(cat2)
+        np.testing.assert_array_equal(gg2.npairs, gg0.npairs)
+        np.testing.assert_array_equal(gg2.xip, gg0.xip)
+        np.testing.assert_array_equal(gg2.xim, gg0.xim)
+
+    # A file that doesn't match the field is ignored and overwritten.
+    cat4 = treecorr.Catalog(x=x, y=y, save_tree_dir=tree_dir)
+    field4 = cat4.getNField(min_size=2)
+    file_name = cat4._get_tree_file_name(field4)
+    field5 = treecorr.Catalog(x=x, y=y).getNField(min_size=3)
+    field5.write_tree(file_name)
+    cat6 = treecorr.Catalog(x=x, y=y, save_tree_dir=tree_dir)
+    with CaptureLog() as cl:
+        field6 = cat6.getNField(min_size=2, logger=cl.logger)
+    assert 'does not match' in cl.output
+    np.testing.assert_array_equal(field6.get_near(50, 50, 10), field4.get_near(50, 50, 10))
+    with CaptureLog() as cl:
+        cat6.clear_cache()
+        cat6.getNField(min_size=2, logger=cl.logger)
+    assert 'Reading tree' in cl.output
+
+    # A different version of TreeCorr uses a different file.
+    version = treecorr.__version__
+    try:
+        treecorr.__version__ = version + '.test'
+        assert cat6._get_tree_file_name(field6) != file_name
+    finally:
+        treecorr.__version__ = version
+    assert cat6._get_tree_file_name(field6) == file_name
+
+    # The file holds the raw blocks of cells for each top-level cell, along with the number
+    # of cells and bytes in each block (always as 64 bit ints).
+    tree = np.load(file_name)
+    nh = field6._tree_header_size
+    ntop, ncells, nbytes = int(tree[3]), int(tree[4]), int(tree[18])
+    assert ntop == field6.nTopLevelNodes
+    blocksizes = tree[nh:nh+2*ntop].view(np.int64).reshape(ntop, 2)
+    assert np.sum(blocksizes[:,0]) == ncells
+    assert np.sum(blocksizes[:,1]) == nbytes
+    assert len(tree) == nh + 2*ntop + (nbytes+7)//8
+
+    # The fields use the cells in place from a memory map of the file, both the one that
+    # built the tree and the ones that read it.
+    assert isinstance(field4._tree, np.memmap)
+    assert isinstance(field6._tree, np.memmap)
+    assert field4._tree.filename == field6._tree.filename == os.path.abspath(file_name)
+
+    # A file written with a different layout of the cells is also rebuilt.
+    tree[17] += 8
+    np.save(file_name, tree)
+    cat6.clear_cache()
+    with CaptureLog() as cl:
+        field7 = cat6.getNField(min_size=2, logger=cl.logger)
+    assert 'does not match' in cl.output
+    np.testing.assert_array_equal(field7.get_near(50, 50, 10), field4.get_near(50, 50, 10))
+
+    # Files that are truncated or don't have all the bytes the header says are also rebuilt.
+    tree[17] -= 8
+    raw = open(file_name, 'rb').read()
+    bad_blocksizes = tree.copy()
+    bad_blocksizes[nh:nh+2*ntop].view(np.int64)[1] += 8
+    for bad, msg in [(tree[:-10], 'is incomplete'),
+                     (bad_blocksizes, 'is incomplete'),
+                     (tree[:nh-2], 'does not match'),
+                     (None, 'Unable to read')]:
+        if bad is None:
+            with open(file_name, 'wb') as fid:
+                fid.write(raw[:len(raw)//2])
+        else:
+            np.save(file_name, bad)
+        cat6.clear_cache()
+        with CaptureLog() as cl:
+            field7 = cat6.getNField(min_size=2, logger=cl.logger)
+        assert msg in cl.output
+        assert 'Reading tree' not in cl.output
+        np.testing.assert_array_equal(field7.get_near(50, 50, 10),
+                                      field4.get_near(50, 50, 10))
+
+    # If the new file can't be read back, the field keeps the tree it built.
+    read_tree = treecorr.Field._read_tree
+    treecorr.Field._read_tree = lambda self, file_name, logger=None: False
+    try:
+        cat6.clear_cache()
+        with CaptureLog() as cl:
+            field7 = cat6.getNField(min_size=2, logger=cl.logger)
+        assert 'Unable to read back' in cl.output
+        assert not hasattr(field7, '_tree')
+        np.testing.assert_array_equal(field7.get_near(50, 50, 10),
+                                      field4.get_near(50, 50, 10))
+        del field7
+    finally:
+        treecorr.Field._read_tree = read_tree
+
+    # When several processes or threads need the same tree at once, only one builds it.
+    # The others wait for it to finish and read it back.
+    import threading
+    tree_dir2 = os.path.join(tree_dir, 'shared')  # Also checks that the directory is made.
+    cats = [treecorr.Catalog(x=x, y=y, k=k, save_tree_dir=tree_dir2) for i in range(4)]
+    with CaptureLog() as cl:
+        threads = [threading.Thread(target=cat.getKField, kwargs=dict(min_size=0.1,
+                                                                       logger=cl.logger))
+                   for cat in cats]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    assert cl.output.count('Reading tree') == 3
+    assert len([f for f in os.listdir(tree_dir2) if f.endswith('.npy')]) == 1
+
+
+@timer
+def test_build_threads():
+    # The tree build is parallelized using OpenMP tasks.  Check that the tree is identical
+    # regardless of the number of threads.
+    # (split_method='random' draws a new seed for each build, so it can't be checked this way.
+    # But the split of each cell only depends on that seed and the objects in the cell, not on
+    # the order in which the cells are built.)
+    np.random.seed(1234)
+    ngal = 50000
+    ra = np.random.uniform(0, 0.3, ngal)
+    dec = np.random.uniform(-0.15, 0.15, ngal)
+    k = np.random.normal(0, 0.1, ngal)
+    cat = treecorr.Catalog(ra=ra, dec=dec, k=k, ra_units='rad', dec_units='rad')
+    trees = []
+    for num_threads in [1, 4]:
+        treecorr.set_omp_threads(num_threads)
+        for split_method in ['mean', 'median', 'middle']:
+            cat.clear_cache()
+            field = cat.getKField(min_size=1.e-4, max_size=0.01, split_method=split_method)
+            file_name = os.path.join('output', 'tree_%s_%d.npy'%(split_method, num_threads))
+            field.write_tree(file_name)
+            trees.append(np.load(file_name))
+    treecorr.set_omp_threads(None)
+    for t1, t4 in zip(trees[:3], trees[3:]):
+        np.testing.assert_array_equal(t4, t1)
+
+
 @timer
 def test_lru():
     f = lambda x: x+1
@@ -1727,4 +1933,6 @@ if __name__ == '__main__':
     test_list()
     test_write()
     test_field()
+    test_save_tree()
+    test_build_threads()
     test_lru()
@@ -1340,6 +1340,285 @@ def test_varxi():
     np.testing.assert_allclose(mean_varxim, var_xim, rtol=0.02 * tol_factor)
 
 
+@timer
+def test_realizations():
+    # Test processing many realizations of the shear on the same positions at once.
+    ngal = 2000
+    nreal = 5
+    rng = np.random.RandomState(8675309)
+    ra = rng.uniform(10., 20., (ngal,) )
+    dec = rng.uniform(-5., 5., (ngal,) )
+    w = rng.random_sample(ngal)
+    g1 = rng.normal(0,0.2, (ngal,nreal) )
+    g2 = rng.normal(0,0.2, (ngal,nreal) )
+
+    for coords in ['flat', 'spherical']:
+        if coords == 'flat':
+            pos = dict(x=ra, y=dec, x_units='deg', y_units='deg')
+            pos2 = dict(x=ra[::3]+0.1, y=dec[::3], x_units='deg', y_units='deg')
+        else:
+            pos = dict(ra=ra, dec=dec, ra_units='deg', dec_units='deg')
+            pos2 = dict(ra=ra[::3]+0.1, dec=dec[::3], ra_units='deg', dec_units='deg')
+        cat = treecorr.Catalog(w=w, g1=g1, g2=g2, **pos)
+        assert cat.nreal == nreal
+        gg = treecorr.GGCorrelation(bin_size=0.2, min_sep=10., max_sep=200., sep_units='arcmin')
+        gg.process(cat)
+        assert gg.xip.shape == (nreal, gg.nbins)
+        assert gg.xim_im.shape == (nreal, gg.nbins)
+        assert gg.varxip.shape == (gg.nbins,)
+
+        # Each realization should match the result of processing it separately.
+        gg1 = treecorr.GGCorrelation(bin_size=0.2, min_sep=10., max_sep=200., sep_units='arcmin')
+        for r in range(nreal):
+            cat1 = treecorr.Catalog(w=w, g1=g1[:,r], g2=g2[:,r], **pos)
+            gg1.process(cat1)
+            np.testing.assert_allclose(gg.xip[r], gg1.xip, rtol=1.e-5, atol=1.e-8)
+            np.testing.assert_allclose(gg.xim[r], gg1.xim, rtol=1.e-5, atol=1.e-8)
+            np.testing.assert_allclose(gg.xip_im[r], gg1.xip_im, rtol=1.e-5, atol=1.e-8)
+            np.testing.assert_allclose(gg.xim_im[r], gg1.xim_im, rtol=1.e-5, atol=1.e-8)
+            np.testing.assert_allclose(gg.weight, gg1.weight, rtol=1.e-6)
+
+        # Cross-correlation with a different set of positions.
+        cat2 = treecorr.Catalog(g1=g1[::3], g2=g2[::3], **pos2)
+        gg.process(cat, cat2)
+        for r in range(nreal):
+            cat1 = treecorr.Catalog(w=w, g1=g1[:,r], g2=g2[:,r], **pos)
+            cat3 = treecorr.Catalog(g1=g1[::3,r], g2=g2[::3,r], **pos2)
+            gg1.process(cat1, cat3)
+            np.testing.assert_allclose(gg.xip[r], gg1.xip, rtol=1.e-5, atol=1.e-8)
+            np.testing.assert_allclose(gg.xim[r], gg1.xim, rtol=1.e-5, atol=1.e-8)
+
+    with assert_raises(ValueError):
+        treecorr.Catalog(ra=ra, dec=dec, ra_units='deg', dec_units='deg', g1=g1, g2=g2[:,:2])
+    with assert_raises(ValueError):
+        gg.write(os.path.join('output','gg_real.out'))
+
+@timer
+def test_process_tomo():
+    # Test process_tomo, which does all the pairs of a list of catalogs.
+    nbin = 3
+    ngal = 1000
+    s = 10.
+    rng = np.random.RandomState(8675309)
+    cats = []
+    for i in range(nbin):
+        x = rng.uniform(-3*s, 3*s, (ngal,) )
+        y = rng.uniform(-3*s, 3*s, (ngal,) )
+        g1 = rng.normal(0, 0.2, (ngal,) )
+        g2 = rng.normal(0, 0.2, (ngal,) )
+        cats.append(treecorr.Catalog(x=x, y=y, g1=g1, g2=g2))
+
+    # Count how many times the fields are built.
+    nbuild = [0]
+    for cat in cats:
+        def build(*args, _build=cat.gfields.user_function, **kwargs):
+            nbuild[0] += 1
+            return _build(*args, **kwargs)
+        cat.gfields.user_function = build
+
+    gg = treecorr.GGCorrelation(bin_size=0.3, min_sep=1., max_sep=20.)
+    results = treecorr.process_tomo(gg, cats)
+    assert sorted(results.keys()) == [(0,0), (0,1), (0,2), (1,1), (1,2), (2,2)]
+    assert nbuild[0] == nbin
+    assert gg.npairs.sum() == 0
+    for (i,j), gg_ij in results.items():
+        gg2 = gg.copy()
+        if i == j:
+            gg2.process(cats[i])
+        else:
+            gg2.process(cats[i], cats[j])
+        np.testing.assert_allclose(gg_ij.npairs, gg2.npairs)
+        np.testing.assert_allclose(gg_ij.xip, gg2.xip)
+        np.testing.assert_allclose(gg_ij.xim, gg2.xim)
+        np.testing.assert_allclose(gg_ij.varxip, gg2.varxip)
+    assert nbuild[0] == nbin
+
+    # Processing several pairs at once gives the same answers.
+    results2 = treecorr.process_tomo(gg, cats, num_pair_threads=3)
+    assert list(results2.keys()) == list(results.keys())
+    for key in results:
+        np.testing.assert_allclose(results2[key].xip, results[key].xip)
+        np.testing.assert_allclose(results2[key].xim, results[key].xim)
+
+    # With patches, the covariance is available for each pair.
+    pcats = [treecorr.Catalog(x=cat.x, y=cat.y, g1=cat.g1, g2=cat.g2, npatch=4)
+             for cat in cats]
+    results = treecorr.process_tomo(gg, pcats, num_pair_threads=2)
+    gg2 = gg.copy()
+    gg2.process(pcats[0], pcats[2])
+    np.testing.assert_allclose(results[(0,2)].xip, gg2.xip)
+    np.testing.assert_allclose(results[(0,2)].estimate_cov('jackknife'),
+                               gg2.estimate_cov('jackknife'))
+
+    # For NG, the lens and source catalogs are separate lists.
+    lens = treecorr.Catalog(x=rng.uniform(-3*s, 3*s, (ngal,)), y=rng.uniform(-3*s, 3*s, (ngal,)))
+    ng = treecorr.NGCorrelation(bin_size=0.3, min_sep=1., max_sep=20.)
+    results = treecorr.process_tomo(ng, [lens], cats, num_pair_threads=2)
+    assert sorted(results.keys()) == [(0,0), (0,1), (0,2)]
+    ng2 = ng.copy()
+    ng2.process(lens, cats[1])
+    np.testing.assert_allclose(results[(0,1)].xi, ng2.xi)
+
+    with assert_raises(ValueError):
+        treecorr.process_tomo(ng, cats)
+    with assert_raises(ValueError):
+        treecorr.process_tomo(gg, [])
+    with assert_raises(TypeError):
+        treecorr.process_tomo(cats[0], cats)
+
+
+@timer
+def test_process_binnings():
+    # Test process_binnings, which fills several binnings in one traversal.
+    ngal = 2000
+    s = 10.
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(-3*s, 3*s, (ngal,) )
+    y = rng.uniform(-3*s, 3*s, (ngal,) )
+    w = rng.uniform(0.5, 1.5, (ngal,) )
+    g1 = rng.normal(0, 0.2, (ngal,) )
+    g2 = rng.normal(0, 0.2, (ngal,) )
+    cat = treecorr.Catalog(x=x, y=y, w=w, g1=g1, g2=g2)
+    cat2 = treecorr.Catalog(x=x[:500]+1.3, y=y[:500]-0.2, g1=g1[:500], g2=g2[:500])
+
+    configs = [ dict(min_sep=1., max_sep=20., nbins=8),
+                dict(min_sep=0.5, max_sep=15., nbins=12, bin_type='Linear'),
+                dict(max_sep=8., nbins=6, bin_type='TwoD'),
+                dict(min_sep=2., max_sep=40., nbins=30) ]
+
+    # With brute=True, the results are the same as doing them separately.
+    for cat1, cat2_ in [(cat, None), (cat, cat2)]:
+        ggs = [treecorr.GGCorrelation(brute=True, **config) for config in configs]
+        treecorr.process_binnings(ggs, cat1, cat2_)
+        for gg, config in zip(ggs, configs):
+            gg2 = treecorr.GGCorrelation(brute=True, **config)
+            gg2.process(cat1, cat2_)
+            np.testing.assert_allclose(gg.npairs, gg2.npairs)
+            np.testing.assert_allclose(gg.weight, gg2.weight)
+            np.testing.assert_allclose(gg.meanr, gg2.meanr)
+            np.testing.assert_allclose(gg.xip, gg2.xip, atol=1.e-10)
+            np.testing.assert_allclose(gg.xim, gg2.xim, atol=1.e-10)
+            np.testing.assert_allclose(gg.varxip, gg2.varxip)
+
+    # Otherwise, they have about the same accuracy as doing them separately.
+    ggs = [treecorr.GGCorrelation(bin_slop=0.1, **config) for config in configs]
+    treecorr.process_binnings(ggs, cat)
+    for gg, config in zip(ggs, configs):
+        gg1 = treecorr.GGCorrelation(bin_slop=0.1, **config)
+        gg1.process(cat)
+        gg2 = treecorr.GGCorrelation(brute=True, **config)
+        gg2.process(cat)
+        np.testing.assert_allclose(gg.npairs, gg2.npairs, rtol=2.e-2)
+        for attr in ['xip', 'xim']:
+            err = np.max(np.abs(getattr(gg, attr) - getattr(gg2, attr)))
+            err1 = np.max(np.abs(getattr(gg1, attr) - getattr(gg2, attr)))
+            print(attr, err, err1)
+            assert err < 1.5 * err1
+
+    # The binnings may also have different bin_slop.  Each one splits the cells according
+    # to its own bin_slop, so the one with the larger bin_slop isn't made less accurate by
+    # being done with the other one.
+    x3 = rng.uniform(-3*s, 3*s, (3000,) )
+    y3 = rng.uniform(-3*s, 3*s, (3000,) )
+    g13 = rng.normal(0, 0.2, (3000,) )
+    g23 = rng.normal(0, 0.2, (3000,) )
+    cat3 = treecorr.Catalog(x=x3, y=y3, g1=g13, g2=g23)
+    configs3 = [ dict(min_sep=2., max_sep=60., nbins=20, bin_type='Linear', bin_slop=0),
+                 dict(min_sep=0.5, max_sep=80., nbins=20, bin_slop=0.3) ]
+    ggs = [treecorr.GGCorrelation(**config) for config in configs3]
+    treecorr.process_binnings(ggs, cat3)
+    for gg, config in zip(ggs, configs3):
+        gg1 = treecorr.GGCorrelation(**config)
+        gg1.process(cat3)
+        config = dict(config)
+        del config['bin_slop']
+        gg2 = treecorr.GGCorrelation(brute=True, **config)
+        gg2.process(cat3)
+        for attr in ['xip', 'xim', 'npairs', 'meanr']:
+            err = np.max(np.abs(getattr(gg, attr) - getattr(gg2, attr)))
+            err1 = np.max(np.abs(getattr(gg1, attr) - getattr(gg2, attr)))
+            print(config, attr, err, err1)
+            assert err <= 1.05 * err1 + 1.e-10
+
+    # With patches, the covariance matrices are also available.
+    pcat = treecorr.Catalog(x=x, y=y, w=w, g1=g1, g2=g2, npatch=4)
+    ggs = [treecorr.GGCorrelation(brute=True, **config) for config in configs[:2]]
+    treecorr.process_binnings(ggs, pcat)
+    for gg, config in zip(ggs, configs):
+        gg2 = treecorr.GGCorrelation(brute=True, **config)
+        gg2.process(pcat)
+        np.testing.assert_allclose(gg.xip, gg2.xip, atol=1.e-10)
+        np.testing.assert_allclose(gg.estimate_cov('jackknife'), gg2.estimate_cov('jackknife'),
+                                   atol=1.e-12)
+
+    with assert_raises(ValueError):
+        treecorr.process_binnings([], cat)
+    with assert_raises(TypeError):
+        treecorr.process_binnings([ggs[0], treecorr.KKCorrelation(**configs[0])], cat)
+    with assert_raises(ValueError):
+        treecorr.process_binnings([ggs[0], treecorr.GGCorrelation(min_rpar=0, **configs[0])],
+                                  cat)
+
+
+@timer
+def test_mapsq_batch():
+    # Test calculating Map^2 for many realizations of the correlation function at once.
+    ngal = 2000
+    nreal = 5
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(0, 100., (ngal,) )
+    y = rng.uniform(0, 100., (ngal,) )
+    g1 = rng.normal(0,0.2, (ngal,nreal) )
+    g2 = rng.normal(0,0.2, (ngal,nreal) )
+    cat = treecorr.Catalog(x=x, y=y, g1=g1, g2=g2)
+    gg = treecorr.GGCorrelation(bin_size=0.2, min_sep=1., max_sep=50.)
+    gg.process(cat)
+    assert gg.xip.shape == (nreal, gg.nbins)
+    R = gg.rnom[::2]
+
+    for m2_uform in ['Crittenden', 'Schneider']:
+        assert len(gg._mapsq_cache) == 0
+        # The realizations can be done all at once from the stacked xi values.
+        batch = gg.calculateMapSq(R, m2_uform=m2_uform)
+        assert len(gg._mapsq_cache) == 1
+        kernels = list(gg._mapsq_cache.values())[0]
+        for m in batch[:4]:
+            assert m.shape == (nreal, len(R))
+        assert batch[4].shape == (len(R),)
+
+        for r in range(nreal):
+            single = gg.calculateMapSq(R, m2_uform=m2_uform, xip=gg.xip[r], xim=gg.xim[r],
+                                       xip_im=gg.xip_im[r], xim_im=gg.xim_im[r])
+            for m1, m2 in zip(batch, single):
+                np.testing.assert_allclose(m1[r] if m1.ndim == 2 else m1, m2, rtol=1.e-10)
+
+            # Also check against a correlation function with only this realization.
+            gg1 = treecorr.GGCorrelation(bin_size=0.2, min_sep=1., max_sep=50.)
+            gg1.process(treecorr.Catalog(x=x, y=y, g1=g1[:,r], g2=g2[:,r]))
+            single1 = gg1.calculateMapSq(R, m2_uform=m2_uform)
+            np.testing.assert_allclose(batch[0][r], single1[0], rtol=1.e-5, atol=1.e-10)
+            np.testing.assert_allclose(batch[2][r], single1[2], rtol=1.e-5, atol=1.e-10)
+
+        # The kernels are reused for the same R.
+        assert len(gg._mapsq_cache) == 1
+        assert list(gg._mapsq_cache.values())[0] is kernels
+
+        # Changing the results clears the cache.
+        gg.clear()
+        assert len(gg._mapsq_cache) == 0
+        gg.process(cat)
+
+    # Reading from a file also clears the cache.
+    gg2 = treecorr.GGCorrelation(bin_size=0.2, min_sep=1., max_sep=50.)
+    gg2.process(treecorr.Catalog(x=x, y=y, g1=g1[:,0], g2=g2[:,0]))
+    gg2.calculateMapSq()
+    assert len(gg2._mapsq_cache) == 1
+    file_name = os.path.join('output','gg_mapsq_batch.fits')
+    gg2.write(file_name)
+    gg2.read(file_name)
+    assert len(gg2._mapsq_cache) == 0
+
+
 if __name__ == '__main__':
     test_direct()
     test_direct_spherical()
@@ -1351,3 +1630,7 @@ if __name__ == '__main__':
     test_shuffle()
     test_haloellip()
     test_varxi
+    test_realizations()
+    test_process_tomo()
+    test_process_binnings()
+    test_mapsq_batch()
@@ -1019,8 +1019,217 @@ def test_map3():
     np.testing.assert_allclose(data['Map3'], map3)
 
 
+@timer
+def test_multipole():
+    # Same shear field as in test_ggg, but computed with the multipole algorithm.
+    # The accuracy is comparable to what the regular algorithm gets with the default bin_slop.
+    gamma0 = 0.05
+    r0 = 10.
+    ngal = 10000
+    L = 20.*r0
+    tol_factor = 5
+    rng = np.random.RandomState(8675309)
+    x = (rng.random_sample(ngal)-0.5) * L
+    y = (rng.random_sample(ngal)-0.5) * L
+    r2 = (x**2 + y**2)/r0**2
+    g1 = -gamma0 * np.exp(-r2/2.) * (x**2-y**2)/r0**2
+    g2 = -gamma0 * np.exp(-r2/2.) * (2.*x*y)/r0**2
+
+    cat = treecorr.Catalog(x=x, y=y, g1=g1, g2=g2, x_units='arcmin', y_units='arcmin')
+    ggg = treecorr.GGGCorrelation(min_sep=11., max_sep=15., nbins=3,
+                                  min_u=0.7, max_u=1.0, nubins=3,
+                                  min_v=0.1, max_v=0.3, nvbins=2,
+                                  sep_units='arcmin', algo='multipole')
+    ggg.process(cat)
+
+    d1 = ggg.meand1
+    d2 = ggg.meand2
+    d3 = ggg.meand3
+    s = d2
+    tx = (d2**2 + d3**2 - d1**2)/(2.*d2)
+    ty = np.sqrt(d3**2 - tx**2)
+    ty[ggg.meanv > 0] *= -1.
+    t = tx + 1j * ty
+    q1 = (s + t)/3.
+    q2 = q1 - t
+    q3 = q1 - s
+    nq1 = np.abs(q1)**2
+    nq2 = np.abs(q2)**2
+    nq3 = np.abs(q3)**2
+    L = L - 2.*(q1 + q2 + q3)/3.
+
+    true_gam0 = ((-2.*np.pi * gamma0**3)/(3. * L**2 * r0**4) *
+                    np.exp(-(nq1+nq2+nq3)/(2.*r0**2)) * (nq1*nq2*nq3) )
+    true_gam1 = ((-2.*np.pi * gamma0**3)/(3. * L**2 * r0**4) *
+                    np.exp(-(nq1+nq2+nq3)/(2.*r0**2)) *
+                    (nq1*nq2*nq3 - 8./3. * r0**2 * q1**2*nq2*nq3/(q2*q3)
+                     + (8./9. * r0**4 * (q1**2 * nq2 * nq3)/(nq1 * q2**2 * q3**2) *
+                         (2.*q1**2 - q2**2 - q3**2)) ))
+    true_gam2 = ((-2.*np.pi * gamma0**3)/(3. * L**2 * r0**4) *
+                    np.exp(-(nq1+nq2+nq3)/(2.*r0**2)) *
+                    (nq1*nq2*nq3 - 8./3. * r0**2 * nq1*q2**2*nq3/(q1*q3)
+                     + (8./9. * r0**4 * (nq1 * q2**2 * nq3)/(q1**2 * nq2 * q3**2) *
+                         (2.*q2**2 - q1**2 - q3**2)) ))
+    true_gam3 = ((-2.*np.pi * gamma0**3)/(3. * L**2 * r0**4) *
+                    np.exp(-(nq1+nq2+nq3)/(2.*r0**2)) *
+                    (nq1*nq2*nq3 - 8./3. * r0**2 * nq1*nq2*q3**2/(q1*q2)
+                     + (8./9. * r0**4 * (nq1 * nq2 * q3**2)/(q1**2 * q2**2 * nq3) *
+                         (2.*q3**2 - q1**2 - q2**2)) ))
+
+    print('gam0 = ',ggg.gam0)
+    print('true_gam0 = ',true_gam0)
+    print('max rel diff = ',np.max(np.abs((ggg.gam0 - true_gam0)/true_gam0)))
+    np.testing.assert_allclose(ggg.gam0, true_gam0, rtol=0.2 * tol_factor, atol=1.e-7)
+    np.testing.assert_allclose(np.log(np.abs(ggg.gam0)),
+                                  np.log(np.abs(true_gam0)), atol=0.2 * tol_factor)
+    for gam, true_gam in [(ggg.gam1, true_gam1), (ggg.gam2, true_gam2), (ggg.gam3, true_gam3)]:
+        print('gam = ',gam)
+        print('true_gam = ',true_gam)
+        print('max rel diff = ',np.max(np.abs((gam - true_gam)/true_gam)))
+        np.testing.assert_allclose(gam, true_gam, rtol=0.1 * tol_factor)
+        np.testing.assert_allclose(np.log(np.abs(gam)), np.log(np.abs(true_gam)),
+                                      atol=0.1 * tol_factor)
+
+    # The aperture mass statistics work the same way on the multipole result.
+    map3 = ggg.calculateMap3()[0]
+    assert np.all(np.isfinite(map3))
+
+    # Compare directly to the triangle algorithm on a smaller catalog.
+    ngal = 800
+    L = 5.*r0
+    x = (rng.random_sample(ngal)-0.5) * L
+    y = (rng.random_sample(ngal)-0.5) * L
+    r2 = (x**2 + y**2)/r0**2
+    g1 = -gamma0 * np.exp(-r2/2.) * (x**2-y**2)/r0**2
+    g2 = -gamma0 * np.exp(-r2/2.) * (2.*x*y)/r0**2
+    cat = treecorr.Catalog(x=x, y=y, g1=g1, g2=g2)
+    kwargs = dict(min_sep=11., max_sep=15., nbins=3, min_u=0.7, max_u=1.0, nubins=3,
+                  min_v=0.1, max_v=0.3, nvbins=2, brute=True)
+    ggg = treecorr.GGGCorrelation(**kwargs)
+    ggg.process(cat)
+    mmm = treecorr.GGGCorrelation(algo='multipole', **kwargs)
+    mmm.process(cat)
+    print('ntri ratio = ',mmm.ntri/ggg.ntri)
+    np.testing.assert_allclose(mmm.ntri, ggg.ntri, rtol=0.03)
+    np.testing.assert_allclose(mmm.weight, ggg.weight, rtol=0.03)
+    np.testing.assert_allclose(mmm.meand2, ggg.meand2, rtol=0.01)
+    np.testing.assert_allclose(mmm.meanu, ggg.meanu, atol=0.01)
+    np.testing.assert_allclose(mmm.meanv, ggg.meanv, atol=0.01)
+    # The multipole algorithm spreads the triangles near the edges of the bins into the
+    # neighboring bins, which leads to errors of a few percent of the typical value of the
+    # natural components.  gam0 is a few times smaller than the others here, so its relative
+    # errors are larger (up to ~40% in individual bins), but the absolute errors are similar.
+    gmax = np.max(np.abs([ggg.gam0, ggg.gam1, ggg.gam2, ggg.gam3]))
+    for gam, mgam in [(ggg.gam0, mmm.gam0), (ggg.gam1, mmm.gam1), (ggg.gam2, mmm.gam2),
+                      (ggg.gam3, mmm.gam3)]:
+        print('max diff / gmax = ',np.max(np.abs(mgam - gam))/gmax)
+        np.testing.assert_allclose(mgam, gam, rtol=0, atol=0.1 * gmax)
+    for gam, mgam in [(ggg.gam1, mmm.gam1), (ggg.gam2, mmm.gam2), (ggg.gam3, mmm.gam3)]:
+        np.testing.assert_allclose(mgam, gam, rtol=0.1)
+
+    # These errors get smaller with finer separation bins and more multipoles.
+    err = np.max(np.abs([mmm.gam0 - ggg.gam0, mmm.gam1 - ggg.gam1,
+                         mmm.gam2 - ggg.gam2, mmm.gam3 - ggg.gam3]))
+    mmm = treecorr.GGGCorrelation(algo='multipole', nsub=8, max_n=60, **kwargs)
+    mmm.process(cat)
+    err2 = np.max(np.abs([mmm.gam0 - ggg.gam0, mmm.gam1 - ggg.gam1,
+                          mmm.gam2 - ggg.gam2, mmm.gam3 - ggg.gam3]))
+    print('refined max diff / gmax = ',err2/gmax,' cf. ',err/gmax)
+    assert err2 < 0.7 * err
+    for gam, mgam in [(ggg.gam0, mmm.gam0), (ggg.gam1, mmm.gam1), (ggg.gam2, mmm.gam2),
+                      (ggg.gam3, mmm.gam3)]:
+        np.testing.assert_allclose(mgam, gam, rtol=0, atol=0.03 * gmax)
+
+
+@timer
+def test_map3_batch():
+    # Test calculating Map^3 for many realizations of the correlation function at once.
+    ngal = 2000
+    s = 10.
+    rng = np.random.RandomState(8675309)
+    x = rng.normal(0,s, (ngal,) )
+    y = rng.normal(0,s, (ngal,) )
+    g1 = rng.normal(0,0.2, (ngal,) )
+    g2 = rng.normal(0,0.2, (ngal,) )
+    cat = treecorr.Catalog(x=x, y=y, g1=g1, g2=g2)
+    ggg = treecorr.GGGCorrelation(min_sep=1., max_sep=20., nbins=5,
+                                  min_u=0.5, max_u=1.0, nubins=2,
+                                  min_v=0., max_v=0.5, nvbins=2)
+    ggg.process(cat)
+
+    # Some fake realizations of the correlation function.
+    nreal = 4
+    shape = (nreal,) + ggg.gam0.shape
+    gams = [g + 1.e-3 * (rng.normal(0,1,shape) + 1j*rng.normal(0,1,shape))
+            for g in [ggg.gam0, ggg.gam1, ggg.gam2, ggg.gam3]]
+    R = np.array([2., 3., 5., 8.])
+
+    for k2, k3 in [(1,1), (1.5,2)]:
+        ggg.clear()
+        ggg.process(cat)
+        assert len(ggg._map3_cache) == 0
+        batch = ggg.calculateMap3(R=R, k2=k2, k3=k3, gam0=gams[0], gam1=gams[1],
+                                  gam2=gams[2], gam3=gams[3])
+        assert len(ggg._map3_cache) == 1
+        kernels = list(ggg._map3_cache.values())[0]
+        for m in batch[:8]:
+            assert m.shape == (nreal, len(R))
+        assert batch[8].shape == (len(R),)
+
+        ggg2 = ggg.copy()
+        for r in range(nreal):
+            # Each realization should match the regular calculation with those values.
+            ggg2.gam0r, ggg2.gam0i = gams[0][r].real, gams[0][r].imag
+            ggg2.gam1r, ggg2.gam1i = gams[1][r].real, gams[1][r].imag
+            ggg2.gam2r, ggg2.gam2i = gams[2][r].real, gams[2][r].imag
+            ggg2.gam3r, ggg2.gam3i = gams[3][r].real, gams[3][r].imag
+            single = ggg2.calculateMap3(R=R, k2=k2, k3=k3)
+            for m1, m2 in zip(batch[:8], single[:8]):
+                np.testing.assert_allclose(m1[r], m2, rtol=1.e-10, atol=1.e-14)
+            np.testing.assert_allclose(batch[8], single[8])
+
+            # And the unbatched form of the parameters.
+            single2 = ggg.calculateMap3(R=R, k2=k2, k3=k3, gam0=gams[0][r], gam1=gams[1][r],
+                                        gam2=gams[2][r], gam3=gams[3][r])
+            for m1, m2 in zip(single, single2):
+                np.testing.assert_allclose(m1, m2, rtol=1.e-10, atol=1.e-14)
+
+        # The kernels are reused for the same R, k2, k3.
+        assert len(ggg._map3_cache) == 1
+        assert list(ggg._map3_cache.values())[0] is kernels
+
+        # Gams not given are taken from self, and can be mixed with batched ones.
+        mix = ggg.calculateMap3(R=R, k2=k2, k3=k3, gam0=gams[0])
+        default = ggg.calculateMap3(R=R, k2=k2, k3=k3)
+        assert mix[0].shape == (nreal, len(R))
+        assert default[0].shape == (len(R),)
+        np.testing.assert_allclose(mix[1][0],
+                                   ggg.calculateMap3(R=R, k2=k2, k3=k3, gam0=gams[0][0])[1])
+
+    # Writing and reading back clears the cache.
+    ggg.calculateMap3(R=R)
+    assert len(ggg._map3_cache) > 0
+    file_name = os.path.join('output','ggg_map3_batch.fits')
+    ggg.write(file_name)
+    ggg.read(file_name)
+    assert len(ggg._map3_cache) == 0
+
+    # The cache is not copied, but is rebuilt as needed.
+    ggg.calculateMap3(R=R)
+    ggg3 = ggg.copy()
+    assert len(ggg3._map3_cache) == 0
+    np.testing.assert_allclose(ggg3.calculateMap3(R=R)[0], ggg.calculateMap3(R=R)[0])
+
+    with assert_raises(ValueError):
+        ggg.calculateMap3(R=R, gam0=ggg.gam0.ravel())
+    with assert_raises(ValueError):
+        ggg.calculateMap3(R=R, gam0=gams[0][:2], gam1=gams[1])
+
+
 if __name__ == '__main__':
     test_direct()
     test_direct_spherical()
     test_ggg()
     test_map3()
+    test_multipole()
+    test_map3_batch()
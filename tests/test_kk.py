@@ -614,6 +614,133 @@ def test_varxi():
 
 
 
+@timer
+def test_realizations():
+    # Test processing many realizations of kappa on the same positions at once.
+    ngal = 2000
+    nreal = 6
+    s = 10.
+    rng = np.random.RandomState(8675309)
+    x = rng.normal(0,s, (ngal,) )
+    y = rng.normal(0,s, (ngal,) )
+    w = rng.random_sample(ngal)
+    k = rng.normal(0,0.2, (ngal,nreal) )
+
+    cat = treecorr.Catalog(x=x, y=y, w=w, k=k)
+    assert cat.nreal == nreal
+    np.testing.assert_allclose(cat.vark, np.sum(w[:,np.newaxis]**2 * k**2) / np.sum(w) / nreal)
+    kk = treecorr.KKCorrelation(bin_size=0.2, min_sep=1., max_sep=20.)
+    kk.process(cat)
+    assert kk.xi.shape == (nreal, kk.nbins)
+    assert kk.varxi.shape == (kk.nbins,)
+
+    # Also do them in several chunks.
+    kk2 = kk.copy()
+    kk2._max_realization_values = 2 * ngal
+    kk2.process(cat)
+    np.testing.assert_allclose(kk2.xi, kk.xi)
+    # The other sums are only accumulated once, not for each chunk.
+    np.testing.assert_allclose(kk2.weight, kk.weight)
+    np.testing.assert_allclose(kk2.npairs, kk.npairs)
+    np.testing.assert_allclose(kk2.meanr, kk.meanr)
+
+    # With brute force, there are many more pairs than are kept in memory at once, so the
+    # recorded pairs are applied in many batches.
+    kkb = treecorr.KKCorrelation(bin_size=0.2, min_sep=1., max_sep=20., brute=True)
+    kkb.process(cat)
+    assert np.sum(kkb.npairs) > 2**20
+    kk1 = treecorr.KKCorrelation(bin_size=0.2, min_sep=1., max_sep=20., brute=True)
+    for r in [0, nreal-1]:
+        cat1 = treecorr.Catalog(x=x, y=y, w=w, k=k[:,r])
+        kk1.process(cat1)
+        np.testing.assert_allclose(kkb.xi[r], kk1.xi, rtol=1.e-6, atol=1.e-8)
+        np.testing.assert_allclose(kkb.weight, kk1.weight, rtol=1.e-6)
+
+    # Each realization should match the result of processing it separately.
+    kk1 = treecorr.KKCorrelation(bin_size=0.2, min_sep=1., max_sep=20.)
+    for r in range(nreal):
+        cat1 = treecorr.Catalog(x=x, y=y, w=w, k=k[:,r])
+        kk1.process(cat1)
+        np.testing.assert_allclose(kk.xi[r], kk1.xi, rtol=1.e-6, atol=1.e-8)
+        np.testing.assert_allclose(kk.weight, kk1.weight, rtol=1.e-6)
+        np.testing.assert_allclose(kk.npairs, kk1.npairs)
+
+    # Cross-correlations and patches work too.
+    cat2 = treecorr.Catalog(x=x[::2]+1, y=y[::2], k=k[::2], npatch=4)
+    kk.process(cat, cat2)
+    assert kk.xi.shape == (nreal, kk.nbins)
+    for r in range(nreal):
+        cat1 = treecorr.Catalog(x=x, y=y, w=w, k=k[:,r])
+        cat3 = treecorr.Catalog(x=x[::2]+1, y=y[::2], k=k[::2,r], patch_centers=cat2.patch_centers)
+        kk1.process(cat1, cat3)
+        np.testing.assert_allclose(kk.xi[r], kk1.xi, rtol=1.e-6, atol=1.e-8)
+
+    # Going back to a single realization resets the shape.
+    kk.process(cat1)
+    assert kk.xi.shape == (kk.nbins,)
+
+    with assert_raises(ValueError):
+        kk.process(cat, cat1)
+    kk.process(cat)
+    with assert_raises(ValueError):
+        kk.write(os.path.join('output','kk_real.out'))
+    with assert_raises(ValueError):
+        kk += kk1
+    kk3 = treecorr.KKCorrelation(bin_size=0.2, min_sep=1., max_sep=20., var_method='jackknife')
+    with assert_raises(ValueError):
+        kk3.process(cat)
+
+    # Other correlation classes would only use the first realization, so they don't allow it.
+    # Nor does process_pairwise.
+    nk = treecorr.NKCorrelation(bin_size=0.2, min_sep=1., max_sep=20.)
+    nk.process(cat, cat1)
+    assert_raises(ValueError, nk.process, cat1, cat)
+    assert_raises(ValueError, nk.process_pairwise, cat1, cat)
+    kg = treecorr.KGCorrelation(bin_size=0.2, min_sep=1., max_sep=20.)
+    catg = treecorr.Catalog(x=x, y=y, w=w, g1=k[:,0], g2=k[:,1])
+    assert_raises(ValueError, kg.process, cat, catg)
+    assert_raises(ValueError, kg.process_pairwise, cat, catg)
+    ng = treecorr.NGCorrelation(bin_size=0.2, min_sep=1., max_sep=20.)
+    catg2 = treecorr.Catalog(x=x, y=y, w=w, g1=k, g2=k)
+    assert catg2.nreal == nreal
+    ng.process(cat, catg)
+    assert_raises(ValueError, ng.process, cat, catg2)
+    assert_raises(ValueError, ng.process_pairwise, cat, catg2)
+    # The error message says which classes can use them, not just that process_pairwise can't.
+    try:
+        ng.process(cat, catg2)
+    except ValueError as e:
+        assert 'can only be used by GGCorrelation and KKCorrelation' in str(e)
+    else:
+        assert False, 'ng.process should have raised ValueError'
+    kk4 = treecorr.KKCorrelation(bin_size=0.2, min_sep=1., max_sep=20.)
+    assert_raises(ValueError, kk4.process_pairwise, cat, cat)
+    kkk = treecorr.KKKCorrelation(min_sep=1., max_sep=5., nbins=3)
+    assert_raises(ValueError, kkk.process, cat)
+    assert_raises(ValueError, kkk.process, cat, cat, cat)
+    cat2 = treecorr.Catalog(x=x, y=y, w=w, k=k, npatch=4)
+    assert_raises(ValueError, kkk.process, cat2)
+    kkk = treecorr.KKKCorrelation(min_sep=1., max_sep=5., nbins=3, algo='multipole')
+    assert_raises(ValueError, kkk.process, cat)
+
+    # A single object with several realizations is (1, nreal), not a row vector.
+    cat1 = treecorr.Catalog(x=x[:1], y=y[:1], k=k[:1])
+    assert cat1.nreal == nreal
+    assert cat1.k.shape == (1, nreal)
+    # But a row vector for a single realization is still allowed.
+    cat1 = treecorr.Catalog(x=x, y=y, k=k[:,0].reshape(1,-1))
+    assert cat1.nreal is None
+    np.testing.assert_array_equal(cat1.k, k[:,0])
+    # As is a column vector.
+    cat1 = treecorr.Catalog(x=x, y=y, k=k[:,:1])
+    assert cat1.nreal is None
+    np.testing.assert_array_equal(cat1.k, k[:,0])
+    # And the rows still line up with the positions when using every_nth.
+    cat1 = treecorr.Catalog(x=x, y=y, k=k, every_nth=3)
+    assert cat1.nreal == nreal
+    np.testing.assert_array_equal(cat1.k, k[::3])
+
+
 if __name__ == '__main__':
     test_direct()
     test_direct_spherical()
@@ -622,3 +749,4 @@ if __name__ == '__main__':
     test_kk()
     test_large_scale()
     test_varxi()
+    test_realizations()
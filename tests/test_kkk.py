@@ -91,6 +91,14 @@ def test_direct():
     np.testing.assert_allclose(kkk.weight, true_weight, rtol=1.e-5, atol=1.e-8)
     np.testing.assert_allclose(kkk.zeta, true_zeta, rtol=1.e-5, atol=1.e-8)
 
+    # With an odd number of threads, one of the per-thread results is left unpaired in the
+    # first round of the reduction.  Make sure it still gets included.
+    kkk3 = treecorr.KKKCorrelation(min_sep=min_sep, bin_size=bin_size, nbins=nrbins, brute=True)
+    kkk3.process(cat, num_threads=3)
+    np.testing.assert_array_equal(kkk3.ntri, true_ntri)
+    np.testing.assert_allclose(kkk3.weight, true_weight, rtol=1.e-5, atol=1.e-8)
+    np.testing.assert_allclose(kkk3.zeta, true_zeta, rtol=1.e-5, atol=1.e-8)
+
     try:
         import fitsio
     except ImportError:
@@ -559,8 +567,60 @@ def test_kkk():
     assert kkk2.sep_units == kkk.sep_units
     assert kkk2.bin_type == kkk.bin_type
 
+@timer
+def test_multipole():
+    # Check that the multipole algorithm gives nearly the same answer as the regular
+    # triangle algorithm.  Use a field made of a number of Gaussian blobs, so there is
+    # plenty of structure in the three-point function.
+    ngal = 1000
+    L = 30.
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(-L, L, (ngal,) )
+    y = rng.uniform(-L, L, (ngal,) )
+    w = rng.uniform(0.5, 1.5, (ngal,) )
+    k = np.zeros(ngal)
+    for i in range(20):
+        x0, y0 = rng.uniform(-L, L, 2)
+        k += np.exp(-((x-x0)**2 + (y-y0)**2) / (2.*5.**2))
+    cat = treecorr.Catalog(x=x, y=y, w=w, k=k)
+
+    kwargs = dict(min_sep=3., max_sep=12., nbins=3, nubins=3, nvbins=3, brute=True)
+    kkk = treecorr.KKKCorrelation(**kwargs)
+    kkk.process(cat)
+    mmm = treecorr.KKKCorrelation(algo='multipole', **kwargs)
+    mmm.process(cat)
+    print('kkk.zeta = ',kkk.zeta)
+    print('mmm.zeta = ',mmm.zeta)
+    print('max rel diff = ',np.max(np.abs((mmm.zeta - kkk.zeta)/kkk.zeta)))
+    np.testing.assert_allclose(mmm.zeta, kkk.zeta, rtol=0.05,
+                               atol=0.02 * np.max(np.abs(kkk.zeta)))
+    np.testing.assert_allclose(mmm.weight, kkk.weight, rtol=0.05)
+    np.testing.assert_allclose(mmm.meand2, kkk.meand2, rtol=0.01)
+    np.testing.assert_allclose(mmm.meanu, kkk.meanu, atol=0.01)
+    np.testing.assert_allclose(mmm.meanv, kkk.meanv, atol=0.01)
+    np.testing.assert_allclose(mmm.varzeta, kkk.varzeta, rtol=0.05)
+
+    # The main approximation is the resolution of the fine separation bins, which is 3 per
+    # r bin here by default.  With finer bins, the results converge to the triangle ones.
+    err = np.max(np.abs(mmm.zeta - kkk.zeta))
+    werr = np.max(np.abs(mmm.weight/kkk.weight - 1))
+    for nsub in [8, 16]:
+        mmm = treecorr.KKKCorrelation(algo='multipole', nsub=nsub, **kwargs)
+        mmm.process(cat)
+        err2 = np.max(np.abs(mmm.zeta - kkk.zeta))
+        werr2 = np.max(np.abs(mmm.weight/kkk.weight - 1))
+        print('nsub = ',nsub,': max zeta diff = ',err2,', max weight diff = ',werr2)
+        assert err2 < err
+        assert werr2 < werr
+        err, werr = err2, werr2
+    np.testing.assert_allclose(mmm.zeta, kkk.zeta, rtol=0.02,
+                               atol=0.01 * np.max(np.abs(kkk.zeta)))
+    np.testing.assert_allclose(mmm.weight, kkk.weight, rtol=0.015)
+
+
 if __name__ == '__main__':
     test_direct()
     test_direct_spherical()
     test_constant()
     test_kkk()
+    test_multipole()
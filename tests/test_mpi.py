@@ -62,6 +62,22 @@ def test_mpi_kk():
     mock_mpiexec(4, do_mpi_kk, output)
     mock_mpiexec(1, do_mpi_kk, output)
 
+@unittest.skipIf(sys.version_info < (3, 0), "mock_mpiexec doesn't support python 2")
+@timer
+def test_mpi_dynamic():
+    output = __name__ == '__main__'
+    mock_mpiexec(4, do_mpi_dynamic, output)
+    mock_mpiexec(2, do_mpi_dynamic, output)
+    mock_mpiexec(1, do_mpi_dynamic, output)
+
+@unittest.skipIf(sys.version_info < (3, 0), "mock_mpiexec doesn't support python 2")
+@timer
+def test_mpi_3pt():
+    output = __name__ == '__main__'
+    mock_mpiexec(4, do_mpi_3pt, output)
+    mock_mpiexec(3, do_mpi_3pt, output)
+    mock_mpiexec(1, do_mpi_3pt, output)
+
 if __name__ == '__main__':
     setup()
     test_mpi_gg()
@@ -70,3 +86,5 @@ if __name__ == '__main__':
     test_mpi_nn()
     test_mpi_kg()
     test_mpi_kk()
+    test_mpi_dynamic()
+    test_mpi_3pt()
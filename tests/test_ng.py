@@ -407,6 +407,14 @@ def test_single():
     np.testing.assert_allclose(ng.xi, true_gt, rtol=3.e-2)
     np.testing.assert_allclose(ng.xi_im, 0, atol=1.e-4)
 
+    # The cross correlation is parallelized over pairs of top-level cells, so multiple
+    # threads are useful even with a single lens.  They should all give the same answer.
+    ng4 = treecorr.NGCorrelation(bin_size=0.1, min_sep=1., max_sep=20., sep_units='arcmin')
+    ng4.process(lens_cat, source_cat, num_threads=4)
+    np.testing.assert_allclose(ng4.npairs, ng.npairs, rtol=1.e-10)
+    np.testing.assert_allclose(ng4.xi, ng.xi, rtol=1.e-10)
+    np.testing.assert_allclose(ng4.xi_im, ng.xi_im, rtol=1.e-10, atol=1.e-14)
+
     # Check that we get the same result using the corr2 function:
     lens_cat.write(os.path.join('data','ng_single_lens.dat'))
     source_cat.write(os.path.join('data','ng_single_source.dat'))
@@ -1377,6 +1385,73 @@ def test_varxi():
     np.testing.assert_allclose(mean_varxi, var_xi, rtol=0.02 * tol_factor)
 
 
+@timer
+def test_process_multi():
+    # Test that process_multi gives the same results as processing each correlation separately.
+    ngal = 2000
+    s = 10.
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(-3*s, 3*s, (ngal,) )
+    y = rng.uniform(-3*s, 3*s, (ngal,) )
+    w = rng.uniform(0.5, 1.5, (ngal,) )
+    k = rng.normal(0, 1, (ngal,) )
+    g1 = rng.normal(0, 0.2, (ngal,) )
+    g2 = rng.normal(0, 0.2, (ngal,) )
+    classes = [treecorr.NNCorrelation, treecorr.NKCorrelation, treecorr.NGCorrelation,
+               treecorr.KKCorrelation, treecorr.KGCorrelation, treecorr.GGCorrelation]
+
+    def check(cat1, cat2, **config):
+        corrs = [cls(**config) for cls in classes]
+        treecorr.process_multi(corrs, cat1, cat2)
+        for corr, cls in zip(corrs, classes):
+            corr2 = cls(**config)
+            if cat2 is None and corr._d1 != corr._d2:
+                corr2.process(cat1, cat1)
+            elif cat2 is None:
+                corr2.process(cat1)
+            else:
+                corr2.process(cat1, cat2)
+            names = ['weight', 'npairs', 'meanr', 'meanlogr'] + list(corr._xi_attrs)
+            names += [name for name in ['varxi', 'varxip'] if hasattr(corr, name)]
+            for name in names:
+                np.testing.assert_allclose(getattr(corr, name), getattr(corr2, name),
+                                           rtol=1.e-5, atol=1.e-8)
+            if cls is treecorr.NNCorrelation:
+                np.testing.assert_allclose(corr.tot, corr2.tot)
+            elif cat1.npatch > 1:
+                np.testing.assert_allclose(corr.estimate_cov('jackknife'),
+                                           corr2.estimate_cov('jackknife'),
+                                           rtol=1.e-4, atol=1.e-12)
+
+    cat = treecorr.Catalog(x=x, y=y, w=w, k=k, g1=g1, g2=g2)
+    cat2 = treecorr.Catalog(x=x[:500]+5, y=y[:500]+0.1, k=k[:500], g1=g1[:500], g2=g2[:500])
+    check(cat, None, min_sep=1., max_sep=30., nbins=8)
+    check(cat, None, min_sep=1., max_sep=30., nbins=8, brute=True)
+    check(cat, cat2, min_sep=1., max_sep=30., nbins=8)
+    # Avoid pairs exactly on the edges of the TwoD bins by shifting cat2 a bit in y.
+    check(cat, cat2, min_sep=1., max_sep=10., nbins=6, bin_type='TwoD', brute=True)
+    check(cat, None, min_sep=1., max_sep=10., nbins=6, bin_type='TwoD', brute=True)
+
+    # With patches, the results for each pair of patches are kept for the covariance.
+    catp = treecorr.Catalog(x=x, y=y, w=w, k=k, g1=g1, g2=g2, npatch=4)
+    check(catp, None, min_sep=1., max_sep=30., nbins=8)
+    check(catp, None, min_sep=1., max_sep=10., nbins=6, bin_type='TwoD', brute=True)
+
+    # Spherical coordinates
+    ra = x / 10.
+    dec = y / 10.
+    cat = treecorr.Catalog(ra=ra, dec=dec, ra_units='deg', dec_units='deg', w=w, k=k,
+                           g1=g1, g2=g2, npatch=4)
+    check(cat, None, min_sep=5., max_sep=200., nbins=8, sep_units='arcmin')
+
+    # The binning must be the same for all the correlations.
+    nn = treecorr.NNCorrelation(min_sep=1., max_sep=30., nbins=8)
+    gg = treecorr.GGCorrelation(min_sep=1., max_sep=30., nbins=9)
+    with assert_raises(ValueError):
+        treecorr.process_multi([nn, gg], cat)
+    with assert_raises(ValueError):
+        treecorr.process_multi([], cat)
+
 
 if __name__ == '__main__':
     test_direct()
@@ -1390,3 +1465,4 @@ if __name__ == '__main__':
     test_pieces()
     test_haloellip()
     test_varxi()
+    test_process_multi()
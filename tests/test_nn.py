@@ -903,6 +903,66 @@ def test_direct_3d():
     with assert_raises(ValueError):
         dd3.process(cat1, metric='Rlens')
 
+
+@timer
+def test_direct_blocks():
+    # With brute=True, the pairs of leaves are processed in blocks, rather than one at a time
+    # at the bottom of the recursion.  Use enough points to need several blocks, and check
+    # all the accumulated quantities, not just npairs.
+
+    ngal = 800
+    s = 10.
+    rng = np.random.RandomState(8675309)
+    x1 = rng.normal(312, s, (ngal,) )
+    y1 = rng.normal(728, s, (ngal,) )
+    z1 = rng.normal(-932, s, (ngal,) )
+    w1 = rng.random_sample(ngal)
+    cat1 = treecorr.Catalog(x=x1, y=y1, z=z1, w=w1)
+    x2 = rng.normal(312, s, (ngal,) )
+    y2 = rng.normal(728, s, (ngal,) )
+    z2 = rng.normal(-932, s, (ngal,) )
+    w2 = rng.random_sample(ngal)
+    cat2 = treecorr.Catalog(x=x2, y=y2, z=z2, w=w2)
+
+    min_sep = 1.
+    max_sep = 50.
+    nbins = 20
+    bin_size = np.log(max_sep/min_sep) / nbins
+
+    def direct(x1, y1, z1, w1, x2, y2, z2, w2, auto):
+        r = np.sqrt((x1[:,None]-x2)**2 + (y1[:,None]-y2)**2 + (z1[:,None]-z2)**2)
+        ww = w1[:,None] * w2
+        if auto:
+            r = r[np.triu_indices(ngal, 1)]
+            ww = ww[np.triu_indices(ngal, 1)]
+        logr = np.log(r)
+        k = np.floor((logr - np.log(min_sep)) / bin_size).astype(int)
+        use = (r >= min_sep) & (r < max_sep)
+        npairs = np.bincount(k[use], minlength=nbins)
+        weight = np.bincount(k[use], weights=ww[use], minlength=nbins)
+        meanr = np.bincount(k[use], weights=(ww*r)[use], minlength=nbins) / weight
+        meanlogr = np.bincount(k[use], weights=(ww*logr)[use], minlength=nbins) / weight
+        return npairs, weight, meanr, meanlogr
+
+    # With max_top=0, there is a single top-level cell, so it needs several blocks.
+    # With the default max_top, there are lots of small top-level cells.
+    for max_top, auto in [(0, False), (0, True), (10, False), (10, True)]:
+        dd = treecorr.NNCorrelation(min_sep=min_sep, max_sep=max_sep, nbins=nbins, brute=True,
+                                    max_top=max_top)
+        if auto:
+            dd.process(cat1)
+            npairs, weight, meanr, meanlogr = direct(x1, y1, z1, w1, x1, y1, z1, w1, True)
+        else:
+            dd.process(cat1, cat2)
+            npairs, weight, meanr, meanlogr = direct(x1, y1, z1, w1, x2, y2, z2, w2, False)
+        print('dd.npairs = ',dd.npairs)
+        print('true npairs = ',npairs)
+        np.testing.assert_array_equal(dd.npairs, npairs)
+        np.testing.assert_allclose(dd.weight, weight, rtol=1.e-6)
+        np.testing.assert_allclose(dd.meanr, meanr, rtol=1.e-6)
+        np.testing.assert_allclose(dd.meanlogr, meanlogr, rtol=1.e-6)
+
+
 @timer
 def test_direct_arc():
     # This is the same as the above test, but using the Arc distance metric
@@ -2008,6 +2068,104 @@ def test_linear_binslop():
             np.testing.assert_allclose(dd1.npairs, dd0.npairs, rtol=bin_slop)
 
 
+@timer
+def test_cache_dir():
+    # Test that process can save its results in cache_dir and read them back.
+    ngal = 2000
+    s = 10.
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(-3*s, 3*s, (ngal,) )
+    y = rng.uniform(-3*s, 3*s, (ngal,) )
+    w = rng.uniform(0.5, 1.5, (ngal,) )
+    cat = treecorr.Catalog(x=x, y=y, w=w, npatch=4)
+    cache_dir = os.path.join('output', 'nn_cache')
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+
+    config = dict(min_sep=1., max_sep=20., nbins=10, cache_dir=cache_dir)
+    rr1 = treecorr.NNCorrelation(config)
+    rr1.process(cat)
+    assert len(os.listdir(cache_dir)) == 1
+
+    # The second time, the results come from the cache, not a new calculation.
+    with CaptureLog() as cl:
+        rr2 = treecorr.NNCorrelation(config, logger=cl.logger)
+        rr2.process_auto = None  # Would fail if called.
+        rr2.process(cat)
+    assert 'Reading cached results' in cl.output
+    np.testing.assert_array_equal(rr2.npairs, rr1.npairs)
+    np.testing.assert_array_equal(rr2.weight, rr1.weight)
+    np.testing.assert_array_equal(rr2.meanr, rr1.meanr)
+    np.testing.assert_array_equal(rr2.meanlogr, rr1.meanlogr)
+    assert rr2.tot == rr1.tot
+    assert rr2.npatch1 == rr2.npatch2 == 4
+    assert rr2.coords == rr1.coords
+    # The results for each pair of patches are also saved, so the covariance is the same.
+    dd = treecorr.NNCorrelation(min_sep=1., max_sep=20., nbins=10)
+    dd.process(cat)
+    dd.calculateXi(rr1)
+    cov1 = dd.estimate_cov('jackknife')
+    dd.calculateXi(rr2)
+    np.testing.assert_allclose(dd.estimate_cov('jackknife'), cov1)
+    # The C++ layer sees the same arrays as before.
+    del rr2.process_auto
+    rr2.process_auto(cat)
+    np.testing.assert_allclose(rr2.weight, 2*rr1.weight, rtol=1.e-2)
+
+    # Cross correlations work too.
+    cat2 = treecorr.Catalog(x=x[:500]+1., y=y[:500], patch_centers=cat.patch_centers)
+    rr1.process(cat, cat2)
+    rr2 = treecorr.NNCorrelation(config)
+    rr2.process_cross = None
+    rr2.process(cat, cat2)
+    np.testing.assert_array_equal(rr2.weight, rr1.weight)
+    assert len(os.listdir(cache_dir)) == 2
+
+    # Any change to the positions, weights, patches, or binning needs a new calculation.
+    for cat3 in [treecorr.Catalog(x=x, y=y+1.e-8, w=w, patch_centers=cat.patch_centers),
+                 treecorr.Catalog(x=x, y=y, w=w**2, patch_centers=cat.patch_centers),
+                 treecorr.Catalog(x=x, y=y, w=w, npatch=3)]:
+        rr3 = treecorr.NNCorrelation(config)
+        rr3.process(cat3)
+    assert len(os.listdir(cache_dir)) == 5
+    for config3 in [dict(config, nbins=11), dict(config, bin_slop=0.5),
+                    dict(config, bin_type='Linear'), dict(config, brute=True)]:
+        rr3 = treecorr.NNCorrelation(config3)
+        rr3.process(cat)
+    assert len(os.listdir(cache_dir)) == 9
+    rr3 = treecorr.NNCorrelation(config, period=100)
+    rr3.process(cat, metric='Periodic')
+    assert len(os.listdir(cache_dir)) == 10
+
+    # If the file is corrupted somehow, it just recomputes.
+    cache_file = rr1._get_cache_file(cat, None, None)
+    with open(cache_file, 'w') as fid:
+        fid.write('garbage')
+    with CaptureLog() as cl:
+        rr2 = treecorr.NNCorrelation(config, logger=cl.logger)
+        rr2.process(cat)
+    assert 'Unable to read cache file' in cl.output
+    rr0 = treecorr.NNCorrelation(min_sep=1., max_sep=20., nbins=10)
+    rr0.process(cat)
+    np.testing.assert_array_equal(rr2.weight, rr0.weight)
+    np.testing.assert_array_equal(rr2.npairs, rr0.npairs)
+
+    # NNNCorrelation can also use a cache.
+    cat = treecorr.Catalog(x=x[:300], y=y[:300], w=w[:300])
+    config = dict(min_sep=1., max_sep=10., nbins=5, nubins=3, nvbins=3, cache_dir=cache_dir)
+    rrr1 = treecorr.NNNCorrelation(config)
+    rrr1.process(cat)
+    rrr2 = treecorr.NNNCorrelation(config)
+    rrr2.process_auto = None
+    rrr2.process(cat)
+    np.testing.assert_array_equal(rrr2.ntri, rrr1.ntri)
+    np.testing.assert_array_equal(rrr2.weight, rrr1.weight)
+    np.testing.assert_array_equal(rrr2.meand2, rrr1.meand2)
+    np.testing.assert_array_equal(rrr2.meanu, rrr1.meanu)
+    assert rrr2.tot == rrr1.tot
+    assert len(os.listdir(cache_dir)) == 11
+
+
 if __name__ == '__main__':
     test_log_binning()
     test_linear_binning()
@@ -2015,6 +2173,7 @@ if __name__ == '__main__':
     test_direct_spherical()
     test_pairwise()
     test_direct_3d()
+    test_direct_blocks()
     test_direct_arc()
     test_direct_partial()
     test_direct_linear()
@@ -2025,3 +2184,4 @@ if __name__ == '__main__':
     test_varxi()
     test_sph_linear()
     test_linear_binslop()
+    test_cache_dir()
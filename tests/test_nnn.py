@@ -2285,6 +2285,133 @@ def test_list():
     np.testing.assert_allclose(corr3_output['zeta'], zeta.flatten(), rtol=1.e-3)
 
 
+@timer
+def test_multipole():
+    # Check that the multipole algorithm gives nearly the same answer as the regular
+    # triangle algorithm.
+    ngal = 1000
+    s = 10.
+    rng = np.random.RandomState(8675309)
+    x = rng.normal(0,s, (ngal,) )
+    y = rng.normal(0,s, (ngal,) )
+    w = rng.uniform(0.5, 1.5, (ngal,) )
+    cat = treecorr.Catalog(x=x, y=y, w=w)
+
+    kwargs = dict(min_sep=2., max_sep=10., nbins=4, nubins=4, nvbins=4, brute=True)
+    ddd = treecorr.NNNCorrelation(**kwargs)
+    ddd.process(cat)
+    mmm = treecorr.NNNCorrelation(algo='multipole', **kwargs)
+    mmm.process(cat)
+    print('ddd.ntri = ',ddd.ntri)
+    print('mmm.ntri = ',mmm.ntri)
+    print('ratio = ',mmm.ntri/ddd.ntri)
+    # The multipole algorithm spreads the triangles near the edges of the bins, so individual
+    # bins are only accurate to a few percent for this many triangles.
+    np.testing.assert_allclose(mmm.ntri, ddd.ntri, rtol=0.05)
+    np.testing.assert_allclose(mmm.weight, ddd.weight, rtol=0.05)
+    # But the totals along each axis should be quite accurate.
+    for axis in [(1,2), (0,2), (0,1)]:
+        np.testing.assert_allclose(mmm.weight.sum(axis=axis), ddd.weight.sum(axis=axis),
+                                   rtol=3.e-3)
+    np.testing.assert_allclose(mmm.tot, ddd.tot)
+    np.testing.assert_allclose(mmm.meand1, ddd.meand1, rtol=0.01)
+    np.testing.assert_allclose(mmm.meand2, ddd.meand2, rtol=0.01)
+    np.testing.assert_allclose(mmm.meand3, ddd.meand3, rtol=0.01)
+    np.testing.assert_allclose(mmm.meanlogd1, ddd.meanlogd1, atol=0.01)
+    np.testing.assert_allclose(mmm.meanu, ddd.meanu, atol=0.01)
+    np.testing.assert_allclose(mmm.meanv, ddd.meanv, atol=0.01)
+
+    # Higher max_n doesn't change much.  With max_n = 0, the triangles are spread uniformly in
+    # the opening angle, which is quite wrong.
+    mmm2 = treecorr.NNNCorrelation(algo='multipole', max_n=60, **kwargs)
+    mmm2.process(cat)
+    np.testing.assert_allclose(mmm2.weight, mmm.weight, rtol=0.02)
+    mmm2 = treecorr.NNNCorrelation(algo='multipole', max_n=0, **kwargs)
+    mmm2.process(cat)
+    print('max_n=0 ratio = ',mmm2.weight/ddd.weight)
+    assert np.max(np.abs(mmm2.weight/ddd.weight-1)) > 0.2
+
+    # The default bin_slop is also pretty close.
+    del kwargs['brute']
+    mmm2 = treecorr.NNNCorrelation(algo='multipole', **kwargs)
+    mmm2.process(cat)
+    np.testing.assert_allclose(mmm2.weight, ddd.weight, rtol=0.05)
+
+    # Restricted ranges of u and v work too.
+    kwargs = dict(min_sep=2., max_sep=10., nbins=4, min_u=0.3, max_u=0.9, nubins=3,
+                  min_v=0.2, max_v=0.8, nvbins=3)
+    ddd = treecorr.NNNCorrelation(**kwargs)
+    ddd.process(cat)
+    mmm = treecorr.NNNCorrelation(algo='multipole', **kwargs)
+    mmm.process(cat)
+    print('ratio = ',mmm.ntri/ddd.ntri)
+    np.testing.assert_allclose(mmm.ntri, ddd.ntri, rtol=0.05)
+    np.testing.assert_allclose(mmm.weight.sum(), ddd.weight.sum(), rtol=0.01)
+    np.testing.assert_allclose(mmm.meand1, ddd.meand1, rtol=0.01)
+    np.testing.assert_allclose(mmm.meanv, ddd.meanv, atol=0.01)
+
+    # Spherical coordinates, with either Euclidean or Arc metric.
+    # At these small separations, the two metrics are nearly identical, so just compare
+    # both to the regular Euclidean calculation.
+    ra, dec = coord.CelestialCoord(20 * coord.degrees, -40 * coord.degrees).deproject_rad(
+            x * (coord.arcmin / coord.radians), y * (coord.arcmin / coord.radians))
+    cat = treecorr.Catalog(ra=ra, dec=dec, ra_units='rad', dec_units='rad', w=w)
+    kwargs = dict(min_sep=2., max_sep=10., nbins=4, nubins=4, nvbins=4, sep_units='arcmin')
+    ddd = treecorr.NNNCorrelation(**kwargs)
+    ddd.process(cat)
+    for metric in ['Euclidean', 'Arc']:
+        mmm = treecorr.NNNCorrelation(metric=metric, algo='multipole', **kwargs)
+        mmm.process(cat)
+        print(metric,' ratio = ',mmm.ntri/ddd.ntri)
+        np.testing.assert_allclose(mmm.ntri, ddd.ntri, rtol=0.05)
+        np.testing.assert_allclose(mmm.weight.sum(), ddd.weight.sum(), rtol=0.01)
+        np.testing.assert_allclose(mmm.meand1, ddd.meand1, rtol=0.01)
+        np.testing.assert_allclose(mmm.meand2, ddd.meand2, rtol=0.01)
+        np.testing.assert_allclose(mmm.meanv, ddd.meanv, atol=0.01)
+
+    # A list with a single catalog is allowed, but not more than that.
+    mmm2 = treecorr.NNNCorrelation(metric=metric, algo='multipole', **kwargs)
+    mmm2.process([cat])
+    np.testing.assert_allclose(mmm2.weight, mmm.weight)
+    assert_raises(ValueError, mmm.process, [cat, cat])
+
+    # Only auto-correlations are implemented.
+    assert_raises(NotImplementedError, mmm.process, cat, cat, cat)
+    assert_raises(NotImplementedError, mmm.process, cat, cat)
+
+    # Only flat and spherical coordinates with Euclidean or Arc metrics.
+    cat3d = treecorr.Catalog(x=x, y=y, z=x+y, w=w)
+    assert_raises(ValueError, mmm.process, cat3d)
+    catp = treecorr.Catalog(x=x, y=y, w=w)
+    mmmp = treecorr.NNNCorrelation(algo='multipole', metric='Periodic', period=100,
+                                   min_sep=2., max_sep=10., nbins=4)
+    assert_raises(ValueError, mmmp.process, catp)
+
+    # The results aren't split up by patch, so only shot variance is possible, and MPI
+    # isn't allowed.
+    kwargs = dict(min_sep=2., max_sep=10., nbins=4)
+    mmm = treecorr.NNNCorrelation(algo='multipole', **kwargs)
+    mmm.process(catp)
+    catp = treecorr.Catalog(x=x, y=y, w=w, npatch=4)
+    mmmp = treecorr.NNNCorrelation(algo='multipole', **kwargs)
+    mmmp.process(catp)
+    np.testing.assert_allclose(mmmp.weight, mmm.weight)
+    for var_method in ['jackknife', 'sample', 'bootstrap', 'marked_bootstrap']:
+        mmmp = treecorr.NNNCorrelation(algo='multipole', var_method=var_method, **kwargs)
+        assert_raises(NotImplementedError, mmmp.process, catp)
+    ggg = treecorr.GGGCorrelation(algo='multipole', var_method='jackknife', **kwargs)
+    assert_raises(NotImplementedError, ggg.process, catp)
+    mmmp = treecorr.NNNCorrelation(algo='multipole', **kwargs)
+    assert_raises(NotImplementedError, mmmp.process, catp, comm=object())
+
+    assert_raises(ValueError, treecorr.NNNCorrelation, algo='invalid', min_sep=2., max_sep=10.,
+                  nbins=4)
+    assert_raises(ValueError, treecorr.NNNCorrelation, algo='multipole', max_n=-1, min_sep=2.,
+                  max_sep=10., nbins=4)
+    assert_raises(ValueError, treecorr.NNNCorrelation, algo='multipole', nsub=0, min_sep=2.,
+                  max_sep=10., nbins=4)
+
+
 if __name__ == '__main__':
     test_log_binning()
     test_direct_count_auto()
@@ -2297,3 +2424,4 @@ if __name__ == '__main__':
     test_nnn()
     test_3d()
     test_list()
+    test_multipole()
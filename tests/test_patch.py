@@ -14,11 +14,12 @@
 from __future__ import print_function
 import numpy as np
 import os
+import shutil
 import coord
 import time
 import treecorr
 
-from test_helper import assert_raises, do_pickle, profile, timer, get_from_wiki
+from test_helper import assert_raises, do_pickle, profile, timer, get_from_wiki, CaptureLog
 
 @timer
 def test_cat_patches():
@@ -2460,6 +2461,833 @@ def test_config():
     print('gg2.varxim = ',gg2.varxim)
     np.testing.assert_allclose(varxi_jk, np.concatenate([gg2.varxip, gg2.varxim]), rtol=1.e-10)
 
+@timer
+def test_patch_threads():
+    """Test processing several pairs of patches concurrently with num_patch_threads.
+    """
+    if __name__ == '__main__':
+        ngal = 20000
+        npatch = 32
+    else:
+        ngal = 2000
+        npatch = 8
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(-20,20, (ngal,) )
+    y = rng.uniform(-20,20, (ngal,) )
+    k = rng.normal(0,1, (ngal,) )
+    g1 = rng.normal(0,0.2, (ngal,) )
+    g2 = rng.normal(0,0.2, (ngal,) )
+    cat = treecorr.Catalog(x=x, y=y, k=k, g1=g1, g2=g2, npatch=npatch)
+    rcat = treecorr.Catalog(x=rng.uniform(-20,20, (2*ngal,)), y=rng.uniform(-20,20, (2*ngal,)),
+                            patch_centers=cat.patch_centers)
+
+    # Auto-correlations
+    gg1 = treecorr.GGCorrelation(bin_size=0.3, min_sep=1., max_sep=10., bin_slop=0)
+    gg1.process(cat)
+    gg2 = treecorr.GGCorrelation(bin_size=0.3, min_sep=1., max_sep=10., bin_slop=0,
+                                 num_patch_threads=4)
+    gg2.process(cat)
+    np.testing.assert_allclose(gg2.npairs, gg1.npairs)
+    np.testing.assert_allclose(gg2.weight, gg1.weight)
+    np.testing.assert_allclose(gg2.xip, gg1.xip, rtol=1.e-10, atol=1.e-14)
+    np.testing.assert_allclose(gg2.xim, gg1.xim, rtol=1.e-10, atol=1.e-14)
+    assert sorted(gg2.results.keys()) == sorted(gg1.results.keys())
+    np.testing.assert_allclose(gg2.estimate_cov('jackknife'), gg1.estimate_cov('jackknife'),
+                               rtol=1.e-8, atol=1.e-14)
+
+    # Cross-correlations, including NN, which needs to get tot right.
+    ng1 = treecorr.NGCorrelation(bin_size=0.3, min_sep=1., max_sep=10., bin_slop=0)
+    ng1.process(rcat, cat)
+    ng2 = treecorr.NGCorrelation(bin_size=0.3, min_sep=1., max_sep=10., bin_slop=0,
+                                 num_patch_threads=3)
+    ng2.process(rcat, cat)
+    np.testing.assert_allclose(ng2.npairs, ng1.npairs)
+    np.testing.assert_allclose(ng2.xi, ng1.xi, rtol=1.e-10, atol=1.e-14)
+    np.testing.assert_allclose(ng2.estimate_cov('sample'), ng1.estimate_cov('sample'),
+                               rtol=1.e-8, atol=1.e-14)
+
+    dd1 = treecorr.NNCorrelation(bin_size=0.3, min_sep=1., max_sep=10., bin_slop=0)
+    dd1.process(cat, rcat)
+    dd2 = treecorr.NNCorrelation(bin_size=0.3, min_sep=1., max_sep=10., bin_slop=0,
+                                 num_patch_threads=4)
+    dd2.process(cat, rcat)
+    np.testing.assert_allclose(dd2.npairs, dd1.npairs)
+    assert dd2.tot == dd1.tot
+
+    # With low_mem, it reverts to processing the patches one at a time.
+    kk1 = treecorr.KKCorrelation(bin_size=0.3, min_sep=1., max_sep=10., bin_slop=0)
+    kk1.process(cat)
+    kk2 = treecorr.KKCorrelation(bin_size=0.3, min_sep=1., max_sep=10., bin_slop=0,
+                                 num_patch_threads=4)
+    kk2.process(cat, low_mem=True)
+    np.testing.assert_allclose(kk2.xi, kk1.xi, rtol=1.e-10, atol=1.e-14)
+
+
+@timer
+def test_patch_schedule():
+    """Test the cost-based ordering and assignment of pairs of patches.
+    """
+    if __name__ == '__main__':
+        ngal = 20000
+        npatch = 32
+    else:
+        ngal = 2000
+        npatch = 10
+    rng = np.random.RandomState(8675309)
+    # Make the density very non-uniform, so the patches have different costs.
+    x = rng.exponential(10, (ngal,) )
+    y = rng.uniform(-20,20, (ngal,) )
+    k = rng.normal(0,1, (ngal,) )
+    cat = treecorr.Catalog(x=x, y=y, k=k, npatch=npatch)
+    rcat = treecorr.Catalog(x=rng.uniform(0,50, (ngal,)), y=rng.uniform(-20,20, (ngal,)),
+                            patch_centers=cat.patch_centers)
+
+    kk1 = treecorr.KKCorrelation(bin_size=0.3, min_sep=1., max_sep=10., bin_slop=0)
+    kk1.process(cat)
+    kk2 = treecorr.KKCorrelation(bin_size=0.3, min_sep=1., max_sep=10., bin_slop=0,
+                                 patch_schedule='cost')
+    kk2.process(cat)
+    np.testing.assert_allclose(kk2.npairs, kk1.npairs)
+    np.testing.assert_allclose(kk2.xi, kk1.xi, rtol=1.e-10, atol=1.e-14)
+    assert sorted(kk2.results.keys()) == sorted(kk1.results.keys())
+    np.testing.assert_allclose(kk2.estimate_cov('jackknife'), kk1.estimate_cov('jackknife'),
+                               rtol=1.e-8, atol=1.e-14)
+
+    dd1 = treecorr.NNCorrelation(bin_size=0.3, min_sep=1., max_sep=10., bin_slop=0)
+    dd1.process(cat, rcat)
+    dd2 = treecorr.NNCorrelation(bin_size=0.3, min_sep=1., max_sep=10., bin_slop=0,
+                                 patch_schedule='cost', num_patch_threads=2)
+    dd2.process(cat, rcat)
+    np.testing.assert_allclose(dd2.npairs, dd1.npairs)
+    assert dd2.tot == dd1.tot
+
+    # The auto costs scale as n^2 times the fraction of pairs within max_sep.
+    # And the costs are zero for distant pairs.
+    costs = kk2._get_patch_costs(cat.get_patches(), None, False)
+    assert len(costs) == npatch*(npatch+1)//2
+    for i, p in enumerate(cat.get_patches()):
+        s = p._get_center_size()[3]
+        expected = 0.5 * p.nobj**2 * min(1, 10.**2 / (2*s**2)) + p.nobj
+        np.testing.assert_allclose(costs[(i,i)], expected)
+    for (i,j), c in costs.items():
+        p1 = cat.get_patches()[i]
+        p2 = cat.get_patches()[j]
+        assert (c == 0) == kk2._trivially_zero(p1, p2, 'Euclidean')
+
+    # Check that the assignment to MPI ranks covers all the jobs exactly once and is
+    # reasonably well balanced.
+    pairs = list(costs.keys())
+    values = list(costs.values())
+    size = 3
+    mine = [kk2._assign_patch_jobs(pairs, values, size, rank) for rank in range(size)]
+    assert sum(len(m) for m in mine) == len(pairs)
+    assert set.union(*mine) == set(pairs)
+    loads = [np.sum([costs[p] for p in m]) for m in mine]
+    print('loads = ',loads)
+    assert np.max(loads) <= np.sum(values)/size + np.max(values)
+
+    with assert_raises(ValueError):
+        kk3 = treecorr.KKCorrelation(bin_size=0.3, min_sep=1., max_sep=10.,
+                                     patch_schedule='invalid')
+        kk3.process(cat)
+
+
+@timer
+def test_patch_results():
+    """Test the compact storage of the results for each pair of patches.
+    """
+    import pickle
+    ngal = 2000
+    npatch = 8
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(-20,20, (ngal,) )
+    y = rng.uniform(-20,20, (ngal,) )
+    g1 = rng.normal(0,0.2, (ngal,) )
+    g2 = rng.normal(0,0.2, (ngal,) )
+    cat = treecorr.Catalog(x=x, y=y, g1=g1, g2=g2, npatch=npatch)
+    patches = cat.get_patches()
+
+    gg = treecorr.GGCorrelation(bin_size=0.3, min_sep=1., max_sep=10., bin_slop=0)
+    gg.process(cat)
+    assert isinstance(gg.results, treecorr.util.PatchPairResults)
+    assert len(gg.results) == len(gg.results.keys())
+
+    # Each entry should match running that pair on its own.
+    for (i,j) in [(0,0), (2,2), gg.results.keys()[-1]]:
+        gg1 = treecorr.GGCorrelation(bin_size=0.3, min_sep=1., max_sep=10., bin_slop=0)
+        if i == j:
+            gg1.process_auto(patches[i])
+        else:
+            gg1.process_cross(patches[i], patches[j])
+        cij = gg.results[(i,j)]
+        assert isinstance(cij, treecorr.GGCorrelation)
+        np.testing.assert_allclose(cij.xip, gg1.xip)
+        np.testing.assert_allclose(cij.xim, gg1.xim)
+        np.testing.assert_allclose(cij.weight, gg1.weight)
+        np.testing.assert_allclose(cij._getStat(), gg1._getStat())
+    assert (0,1) in gg.results or np.sum(gg.npairs) == 0
+    assert (npatch,npatch) not in gg.results
+    with assert_raises(KeyError):
+        gg.results[(npatch,npatch)]
+
+    # The stacked arrays hold all the rows.
+    np.testing.assert_allclose(np.sum(gg.results.stack('weight'), axis=0), gg.weight)
+
+    # Pickling and copying keep the same results.
+    gg2 = pickle.loads(pickle.dumps(gg))
+    assert gg2.results.keys() == gg.results.keys()
+    np.testing.assert_allclose(gg2.estimate_cov('jackknife'), gg.estimate_cov('jackknife'))
+    gg3 = gg.copy()
+    np.testing.assert_allclose(gg3.estimate_cov('jackknife'), gg.estimate_cov('jackknife'))
+
+    # Changing the copy doesn't change the original.
+    gg3.results[(0,0)] = gg3.results[(0,1)] if (0,1) in gg3.results else gg3.results[(1,1)]
+    np.testing.assert_allclose(gg.results[(0,0)].xip, gg2.results[(0,0)].xip)
+
+    # update combines two sets of results, as when combining results from MPI processes.
+    keys = gg.results.keys()
+    gg4 = gg.copy()
+    gg4.results.clear()
+    assert len(gg4.results) == 0
+    half = treecorr.util.PatchPairResults()
+    for ij in keys[:len(keys)//2]:
+        gg4.results[ij] = gg.results[ij]
+    for ij in keys[len(keys)//2:]:
+        half[ij] = gg.results[ij]
+    gg4.results.update(half)
+    assert gg4.results.keys() == keys
+    np.testing.assert_allclose(gg4.estimate_cov('jackknife'), gg.estimate_cov('jackknife'))
+
+    # clear empties the results
+    gg.clear()
+    assert len(gg.results) == 0
+    assert gg.results.keys() == []
+
+
+@timer
+def test_cov_vectorized():
+    """Test that the covariance estimates match explicit sums over the lists of patch pairs.
+    """
+    ngal = 3000
+    npatch = 10
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(-30,30, (ngal,) )
+    y = rng.uniform(-30,30, (ngal,) )
+    k = rng.normal(0,1, (ngal,) )
+    cat = treecorr.Catalog(x=x, y=y, k=k, npatch=npatch)
+    kk = treecorr.KKCorrelation(bin_size=0.3, min_sep=1., max_sep=10., num_bootstrap=30)
+    kk.process(cat)
+    pairs = kk.results.keys()
+
+    def design(vpairs):
+        v = []
+        for p in vpairs:
+            n = np.sum([kk.results[ij].xi for ij in p], axis=0)
+            d = np.sum([kk.results[ij].weight for ij in p], axis=0)
+            d[d == 0] = 1
+            v.append(n/d)
+        v = np.array(v)
+        return v - np.mean(v, axis=0)
+
+    # jackknife excludes all pairs involving patch i.
+    v = design([ [(j,k) for j,k in pairs if j!=i and k!=i] for i in range(npatch) ])
+    cov = (1.-1./npatch) * v.T.dot(v)
+    np.testing.assert_allclose(kk.estimate_cov('jackknife'), cov)
+
+    # bootstrap includes the auto pairs once per selection and cross pairs for each pair of
+    # selections.  The random selections are drawn in order, one realization at a time.
+    np.random.seed(1234)
+    indx = np.random.randint(npatch, size=(kk.num_bootstrap, npatch))
+    vpairs = []
+    for ind in indx:
+        vp = [ (i,i) for i in ind if (i,i) in pairs ]
+        vp += [ (i,j) for i in ind for j in ind if i != j and (i,j) in pairs ]
+        vpairs.append(vp)
+    v = design(vpairs)
+    cov = 1./(kk.num_bootstrap-1) * v.T.dot(v)
+    np.random.seed(1234)
+    np.testing.assert_allclose(kk.estimate_cov('bootstrap'), cov)
+
+    # marked_bootstrap includes all pairs with a selected patch first.
+    vpairs = [ [ (i,j) for i in ind for j in range(npatch) if (i,j) in pairs ] for ind in indx ]
+    v = design(vpairs)
+    cov = 1./(kk.num_bootstrap-1) * v.T.dot(v)
+    np.random.seed(1234)
+    np.testing.assert_allclose(kk.estimate_cov('marked_bootstrap'), cov)
+
+
+@timer
+def test_cov_cache():
+    """Test that the values used for the covariance estimates are reused until the results change.
+    """
+    ngal = 3000
+    npatch = 10
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(-30,30, (ngal,) )
+    y = rng.uniform(-30,30, (ngal,) )
+    k = rng.normal(0,1, (ngal,) )
+    cat = treecorr.Catalog(x=x, y=y, k=k, npatch=npatch)
+    kk = treecorr.KKCorrelation(bin_size=0.3, min_sep=1., max_sep=10., num_bootstrap=30,
+                                var_method='jackknife')
+    kk.process(cat)
+
+    # finalize already computed the jackknife design matrix.
+    assert ('design', 'jackknife', npatch) in kk._cov_cache
+    cov1 = kk.estimate_cov('jackknife')
+    np.testing.assert_allclose(kk.varxi, cov1.diagonal())
+
+    # The sums for each patch are shared with the other methods.
+    nsums = len(kk._cov_cache)
+    cov2 = kk.estimate_cov('sample')
+    kk.estimate_cov('bootstrap')
+    kk.estimate_cov('marked_bootstrap')
+    assert len(kk._cov_cache) == nsums + 1  # Just the sample design matrix.
+    np.testing.assert_allclose(treecorr.estimate_multi_cov([kk,kk], 'jackknife')[:kk.nbins,:kk.nbins],
+                               cov1)
+
+    # Modifying the results clears the cache.
+    kk2 = kk.copy()
+    kk2 += kk
+    assert len(kk2._cov_cache) == 0
+    kk.clear()
+    assert len(kk._cov_cache) == 0
+
+    # Processing a different catalog gives the new covariance.
+    cat2 = treecorr.Catalog(x=x, y=y, k=2*k, patch_centers=cat.patch_centers)
+    kk.process(cat2)
+    np.testing.assert_allclose(kk.estimate_cov('jackknife'), 16*cov1)
+    np.testing.assert_allclose(kk.estimate_cov('sample'), 16*cov2)
+
+    # Same for NN, where calculateXi also clears the cache.
+    rx = rng.uniform(-30,30, (3*ngal,) )
+    ry = rng.uniform(-30,30, (3*ngal,) )
+    rand = treecorr.Catalog(x=rx, y=ry, patch_centers=cat.patch_centers)
+    dd = treecorr.NNCorrelation(bin_size=0.3, min_sep=1., max_sep=10., var_method='jackknife')
+    rr = treecorr.NNCorrelation(bin_size=0.3, min_sep=1., max_sep=10.)
+    dr = treecorr.NNCorrelation(bin_size=0.3, min_sep=1., max_sep=10.)
+    dd.process(cat)
+    rr.process(rand)
+    dr.process(cat, rand)
+    dd.calculateXi(rr)
+    cov3 = dd.estimate_cov('jackknife')
+    dd.calculateXi(rr, dr)
+    cov4 = dd.estimate_cov('jackknife')
+    assert not np.allclose(cov3, cov4)
+    dd2 = dd.copy()
+    dd2.clear()
+    dd2.process(cat)
+    dd2.calculateXi(rr, dr)
+    np.testing.assert_allclose(dd2.estimate_cov('jackknife'), cov4)
+
+    # If rr or dr are processed again in place, the cached values in dd are not used.
+    rand2 = treecorr.Catalog(x=rng.uniform(-30,30, (3*ngal,)), y=rng.uniform(-30,30, (3*ngal,)),
+                             patch_centers=cat.patch_centers)
+    rr2 = treecorr.NNCorrelation(bin_size=0.3, min_sep=1., max_sep=10.)
+    dr2 = treecorr.NNCorrelation(bin_size=0.3, min_sep=1., max_sep=10.)
+    rr2.process(rand2)
+    dr2.process(cat, rand2)
+    dd3 = dd.copy()
+    dd3.calculateXi(rr2, dr)
+    cov5 = dd3.estimate_cov('jackknife')
+    dd4 = dd.copy()
+    dd4.calculateXi(rr2, dr2)
+    cov6 = dd4.estimate_cov('jackknife')
+    assert not np.allclose(cov5, cov4)
+    assert not np.allclose(cov6, cov5)
+    # Make sure dd has the cached values from rr and dr.
+    np.testing.assert_allclose(dd.estimate_cov('jackknife'), cov4)
+    rr.process(rand2)
+    np.testing.assert_allclose(dd.estimate_cov('jackknife'), cov5)
+    dr.process(cat, rand2)
+    np.testing.assert_allclose(dd.estimate_cov('jackknife'), cov6)
+    np.testing.assert_allclose(dd.estimate_cov('sample'), dd4.estimate_cov('sample'))
+
+@timer
+def test_checkpoint():
+    # Test checkpointing and resuming the processing of pairs of patches.
+    ngal = 3000
+    npatch = 8
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(-30,30, (ngal,) )
+    y = rng.uniform(-30,30, (ngal,) )
+    k = rng.normal(0,1, (ngal,) )
+    cat = treecorr.Catalog(x=x, y=y, k=k, npatch=npatch)
+    rand = treecorr.Catalog(x=rng.uniform(-30,30, (ngal,)), y=rng.uniform(-30,30, (ngal,)),
+                            patch_centers=cat.patch_centers)
+    ckpt_file = os.path.join('output','test_checkpoint.pkl')
+
+    def fail_after(corr, n):
+        # Make corr raise an exception after processing n pairs of patches.
+        orig = corr._process_patch_pair
+        count = [0]
+        def process_patch_pair(*args):
+            count[0] += 1
+            if count[0] > n:
+                raise RuntimeError("Simulated failure")
+            return orig(*args)
+        corr._process_patch_pair = process_patch_pair
+        return count
+
+    config = dict(bin_size=0.3, min_sep=1., max_sep=10., checkpoint=ckpt_file)
+    for Correlation, cats, attrs in [
+            (treecorr.KKCorrelation, [cat], ['xi', 'npairs', 'weight']),
+            (treecorr.NNCorrelation, [cat, rand], ['npairs', 'weight', 'tot']) ]:
+        for num_patch_threads in [1, 2]:
+            corr0 = Correlation(config)
+            corr0.process(*cats)
+            njobs = npatch*(npatch+1)//2 if len(cats) == 1 else npatch**2
+
+            corr1 = Correlation(config, checkpoint_interval=0,
+                                num_patch_threads=num_patch_threads)
+            # The actual file name includes the class name and a hash of the catalogs.
+            file_name = corr1._get_checkpoint_file(*[c.get_patches() for c in cats])[0]
+            assert file_name.startswith(os.path.join('output','test_checkpoint_'+
+                                                     Correlation.__name__+'_'))
+            assert file_name.endswith('.pkl')
+            if os.path.exists(file_name):
+                os.remove(file_name)
+            fail_after(corr1, 10)
+            with assert_raises(RuntimeError):
+                corr1.process(*cats)
+            assert os.path.isfile(file_name)
+
+            # Resuming only does the rest of the pairs.
+            with CaptureLog() as cl:
+                corr2 = Correlation(config, resume=True, logger=cl.logger)
+                count = fail_after(corr2, 1000)
+                corr2.process(*cats)
+            print(cl.output)
+            assert 'Resuming from checkpoint' in cl.output
+            assert 0 < count[0] <= njobs - 10
+            for a in attrs:
+                np.testing.assert_allclose(getattr(corr2,a), getattr(corr0,a), rtol=1.e-10)
+            assert sorted(corr2.results.keys()) == sorted(corr0.results.keys())
+            if Correlation is treecorr.KKCorrelation:
+                np.testing.assert_allclose(corr2.estimate_cov('jackknife'),
+                                           corr0.estimate_cov('jackknife'))
+
+            # After finishing, the checkpoint has everything, so resuming doesn't process anything.
+            corr3 = Correlation(config, resume=True)
+            count = fail_after(corr3, 0)
+            corr3.process(*cats)
+            assert count[0] == 0
+            for a in attrs:
+                np.testing.assert_allclose(getattr(corr3,a), getattr(corr0,a), rtol=1.e-10)
+
+    # Without resume, the checkpoint is ignored and gets overwritten.
+    corr4 = treecorr.NNCorrelation(config)
+    count = fail_after(corr4, 1000)
+    corr4.process(cat)
+    corr0 = treecorr.NNCorrelation(bin_size=0.3, min_sep=1., max_sep=10.)
+    count0 = fail_after(corr0, 1000)
+    corr0.process(cat)
+    assert count[0] == count0[0]
+
+    # A checkpoint from a different calculation is not used.
+    with CaptureLog() as cl:
+        corr5 = treecorr.NNCorrelation(config, resume=True, min_sep=2., logger=cl.logger)
+        corr5.process(cat)
+    assert 'does not match' in cl.output
+    corr6 = treecorr.NNCorrelation(config, min_sep=2.)
+    corr6.process(cat)
+    np.testing.assert_allclose(corr5.npairs, corr6.npairs)
+    assert corr5.tot == corr6.tot
+
+    # Nor is a corrupted one.
+    file_name = treecorr.NNCorrelation(config)._get_checkpoint_file(cat.get_patches())[0]
+    with open(file_name, 'w') as fid:
+        fid.write('garbage')
+    with CaptureLog() as cl:
+        corr7 = treecorr.NNCorrelation(config, resume=True, min_sep=2., logger=cl.logger)
+        corr7.process(cat)
+    assert 'Unable to read checkpoint file' in cl.output
+    np.testing.assert_allclose(corr7.npairs, corr6.npairs)
+
+
+@timer
+def test_checkpoint_catalogs():
+    # Test that a checkpoint from one catalog is not used for a different one, or for a
+    # different class using the same catalog.
+    ngal = 3000
+    npatch = 8
+    rng = np.random.RandomState(1234)
+    x = rng.normal(0,10, (ngal,) )
+    y = rng.normal(0,10, (ngal,) )
+    k = rng.normal(0,1, (ngal,) )
+    cat = treecorr.Catalog(x=x, y=y, k=k, npatch=npatch)
+    rand = treecorr.Catalog(x=rng.uniform(-30,30, (5*ngal,)), y=rng.uniform(-30,30, (5*ngal,)),
+                            patch_centers=cat.patch_centers)
+    ckpt_file = os.path.join('output','test_checkpoint_cats.pkl')
+    config = dict(bin_size=0.3, min_sep=1., max_sep=10., checkpoint=ckpt_file, resume=True)
+
+    # DD and RR using the same checkpoint parameter each get the right answer.
+    dd = treecorr.NNCorrelation(config)
+    dd.process(cat)
+    rr = treecorr.NNCorrelation(config)
+    rr.process(rand)
+    dd0 = treecorr.NNCorrelation(bin_size=0.3, min_sep=1., max_sep=10.)
+    dd0.process(cat)
+    rr0 = treecorr.NNCorrelation(bin_size=0.3, min_sep=1., max_sep=10.)
+    rr0.process(rand)
+    print('dd.npairs = ',dd.npairs, dd0.npairs)
+    print('rr.npairs = ',rr.npairs, rr0.npairs)
+    np.testing.assert_allclose(dd.npairs, dd0.npairs)
+    np.testing.assert_allclose(rr.npairs, rr0.npairs)
+    assert rr.tot == rr0.tot
+    f1 = dd._get_checkpoint_file(cat.get_patches())[0]
+    f2 = rr._get_checkpoint_file(rand.get_patches())[0]
+    assert f1 != f2
+    assert os.path.isfile(f1)
+    assert os.path.isfile(f2)
+
+    # Likewise for different classes using the same catalog.
+    kk = treecorr.KKCorrelation(config)
+    kk.process(cat)
+    kk0 = treecorr.KKCorrelation(bin_size=0.3, min_sep=1., max_sep=10.)
+    kk0.process(cat)
+    np.testing.assert_allclose(kk.xi, kk0.xi)
+    assert kk._get_checkpoint_file(cat.get_patches())[0] != f1
+
+    # And for the same positions with different k values.
+    cat2 = treecorr.Catalog(x=x, y=y, k=2*k, patch_centers=cat.patch_centers)
+    kk2 = treecorr.KKCorrelation(config)
+    kk2.process(cat2)
+    np.testing.assert_allclose(kk2.xi, 4*kk0.xi)
+
+    # Even if a mismatched file is put in place, it is ignored.
+    shutil.copyfile(f1, f2)
+    with CaptureLog() as cl:
+        rr2 = treecorr.NNCorrelation(config, logger=cl.logger)
+        rr2.process(rand)
+    assert 'does not match' in cl.output
+    np.testing.assert_allclose(rr2.npairs, rr0.npairs)
+    assert rr2.tot == rr0.tot
+
+
+@timer
+def test_3pt_nnn_tot():
+    # The results for NNN need to include the tot values of every triple of patches, including
+    # those with no triangles and those that are skipped for being too far apart.
+    # Otherwise, the covariance estimates use the wrong normalization for each realization.
+    # The realization that uses every patch exactly once (i.e. all the triples) should
+    # reproduce the regular calculateZeta result.
+    ngal = 800
+    npatch = 8
+    kwargs = dict(min_sep=2., max_sep=8., nbins=3, min_u=0.5, max_u=1., nubins=2,
+                  min_v=0., max_v=0.5, nvbins=2)
+
+    def check(ddd, rrr, ntriples):
+        zeta, varzeta = ddd.calculateZeta(rrr)
+
+        # Every triple is in results.
+        for c in [ddd, rrr]:
+            assert len(c.results) == ntriples
+            np.testing.assert_allclose(np.sum(c.results.stack('weight'), axis=0), c.weight)
+            np.testing.assert_allclose(np.sum(c.results.stack('tot')), c.tot)
+
+        d = np.sum(ddd.results.stack('weight'), axis=0)
+        dt = np.sum(ddd.results.stack('tot'))
+        r = np.sum(rrr.results.stack('weight'), axis=0)
+        rt = np.sum(rrr.results.stack('tot'))
+        print('max diff = ',np.max(np.abs(d/r * rt/dt - 1. - zeta)))
+        np.testing.assert_allclose(d/r * rt/dt - 1., zeta, atol=1.e-12)
+
+        # Likewise using the bootstrap machinery with each patch selected exactly once.
+        pairs = treecorr.binnedcorr2._PatchPairWeights('bootstrap', ddd, npatch,
+                                                       counts=np.ones((1,npatch)))
+        z, w = ddd._calculate_xi_from_pairs(pairs)
+        np.testing.assert_allclose(z[0], zeta.ravel(), atol=1.e-12)
+
+    # With L = 20, all the triples are processed, but some have no triangles.
+    # With L = 60, many of the triples are skipped.
+    for L in [20., 60.]:
+        rng = np.random.RandomState(1234)
+        x = rng.uniform(-L,L, (ngal,) )
+        y = rng.uniform(-L,L, (ngal,) )
+        cat = treecorr.Catalog(x=x, y=y, npatch=npatch)
+        rand = treecorr.Catalog(x=rng.uniform(-L,L, (3*ngal,)), y=rng.uniform(-L,L, (3*ngal,)),
+                                patch_centers=cat.patch_centers)
+        with CaptureLog() as cl:
+            ddd = treecorr.NNNCorrelation(logger=cl.logger, **kwargs)
+            ddd.process(cat)
+        print(cl.output)
+        ntriples = npatch + npatch*(npatch-1) + npatch*(npatch-1)*(npatch-2)//6
+        skipped = 'Processing %d of %d patch triples'%(ntriples, ntriples) not in cl.output
+        assert skipped == (L == 60.)
+        rrr = treecorr.NNNCorrelation(**kwargs)
+        rrr.process(rand)
+        check(ddd, rrr, ntriples)
+
+        # The cross-correlation results have every ordered triple.
+        ddd2 = treecorr.NNNCorrelation(**kwargs)
+        ddd2.process(cat, cat, cat)
+        rrr2 = treecorr.NNNCorrelation(**kwargs)
+        rrr2.process(rand, rand, rand)
+        check(ddd2, rrr2, npatch**3)
+
+    # If rrr is processed again, the cached values in ddd are not used.
+    cov1 = ddd.estimate_cov('jackknife')
+    rrr.process(cat)
+    cov2 = ddd.estimate_cov('jackknife')
+    assert not np.allclose(cov2, cov1)
+    np.testing.assert_allclose(cov2, ddd.copy().estimate_cov('jackknife'))
+
+
+@timer
+def test_3pt_jk():
+    # Test the patch-based covariance estimates for 3-point correlations.
+    ngal = 800
+    npatch = 5
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(-20,20, (ngal,) )
+    y = rng.uniform(-20,20, (ngal,) )
+    k = rng.normal(0,1, (ngal,) ) + 0.3 * np.sin(x/3.)
+    g1 = rng.normal(0,0.2, (ngal,) )
+    g2 = rng.normal(0,0.2, (ngal,) )
+    cat = treecorr.Catalog(x=x, y=y, k=k, g1=g1, g2=g2, npatch=npatch)
+    cat0 = treecorr.Catalog(x=x, y=y, k=k)
+    kwargs = dict(min_sep=2., max_sep=8., nbins=2, nubins=2, nvbins=2, num_bootstrap=20)
+
+    kkk = treecorr.KKKCorrelation(var_method='jackknife', **kwargs)
+    kkk.process(cat)
+    # The results for each triple of patches are kept.
+    assert kkk.npatch1 == kkk.npatch2 == kkk.npatch3 == npatch
+    assert (0,0,0) in kkk.results
+    assert all(len(ijk) == 3 for ijk in kkk.results)
+    np.testing.assert_allclose(np.sum(kkk.results.stack('weight'), axis=0), kkk.weight)
+    triples = kkk.results.keys()
+
+    def design(vtriples):
+        v = []
+        for p in vtriples:
+            n = np.sum([kkk.results[ijk].zeta for ijk in p], axis=0).ravel()
+            d = np.sum([kkk.results[ijk].weight for ijk in p], axis=0).ravel()
+            d[d == 0] = 1
+            v.append(n/d)
+        v = np.array(v)
+        return v - np.mean(v, axis=0)
+
+    # jackknife excludes all triples involving patch i.
+    v = design([ [ijk for ijk in triples if i not in ijk] for i in range(npatch) ])
+    cov = (1.-1./npatch) * v.T.dot(v)
+    np.testing.assert_allclose(kkk.cov, cov)
+    np.testing.assert_allclose(kkk.varzeta.ravel(), cov.diagonal())
+    np.testing.assert_allclose(kkk.estimate_cov('jackknife'), cov)
+
+    # sample uses the triples with patch i first.
+    v = design([ [ijk for ijk in triples if ijk[0] == i] for i in range(npatch) ])
+    w = np.array([np.sum([kkk.results[ijk].weight for ijk in triples if ijk[0] == i])
+                  for i in range(npatch)])
+    w /= np.sum(w)
+    cov = 1./(npatch-1) * (w * v.T).dot(v)
+    np.testing.assert_allclose(kkk.estimate_cov('sample'), cov)
+
+    # bootstrap includes each triple once for each combination of selections of the
+    # distinct patches it involves.
+    np.random.seed(1234)
+    indx = np.random.randint(npatch, size=(kkk.num_bootstrap, npatch))
+    vtriples = []
+    for ind in indx:
+        vt = []
+        for ijk in triples:
+            vt += [ijk] * int(np.prod([np.sum(ind == p) for p in set(ijk)]))
+        vtriples.append(vt)
+    v = design(vtriples)
+    cov = 1./(kkk.num_bootstrap-1) * v.T.dot(v)
+    np.random.seed(1234)
+    np.testing.assert_allclose(kkk.estimate_cov('bootstrap'), cov)
+
+    # marked_bootstrap includes all triples with a selected patch first.
+    vtriples = [ [ijk for i in ind for ijk in triples if ijk[0] == i] for ind in indx ]
+    v = design(vtriples)
+    cov = 1./(kkk.num_bootstrap-1) * v.T.dot(v)
+    np.random.seed(1234)
+    np.testing.assert_allclose(kkk.estimate_cov('marked_bootstrap'), cov)
+
+    # The shot noise is the same as the default variance.
+    kkk2 = treecorr.KKKCorrelation(**kwargs)
+    kkk2.process(cat)
+    np.testing.assert_allclose(kkk.estimate_cov('shot').diagonal(), kkk2.varzeta.ravel())
+    np.testing.assert_allclose(kkk2.zeta, kkk.zeta)
+
+    # GGG uses the real and imaginary parts of the four natural components.
+    ggg = treecorr.GGGCorrelation(var_method='jackknife', **kwargs)
+    ggg.process(cat)
+    nbins = ggg.weight.size
+    assert ggg.cov.shape == (8*nbins, 8*nbins)
+    var = ggg.cov.diagonal()
+    np.testing.assert_allclose(ggg.vargam0.ravel(), var[:nbins] + var[nbins:2*nbins])
+    np.testing.assert_allclose(ggg.vargam3.ravel(), var[6*nbins:7*nbins] + var[7*nbins:])
+    ggg2 = treecorr.GGGCorrelation(**kwargs)
+    ggg2.process(cat)
+    np.testing.assert_allclose(ggg.estimate_cov('shot').diagonal()[:nbins] * 2,
+                               ggg2.vargam0.ravel())
+
+    # These can be combined with each other and with 2-point statistics.
+    kk = treecorr.KKCorrelation(min_sep=2., max_sep=8., nbins=3)
+    kk.process(cat)
+    cov = treecorr.estimate_multi_cov([kk, kkk, ggg], 'jackknife')
+    n1 = kk.nbins
+    n2 = n1 + kkk.weight.size
+    np.testing.assert_allclose(cov[n1:n2,n1:n2], kkk.cov)
+    np.testing.assert_allclose(cov[n2:,n2:], ggg.cov)
+    np.testing.assert_allclose(cov[:n1,:n1], kk.estimate_cov('jackknife'))
+
+    # Cross correlations work the same way.
+    kkk3 = treecorr.KKKCorrelation(var_method='jackknife', **kwargs)
+    kkk3.process(cat, cat, cat)
+    assert kkk3.npatch1 == kkk3.npatch2 == kkk3.npatch3 == npatch
+    np.testing.assert_allclose(np.sum(kkk3.results.stack('weight'), axis=0), kkk3.weight)
+    np.testing.assert_allclose(kkk3.varzeta.ravel(), kkk3.cov.diagonal())
+
+    # If only some catalogs have patches, the others are patch 0.
+    kkk4 = treecorr.KKKCorrelation(var_method='jackknife', **kwargs)
+    kkk4.process(cat, cat0, cat0)
+    assert (kkk4.npatch1, kkk4.npatch2, kkk4.npatch3) == (npatch, 1, 1)
+    assert all(ijk[1] == ijk[2] == 0 for ijk in kkk4.results)
+    v = np.array([ ((kkk4.zeta*kkk4.weight - kkk4.results[(i,0,0)].zeta) /
+                    (kkk4.weight - kkk4.results[(i,0,0)].weight)).ravel()
+                   for i in range(npatch) ])
+    v -= np.mean(v, axis=0)
+    np.testing.assert_allclose(kkk4.cov, (1.-1./npatch) * v.T.dot(v))
+
+    # NNN needs the randoms to use the same patches.
+    rx = rng.uniform(-20,20, (2*ngal,) )
+    ry = rng.uniform(-20,20, (2*ngal,) )
+    rand = treecorr.Catalog(x=rx, y=ry, patch_centers=cat.patch_centers)
+    ddd = treecorr.NNNCorrelation(var_method='jackknife', **kwargs)
+    rrr = treecorr.NNNCorrelation(**kwargs)
+    ddd.process(cat)
+    rrr.process(rand)
+    zeta, varzeta = ddd.calculateZeta(rrr)
+    np.testing.assert_allclose(varzeta.ravel(), ddd.cov.diagonal())
+    v = []
+    for i in range(npatch):
+        d = np.sum([ddd.results[ijk].weight for ijk in ddd.results if i not in ijk], axis=0)
+        dt = np.sum([ddd.results[ijk].tot for ijk in ddd.results if i not in ijk])
+        r = np.sum([rrr.results[ijk].weight for ijk in rrr.results if i not in ijk], axis=0)
+        rt = np.sum([rrr.results[ijk].tot for ijk in rrr.results if i not in ijk])
+        v.append((d/r * rt/dt - 1.).ravel())
+    v = np.array(v)
+    v -= np.mean(v, axis=0)
+    np.testing.assert_allclose(ddd.cov, (1.-1./npatch) * v.T.dot(v))
+
+    # With the data-random cross terms.
+    drr = treecorr.NNNCorrelation(**kwargs)
+    rdd = treecorr.NNNCorrelation(**kwargs)
+    drr.process(cat, rand, rand)
+    rdd.process(rand, cat, cat)
+    zeta2, varzeta2 = ddd.calculateZeta(rrr, drr, drr, drr, rdd, rdd, rdd)
+    np.testing.assert_allclose(varzeta2.ravel(), ddd.cov.diagonal())
+    assert not np.allclose(varzeta2, varzeta)
+
+    # Randoms without patches are invalid for the patch-based methods, but fine for shot.
+    rrr2 = treecorr.NNNCorrelation(**kwargs)
+    rrr2.process(treecorr.Catalog(x=rx, y=ry))
+    with assert_raises(RuntimeError):
+        ddd.calculateZeta(rrr2)
+    ddd.var_method = 'shot'
+    zeta3, varzeta3 = ddd.calculateZeta(rrr2)
+    np.testing.assert_allclose(ddd.estimate_cov('shot').diagonal(), varzeta3.ravel())
+
+    # Without patches, only shot is possible.
+    with assert_raises(ValueError):
+        kkk.process(cat0)
+    kkk2.process(cat0)
+    assert len(kkk2.results) == 0
+    with assert_raises(ValueError):
+        kkk2.estimate_cov('jackknife')
+    with assert_raises(ValueError):
+        treecorr.KKKCorrelation(var_method='invalid', **kwargs)
+    ddd4 = treecorr.NNNCorrelation(**kwargs)
+    with assert_raises(RuntimeError):
+        ddd4.estimate_cov('shot')
+
+
+@timer
+def test_3pt_patch_triples():
+    # Test that the patch-based 3-point auto-correlation, which does each set of patches only
+    # once and skips sets of patches that are too far apart, matches the non-patch result.
+    ngal = 600
+    npatch = 12
+    rng = np.random.RandomState(8675309)
+    x = rng.uniform(-40,40, (ngal,) )
+    y = rng.uniform(-40,40, (ngal,) )
+    k = rng.normal(0,1, (ngal,) )
+    g1 = rng.normal(0,0.2, (ngal,) )
+    g2 = rng.normal(0,0.2, (ngal,) )
+    cat = treecorr.Catalog(x=x, y=y, k=k, g1=g1, g2=g2, npatch=npatch)
+    cat0 = treecorr.Catalog(x=x, y=y, k=k, g1=g1, g2=g2)
+    kwargs = dict(min_sep=2., max_sep=6., nbins=2, nubins=2, nvbins=2, brute=True)
+
+    kkk0 = treecorr.KKKCorrelation(**kwargs)
+    kkk0.process(cat0)
+    kkk = treecorr.KKKCorrelation(**kwargs)
+    kkk.process(cat)
+    np.testing.assert_array_equal(kkk.ntri, kkk0.ntri)
+    np.testing.assert_allclose(kkk.zeta, kkk0.zeta, atol=1.e-12)
+    np.testing.assert_allclose(kkk.meand2, kkk0.meand2)
+    np.testing.assert_allclose(kkk.meanu, kkk0.meanu)
+    # Triangles with two points in one patch are keyed (i,i,j).  Those with three different
+    # patches are only done once, so there are no permutations of the same set of patches.
+    assert all(ijk[1] != ijk[0] or ijk[2] != ijk[0] or ijk[1] == ijk[2]
+               for ijk in kkk.results)
+    sets = [tuple(sorted(ijk)) for ijk in kkk.results if len(set(ijk)) == 3]
+    assert len(sets) == len(set(sets))
+    # Most of the triples of patches are too far apart to have any triangles.
+    assert len(kkk.results) < npatch**2
+
+    ggg0 = treecorr.GGGCorrelation(**kwargs)
+    ggg0.process(cat0)
+    ggg = treecorr.GGGCorrelation(**kwargs)
+    ggg.process(cat)
+    np.testing.assert_array_equal(ggg.ntri, ggg0.ntri)
+    np.testing.assert_allclose(ggg.gam0, ggg0.gam0, atol=1.e-12)
+    np.testing.assert_allclose(ggg.gam1, ggg0.gam1, atol=1.e-12)
+    np.testing.assert_allclose(ggg.gam2, ggg0.gam2, atol=1.e-12)
+    np.testing.assert_allclose(ggg.gam3, ggg0.gam3, atol=1.e-12)
+
+    # The normalization includes the skipped triples.
+    ddd0 = treecorr.NNNCorrelation(**kwargs)
+    ddd0.process(cat0)
+    ddd = treecorr.NNNCorrelation(**kwargs)
+    ddd.process(cat)
+    np.testing.assert_array_equal(ddd.weight, ddd0.weight)
+    np.testing.assert_allclose(ddd.tot, ddd0.tot)
+    np.testing.assert_allclose(np.sum(ddd.results.stack('tot')), ddd0.tot)
+
+    # Running several triples at once gives the same answer.
+    kkk2 = treecorr.KKKCorrelation(num_patch_threads=3, **kwargs)
+    kkk2.process(cat)
+    np.testing.assert_allclose(kkk2.zeta, kkk.zeta)
+    np.testing.assert_array_equal(kkk2.ntri, kkk.ntri)
+    assert kkk2.results.keys() == kkk.results.keys()
+
+    # The cross-correlation also skips the triples that are too far apart.
+    kkk3 = treecorr.KKKCorrelation(**kwargs)
+    kkk3.process(cat0, cat0, cat0)
+    kkk4 = treecorr.KKKCorrelation(**kwargs)
+    kkk4.process(cat, cat, cat)
+    np.testing.assert_array_equal(kkk4.ntri, kkk3.ntri)
+    np.testing.assert_allclose(kkk4.zeta, kkk3.zeta, atol=1.e-12)
+    ddd3 = treecorr.NNNCorrelation(**kwargs)
+    ddd3.process(cat0, cat0, cat0)
+    ddd4 = treecorr.NNNCorrelation(**kwargs)
+    ddd4.process(cat, cat, cat)
+    np.testing.assert_array_equal(ddd4.weight, ddd3.weight)
+    np.testing.assert_allclose(ddd4.tot, ddd3.tot)
+    np.testing.assert_allclose(np.sum(ddd4.results.stack('tot')), ddd3.tot)
+    assert len(ddd4.results) == npatch**3
+
+    # With the periodic metric, nothing is skipped, since the patches may wrap around.
+    ddd5 = treecorr.NNNCorrelation(period=80, **kwargs)
+    ddd5.process(cat0, metric='Periodic')
+    ddd6 = treecorr.NNNCorrelation(period=80, **kwargs)
+    ddd6.process(cat, metric='Periodic')
+    np.testing.assert_array_equal(ddd6.weight, ddd5.weight)
+    np.testing.assert_allclose(ddd6.tot, ddd5.tot)
+    assert np.sum(ddd6.weight) > np.sum(ddd.weight)
+
 
 if __name__ == '__main__':
     test_cat_patches()
@@ -2472,3 +3300,13 @@ if __name__ == '__main__':
     test_clusters()
     test_brute_jk()
     test_lowmem()
+    test_patch_threads()
+    test_patch_schedule()
+    test_patch_results()
+    test_cov_vectorized()
+    test_cov_cache()
+    test_checkpoint()
+    test_checkpoint_catalogs()
+    test_3pt_jk()
+    test_3pt_nnn_tot()
+    test_3pt_patch_triples()
@@ -491,6 +491,90 @@ def test_3pt():
         ddd.process(cat)
 
 
+@timer
+def test_uniform():
+    # Test process_uniform, which computes the rr counts for a periodic box analytically.
+    rng = np.random.RandomState(8675309)
+    Lx = 50.
+    Ly = 80.
+    Lz = 60.
+    ngal = 3000
+    x = rng.uniform(0, Lx, ngal)
+    y = rng.uniform(0, Ly, ngal)
+    z = rng.uniform(0, Lz, ngal)
+
+    for coords, bin_type in [('flat', 'Log'), ('3d', 'Linear'), ('3d', 'Log')]:
+        if coords == 'flat':
+            cat = treecorr.Catalog(x=x, y=y)
+        else:
+            cat = treecorr.Catalog(x=x, y=y, z=z)
+        config = dict(min_sep=1., max_sep=20., nbins=8, bin_type=bin_type,
+                      xperiod=Lx, yperiod=Ly, zperiod=Lz, brute=True)
+        rr = treecorr.NNCorrelation(config)
+        rr.process(cat, metric='Periodic')
+        ru = treecorr.NNCorrelation(config)
+        ru.process_uniform(coords)
+        print(coords, bin_type)
+        assert ru.metric == 'Periodic'
+        assert ru.coords == coords
+        ratio = (rr.weight/rr.tot) / (ru.weight/ru.tot)
+        print('ratio = ',ratio)
+        np.testing.assert_array_less(np.abs(ratio-1), 5./np.sqrt(rr.npairs))
+        np.testing.assert_allclose(rr.meanr, ru.meanr, rtol=3.e-2)
+        np.testing.assert_allclose(rr.meanlogr, ru.meanlogr, atol=3.e-2)
+
+        # Uniform points should have xi consistent with 0.
+        xi, varxi = rr.calculateXi(ru)
+        print('xi = ',xi)
+        print('sigma = ',np.sqrt(varxi))
+        np.testing.assert_array_less(np.abs(xi), 5.*np.sqrt(varxi))
+
+    # The same thing for three-point counts.
+    cat = treecorr.Catalog(x=x[:1000], y=y[:1000])
+    config = dict(min_sep=5., max_sep=10., nbins=2, nubins=2, nvbins=2,
+                  xperiod=Lx, yperiod=Ly, brute=True)
+    rrr = treecorr.NNNCorrelation(config)
+    rrr.process(cat, metric='Periodic')
+    rru = treecorr.NNNCorrelation(config)
+    rru.process_uniform('flat')
+    ratio = (rrr.weight/rrr.tot) / (rru.weight/rru.tot)
+    print('ratio = ',ratio)
+    # Triangle counts are not independent, so the noise is larger than 1/sqrt(ntri).
+    np.testing.assert_allclose(ratio, 1., rtol=0.05)
+    np.testing.assert_allclose(rrr.meand1, rru.meand1, rtol=1.e-2)
+    np.testing.assert_allclose(rrr.meand2, rru.meand2, rtol=1.e-2)
+    np.testing.assert_allclose(rrr.meand3, rru.meand3, rtol=1.e-2)
+    np.testing.assert_allclose(rrr.meanu, rru.meanu, atol=1.e-2)
+    np.testing.assert_allclose(rrr.meanv, rru.meanv, atol=1.e-2)
+    zeta, varzeta = rrr.calculateZeta(rru)
+    np.testing.assert_allclose(zeta, ratio-1., atol=1.e-10)
+
+    # The 3d version should agree with a direct integral of the 3d triangle density, which
+    # for the full range of u and v is 8 pi^2 r^5 u^2 (1+uv), integrated over r,u,v.
+    config3 = dict(min_sep=5., max_sep=10., nbins=1, nubins=1, nvbins=1,
+                   xperiod=Lx, yperiod=Ly, zperiod=Lz)
+    rru = treecorr.NNNCorrelation(config3)
+    rru.process_uniform()
+    expected = 8*np.pi**2 * (10.**6 - 5.**6)/6. * (1./3. + 1./8.) / (Lx*Ly*Lz)**2 * 6
+    np.testing.assert_allclose(np.sum(rru.weight)/rru.tot, expected, rtol=1.e-10)
+
+    # Invalid configurations
+    with assert_raises(ValueError):
+        treecorr.NNCorrelation(min_sep=1., max_sep=20., nbins=8).process_uniform()
+    with assert_raises(ValueError):
+        treecorr.NNCorrelation(min_sep=1., max_sep=30., nbins=8, period=50).process_uniform()
+    with assert_raises(ValueError):
+        treecorr.NNCorrelation(min_sep=1., max_sep=20., nbins=8, period=50,
+                               bin_type='TwoD').process_uniform('flat')
+    with assert_raises(ValueError):
+        treecorr.NNCorrelation(min_sep=1., max_sep=20., nbins=8, period=50).process_uniform(
+                'spherical')
+    with assert_raises(ValueError):
+        treecorr.NNNCorrelation(min_sep=5., max_sep=10., nbins=1, period=30).process_uniform()
+    with assert_raises(ValueError):
+        treecorr.NNNCorrelation(min_sep=5., max_sep=10., nbins=1, period=50).process_uniform(
+                'spherical')
+
 
 if __name__ == '__main__':
     test_direct_count()
@@ -498,3 +582,4 @@ if __name__ == '__main__':
     test_periodic_ps()
     test_halotools()
     test_3pt()
+    test_uniform()
@@ -135,6 +135,13 @@ def test_twod():
     print('max rel diff = ',np.max(np.abs(kk.xi - xi_brut)/np.abs(kk.xi)))
     np.testing.assert_allclose(kk.xi, xi_brut, atol=1.e-7)
 
+    # The per-thread results are combined by a reduction, which should give the same answer
+    # for any number of threads.
+    kk.process(cat1, num_threads=3)
+    np.testing.assert_allclose(kk.xi, xi_brut, atol=1.e-7)
+    kk.process(cat1, cat1, num_threads=4)
+    np.testing.assert_allclose(kk.xi, xi_brut, atol=1.e-7)
+
     # Repeat with weights.
     xi_brut = corr2d(x, y, kappa, kappa, w=1./kappa_err**2, rmax=max_sep, bins=nbins)
     cat2 = treecorr.Catalog(x=x, y=y, k=kappa, g1=gamma1, g2=gamma2, w=1./kappa_err**2)
@@ -47,6 +47,7 @@ from .config import read_config
 from .util import set_omp_threads, get_omp_threads
 from .catalog import Catalog, read_catalogs, calculateVarG, calculateVarK
 from .binnedcorr2 import BinnedCorr2, estimate_multi_cov
+from .binnedcorr2 import process_multi, process_tomo, process_binnings
 from .ggcorrelation import GGCorrelation
 from .nncorrelation import NNCorrelation
 from .kkcorrelation import KKCorrelation
@@ -18,6 +18,10 @@
 import math
 import numpy as np
 import sys
+import os
+import time
+import pickle
+import hashlib
 import coord
 import treecorr
 
@@ -197,6 +201,57 @@ class BinnedCorr2(object):
 
                                 This won't work if the system's C compiler cannot use OpenMP
                                 (e.g. clang prior to version 3.7.)
+
+        num_patch_threads (int): When using patches, how many pairs of patches to process
+                            concurrently.  Each concurrent job gets an equal share of the
+                            ``num_threads`` OpenMP threads.  This helps when the patches are
+                            small, so each pair of patches has too few top-level cells to keep
+                            all the cores busy.  (default: 1)
+        patch_schedule (str):   How to decide the order in which to process pairs of patches
+                            and, when using MPI, which process does each pair.  Options are:
+
+                                - 'index' = Go through the pairs in order of the patch indices.
+                                  When using MPI, split them up by patch index, which minimizes
+                                  how many patches each process needs to load. (default)
+                                - 'cost' = Estimate the cost of each pair from the number of
+                                  objects and the separation and size of the two patches.
+                                  Then do the most expensive pairs first and balance the
+                                  total cost across the MPI processes.  This is usually faster
+                                  when the patches have very different numbers of objects.
+        mpi_mode (str):     How to divide up the pairs of patches when running with MPI (i.e.
+                            when passing ``comm`` to `process`).  Options are:
+
+                                - 'static' = Each process decides up front which pairs it will
+                                  do according to ``patch_schedule``. (default)
+                                - 'dynamic' = Rank 0 hands out the pairs to the other ranks
+                                  one at a time as they finish their previous pair, and the
+                                  other ranks send back just the arrays of results for each
+                                  pair.  Rank 0 doesn't process any pairs itself.  This avoids
+                                  having some processes finish long after the others.
+        cache_dir (str):    For `NNCorrelation`, a directory in which to save the results of
+                            `process <NNCorrelation.process>`.  The file name is a hash of the
+                            positions, weights and patches of the catalogs along with the
+                            binning and metric parameters.  If `process <NNCorrelation.process>`
+                            is called again with the same inputs, the results are just read
+                            back from this file.  This is mostly useful for the random-random
+                            pair counts, which are often the most expensive part of a
+                            calculation and rarely change.  (default: None)
+        checkpoint (str):   When using patches, a file in which to periodically save the
+                            results of the pairs of patches that have been completed so far.
+                            If the calculation is interrupted, it can be restarted with
+                            ``resume=True`` to skip the pairs that were already done.
+                            The class name and a hash of the input catalogs are inserted
+                            before the extension, so e.g. DD and RR use different files.
+                            When using MPI, the file name for each rank other than 0 gets the
+                            rank number appended (except with ``mpi_mode='dynamic'``, where
+                            only rank 0 writes the file).  (default: None)
+        checkpoint_interval (float): How often (in seconds) to write the checkpoint file.
+                            It is also written when the calculation is finished.
+                            (default: 600)
+        resume (bool):      Whether to start from the results in the checkpoint file, if it
+                            exists.  The checkpoint records the binning parameters, the
+                            number of patches and a hash of the input catalogs, and it is
+                            ignored (with a warning) if these don't match.  (default: False)
     """
     _valid_params = {
         'nbins' : (int, False, None, None,
@@ -260,6 +315,20 @@ class BinnedCorr2(object):
                 'How many bootstrap samples to use for the var_method=bootstrap and marked_bootstrap'),
         'num_threads' : (int, False, None, None,
                 'How many threads should be used. num_threads <= 0 means auto based on num cores.'),
+        'num_patch_threads' : (int, False, 1, None,
+                'How many pairs of patches to process concurrently when using patches.'),
+        'patch_schedule' : (str, False, 'index', ['index', 'cost'],
+                'How to order and distribute the pairs of patches when using patches.'),
+        'mpi_mode' : (str, False, 'static', ['static', 'dynamic'],
+                'How to divide up the pairs of patches among processes when using MPI.'),
+        'cache_dir' : (str, False, None, None,
+                'A directory in which to cache the results of NNCorrelation.process.'),
+        'checkpoint' : (str, False, None, None,
+                'A file in which to periodically save the completed pairs of patches.'),
+        'checkpoint_interval' : (float, False, 600., None,
+                'How often (in seconds) to write the checkpoint file.'),
+        'resume' : (bool, False, False, None,
+                'Whether to resume from the checkpoint file if it exists.'),
     }
 
     def __init__(self, config=None, logger=None, **kwargs):
@@ -455,13 +524,37 @@ class BinnedCorr2(object):
 
         self.var_method = treecorr.config.get(self.config,'var_method',str,'shot')
         self.num_bootstrap = treecorr.config.get(self.config,'num_bootstrap',int,500)
-        self.results = {}  # for jackknife, etc. store the results of each pair of patches.
+        # for jackknife, etc. store the results of each pair of patches.
+        self.results = treecorr.util.PatchPairResults()
         self.npatch1 = self.npatch2 = 1
+        # Values used by estimate_cov that can be reused until the results change.
+        self._cov_cache = {}
+        # Incremented whenever the results change, so other objects that use these results
+        # (e.g. the dd correlation using this as rr) can tell if their cached values are stale.
+        self._cov_version = 0
+        self.cache_dir = self.config.get('cache_dir',None)
 
     def _add_tot(self, i, j, c1, c2):
         # No op for all but NNCorrelation, which needs to add the tot value
         pass
 
+    def _get_cache_file(self, cat1, cat2, metric):
+        # The file in cache_dir where the results of process for these catalogs would be
+        # stored, or None if not using a cache.
+        if self.cache_dir is None:
+            return None
+        params = self._get_binning_params(metric)
+        return treecorr.util.get_cache_file(self.cache_dir, params, [cat1, cat2])
+
+    def _get_binning_params(self, metric):
+        # The parameters that determine the results for a given set of input catalogs.
+        if metric is None:
+            metric = treecorr.config.get(self.config,'metric',str,'Euclidean')
+        return (self.__class__.__name__, self.bin_type, self.min_sep, self.max_sep,
+                self.nbins, self.bin_size, self.sep_units, self.b, self.split_method,
+                self.brute, self.min_top, self.max_top, self.min_rpar, self.max_rpar,
+                self.xperiod, self.yperiod, self.zperiod, metric)
+
     def _trivially_zero(self, c1, c2, metric):
         # For now, ignore the metric.  Just be conservative about how much space we need.
         x1,y1,z1,s1 = c1._get_center_size()
@@ -469,6 +562,395 @@ class BinnedCorr2(object):
         d = ((x1-x2)**2 + (y1-y2)**2 + (z1-z2)**2)**0.5
         return (d > s1 + s2 + 2*self._max_sep)  # The 2* is where we are being conservative.
 
+    def _patch_pair_cost(self, c1, c2):
+        # Estimate the relative cost of processing a pair of patches, each given as a tuple
+        # (x, y, z, s, n) of the center, size and number of objects.
+        # c2 = None means the auto-correlation of patch c1.
+        # The number of pairs to consider scales as n1*n2, but only the pairs closer than
+        # max_sep really cost anything, and the tree prunes most of the others.
+        x1,y1,z1,s1,n1 = c1
+        if c2 is None:
+            x2,y2,z2,s2,n2 = c1
+            npairs = 0.5 * n1**2
+            n = n1
+        else:
+            x2,y2,z2,s2,n2 = c2
+            npairs = n1 * n2
+            n = n1 + n2
+        d = ((x1-x2)**2 + (y1-y2)**2 + (z1-z2)**2)**0.5
+        reach = s1 + s2 + 2*self._max_sep
+        if d > reach:
+            # Same criterion as _trivially_zero.
+            return 0.
+        # The fraction of the pairs that are within max_sep is roughly (max_sep/size)^2
+        # when the patches are larger than max_sep.  Then the overlap drops linearly as
+        # the patches move apart.
+        frac = min(1., self._max_sep**2 / max(s1**2 + s2**2, 1.e-300))
+        overlap = (reach - d) / reach
+        # Include a term for building and walking the trees, which scales as n.
+        return npairs * frac * overlap + n
+
+    def _assign_patch_jobs(self, pairs, costs, size, rank):
+        # Assign the (i,j) pairs to the size processes to minimize the total time taken.
+        # This uses the LPT algorithm: take the jobs in order of decreasing cost and give each
+        # one to the process that currently has the least total work.  Every rank runs the
+        # same deterministic calculation, so they all agree on the assignment.
+        order = sorted(range(len(pairs)), key=lambda k: (-costs[k], pairs[k]))
+        loads = np.zeros(size)
+        mine = set()
+        for k in order:
+            p = int(np.argmin(loads))
+            loads[p] += costs[k]
+            if p == rank:
+                mine.add(pairs[k])
+        self.logger.info("Rank %d: Estimated cost %.3g of total %.3g",
+                         rank, loads[rank], np.sum(loads))
+        return mine
+
+    def _get_patch_costs(self, cat1, cat2, low_mem):
+        # Return a dict of the estimated cost for each (i,j) pair of patches, or None if
+        # patch_schedule is not 'cost'.  cat2 = None means an auto-correlation of cat1.
+        schedule = treecorr.config.get(self.config,'patch_schedule',str,'index')
+        if schedule == 'index':
+            return None
+        elif schedule != 'cost':
+            raise ValueError("Invalid patch_schedule: %s"%schedule)
+
+        def get_info(cat):
+            # The center and size are cached, so only need to load each catalog once.
+            info = []
+            for k,c in enumerate(cat):
+                x,y,z,s = c._get_center_size()
+                info.append((c.patch if c.patch is not None else k, (x,y,z,s,float(c.nobj))))
+                if low_mem:
+                    c.unload()
+            return info
+
+        info1 = get_info(cat1)
+        info2 = get_info(cat2) if cat2 is not None else None
+        costs = {}
+        for i,c1 in info1:
+            if info2 is None:
+                costs[(i,i)] = self._patch_pair_cost(c1, None)
+                for j,c2 in info1:
+                    if i < j:
+                        costs[(i,j)] = self._patch_pair_cost(c1, c2)
+            else:
+                for j,c2 in info2:
+                    costs[(i,j)] = self._patch_pair_cost(c1, c2)
+        return costs
+
+    def _sort_patch_jobs(self, jobs, costs, low_mem):
+        # Put the jobs in order of decreasing cost.  Doing the big jobs first minimizes the
+        # time when only a few threads are still working at the end.
+        # With low_mem, the jobs need to stay in index order, since the unload lists assume
+        # the catalogs are used in that order.
+        if costs is None or low_mem:
+            return jobs
+        return sorted(jobs, key=lambda job: -costs[(job[0],job[1])])
+
+    def _process_patch_pair(self, temp, i, j, c1, c2, metric, num_threads):
+        # Process a single pair of patches into temp, which is assumed to be clear.
+        # c2 = None means to do the auto-correlation of patch i.
+        if c2 is None:
+            self.logger.info('Process patch %d auto',i)
+            temp.process_auto(c1,metric,num_threads)
+        else:
+            self.logger.info('Process patches %d,%d cross',i,j)
+            temp.process_cross(c1,c2,metric,num_threads)
+        return temp
+
+    def _add_patch_pair(self, temp, i, j, c1, c2):
+        # Accumulate the results of a single pair of patches from temp into self.
+        if c2 is None or np.sum(temp.npairs) > 0:
+            self.results[(i,j)] = temp._copy_for_results()
+            self += temp
+        else:
+            # NNCorrelation needs to add the tot value
+            self._add_tot(i, j, c1, c2)
+
+    def _get_checkpoint_hash(self, cat1, cat2, low_mem):
+        # A hash of the catalogs being processed, including the k and shear values, so a
+        # checkpoint from one calculation is never used for a different one.
+        # cat2 = None means an auto-correlation of cat1.
+        h = hashlib.sha1()
+        h.update(self.__class__.__name__.encode())
+        for cat in [cat1, cat2]:
+            if cat is None:
+                h.update(b'None')
+                continue
+            for c in cat:
+                h.update(c._get_content_hash(values=True).encode())
+                if low_mem:
+                    c.unload()
+        return h.hexdigest()
+
+    def _get_checkpoint_file(self, cat1, cat2=None, low_mem=False, comm=None):
+        # The name of the checkpoint file to use for processing cat1 (and cat2), or None if
+        # not checkpointing.  The class name and a hash of the catalogs are inserted before
+        # the extension of the checkpoint parameter, so different calculations using the same
+        # checkpoint parameter (e.g. DD and RR) use different files.
+        # Returns the file name and the hash.
+        file_name = self.config.get('checkpoint',None)
+        if file_name is None:
+            return None, None
+        rank = comm.Get_rank() if comm is not None else 0
+        if rank != 0 and self._use_dynamic_mpi(comm):
+            # Only rank 0 collects the results.
+            return None, None
+        cat_hash = self._get_checkpoint_hash(cat1, cat2, low_mem)
+        root, ext = os.path.splitext(file_name)
+        file_name = '%s_%s_%s%s'%(root, self.__class__.__name__, cat_hash[:16], ext)
+        if rank != 0:
+            file_name = '%s.%d'%(file_name, rank)
+        return file_name, cat_hash
+
+    def _start_checkpoint(self, jobs, metric, comm, cat1, cat2, low_mem):
+        # Set up the checkpointing of the patch pairs in jobs, if requested.
+        # Returns the state to pass to _update_checkpoint, or None if not checkpointing.
+        # If resume is set and there is a matching checkpoint file, the saved results are
+        # added to self, and those pairs are marked as done in the returned state.
+        file_name, cat_hash = self._get_checkpoint_file(cat1, cat2, low_mem, comm)
+        if file_name is None:
+            return None
+        key = (self.__class__.__name__, cat_hash, self._get_binning_params(metric),
+               self.npatch1, self.npatch2, sorted((i,j) for i,j,c1,c2,_ in jobs))
+        ckpt = { 'file_name' : file_name, 'key' : key, 'done' : set(), 'time' : time.time(),
+                 'interval' : treecorr.config.get(self.config,'checkpoint_interval',float,600.) }
+
+        resume = treecorr.config.get(self.config,'resume',bool,False)
+        if resume and os.path.isfile(file_name):
+            try:
+                with open(file_name, 'rb') as fid:
+                    state = pickle.load(fid)
+            except Exception as e:
+                self.logger.warning("Unable to read checkpoint file %s: %r.  Starting over.",
+                                    file_name, e)
+                return ckpt
+            if state['key'] != key:
+                self.logger.warning("Checkpoint file %s does not match the current calculation."
+                                    "  Starting over.", file_name)
+                return ckpt
+            self.logger.info("Resuming from checkpoint %s with %d of %d patch pairs done",
+                             file_name, len(state['done']), len(jobs))
+            if state['metric'] is not None:
+                self._set_metric(state['metric'], state['coords'])
+            self._set_sums(state['sums'])
+            self.results.update(state['results'])
+            ckpt['done'] = state['done']
+        return ckpt
+
+    def _skip_done_jobs(self, jobs, ckpt):
+        # Remove the jobs that were already done according to the checkpoint.
+        if ckpt is None or len(ckpt['done']) == 0:
+            return jobs
+        new_jobs = []
+        for job in jobs:
+            if job[:2] not in ckpt['done']:
+                new_jobs.append(job)
+            elif len(new_jobs) > 0:
+                # Keep unloading any catalogs that this job would have unloaded.
+                new_jobs[-1][4].extend(job[4])
+        return new_jobs
+
+    def _update_checkpoint(self, ckpt, i, j, final=False):
+        # Record that the pair (i,j) is done, and write the checkpoint file if it is time.
+        if ckpt is None:
+            return
+        if i is not None:
+            ckpt['done'].add((i,j))
+        now = time.time()
+        if final or now - ckpt['time'] >= ckpt['interval']:
+            self.logger.info("Writing checkpoint with %d patch pairs done to %s",
+                             len(ckpt['done']), ckpt['file_name'])
+            state = { 'key' : ckpt['key'], 'done' : ckpt['done'], 'sums' : self._get_sums(),
+                      'metric' : self.metric, 'coords' : self.coords, 'results' : self.results }
+            treecorr.util.write_pickle(ckpt['file_name'], state)
+            ckpt['time'] = now
+
+    def _process_patch_jobs(self, jobs, metric, num_threads, low_mem, ckpt=None):
+        # Process a list of patch pair jobs, each given as a tuple (i, j, c1, c2, unload),
+        # where c2 is None for auto-correlations and unload is a list of catalogs that may
+        # be unloaded once the job is done (only relevant for low_mem).
+        num_patch_threads = treecorr.config.get(self.config,'num_patch_threads',int,1)
+        if low_mem and num_patch_threads != 1:
+            # Unloading catalogs that other threads might still be using is not safe.
+            self.logger.info("Using num_patch_threads = 1, since low_mem = True")
+            num_patch_threads = 1
+
+        temp = self.copy()
+        temp.clear()
+
+        def trivially_zero(i, j, c1, c2):
+            if c2 is not None and self._trivially_zero(c1,c2,metric):
+                self.logger.info('Skipping %d,%d pair, which are too far apart ' +
+                                 'for this set of separations',i,j)
+                return True
+            else:
+                return False
+
+        if num_patch_threads <= 1 or len(jobs) <= 1:
+            for i, j, c1, c2, unload in jobs:
+                temp.clear()
+                if not trivially_zero(i, j, c1, c2):
+                    self._process_patch_pair(temp, i, j, c1, c2, metric, num_threads)
+                self._add_patch_pair(temp, i, j, c1, c2)
+                self._update_checkpoint(ckpt, i, j)
+                for c in unload:
+                    c.unload()
+        else:
+            # Run several patch pairs at once in a pool of threads.  The C++ layer releases
+            # the GIL, so each thread is able to run its own OpenMP calculation.  Split up the
+            # available OpenMP threads among them.
+            from concurrent.futures import ThreadPoolExecutor
+            from collections import deque
+            self._set_num_threads(num_threads)
+            job_threads = max(1, treecorr.get_omp_threads() // num_patch_threads)
+            self.logger.info('Processing %d patch pairs with %d concurrent jobs using %d '
+                             'threads each', len(jobs), num_patch_threads, job_threads)
+
+            # Only keep a limited number of jobs in flight at once, so we don't use a lot of
+            # memory for finished results.  Also, add the results in the original order, so
+            # the sums don't depend on which threads happen to finish first.
+            pending = deque()
+            with ThreadPoolExecutor(max_workers=num_patch_threads) as executor:
+                for i, j, c1, c2, _ in jobs:
+                    if trivially_zero(i, j, c1, c2):
+                        self._add_patch_pair(temp, i, j, c1, c2)
+                        self._update_checkpoint(ckpt, i, j)
+                        continue
+                    # Make sure the catalogs are loaded here, rather than in the worker threads.
+                    c1.load()
+                    if c2 is not None: c2.load()
+                    future = executor.submit(self._process_patch_pair, temp.copy(),
+                                             i, j, c1, c2, metric, job_threads)
+                    pending.append((i, j, c1, c2, future))
+                    if len(pending) >= 2*num_patch_threads:
+                        i, j, c1, c2, future = pending.popleft()
+                        self._add_patch_pair(future.result(), i, j, c1, c2)
+                        self._update_checkpoint(ckpt, i, j)
+                while pending:
+                    i, j, c1, c2, future = pending.popleft()
+                    self._add_patch_pair(future.result(), i, j, c1, c2)
+                    self._update_checkpoint(ckpt, i, j)
+            # Reset the OpenMP threads for this thread.
+            self._set_num_threads(num_threads)
+        self._update_checkpoint(ckpt, None, None, final=True)
+
+    def _get_sums(self):
+        # The accumulated values, which are enough to reconstruct the results of a pair of
+        # patches using _set_sums.  This is much more compact to send via MPI than the full
+        # correlation object.
+        return [ np.copy(getattr(self,name)) for name in self._sum_attrs ]
+
+    def _set_sums(self, sums):
+        for name, value in zip(self._sum_attrs, sums):
+            current = getattr(self, name)
+            if isinstance(current, np.ndarray):
+                # Copy into the existing array, since some of these are aliased (e.g. xi and
+                # raw_xi) or have pointers to them held by the C++ layer.
+                current.ravel()[:] = np.asarray(value).ravel()
+            else:
+                setattr(self, name, value)
+
+    def _reduce_mpi(self, comm):
+        # Combine the results from all the processes onto rank 0.
+        # Rather than having rank 0 receive from every other process in turn, do this as a
+        # binary tree, so it takes log2(size) steps rather than size.
+        rank = comm.Get_rank()
+        size = comm.Get_size()
+        step = 1
+        while step < size:
+            if rank % (2*step) == step:
+                comm.send(self, dest=rank-step)
+                break
+            elif rank % (2*step) == 0 and rank+step < size:
+                temp = comm.recv(source=rank+step)
+                self.logger.info("Rank %d: Received results from rank %d",rank,rank+step)
+                if temp.metric is not None:
+                    self += temp
+                self.results.update(temp.results)
+            step *= 2
+
+    def _use_dynamic_mpi(self, comm):
+        # Whether to use the master/worker MPI mode.
+        mpi_mode = treecorr.config.get(self.config,'mpi_mode',str,'static')
+        if mpi_mode not in ['static', 'dynamic']:
+            raise ValueError("Invalid mpi_mode: %s"%mpi_mode)
+        # With only one process, there are no workers, so just do everything on rank 0.
+        return mpi_mode == 'dynamic' and comm is not None and comm.Get_size() > 1
+
+    def _process_patch_jobs_dynamic(self, jobs, metric, num_threads, low_mem, comm, ckpt=None):
+        # Process a list of patch pair jobs using MPI in master/worker mode.
+        # Rank 0 hands out the jobs (by their index in the list, since all ranks build the same
+        # list) to whichever rank asks for more work.  The workers send back the sums for each
+        # pair along with their request for the next job.
+        rank = comm.Get_rank()
+        size = comm.Get_size()
+        # mpi4py doesn't put ANY_SOURCE on the Comm object, but our mock MPI Comm does.
+        any_source = getattr(comm, 'ANY_SOURCE', None)
+        if any_source is None:
+            from mpi4py import MPI
+            any_source = MPI.ANY_SOURCE
+
+        temp = self.copy()
+        temp.clear()
+        if rank == 0:
+            # The indices of the jobs still to be done.  (Only rank 0 knows about the
+            # checkpoint, so the workers keep the full list.)
+            todo = [k for k, job in enumerate(jobs)
+                    if ckpt is None or job[:2] not in ckpt['done']]
+            next_job = 0
+            nworkers = size-1
+            while nworkers > 0:
+                p, k, metric_coords, sums = comm.recv(source=any_source)
+                if k is not None:
+                    i, j, c1, c2, _ = jobs[k]
+                    if sums is None:
+                        # NNCorrelation needs to add the tot value
+                        self._add_tot(i, j, c1, c2)
+                        if low_mem:
+                            c1.unload()
+                            c2.unload()
+                    else:
+                        temp.clear()
+                        temp._set_sums(sums)
+                        temp.metric, temp.coords = metric_coords
+                        self.results[(i,j)] = temp._copy_for_results()
+                        self += temp
+                    self._update_checkpoint(ckpt, i, j)
+                if next_job < len(todo):
+                    k = todo[next_job]
+                    self.logger.info("Rank 0: Sending job %s to rank %d",jobs[k][:2],p)
+                    comm.send(k, dest=p)
+                    next_job += 1
+                else:
+                    comm.send(None, dest=p)
+                    nworkers -= 1
+            self._update_checkpoint(ckpt, None, None, final=True)
+        else:
+            comm.send((rank, None, None, None), dest=0)
+            while True:
+                k = comm.recv(source=0)
+                if k is None:
+                    break
+                i, j, c1, c2, _ = jobs[k]
+                temp.clear()
+                if c2 is None or not self._trivially_zero(c1,c2,metric):
+                    self._process_patch_pair(temp, i, j, c1, c2, metric, num_threads)
+                if c2 is None or np.sum(temp.npairs) > 0:
+                    msg = (rank, k, (temp.metric, temp.coords), temp._get_sums())
+                else:
+                    msg = (rank, k, None, None)
+                if low_mem:
+                    c1.unload()
+                    if c2 is not None: c2.unload()
+                comm.send(msg, dest=0)
+
+        # Don't let any worker start sending messages for some later calculation until rank 0
+        # has received everything for this one.
+        comm.Barrier()
+
     def _process_all_auto(self, cat1, metric, num_threads, comm, low_mem):
 
         def is_my_job(my_indices, i, j, n):
@@ -479,6 +961,10 @@ class BinnedCorr2(object):
             if my_indices is None:
                 return True
 
+            # With patch_schedule = 'cost', the assignment was already made.
+            if my_pairs is not None:
+                return (i,j) in my_pairs
+
             # Now the tricky part.  If using MPI, we need to divide up the jobs smartly.
             # The first point is to divvy up the auto jobs evenly.  This is where most of the
             # work is done, so we want those to be spreads as evenly as possibly across procs.
@@ -520,7 +1006,8 @@ class BinnedCorr2(object):
             n = self.npatch1
 
             # Setup for deciding when this is my job.
-            if comm:
+            dynamic = self._use_dynamic_mpi(comm)
+            if comm and not dynamic:
                 size = comm.Get_size()
                 rank = comm.Get_rank()
                 my_indices = np.arange(n * rank // size, n * (rank+1) // size)
@@ -528,48 +1015,39 @@ class BinnedCorr2(object):
             else:
                 my_indices = None
 
-            temp = self.copy()
+            # With patch_schedule = 'cost', estimate how long each pair will take.
+            costs = self._get_patch_costs(cat1, None, low_mem)
+            if my_indices is not None and costs is not None:
+                my_pairs = self._assign_patch_jobs(list(costs.keys()), list(costs.values()),
+                                                   size, rank)
+            else:
+                my_pairs = None
+
+            jobs = []
             for ii,c1 in enumerate(cat1):
                 i = c1.patch if c1.patch is not None else ii
                 if is_my_job(my_indices, i, i, n):
-                    temp.clear()
-                    self.logger.info('Process patch %d auto',i)
-                    temp.process_auto(c1,metric,num_threads)
-                    self.results[(i,i)] = temp._copy_for_results()
-                    self += temp
+                    jobs.append((i, i, c1, None, []))
                 for jj,c2 in list(enumerate(cat1))[::-1]:
                     j = c2.patch if c2.patch is not None else jj
                     if i < j and is_my_job(my_indices, i, j, n):
-                        temp.clear()
-                        if not self._trivially_zero(c1,c2,metric):
-                            self.logger.info('Process patches %d,%d cross',i,j)
-                            temp.process_cross(c1,c2,metric,num_threads)
-                        else:
-                            self.logger.info('Skipping %d,%d pair, which are too far apart ' +
-                                             'for this set of separations',i,j)
-                        if np.sum(temp.npairs) > 0:
-                            self.results[(i,j)] = temp._copy_for_results()
-                            self += temp
-                        else:
-                            # NNCorrelation needs to add the tot value
-                            self._add_tot(i, j, c1, c2)
-                        if low_mem and jj != ii+1:
-                            # Don't unload i+1, since that's the next one we'll need.
-                            c2.unload()
-                if low_mem:
-                    c1.unload()
-            if comm is not None:
-                rank = comm.Get_rank()
-                size = comm.Get_size()
-                self.logger.info("Rank %d: Completed jobs %s",rank,list(self.results.keys()))
-                # Send all the results back to rank 0 process.
-                if rank > 0:
-                    comm.send(self, dest=0)
-                else:
-                    for p in range(1,size):
-                        temp = comm.recv(source=p)
-                        self += temp
-                        self.results.update(temp.results)
+                        # Don't unload i+1, since that's the next one we'll need.
+                        unload = [c2] if low_mem and jj != ii+1 else []
+                        jobs.append((i, j, c1, c2, unload))
+                if low_mem and len(jobs) > 0:
+                    jobs[-1][4].append(c1)
+            jobs = self._sort_patch_jobs(jobs, costs, low_mem)
+            ckpt = self._start_checkpoint(jobs, metric, comm, cat1, None, low_mem)
+            if dynamic:
+                self._process_patch_jobs_dynamic(jobs, metric, num_threads, low_mem, comm, ckpt)
+            else:
+                jobs = self._skip_done_jobs(jobs, ckpt)
+                self._process_patch_jobs(jobs, metric, num_threads, low_mem, ckpt)
+                if comm is not None:
+                    rank = comm.Get_rank()
+                    self.logger.info("Rank %d: Completed jobs %s",rank,list(self.results.keys()))
+                    # Send all the results back to rank 0 process.
+                    self._reduce_mpi(comm)
 
     def _process_all_cross(self, cat1, cat2, metric, num_threads, comm, low_mem):
 
@@ -581,6 +1059,10 @@ class BinnedCorr2(object):
             if my_indices is None:
                 return True
 
+            # With patch_schedule = 'cost', the assignment was already made.
+            if my_pairs is not None:
+                return (i,j) in my_pairs
+
             # This is much simpler than in the auto case, since the set of catalogs for
             # cat1 and cat2 are different, we can just split up one of them among the jobs.
             if n1 > n2:
@@ -618,7 +1100,8 @@ class BinnedCorr2(object):
             # Setup for deciding when this is my job.
             n1 = self.npatch1
             n2 = self.npatch2
-            if comm:
+            dynamic = self._use_dynamic_mpi(comm)
+            if comm and not dynamic:
                 size = comm.Get_size()
                 rank = comm.Get_rank()
                 if n1 > n2:
@@ -629,41 +1112,38 @@ class BinnedCorr2(object):
             else:
                 my_indices = None
 
-            temp = self.copy()
+            costs = self._get_patch_costs(cat1, cat2, low_mem)
+            if my_indices is not None and costs is not None:
+                my_pairs = self._assign_patch_jobs(list(costs.keys()), list(costs.values()),
+                                                   size, rank)
+            else:
+                my_pairs = None
+
+            jobs = []
             for ii,c1 in enumerate(cat1):
                 i = c1.patch if c1.patch is not None else ii
                 for jj,c2 in enumerate(cat2):
                     j = c2.patch if c2.patch is not None else jj
                     if is_my_job(my_indices, i, j, n1, n2):
-                        temp.clear()
-                        if not self._trivially_zero(c1,c2,metric):
-                            self.logger.info('Process patches %d,%d cross',i,j)
-                            temp.process_cross(c1,c2,metric,num_threads)
-                        else:
-                            self.logger.info('Skipping %d,%d pair, which are too far apart ' +
-                                             'for this set of separations',i,j)
-                        if np.sum(temp.npairs) > 0:
-                            self.results[(i,j)] = temp._copy_for_results()
-                            self += temp
-                        else:
-                            # NNCorrelation needs to add the tot value
-                            self._add_tot(i, j, c1, c2)
-                        if low_mem:
-                            c2.unload()
-                if low_mem:
-                    c1.unload()
-            if comm is not None:
-                rank = comm.Get_rank()
-                size = comm.Get_size()
-                self.logger.info("Rank %d: Completed jobs %s",rank,list(self.results.keys()))
-                # Send all the results back to rank 0 process.
-                if rank > 0:
-                    comm.send(self, dest=0)
-                else:
-                    for p in range(1,size):
-                        temp = comm.recv(source=p)
-                        self += temp
-                        self.results.update(temp.results)
+                        jobs.append((i, j, c1, c2, [c2] if low_mem else []))
+                if low_mem and len(jobs) > 0:
+                    jobs[-1][4].append(c1)
+            jobs = self._sort_patch_jobs(jobs, costs, low_mem)
+            ckpt = self._start_checkpoint(jobs, metric, comm, cat1, cat2, low_mem)
+            if dynamic:
+                self._process_patch_jobs_dynamic(jobs, metric, num_threads, low_mem, comm, ckpt)
+            else:
+                jobs = self._skip_done_jobs(jobs, ckpt)
+                self._process_patch_jobs(jobs, metric, num_threads, low_mem, ckpt)
+                if comm is not None:
+                    rank = comm.Get_rank()
+                    self.logger.info("Rank %d: Completed jobs %s",rank,list(self.results.keys()))
+                    # Send all the results back to rank 0 process.
+                    self._reduce_mpi(comm)
+
+    def _npatches(self):
+        # The number of patches used for each catalog.
+        return (self.npatch1, self.npatch2)
 
     def _getStatLen(self):
         # The length of the array that will be returned by _getStat.
@@ -777,6 +1257,10 @@ class BinnedCorr2(object):
         self.meanr[mask] /= self._sep_units
         self.meanlogr[mask] -= self._log_sep_units
 
+    # Other correlation objects whose binnings are filled during the same traversal as this one.
+    # cf. process_binnings.
+    _extra_binnings = ()
+
     def _get_minmax_size(self):
         if self.metric == 'Euclidean':
             # The minimum size cell that will be useful is one where two cells that just barely
@@ -793,6 +1277,12 @@ class BinnedCorr2(object):
             # be split at the maximum separation even if the other size = 0.
             # i.e. max_size = max_sep * b
             max_size = self._max_sep * self.b
+
+            # If other binnings are being filled in the same traversal, the fields need to be
+            # fine enough for all of them.
+            for c in self._extra_binnings:
+                min_size = min(min_size, c._min_sep * c.b / (2.+3.*c.b))
+                max_size = max(max_size, c._max_sep * c.b)
             return min_size, max_size
         else:
             # For other metrics, the above calculation doesn't really apply, so just skip
@@ -800,6 +1290,83 @@ class BinnedCorr2(object):
             # (And for the max_size, always split 10 levels for the top-level cells.)
             return 0., 0.
 
+    # When processing many realizations, the cell values for at most about this many
+    # (object, realization) combinations are held in memory at a time.  If there are more
+    # than this, the realizations are done in chunks, with one traversal for each chunk.
+    _max_realization_values = 2**24
+
+    def _get_nreal(self):
+        # The number of realizations in the xi arrays, or None for a normal calculation.
+        xi = getattr(self, self._xi_attrs[0])
+        return xi.shape[0] if xi.ndim > self.rnom.ndim else None
+
+    def _check_nreal(self, *cats):
+        # Only process_auto and process_cross for GG and KK can use multiple realizations of
+        # the values.  Anywhere else, they would be silently ignored, so don't allow it.
+        for cat in cats:
+            if cat.nreal is not None:
+                raise ValueError("Catalogs with multiple realizations of k or g can only be "
+                                 "used by GGCorrelation and KKCorrelation (but not with "
+                                 "process_pairwise).")
+
+    def _set_nreal(self, nreal):
+        # Make sure the xi arrays have the right shape for catalogs with nreal realizations
+        # of their values (or nreal=None for normal catalogs).
+        if nreal == self._get_nreal():
+            return
+        if np.any(self.weight != 0):
+            raise ValueError("Cannot combine catalogs with different numbers of realizations.")
+        if nreal is not None and self.var_method != 'shot':
+            raise ValueError("Only var_method='shot' is available for catalogs with multiple "
+                             "realizations.")
+        shape = self.rnom.shape if nreal is None else (nreal,) + self.rnom.shape
+        for name in self._xi_attrs:
+            setattr(self, name, np.zeros(shape, dtype=float))
+        # The C++ object has pointers to the old arrays, so it needs to be made again.
+        if hasattr(self, '_corr'):
+            treecorr._lib.DestroyCorr2(self._corr, self._d1, self._d2, self._bintype)
+            del self._corr
+
+    def _process_realizations(self, f1, f2, process, auto):
+        # Accumulate xi for all the realizations of the values in fields f1 and f2.
+        # process() does the usual traversal of the trees, but the C++ layer records the
+        # pairs of cells that would have been accumulated into xi, and applies them to the
+        # values of the cells for each realization in batches as it goes.  (The other sums,
+        # like weight and npairs, don't depend on the values, so they are accumulated as
+        # usual.)  If there are too many realizations to hold all of their cell values in
+        # memory at once, the traversal is repeated for each chunk of realizations.
+        from treecorr.util import double_ptr as dp
+        nreal = self._get_nreal()
+        xi = [getattr(self, name) for name in self._xi_attrs]
+        xi += [None] * (4 - len(xi))
+        other = [getattr(self, name) for name in self._sum_attrs if name not in self._xi_attrs]
+        step = max(1, self._max_realization_values // max(f1.ntot, f2.ntot))
+        for start in range(0, nreal, step):
+            end = min(start + step, nreal)
+            if start > 0:
+                # The other sums were already accumulated by the first traversal.
+                saved = [a.copy() for a in other]
+            v1 = f1.get_realization_values(start, end)
+            v2 = v1 if f2 is f1 else f2.get_realization_values(start, end)
+            out = [x[start:end] if x is not None else None for x in xi]
+            treecorr._lib.SetRecordPairs(self.corr, 1, self._d1, self._bintype)
+            try:
+                treecorr._lib.AddRecordTarget(self.corr, f1.data, f2.data, dp(v1), dp(v2),
+                                              end-start, 0 if auto else 1,
+                                              dp(out[0]), dp(out[1]), dp(out[2]), dp(out[3]),
+                                              self._d1, self._d1, self._d2,
+                                              self._coords, self._bintype)
+                process()
+                treecorr._lib.FinishRecordedPairs(self.corr, self._d1, self._bintype)
+                npairs = treecorr._lib.GetNRecordedPairs(self.corr, self._d1, self._bintype)
+                self.logger.info('Applied %d pairs of cells to realizations %d to %d',
+                                 npairs, start, end-1)
+            finally:
+                treecorr._lib.SetRecordPairs(self.corr, 0, self._d1, self._bintype)
+            if start > 0:
+                for a, b in zip(other, saved):
+                    a[:] = b
+
     def sample_pairs(self, n, cat1, cat2, min_sep, max_sep, metric=None):
         """Return a random sample of n pairs whose separations fall between min_sep and max_sep.
 
@@ -900,24 +1467,47 @@ class BinnedCorr2(object):
 
         return i1, i2, sep
 
-    def _calculate_xi_from_pairs(self, pairs):
+    def _stackStat(self, results):
+        # The values of _getStat for each pair of patches in results as a 2d array.
+        return results.stack('xi').reshape(len(results), -1)
+
+    def _stackWeight(self, results):
+        # The values of _getWeight for each pair of patches in results as a 2d array.
+        return results.stack('weight').reshape(len(results), -1)
+
+    def _calculate_xi_from_pairs(self, pairs, i=None, j=None, key=''):
         # This is the normal calculation.  It needs to be overridden when there are randoms.
-        n = np.sum([self.results[ij]._getStat() for ij in pairs], axis=0)
-        d = np.sum([self.results[ij]._getWeight() for ij in pairs], axis=0)
+        # pairs is a _PatchPairWeights instance describing which pairs to use for each
+        # realization.  i,j are the patch numbers to use for the entries in results.  Normally
+        # these are just the keys, but cross correlations with randoms sometimes need to map
+        # them onto the pairs of the main correlation.  key distinguishes the cached sums of
+        # such other correlations from our own.
+        if i is None:
+            i, j = self.results.indices()
+        n = pairs.sum((i, j), self._stackStat(self.results), key+'stat')
+        d = pairs.sum((i, j), self._stackWeight(self.results), key+'weight')
         d[d == 0] = 1  # Guard against division by zero.
         xi = n/d
-        w = np.sum(d)
+        w = np.sum(d, axis=1)
         return xi,w
 
-    def _make_cov_design_matrix(self, all_pairs):
+    def _clear_cov_cache(self):
+        # Anything that changes the results needs to clear the cached values used for the
+        # covariance estimates.
+        self._cov_cache.clear()
+        self._cov_version += 1
+
+    def _make_cov_design_matrix(self, pairs):
         xisize = self._getStatLen()
-        nrows = len(all_pairs)
-        x = np.zeros((nrows,xisize), dtype=float)
-        w = np.zeros(nrows, dtype=float)
-        for i, pairs in enumerate(all_pairs):
-            xi, wi = self._calculate_xi_from_pairs(pairs)
-            x[i] = xi
-            w[i] = wi
+        # The jackknife and sample design matrices don't involve any random selections, so
+        # they are saved for the next time they are needed.
+        key = ('design', pairs.method, pairs.npatch) if pairs.counts is None else None
+        if key in self._cov_cache:
+            return self._cov_cache[key]
+        x, w = self._calculate_xi_from_pairs(pairs)
+        x = x.reshape(pairs.nreal, xisize)
+        if key is not None:
+            self._cov_cache[key] = (x, w)
         return x, w
 
 
@@ -925,7 +1515,8 @@ def estimate_multi_cov(corrs, method):
     """Estimate the covariance matrix of multiple statistics.
 
     This is like the method `BinnedCorr2.estimate_cov`, except that it will acoommodate
-    multiple statistics from a list ``corrs`` of `BinnedCorr2` objects.
+    multiple statistics from a list ``corrs`` of `BinnedCorr2` objects.  The list may also
+    include `BinnedCorr3` objects, so long as they all use the same patches.
 
     Options for ``method`` include:
 
@@ -960,7 +1551,7 @@ def estimate_multi_cov(corrs, method):
     statistic, although this is not checked.
 
     Parameters:
-        corrs (list):   A list of `BinnedCorr2` instances.
+        corrs (list):   A list of `BinnedCorr2` and/or `BinnedCorr3` instances.
         method (str):   Which method to use to estimate the covariance matrix.
 
     Returns:
@@ -990,19 +1581,170 @@ def _cov_shot(corrs):
     return np.diag(np.concatenate(vlist))  # Return as a covariance matrix
 
 def _get_patch_nums(corrs, name):
-    pairs = list(corrs[0].results.keys())
-    if len(pairs) == 0:
+    if len(corrs[0].results) == 0:
         raise ValueError("Using %s covariance requires using patches."%name)
-    npatch = max(corrs[0].npatch1, corrs[0].npatch2)
-    all_pairs = [pairs]  # Start these as lists for each corr instance.
+    npatch = max(corrs[0]._npatches())
     for c in corrs[1:]:
-        pairs = list(c.results.keys())
-        if len(pairs) == 0:
+        if len(c.results) == 0:
             raise ValueError("Using %s covariance requires using patches."%name)
-        if (c.npatch1 != 1 and c.npatch1 != npatch) or (c.npatch2 != 1 and c.npatch2 != npatch):
+        if any(n != 1 and n != npatch for n in c._npatches()):
             raise RuntimeError("All correlations must use the same number of patches")
-        all_pairs.append(pairs)
-    return npatch, all_pairs
+    return npatch
+
+def _get_bootstrap_counts(corrs, npatch):
+    # Select npatch patches at random with replacement for each bootstrap realization.
+    # Return the number of times each patch was selected as an (nboot, npatch) array.
+    # The same selections are used for all the correlations, so the cross-covariances between
+    # them are meaningful.
+    nboot = np.max([c.num_bootstrap for c in corrs])  # use the maximum if they differ.
+    indx = np.random.randint(npatch, size=(nboot, npatch))
+    counts = np.zeros((nboot, npatch), dtype=float)
+    np.add.at(counts, (np.arange(nboot)[:,np.newaxis], indx), 1)
+    return counts
+
+def _sum_by_patch(k, v, npatch):
+    # Sum the rows of v with the same value of k.
+    ret = np.zeros((npatch,) + v.shape[1:], dtype=float)
+    np.add.at(ret, k, v)
+    return ret
+
+def _first_use(index):
+    # For each position in the patch indices, whether that patch is not already used at an
+    # earlier position.  E.g. for a pair (i,i), only the first i is a new patch.
+    ret = []
+    for a in range(len(index)):
+        new = np.ones(len(index[a]), dtype=bool)
+        for b in range(a):
+            new &= index[a] != index[b]
+        ret.append(new)
+    return ret
+
+class _PatchPairWeights(object):
+    # A description of the realizations used for one of the patch-based covariance estimates.
+    #
+    # Each realization is a sum over some set of patch pairs (i,j), possibly with repetition.
+    # E.g. for jackknife, realization k includes all pairs that don't involve patch k.  Rather
+    # than build a list of pairs for each realization, which takes O(npatch^3) Python work for
+    # jackknife, we record the rule for how many times each pair is included in each
+    # realization.  Then sum() can do the sums for all realizations at once using array
+    # operations over all the pairs.
+    #
+    # The same rules apply to the patch triples (i,j,k) of a 3-point correlation.  Everything
+    # here works with a tuple of index arrays, one for each catalog, so both cases are handled
+    # the same way.
+    #
+    # The pairs are defined in terms of the correlation c used to make this object.  If c
+    # only has patches for one of its catalogs, the pairs are (i,0) or (0,i).  Otherwise, only
+    # the pairs that are in c.results are used.  Other results (e.g. rr for an NN correlation)
+    # may be summed with the same weights, which will just skip any pairs they don't have.
+    #
+    # The sums over the pairs for each patch are the same for all methods, so these are
+    # cached in c._cov_cache, which is cleared whenever the results change.
+
+    def __init__(self, method, c, npatch, counts=None):
+        self.method = method
+        self.npatch = npatch
+        self.counts = counts        # For bootstrap methods, the multiplicity of each patch.
+        self.nreal = npatch if counts is None else len(counts)
+        self.cache = c._cov_cache
+        # The positions of the catalogs that use patches.  The others only have patch 0.
+        npatches = c._npatches()
+        self.patched = [a for a in range(len(npatches)) if npatches[a] != 1]
+        if len(self.patched) == 0:
+            self.patched = [0]
+        self.unpatched = [a for a in range(len(npatches)) if a not in self.patched]
+        if len(self.patched) > 1:
+            assert all(npatches[a] == npatch for a in self.patched)
+            if 'ok' not in self.cache:
+                index = c.results.indices()
+                self.cache['ok'] = np.unique(self._code([index[a] for a in self.patched]))
+            self.ok = self.cache['ok']
+        else:
+            self.ok = None
+
+    def _code(self, index):
+        # A single integer for each tuple of patch indices.
+        return np.ravel_multi_index(tuple(index), (self.npatch,)*len(index))
+
+    def missing_patches(self):
+        """Whether some patches do not appear in the first position of any pair in results.
+        """
+        if self.ok is None:
+            return False
+        first = np.unravel_index(self.ok, (self.npatch,)*len(self.patched))[0]
+        return len(np.unique(first)) < self.npatch
+
+    def _select(self, index, v):
+        # Select the pairs that are used, and drop the indices of the catalogs without patches.
+        use = np.ones(len(v), dtype=bool)
+        for a in self.unpatched:
+            use &= index[a] == 0
+        index = [index[a] for a in self.patched]
+        if self.ok is not None:
+            use &= np.isin(self._code(index), self.ok)
+        return [k[use] for k in index], v[use]
+
+    def _patch_sums(self, index, v):
+        # The total, the sums of the pairs with each patch in the first position, and the
+        # sums of the pairs that involve each patch in any position.  (The latter counts
+        # each pair once for each distinct patch it involves.)
+        index, v = self._select(index, v)
+        first = _sum_by_patch(index[0], v, self.npatch)
+        involved = first.copy()
+        for k, new in list(zip(index, _first_use(index)))[1:]:
+            involved += _sum_by_patch(k[new], v[new], self.npatch)
+        return np.sum(v, axis=0), first, involved
+
+    def sum(self, index, v, key=None):
+        """Sum the values v for the patch pairs given by the tuple of index arrays for
+        each realization.
+
+        If key is given, it is used to cache the sums for each patch, so subsequent
+        calls with the same key may use them rather than redoing the sums.
+
+        The return value has shape (nreal,) + v.shape[1:].
+        """
+        if key is None:
+            tot, first, involved = self._patch_sums(index, v)
+        else:
+            if ('sums', key) not in self.cache:
+                self.cache[('sums', key)] = self._patch_sums(index, v)
+            tot, first, involved = self.cache[('sums', key)]
+
+        if self.method == 'jackknife':
+            # Realization k is the total minus everything involving patch k.
+            ret = tot - involved
+        elif self.method == 'sample':
+            ret = first.copy()
+        elif self.method == 'marked_bootstrap':
+            # All pairs with a selected patch in the first position, once for each selection.
+            ret = np.tensordot(self.counts, first, axes=1)
+        else:
+            assert self.method == 'bootstrap'
+            # Each pair is included once for each combination of selections of the distinct
+            # patches it involves.  So auto terms are included once for each selection of the
+            # patch, and cross terms for each pair of selections.
+            # Do these in chunks to limit the memory used for the weight matrix.
+            index, v = self._select(index, v)
+            new = _first_use(index)
+            ret = np.zeros((self.nreal,) + v.shape[1:], dtype=float)
+            chunk = max(1, 2**22 // self.nreal)
+            for k in range(0, len(v), chunk):
+                s = slice(k, k+chunk)
+                w = self.counts[:,index[0][s]]
+                for a in range(1, len(index)):
+                    w = w * np.where(new[a][s], self.counts[:,index[a][s]], 1.)
+                ret += np.tensordot(w, v[s], axes=1)
+        return ret
+
+def _design_matrix(corrs, pairs_list):
+    vlist = []
+    wlist = []
+    for c, pairs in zip(corrs, pairs_list):
+        v, w = c._make_cov_design_matrix(pairs)
+        vlist.append(v)
+        wlist.append(w)
+    return np.hstack(vlist), wlist
 
 def _cov_jackknife(corrs):
     # Calculate the jackknife covariance for the given statistics
@@ -1012,21 +1754,8 @@ def _cov_jackknife(corrs):
     # where v_i is the vector when excluding patch i, and v_mean is the mean of all {v_i}.
     #   v_i = Sum_jk!=i num_jk / Sum_jk!=i denom_jk
 
-    npatch, all_pairs = _get_patch_nums(corrs, 'jackknife')
-
-    vlist = []
-    for c, pairs in zip(corrs, all_pairs):
-        if c.npatch2 == 1:
-            vpairs = [ [(j,0) for j in range(c.npatch1) if j!=i] for i in range(c.npatch1) ]
-        elif c.npatch1 == 1:
-            vpairs = [ [(0,j) for j in range(c.npatch2) if j!=i] for i in range(c.npatch2) ]
-        else:
-            assert c.npatch1 == c.npatch2
-            vpairs = [ [(j,k) for j,k in pairs if j!=i and k!=i] for i in range(c.npatch1) ]
-        v, w = c._make_cov_design_matrix(vpairs)
-        vlist.append(v)
-
-    v = np.hstack(vlist)
+    npatch = _get_patch_nums(corrs, 'jackknife')
+    v, _ = _design_matrix(corrs, [_PatchPairWeights('jackknife', c, npatch) for c in corrs])
     vmean = np.mean(v, axis=0)
     v -= vmean
     C = (1.-1./npatch) * v.T.dot(v)
@@ -1043,30 +1772,17 @@ def _cov_sample(corrs):
     # where v_i = Sum_j num_ij / Sum_j denom_ij
     # and w_i is the fraction of the total weight in each patch
 
-    npatch, all_pairs = _get_patch_nums(corrs, 'sample')
+    npatch = _get_patch_nums(corrs, 'sample')
 
-    vlist = []
-    wlist = []
-    for c, pairs in zip(corrs, all_pairs):
-        if c.npatch2 == 1:
-            vpairs = [ [(i,0)] for i in range(c.npatch1) ]
-        elif c.npatch1 == 1:
-            vpairs = [ [(0,i)] for i in range(c.npatch2) ]
-        else:
-            assert c.npatch1 == c.npatch2
-            # Note: It's not obvious to me a priori which of these should be the right choice.
-            #       Empirically, they both underestimate the variance, but the second one
-            #       does so less on the tests I have in test_patch.py.  So that's the one I'm
-            #       using.
-            #vpairs = [ [(j,k) for j,k in pairs if j==i or k==i] for i in range(c.npatch1) ]
-            vpairs = [ [(j,k) for j,k in pairs if j==i] for i in range(c.npatch1) ]
-        if any([len(v) == 0 for v in vpairs]):
+    # Note: It's not obvious to me a priori whether v_i should use the pairs with i in either
+    #       position, or just those with i in the first position.  Empirically, they both
+    #       underestimate the variance, but the second one does so less on the tests I have in
+    #       test_patch.py.  So that's the one I'm using.
+    pairs_list = [_PatchPairWeights('sample', c, npatch) for c in corrs]
+    for pairs in pairs_list:
+        if pairs.missing_patches():
             raise RuntimeError("Cannot compute sample variance when some patches have no data.")
-        v, w = c._make_cov_design_matrix(vpairs)
-        vlist.append(v)
-        wlist.append(w)
-
-    v = np.hstack(vlist)
+    v, wlist = _design_matrix(corrs, pairs_list)
     w = np.sum(wlist,axis=0)
     w /= np.sum(w)  # Now w is the fractional weight for each patch
 
@@ -1092,31 +1808,11 @@ def _cov_marked(corrs):
 
     # C = 1/(nboot) Sum_i (v_i - v_mean) (v_i - v_mean)^T
 
-    npatch, all_pairs = _get_patch_nums(corrs, 'marked_bootstrap')
-
-    nboot = np.max([c.num_bootstrap for c in corrs])  # use the maximum if they differ.
-    vlist = []
-    for c, pairs in zip(corrs, all_pairs):
-        vpairs = []
-        if c.npatch1 != 1 and c.npatch2 != 1:
-            # Precompute this for use below.
-            ok = np.zeros((c.npatch1, c.npatch1), dtype=bool)
-            for (i,j) in pairs:
-                ok[i,j] = True
-        for k in range(nboot):
-            indx = np.random.randint(npatch, size=npatch)
-            if c.npatch2 == 1:
-                vpairs1 = [ (i,0) for i in indx ]
-            elif c.npatch1 == 1:
-                vpairs1 = [ (0,i) for i in indx ]
-            else:
-                assert c.npatch1 == c.npatch2
-                vpairs1 = [ (i,j) for i in indx for j in range(c.npatch2) if ok[i,j] ]
-            vpairs.append(vpairs1)
-        v, w = c._make_cov_design_matrix(vpairs)
-        vlist.append(v)
-
-    v = np.hstack(vlist)
+    npatch = _get_patch_nums(corrs, 'marked_bootstrap')
+    counts = _get_bootstrap_counts(corrs, npatch)
+    nboot = len(counts)
+    v, _ = _design_matrix(corrs, [_PatchPairWeights('marked_bootstrap', c, npatch, counts)
+                                  for c in corrs])
     vmean = np.mean(v, axis=0)
     v -= vmean
     C = 1./(nboot-1) * v.T.dot(v)
@@ -1131,40 +1827,478 @@ def _cov_bootstrap(corrs):
     # It seems to do a slightly better job than the marked-point bootstrap above from the
     # tests done in the test suite.  But the difference is generally pretty small.
 
-    npatch, all_pairs = _get_patch_nums(corrs, 'bootstrap')
-
-    nboot = np.max([c.num_bootstrap for c in corrs])  # use the maximum if they differ.
-    vlist = []
-    for c, pairs in zip(corrs, all_pairs):
-        vpairs = []
-        if c.npatch1 != 1 and c.npatch2 != 1:
-            # Precompute this for use below.
-            ok = np.zeros((c.npatch1, c.npatch1), dtype=bool)
-            for (i,j) in pairs:
-                if i != j:
-                    ok[i,j] = True
-        for k in range(nboot):
-            indx = np.random.randint(npatch, size=npatch)
-            if c.npatch2 == 1:
-                vpairs1 = [ (i,0) for i in indx ]
-            elif c.npatch1 == 1:
-                vpairs1 = [ (0,i) for i in indx ]
-            else:
-                assert c.npatch1 == c.npatch2
-                # Include all represented auto-correlations once, repeating as appropriate
-                vpairs1 = [ (i,i) for i in indx if (i,i) in pairs ]
-
-                # And all other pairs that aren't really auto-correlations
-                # This is way faster with the precomputed ok matrix.
-                # Like 0.005 seconds per call rather than 1.2 seconds for 128 patches!
-                temp = [ (i,j) for i in indx for j in indx if ok[i,j] ]
-                vpairs1.extend(temp)
-            vpairs.append(vpairs1)
-        v, w = c._make_cov_design_matrix(vpairs)
-        vlist.append(v)
-
-    v = np.hstack(vlist)
+    npatch = _get_patch_nums(corrs, 'bootstrap')
+    counts = _get_bootstrap_counts(corrs, npatch)
+    nboot = len(counts)
+    v, _ = _design_matrix(corrs, [_PatchPairWeights('bootstrap', c, npatch, counts)
+                                  for c in corrs])
     vmean = np.mean(v, axis=0)
     v -= vmean
     C = 1./(nboot-1) * v.T.dot(v)
     return C
+
+def _multi_params(corr):
+    # The parameters that need to match for correlations to be processed together in
+    # process_multi, since they determine which pairs of cells are used.
+    return (corr.bin_type, corr._nbins, corr._min_sep, corr._max_sep, corr._bin_size, corr.b,
+            corr.min_rpar, corr.max_rpar, corr.xperiod, corr.yperiod, corr.zperiod,
+            corr.brute, corr.split_method, corr.min_top, corr.max_top,
+            treecorr.config.get(corr.config,'metric',str,'Euclidean'))
+
+def process_multi(corrs, cat1, cat2=None, metric=None, num_threads=None):
+    """Compute several two-point correlation functions of the same catalog(s) at once.
+
+    Normally, each correlation object builds its own fields and traverses the trees separately
+    when you call its `process <BinnedCorr2.process>` method, even if several of them use the
+    same catalogs.  This function does a single traversal of the trees of the positions and
+    uses the resulting pairs of cells for all of the correlation functions in ``corrs``.
+
+    The items in ``corrs`` may be any of `NNCorrelation`, `NKCorrelation`, `NGCorrelation`,
+    `KKCorrelation`, `KGCorrelation`, or `GGCorrelation`.  For each one, the first field uses
+    ``cat1`` and the second uses ``cat2``.  If ``cat2`` is None, then NN, KK and GG are
+    auto-correlations of ``cat1``, and the others are cross-correlations of ``cat1`` with
+    itself, as if you had called e.g. ``ng.process(cat1, cat1)``.  So for a catalog with both
+    positions and shears, you could compute all of the two-point functions with::
+
+        >>> nn = treecorr.NNCorrelation(config)
+        >>> ng = treecorr.NGCorrelation(config)
+        >>> gg = treecorr.GGCorrelation(config)
+        >>> treecorr.process_multi([nn, ng, gg], cat)
+
+    All of the correlation objects need to have the same binning, bin_slop, metric and other
+    parameters that determine which pairs of cells are used.  The results are the same as
+    calling `process <BinnedCorr2.process>` for each of them, up to rounding errors in the
+    sums of the values in each cell.
+
+    If the catalogs have patches, the results of each pair of patches are kept as usual, so
+    the covariance estimates are available.  However, the pairs of patches are processed one
+    at a time, so the MPI and low_mem options of `process <BinnedCorr2.process>` are not
+    available here, nor is ``num_patch_threads``.  Catalogs with multiple realizations
+    of k or g are not allowed.
+
+    Parameters:
+        corrs (list):       A list of `BinnedCorr2` instances to compute.
+        cat1 (Catalog):     A catalog or list of catalogs for the first field.
+        cat2 (Catalog):     A catalog or list of catalogs for the second field, if any.
+                            (default: None)
+        metric (str):       Which metric to use.  See `Metrics` for details.
+                            (default: 'Euclidean'; this value can also be given in the
+                            constructor in the config dict.)
+        num_threads (int):  How many OpenMP threads to use during the calculation.
+                            (default: use the number of cpu cores; this value can also be given
+                            in the constructor in the config dict.)
+    """
+    corrs = list(corrs)
+    if len(corrs) == 0:
+        raise ValueError("No correlation objects given to process_multi")
+    for c in corrs:
+        if not isinstance(c, BinnedCorr2):
+            raise TypeError("process_multi requires BinnedCorr2 instances")
+    for c in corrs[1:]:
+        if _multi_params(c) != _multi_params(corrs[0]):
+            raise ValueError("All correlations in process_multi must use the same binning")
+
+    for c in corrs:
+        c.clear()
+    if not isinstance(cat1,list):
+        for c in corrs:
+            c.npatch1 = cat1._npatch
+            if cat2 is None: c.npatch2 = cat1._npatch
+        cat1 = cat1.get_patches()
+    if cat2 is not None and not isinstance(cat2,list):
+        for c in corrs:
+            c.npatch2 = cat2._npatch
+        cat2 = cat2.get_patches()
+    for cat in cat1 + (cat2 or []):
+        if cat.nreal is not None:
+            raise ValueError("process_multi cannot use catalogs with multiple realizations")
+
+    # The pairs are found by an NN correlation, which is one of the ones requested if possible.
+    nn = [c for c in corrs if isinstance(c, treecorr.NNCorrelation)]
+    if nn:
+        primary = nn[0]
+    else:
+        primary = treecorr.NNCorrelation(corrs[0].config, logger=corrs[0].logger)
+    temps = [c.copy() for c in corrs]
+    ptemp = temps[corrs.index(primary)] if nn else primary.copy()
+    # For cross-correlations of a catalog with itself, the (j,i) pair of patches is
+    # calculated from the same pairs of cells as (i,j).
+    rtemps = [c.copy() for c in corrs]
+
+    if cat2 is None:
+        primary.logger.info("Starting process_multi for %d correlations", len(corrs))
+        for i, c1 in enumerate(cat1):
+            for j in range(i, len(cat1)):
+                c2 = cat1[j] if j > i else None
+                _process_multi_pair(corrs, temps, rtemps, ptemp, i, j, c1, c2, True,
+                                    metric, num_threads)
+    else:
+        primary.logger.info("Starting process_multi for %d cross-correlations", len(corrs))
+        for i, c1 in enumerate(cat1):
+            for j, c2 in enumerate(cat2):
+                _process_multi_pair(corrs, temps, rtemps, ptemp, i, j, c1, c2, False,
+                                    metric, num_threads)
+
+    _finalize_multi(corrs, cat1, cat2)
+
+def _finalize_multi(corrs, cat1, cat2):
+    # Finalize each of the corrs, with the variances of their k or g fields.
+    var = { 2 : treecorr.calculateVarK, 3 : treecorr.calculateVarG }
+    for c in corrs:
+        varx = [ var[d](cat) for d, cat in ((c._d1, cat1), (c._d2, cat2 or cat1)) if d != 1 ]
+        c.finalize(*varx)
+
+def _process_multi_pair(corrs, temps, rtemps, ptemp, i, j, c1, c2, same_cat,
+                        metric, num_threads):
+    # Process a single pair of patches for all the correlations in corrs.
+    # c2 = None means the auto-correlation of patch i.  If same_cat is True, the patches are
+    # from the same catalog, so the (j,i) pair is also needed for the mixed correlations.
+    from treecorr.util import double_ptr as dp
+    for t in temps + rtemps + [ptemp]:
+        t.clear()
+    mixed = [c._d1 != c._d2 for c in corrs]
+
+    if c2 is not None and ptemp._trivially_zero(c1,c2,metric):
+        ptemp.logger.info('Skipping %d,%d pair, which are too far apart ' +
+                          'for this set of separations',i,j)
+    else:
+        # These are the same fields that ptemp will use.
+        ptemp._set_metric(metric, c1.coords, c2.coords if c2 is not None else None)
+        min_size, max_size = ptemp._get_minmax_size()
+        if c2 is None:
+            f1 = f2 = c1.getNField(min_size, max_size, ptemp.split_method,
+                                   bool(ptemp.brute), ptemp.min_top, ptemp.max_top,
+                                   ptemp.coords)
+        else:
+            f1 = c1.getNField(min_size, max_size, ptemp.split_method,
+                              ptemp.brute is True or ptemp.brute == 1,
+                              ptemp.min_top, ptemp.max_top, ptemp.coords)
+            f2 = c2.getNField(min_size, max_size, ptemp.split_method,
+                              ptemp.brute is True or ptemp.brute == 2,
+                              ptemp.min_top, ptemp.max_top, ptemp.coords)
+
+        values = {}
+        def get_values(f, d):
+            # The values of the cells in f for data type d.  For N, this is just the weight.
+            if (f, d) not in values:
+                cat = f.cat
+                if d == 1:
+                    values[f, d] = f._get_cell_values(np.ones((cat.ntot,1)))
+                elif d == 2:
+                    values[f, d] = f._get_cell_values(cat.k[:,np.newaxis])
+                else:
+                    g = cat.g1 + 1j * cat.g2
+                    values[f, d] = f._get_cell_values(g[:,np.newaxis].view(float),
+                                                      shear=True)
+            return values[f, d]
+
+        # Each application of the recorded pairs to a correlation: (t, fa, fb, mode, factor)
+        applies = []
+        for t, rt, m in zip(temps, rtemps, mixed):
+            if t is ptemp:
+                continue
+            if c2 is None and not m:
+                applies.append((t, f1, f2, 0, 1))
+            elif c2 is None:
+                # Both orders of each pair go into the same result.  For TwoD binning, the
+                # NN auto-correlation already counted each pair in both bins.
+                applies.append((t, f1, f2, 1, 1 if ptemp.bin_type == 'TwoD' else 2))
+                applies.append((t, f1, f2, 2, 0))
+            else:
+                applies.append((t, f1, f2, 1, 1))
+                if same_cat and m:
+                    applies.append((rt, f2, f1, 2, 1))
+
+        treecorr._lib.SetRecordPairs(ptemp.corr, 1, ptemp._d1, ptemp._bintype)
+        try:
+            # The recorded pairs are applied to the values for each correlation in batches
+            # during the traversal, so the values need to be set up first.
+            for t, fa, fb, mode, factor in applies:
+                t._set_metric(ptemp.metric, ptemp.coords)
+                if isinstance(t, treecorr.NNCorrelation):
+                    continue
+                xi = [getattr(t, name) for name in t._xi_attrs]
+                xi += [None] * (4 - len(xi))
+                treecorr._lib.AddRecordTarget(ptemp.corr, fa.data, fb.data,
+                                              dp(get_values(fa, t._d1)),
+                                              dp(get_values(fb, t._d2)), 1, mode,
+                                              dp(xi[0]), dp(xi[1]), dp(xi[2]), dp(xi[3]),
+                                              ptemp._d1, t._d1, t._d2,
+                                              ptemp._coords, ptemp._bintype)
+
+            if c2 is None:
+                ptemp.logger.info('Process patch %d auto',i)
+                ptemp.process_auto(c1,metric,num_threads)
+            else:
+                ptemp.logger.info('Process patches %d,%d cross',i,j)
+                ptemp.process_cross(c1,c2,metric,num_threads)
+            treecorr._lib.FinishRecordedPairs(ptemp.corr, ptemp._d1, ptemp._bintype)
+            npairs = treecorr._lib.GetNRecordedPairs(ptemp.corr, ptemp._d1, ptemp._bintype)
+            ptemp.logger.info('Applied %d pairs of cells to %d correlations',
+                              npairs, len(corrs))
+
+            # The sums that don't depend on the values are the same as for ptemp, up to a
+            # factor of 2 for cross-correlations of a patch with itself.
+            for t, fa, fb, mode, factor in applies:
+                if isinstance(t, treecorr.NNCorrelation):
+                    t._set_sums(ptemp._get_sums())
+                    continue
+                for name in ['meanr', 'meanlogr', 'weight', 'npairs']:
+                    sums = getattr(ptemp, name).ravel()
+                    if mode == 2 and ptemp.bin_type == 'TwoD':
+                        # The reversed pairs go into the opposite bins.
+                        sums = sums[::-1]
+                    getattr(t, name).ravel()[:] += factor * sums
+        finally:
+            treecorr._lib.SetRecordPairs(ptemp.corr, 0, ptemp._d1, ptemp._bintype)
+
+    for c, t, rt, m in zip(corrs, temps, rtemps, mixed):
+        c._add_patch_pair(t, i, j, c1, c2)
+        if c2 is not None and same_cat and m:
+            c._add_patch_pair(rt, j, i, c2, c1)
+
+def process_tomo(corr, cats1, cats2=None, metric=None, num_threads=None, num_pair_threads=1):
+    """Compute a correlation function for every pair of catalogs in a list, such as the
+    tomographic bins of a weak lensing survey.
+
+    For instance, for 5 tomographic bins of source galaxies, there are 15 distinct shear-shear
+    correlations.  You could do each of them with a separate call to `process
+    <BinnedCorr2.process>`, but this function does all of them at once::
+
+        >>> gg = treecorr.GGCorrelation(config)
+        >>> results = treecorr.process_tomo(gg, source_cats, num_pair_threads=4)
+        >>> xip_24 = results[(2,4)].xip
+
+    The fields for each catalog (and each of its patches) are built once at the start, using
+    all of the available threads, and then every pair uses the cached fields.  The pairs can
+    also be processed concurrently by setting ``num_pair_threads``, in which case the available
+    OpenMP threads are divided among the pairs being processed at the same time.  The most
+    expensive pairs are started first.
+
+    If ``cats2`` is None, then the results include the auto-correlation of each catalog
+    with itself and the cross-correlation of each pair (i,j) with i < j.  This is only
+    possible if the two fields of ``corr`` are the same type (NN, KK or GG).  Otherwise, the
+    results include all pairs (i,j) with the first field from ``cats1[i]`` and the second from
+    ``cats2[j]``, e.g. for galaxy-galaxy lensing with a list of lens bins and a list of source
+    bins.
+
+    Parameters:
+        corr (BinnedCorr2): A correlation object to use as a template for the results.  All of
+                            the results use its configuration.  It is not itself modified.
+        cats1 (list):       A list of catalogs for the first field.
+        cats2 (list):       A list of catalogs for the second field, if any. (default: None)
+        metric (str):       Which metric to use.  See `Metrics` for details.
+                            (default: 'Euclidean'; this value can also be given in the
+                            constructor in the config dict.)
+        num_threads (int):  How many OpenMP threads to use during the calculation.
+                            (default: use the number of cpu cores; this value can also be given
+                            in the constructor in the config dict.)
+        num_pair_threads (int): How many pairs of catalogs to process at the same time.
+                            (default: 1)
+
+    Returns:
+        A dict of correlation objects of the same type as ``corr``, indexed by the tuple (i,j).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if not isinstance(corr, BinnedCorr2):
+        raise TypeError("process_tomo requires a BinnedCorr2 instance")
+    cats1 = list(cats1)
+    if len(cats1) == 0:
+        raise ValueError("No catalogs given to process_tomo")
+    if cats2 is None:
+        if corr._d1 != corr._d2:
+            raise ValueError("cats2 is required for %s"%corr.__class__.__name__)
+        pairs = [(i,j) for i in range(len(cats1)) for j in range(i,len(cats1))]
+    else:
+        cats2 = list(cats2)
+        if len(cats2) == 0:
+            raise ValueError("No catalogs given to process_tomo")
+        pairs = [(i,j) for i in range(len(cats1)) for j in range(len(cats2))]
+
+    def get_cats(i, j):
+        # The arguments to use for process for the pair (i,j).
+        if cats2 is None:
+            return cats1[i], (cats1[j] if j > i else None)
+        else:
+            return cats1[i], cats2[j]
+
+    # Build all the fields up front, so each one is built once with all the threads available.
+    # These are the same arguments that process_auto and process_cross use for each patch.
+    base = corr.copy()
+    base._set_num_threads(num_threads)
+    getters = { 1 : 'getNField', 2 : 'getKField', 3 : 'getGField' }
+    built = set()
+    def build(cat, d, brute):
+        if (id(cat), d, brute) in built:
+            return
+        built.add((id(cat), d, brute))
+        for c in cat.get_patches():
+            base._set_metric(metric, c.coords)
+            min_size, max_size = base._get_minmax_size()
+            getattr(c, getters[d])(min_size, max_size, base.split_method, brute,
+                                   base.min_top, base.max_top, base.coords)
+    for i, j in pairs:
+        c1, c2 = get_cats(i, j)
+        if c2 is None:
+            build(c1, corr._d1, bool(corr.brute))
+        else:
+            build(c1, corr._d1, corr.brute is True or corr.brute == 1)
+            build(c2, corr._d2, corr.brute is True or corr.brute == 2)
+
+    def process_pair(i, j, job_threads):
+        c1, c2 = get_cats(i, j)
+        result = corr.copy()
+        if c2 is None:
+            result.process(c1, metric=metric, num_threads=job_threads)
+        else:
+            result.process(c1, c2, metric=metric, num_threads=job_threads)
+        return result
+
+    results = {}
+    if num_pair_threads <= 1 or len(pairs) <= 1:
+        for i, j in pairs:
+            results[(i,j)] = process_pair(i, j, num_threads)
+    else:
+        # Start the most expensive pairs first, so the threads finish at about the same time.
+        def cost(pair):
+            c1, c2 = get_cats(*pair)
+            return c1.nobj**2 / 2. if c2 is None else c1.nobj * c2.nobj
+        jobs = sorted(pairs, key=lambda pair: -cost(pair))
+        job_threads = max(1, treecorr.get_omp_threads() // num_pair_threads)
+        corr.logger.info('Processing %d pairs of catalogs with %d concurrent jobs using %d '
+                         'threads each', len(pairs), num_pair_threads, job_threads)
+        with ThreadPoolExecutor(max_workers=num_pair_threads) as executor:
+            futures = { pair : executor.submit(process_pair, pair[0], pair[1], job_threads)
+                        for pair in jobs }
+            for pair in pairs:
+                results[pair] = futures[pair].result()
+        # Reset the OpenMP threads for this thread.
+        base._set_num_threads(num_threads)
+    return results
+
+def process_binnings(corrs, cat1, cat2=None, metric=None, num_threads=None):
+    """Compute the same correlation function with several different binnings at once.
+
+    Sometimes it is useful to have the same correlation function binned in different ways.
+    E.g. you might want 20 log bins for the main science result, linear or TwoD bins for
+    some diagnostics, and very fine bins for a Hankel transform.  Normally, you would need to
+    call `process <BinnedCorr2.process>` for each of them, which traverses the trees again
+    each time.  This function fills all of them in a single traversal::
+
+        >>> gg1 = treecorr.GGCorrelation(min_sep=1., max_sep=100., nbins=20)
+        >>> gg2 = treecorr.GGCorrelation(min_sep=0., max_sep=50., nbins=10, bin_type='Linear')
+        >>> gg3 = treecorr.GGCorrelation(max_sep=20., nbins=20, bin_type='TwoD')
+        >>> treecorr.process_binnings([gg1, gg2, gg3], cat)
+
+    Each binning decides when to split the cells using its own ``bin_slop``, just as it would
+    if it were processed on its own.  When the binnings want to split a pair of cells in
+    different ways, each way is followed separately for the binnings that want it, so the
+    traversal is only shared where the binnings agree.  The trees are built fine enough for
+    all of the binnings, which can be somewhat finer than what a single binning would use.
+    So the results are not always identical to separate calls to
+    `process <BinnedCorr2.process>`, but each binning is only filled from pairs of cells that
+    are small enough for its own ``bin_slop``, so they have the same accuracy.
+    With ``brute=True``, the results are the same as separate calls, up to rounding.
+
+    The savings are largest when the binnings need similar resolution over similar ranges
+    of separation.  If one binning is much finer than the others, most of the work is
+    for that one anyway, so there is not much to gain from doing them together.
+
+    All of the items in ``corrs`` need to be the same class, and they may only differ in the
+    parameters of their binning (``bin_type``, ``min_sep``, ``max_sep``, ``nbins``,
+    ``bin_size``, ``bin_slop``, and ``sep_units``).  At most 64 of them may be done at once.
+
+    If the catalogs have patches, the results of each pair of patches are kept as usual, so
+    the covariance estimates are available.  However, the pairs of patches are processed one
+    at a time, so the MPI and low_mem options of `process <BinnedCorr2.process>` are not
+    available here, nor is ``num_patch_threads``.  Catalogs with multiple realizations
+    of k or g are not allowed.
+
+    Parameters:
+        corrs (list):       A list of `BinnedCorr2` instances to compute.
+        cat1 (Catalog):     A catalog or list of catalogs for the first field.
+        cat2 (Catalog):     A catalog or list of catalogs for the second field, if any.
+                            (default: None)
+        metric (str):       Which metric to use.  See `Metrics` for details.
+                            (default: 'Euclidean'; this value can also be given in the
+                            constructor in the config dict.)
+        num_threads (int):  How many OpenMP threads to use during the calculation.
+                            (default: use the number of cpu cores; this value can also be given
+                            in the constructor in the config dict.)
+    """
+    corrs = list(corrs)
+    if len(corrs) == 0:
+        raise ValueError("No correlation objects given to process_binnings")
+    if len(corrs) > 64:
+        raise ValueError("process_binnings can only do up to 64 binnings at a time")
+    if not isinstance(corrs[0], BinnedCorr2):
+        raise TypeError("process_binnings requires BinnedCorr2 instances")
+    for c in corrs[1:]:
+        if type(c) is not type(corrs[0]):
+            raise TypeError("All correlations in process_binnings must be the same class")
+        # The binning is the first 6 items of _multi_params.
+        if _multi_params(c)[6:] != _multi_params(corrs[0])[6:]:
+            raise ValueError("The correlations in process_binnings may only differ in their "
+                             "binning")
+
+    if cat2 is None and corrs[0]._d1 != corrs[0]._d2:
+        # Like process_multi, do the cross-correlation of cat1 with itself.
+        cat2 = cat1
+    for c in corrs:
+        c.clear()
+    if not isinstance(cat1,list):
+        for c in corrs:
+            c.npatch1 = cat1._npatch
+            if cat2 is None: c.npatch2 = cat1._npatch
+        cat1 = cat1.get_patches()
+    if cat2 is not None and not isinstance(cat2,list):
+        for c in corrs:
+            c.npatch2 = cat2._npatch
+        cat2 = cat2.get_patches()
+    for cat in cat1 + (cat2 or []):
+        if cat.nreal is not None:
+            raise ValueError("process_binnings cannot use catalogs with multiple realizations")
+
+    # The first correlation does the traversal, and the others are filled along the way.
+    temps = [c.copy() for c in corrs]
+    corrs[0].logger.info("Starting process_binnings for %d binnings", len(corrs))
+    if cat2 is None:
+        for i, c1 in enumerate(cat1):
+            for j in range(i, len(cat1)):
+                c2 = cat1[j] if j > i else None
+                _process_binnings_pair(corrs, temps, i, j, c1, c2, metric, num_threads)
+    else:
+        for i, c1 in enumerate(cat1):
+            for j, c2 in enumerate(cat2):
+                _process_binnings_pair(corrs, temps, i, j, c1, c2, metric, num_threads)
+    _finalize_multi(corrs, cat1, cat2)
+
+def _process_binnings_pair(corrs, temps, i, j, c1, c2, metric, num_threads):
+    # Process a single pair of patches for all the binnings in corrs.
+    # c2 = None means the auto-correlation of patch i.
+    for t in temps:
+        t.clear()
+    ptemp = temps[0]
+    if c2 is not None and all(t._trivially_zero(c1,c2,metric) for t in temps):
+        ptemp.logger.info('Skipping %d,%d pair, which are too far apart ' +
+                          'for this set of separations',i,j)
+    else:
+        ptemp._extra_binnings = temps[1:]
+        for t in temps[1:]:
+            treecorr._lib.AddBinning(ptemp.corr, t.corr, ptemp._d1, ptemp._d2,
+                                     ptemp._bintype, t._bintype)
+        try:
+            if c2 is None:
+                ptemp.logger.info('Process patch %d auto',i)
+                ptemp.process_auto(c1,metric,num_threads)
+            else:
+                ptemp.logger.info('Process patches %d,%d cross',i,j)
+                ptemp.process_cross(c1,c2,metric,num_threads)
+            for t in temps[1:]:
+                t._set_metric(ptemp.metric, ptemp.coords)
+        finally:
+            del ptemp._extra_binnings
+            treecorr._lib.ClearBinnings(ptemp.corr, ptemp._d1, ptemp._d2, ptemp._bintype)
+
+    for c, t in zip(corrs, temps):
+        c._add_patch_pair(t, i, j, c1, c2)
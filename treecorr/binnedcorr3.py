@@ -189,8 +189,12 @@ class BinnedCorr3(object):
         zperiod (float):    For the 'Periodic' metric, the period to use in the z direction.
                             (default: period)
 
-        var_method (str):   Which method to use for estimating the variance.  So far, only 'shot'
-                            is implemented. (default: 'shot')
+        var_method (str):   Which method to use for estimating the variance. Options are:
+                            'shot', 'jackknife', 'sample', 'bootstrap', 'marked_bootstrap'.
+                            The methods other than 'shot' require the input catalogs to have
+                            patches.  (default: 'shot')
+        num_bootstrap (int): How many bootstrap samples to use for the 'bootstrap' and
+                            'marked_bootstrap' var_methods.  (default: 500)
 
         num_threads (int):  How many OpenMP threads to use during the calculation.
                             (default: use the number of cpu cores; this value can also be given in
@@ -200,6 +204,44 @@ class BinnedCorr3(object):
 
                                 This won't work if the system's C compiler cannot use OpenMP
                                 (e.g. clang prior to version 3.7.)
+
+        num_patch_threads (int): When using patches, how many triples of patches to process
+                            concurrently.  Each concurrent job gets an equal share of the
+                            ``num_threads`` OpenMP threads.  This helps when the patches are
+                            small, so each triple of patches has too few top-level cells to keep
+                            all the cores busy.  (default: 1)
+
+        cache_dir (str):    For `NNNCorrelation`, a directory in which to save the results of
+                            `process <NNNCorrelation.process>`.  The file name is a hash of the
+                            positions, weights and patches of the catalogs along with the
+                            binning and metric parameters.  If `process <NNNCorrelation.process>`
+                            is called again with the same inputs, the results are just read
+                            back from this file.  (default: None)
+
+        algo (str):         Which algorithm to use for auto-correlations.  Options are:
+
+                            - 'triangle' = Find the triangles by traversing the tree.  (default)
+                            - 'multipole' = Use each point as the vertex between sides d2 and
+                              d3, and accumulate the Fourier components of the distribution of
+                              its neighbors in the angle around it in fine bins of separation.
+                              These are then converted to the usual r,u,v binning.  The cost
+                              scales as :math:`N \\times N_{\\rm neighbor}` rather than
+                              :math:`N \\times N_{\\rm neighbor}^2`, so it is much faster for
+                              large max_sep/min_sep.  It is only available for auto-correlations
+                              in flat or spherical coordinates with the Euclidean or Arc metric.
+                              The results are an approximation, whose accuracy is governed by
+                              max_n, bin_slop, and the resolution of the fine separation bins,
+                              which is set by nsub.  Any patches in the catalog are ignored,
+                              so only var_method='shot' is allowed, and it cannot be run with
+                              MPI (i.e. comm must be None).
+
+        max_n (int):        For algo='multipole', the maximum Fourier mode to use. (default: 30)
+        nsub (int):         For algo='multipole', the number of fine separation bins in each
+                            of the regular r bins.  The results converge to those of the triangle
+                            algorithm as nsub and max_n are increased, but the time and memory
+                            for converting the multipoles to the r,u,v bins grow quickly with
+                            nsub.  (default: enough for the fine bins to be half the size of the
+                            u bins, i.e. ceil(2 bin_size / ubin_size))
     """
     _valid_params = {
         'nbins' : (int, False, None, None,
@@ -269,8 +311,21 @@ class BinnedCorr3(object):
         'zperiod': (float, False, None, None,
                 'The period to use for the z direction for the Periodic metric'),
 
-        'var_method': (str, False, 'shot', ['shot'],
+        'var_method': (str, False, 'shot',
+                ['shot', 'jackknife', 'sample', 'bootstrap', 'marked_bootstrap'],
                 'The method to use for estimating the variance'),
+        'num_bootstrap': (int, False, 500, None,
+                'How many bootstrap samples to use for the var_method=bootstrap and marked_bootstrap'),
+        'num_patch_threads' : (int, False, 1, None,
+                'How many triples of patches to process concurrently.'),
+        'cache_dir' : (str, False, None, None,
+                'A directory in which to cache the results of NNNCorrelation.process.'),
+        'algo' : (str, False, 'triangle', ['triangle', 'multipole'],
+                'Which algorithm to use for auto-correlations.'),
+        'max_n' : (int, False, 30, None,
+                'The maximum Fourier mode to use for the multipole algorithm.'),
+        'nsub' : (int, False, None, None,
+                'The number of fine separation bins in each r bin for the multipole algorithm.'),
     }
 
     def __init__(self, config=None, logger=None, **kwargs):
@@ -472,38 +527,576 @@ class BinnedCorr3(object):
         self.zperiod = treecorr.config.get(self.config,'zperiod',float,period)
 
         self.var_method = treecorr.config.get(self.config,'var_method',str,'shot')
-        self.results = {}  # for jackknife, etc. store the results of each pair of patches.
-
-    def _process_all_auto(self, cat1, metric, num_threads):
-        # I'm not sure which of these is more intuitive, but both are correct...
-        if True:
-            for c1 in cat1:
-                self.process_auto(c1, metric, num_threads)
-                for c2 in cat1:
-                    if c2 is not c1:
-                        self.process_cross(c1,c1,c2, metric, num_threads)
-                        self.process_cross(c1,c2,c1, metric, num_threads)
-                        self.process_cross(c2,c1,c1, metric, num_threads)
-                        for c3 in cat1:
-                            if c3 is not c1 and c3 is not c2:
-                                self.process_cross(c1,c2,c3, metric, num_threads)
-        else: # pragma: no cover
-            for i,c1 in enumerate(cat1):
-                self.process_auto(c1)
-                for j,c2 in enumerate(cat1[i+1:]):
-                    self.process_cross(c1,c1,c2, metric, num_threads)
-                    self.process_cross(c1,c2,c1, metric, num_threads)
-                    self.process_cross(c2,c1,c1, metric, num_threads)
-                    self.process_cross(c1,c2,c2, metric, num_threads)
-                    self.process_cross(c2,c1,c2, metric, num_threads)
-                    self.process_cross(c2,c2,c1, metric, num_threads)
-                    for c3 in cat1[i+j+1:]:
-                        self.process_cross(c1,c2,c3, metric, num_threads)
-                        self.process_cross(c1,c3,c2, metric, num_threads)
-                        self.process_cross(c2,c1,c3, metric, num_threads)
-                        self.process_cross(c2,c3,c1, metric, num_threads)
-                        self.process_cross(c3,c1,c2, metric, num_threads)
-                        self.process_cross(c3,c2,c1, metric, num_threads)
+        self.num_bootstrap = treecorr.config.get(self.config,'num_bootstrap',int,500)
+        # for jackknife, etc. store the results of each triple of patches.
+        self.results = treecorr.util.PatchPairResults()
+        self.npatch1 = self.npatch2 = self.npatch3 = 1
+        # Values used by estimate_cov that can be reused until the results change.
+        self._cov_cache = {}
+        # Incremented whenever the results change, so other objects that use these results
+        # (e.g. the ddd correlation using this as rrr) can tell if their cached values are stale.
+        self._cov_version = 0
+        self.cache_dir = self.config.get('cache_dir',None)
+        self.algo = treecorr.config.get(self.config,'algo',str,'triangle')
+        self.max_n = treecorr.config.get(self.config,'max_n',int,30)
+        if self.max_n < 0:
+            raise ValueError("max_n must be non-negative")
+        self.nsub = treecorr.config.get(self.config,'nsub',int,None)
+        if self.nsub is not None and self.nsub < 1:
+            raise ValueError("nsub must be at least 1")
+
+    def _get_cache_file(self, cat1, cat2, cat3, metric):
+        # The file in cache_dir where the results of process for these catalogs would be
+        # stored, or None if not using a cache.
+        if self.cache_dir is None:
+            return None
+        if metric is None:
+            metric = treecorr.config.get(self.config,'metric',str,'Euclidean')
+        params = (self.__class__.__name__, self.bin_type, self.min_sep, self.max_sep,
+                  self.nbins, self.bin_size, self.sep_units, self.min_u, self.max_u,
+                  self.nubins, self.min_v, self.max_v, self.nvbins, self.b, self.bu, self.bv,
+                  self.split_method, self.brute, self.min_top, self.max_top,
+                  self.min_rpar, self.max_rpar, self.xperiod, self.yperiod, self.zperiod, metric,
+                  self.algo, self.max_n, self.nsub)
+        return treecorr.util.get_cache_file(self.cache_dir, params, [cat1, cat2, cat3])
+
+    def _process_multipole(self, cat, cat2, cat3, metric, num_threads, comm):
+        # Process the auto-correlation of a single catalog using the multipole algorithm.
+        # The weight, ntri and mean distances are accumulated directly into self.  The return
+        # value is a list of the accumulated data values for the derived class, each of which
+        # is complex with the same shape as weight: [] for NNN, [zeta] for KKK, and
+        # [gam0, gam1, gam2, gam3] for GGG.
+        from treecorr.util import double_ptr as dp
+        if cat2 is not None or cat3 is not None:
+            raise NotImplementedError("algo='multipole' is only implemented for "
+                                      "auto-correlations.")
+        if comm is not None:
+            raise NotImplementedError("algo='multipole' cannot be run with MPI.")
+        if self.var_method != 'shot':
+            # The triangles are not kept separate for each triple of patches, so none of the
+            # patch-based covariance estimates are possible.
+            raise NotImplementedError("algo='multipole' only supports var_method='shot', "
+                                      "not %r."%self.var_method)
+        if isinstance(cat, list):
+            if len(cat) != 1:
+                raise ValueError("algo='multipole' requires a single catalog, not a list.")
+            cat = cat[0]
+        if cat.name == '':
+            self.logger.info('Starting multipole process for auto-correlations')
+        else:
+            self.logger.info('Starting multipole process for auto-correlations for cat %s.',
+                             cat.name)
+
+        self._set_metric(metric, cat.coords)
+        self._check_nreal(cat)
+        if self.coords not in ['flat', 'spherical'] or self.metric not in ['Euclidean', 'Arc']:
+            raise ValueError("algo='multipole' requires flat or spherical coordinates with "
+                             "either the Euclidean or Arc metric.")
+        self._set_num_threads(num_threads)
+        min_size, max_size = self._get_minmax_size()
+        get_field = [cat.getNField, cat.getKField, cat.getGField][self._d1-1]
+        field = get_field(min_size, max_size, self.split_method, bool(self.brute),
+                          self.min_top, self.max_top, self.coords)
+
+        # The fine radial bins.  These are aligned with the regular r bins, but go down to
+        # min_sep * min_u (or 0 if min_u = 0) to include all the d3 values.  They need to be
+        # fine enough that d3/d2 is reasonably well determined at the resolution of the u bins.
+        # By default, they are half the size of the u bins, but nsub can make them finer.
+        # If min_u = 0, the lowest bin goes from 0 to 1/10 of the first u bin, since the
+        # mean d3 is not well determined within this bin.
+        nsub = self.nsub
+        if nsub is None:
+            nsub = max(1, int(math.ceil(2.*self.bin_size/self.ubin_size - 1.e-8)))
+        dlogr = self.bin_size / nsub
+        if self.min_u > 0.:
+            nlow = int(math.ceil(-math.log(self.min_u)/dlogr - 1.e-8))
+        else:
+            nlow = int(math.ceil(-math.log(0.1*self.ubin_size)/dlogr))
+        edges = self._min_sep * np.exp(dlogr * np.arange(-nlow, self.nbins*nsub+1))
+        if self.min_u == 0.:
+            edges = np.concatenate([[0.], edges])
+            nlow += 1
+        nr = len(edges)-1
+        if self.metric == 'Arc':
+            # The C++ layer uses chord distances.
+            cedges = 2.*np.sin(edges/2.)
+        else:
+            cedges = edges
+
+        maxn = self.max_n
+        if self._d1 == 3:
+            nz = 6
+            nn = 2*maxn+1
+        else:
+            nz = self._d1 + 1
+            nn = maxn+1
+        zeta = np.zeros((nz, nr-nlow, nr, nn), dtype=complex)
+        sumw = np.zeros(nr, dtype=float)
+        sumwr = np.zeros(nr, dtype=float)
+        sumwlogr = np.zeros(nr, dtype=float)
+        b = 0. if self.brute else min(self.b, self.bu, self.bv)
+
+        self.logger.info('Starting %d jobs.',field.nTopLevelNodes)
+        treecorr._lib.ProcessMultipole3(field.data, self.output_dots, self._d1, self._coords,
+                                        dp(cedges), nr, nlow, maxn, b, dp(zeta),
+                                        dp(sumw), dp(sumwr), dp(sumwlogr))
+
+        self.logger.info('Converting multipoles to r,u,v bins')
+        return self._convert_multipole(zeta, edges, nlow, nsub, sumw, sumwr, sumwlogr)
+
+    def _multipole_d1(self, d2, d3, cosphi):
+        # The third side of a triangle with sides d2, d3 and opening angle phi between them.
+        if self.coords == 'flat':
+            return np.sqrt(np.maximum(d2**2 + d3**2 - 2.*d2*d3*cosphi, 0.))
+        elif self.metric == 'Euclidean':
+            # Chord distances on the unit sphere.
+            d1sq = (d2**2 + d3**2 - 0.5*d2**2*d3**2
+                    - 2.*d2*d3*np.sqrt((1.-d2**2/4.)*(1.-d3**2/4.))*cosphi)
+            return np.sqrt(np.maximum(d1sq, 0.))
+        else:
+            # Great circle distances.
+            cosd1 = np.cos(d2)*np.cos(d3) + np.sin(d2)*np.sin(d3)*cosphi
+            return np.arccos(np.clip(cosd1, -1., 1.))
+
+    def _multipole_cosphi(self, d1, d2, d3):
+        # The inverse of _multipole_d1.
+        if self.coords == 'flat':
+            cosphi = (d2**2 + d3**2 - d1**2) / (2.*d2*d3)
+        elif self.metric == 'Euclidean':
+            cosphi = ((d2**2 + d3**2 - 0.5*d2**2*d3**2 - d1**2) /
+                      (2.*d2*d3*np.sqrt((1.-d2**2/4.)*(1.-d3**2/4.))))
+        else:
+            cosphi = (np.cos(d1) - np.cos(d2)*np.cos(d3)) / (np.sin(d2)*np.sin(d3))
+        return np.clip(cosphi, -1., 1.)
+
+    def _convert_multipole(self, zeta, edges, k2min, nsub, sumw, sumwr, sumwlogr):
+        # Convert the multipoles Z_n(b2,b3) to the regular r,u,v bins.
+        #
+        # The distribution of triangles in the angle phi between the d2 and d3 sides is
+        #     D(phi) = 1/2pi Sum_n Z_n exp(-i n phi)
+        # We integrate this over the range of phi corresponding to each v bin for a few
+        # representative values of d2 and d3 in each fine radial bin.
+        nr = len(edges)-1
+        nz = zeta.shape[0]
+        nn = zeta.shape[3]
+        maxn = self.max_n
+        nv = 2*self.nvbins
+
+        # The weighted mean distance in each fine bin.
+        lo = edges[:-1]
+        hi = edges[1:]
+        mask = sumw > 0.
+        rmean = np.where(lo > 0., np.sqrt(lo*hi), hi/2.)
+        logrmean = np.log(rmean)
+        rmean[mask] = sumwr[mask] / sumw[mask]
+        logrmean[mask] = sumwlogr[mask] / sumw[mask]
+        if self.metric == 'Arc':
+            rmean[mask] = 2.*np.arcsin(rmean[mask]/2.)
+            logrmean[mask] = np.log(2.*np.arcsin(np.exp(logrmean[mask])/2.))
+        # Several sub-points in each bin, placed at equally spaced quantiles of the distribution
+        # of pairs in log(r).  Within each bin, we model this as exp(alpha log(r)), where the
+        # slope alpha is estimated from the counts in the adjacent bins.  The bin going down
+        # to 0 just uses the mean.
+        dlogr = self.bin_size / nsub
+        ns = 4
+        logw = np.log(np.maximum(sumw, 1.e-300*np.max(sumw, initial=1.)))
+        alpha = np.zeros(nr)
+        if nr > 2:
+            alpha[1:-1] = (logw[2:] - logw[:-2]) / (2.*dlogr)
+        alpha = np.clip(alpha, -50./dlogr, 50./dlogr)
+        alpha[sumw <= 0.] = 0.
+        quant = (np.arange(ns)+0.5)/ns
+        ad = alpha[:,None] * dlogr
+        small = np.abs(ad) < 1.e-4
+        ad = np.where(small, 1., ad)
+        t = np.where(small, quant, np.log1p(quant * np.expm1(ad)) / ad)
+        logsub = np.log(np.maximum(lo, 1.e-300))[:,None] + t * dlogr
+        logsub[lo == 0.] = logrmean[lo == 0.][:,None]
+        rsub = np.exp(logsub)
+
+        # All the combinations of sub-points (b2,i2), (b3,i3) with d3 <= d2.
+        # When b2 == b3, the pairs all have d3 <= d2, so the (i2,i3) combinations with i3 > i2
+        # are not used, and those with i3 == i2 get half the weight of the others.
+        b2, b3, i2, i3 = np.meshgrid(np.arange(k2min,nr), np.arange(nr), np.arange(ns),
+                                     np.arange(ns), indexing='ij')
+        b2 = b2.ravel()
+        b3 = b3.ravel()
+        i2 = i2.ravel()
+        i3 = i3.ravel()
+        frac = np.where(b3 < b2, 1., np.where(i3 < i2, 2., 1.)) / ns**2
+        use = (b3 < b2) | (i3 <= i2)
+        b2 = b2[use]
+        b3 = b3[use]
+        i2 = i2[use]
+        i3 = i3[use]
+        frac = frac[use]
+        d2 = rsub[b2,i2]
+        d3 = rsub[b3,i3]
+        # Each sub-point represents a range of log(r) of width w, so log(u) for each
+        # combination has a triangular distribution of half-width w.  For the pairs within
+        # a single sub-point, it is half of that, from -w to 0, so use the mean, -w/3.
+        # Split the weight among the u bins according to this distribution.  Otherwise
+        # the discrete values of u lead to significant errors near the edges of the u bins.
+        w = np.where(lo[b3] > 0., dlogr/ns, 0.)
+        same = (b3 == b2) & (i3 == i2)
+        d3[same] = d2[same] * np.exp(-w[same]/3.)
+        logu = np.log(d3/d2)
+        with np.errstate(divide='ignore'):
+            logue = np.log(self.min_u + self.ubin_size * np.arange(self.nubins+1))
+        x = (logue[None,:] - logu[:,None]) / np.where(w > 0., w, 1.)[:,None]
+        cdf = np.where(x < 0., 0.5*np.clip(1.+x, 0., None)**2,
+                       1. - 0.5*np.clip(1.-x, 0., None)**2)
+        cdf[same] = np.clip(x[same] + 2./3., 0., 1.)**2
+        cdf[w == 0.] = x[w == 0.] > 0.
+        fu = np.diff(cdf, axis=1)
+        p, ku = np.nonzero(fu > 0.)
+        frac = frac[p] * fu[p,ku]
+        b2 = b2[p]
+        b3 = b3[p]
+        d2 = d2[p]
+        d3 = d3[p]
+        kr = (b2 - k2min) // nsub
+
+        # The range of phi for each v bin.
+        vedges = self.min_v + self.vbin_size * np.arange(self.nvbins+1)
+        d1 = d2[:,None] + vedges[None,:] * d3[:,None]
+        phi = np.arccos(self._multipole_cosphi(d1, d2[:,None], d3[:,None]))
+        phi_lo = np.empty((len(d2), nv))
+        phi_hi = np.empty((len(d2), nv))
+        # Positive v is counter-clockwise, which is 0 < phi < pi.
+        phi_lo[:,self.nvbins:] = phi[:,:-1]
+        phi_hi[:,self.nvbins:] = phi[:,1:]
+        phi_lo[:,:self.nvbins] = 2.*np.pi - phi[:,:0:-1]
+        phi_hi[:,:self.nvbins] = 2.*np.pi - phi[:,-2::-1]
+
+        # Gauss-Legendre quadrature with enough points to resolve the highest mode.
+        nq = int(math.ceil(maxn * np.max(phi_hi-phi_lo) / np.pi)) + 6
+        xq, wq = np.polynomial.legendre.leggauss(nq)
+
+        if self._d1 == 3:
+            coef = np.ones(nn)
+        else:
+            # Z_{-n} = Z_n^*, so D(phi) = 1/2pi Re(Z_0 + 2 Sum_n>0 Z_n exp(-i n phi))
+            coef = np.full(nn, 2.)
+            coef[0] = 1.
+        coef /= 2.*np.pi
+
+        shape = self.weight.shape
+        size = self.weight.size
+        out = np.zeros((nz-2, size), dtype=complex)
+        sums = np.zeros((10, size), dtype=float)
+        def add(a, index, x):
+            a += np.bincount(index, weights=x.ravel(), minlength=size)
+
+        chunk = max(1, int(4.e6 / (nv * nq * nn)))
+        for start in range(0, len(d2), chunk):
+            k = slice(start, start+chunk)
+            lo_k = phi_lo[k]
+            hi_k = phi_hi[k]
+            phiq = lo_k[:,:,None] + (hi_k-lo_k)[:,:,None] * (xq+1.)/2.
+            wphi = (hi_k-lo_k)[:,:,None] * wq/2. * frac[k][:,None,None]
+            # Evaluate the sum over n using Horner's method in t = exp(-i phi).
+            zk = zeta[:, b2[k]-k2min, b3[k], :] * coef
+            t = np.exp(-1j * phiq)
+            dphi = np.zeros((nz,) + t.shape, dtype=complex)
+            for j in range(nn-1, -1, -1):
+                dphi *= t
+                dphi += zk[:,:,j,None,None]
+            if self._d1 < 3:
+                dphi = dphi.real
+            else:
+                dphi *= np.exp(1j * maxn * phiq)
+
+            d2k = d2[k][:,None,None]
+            d3k = d3[k][:,None,None]
+            d1q = self._multipole_d1(d2k, d3k, np.cos(phiq))
+            vq = (d1q-d2k)/d3k * np.sign(np.pi - phiq)
+            dw = (dphi[0] * wphi).real
+            w = np.sum(dw, axis=2)
+            index = ((kr[k][:,None] * self.nubins + ku[k][:,None]) * nv
+                     + np.arange(nv)[None,:]).ravel()
+
+            add(sums[0], index, w)
+            add(sums[1], index, np.sum((dphi[1] * wphi).real, axis=2))
+            add(sums[2], index, np.sum(dw * d1q, axis=2))
+            add(sums[3], index, np.sum(dw * np.log(np.maximum(d1q, 1.e-300)), axis=2))
+            add(sums[4], index, w * d2k[:,:,0])
+            add(sums[5], index, w * np.log(d2k[:,:,0]))
+            add(sums[6], index, w * d3k[:,:,0])
+            add(sums[7], index, w * np.log(d3k[:,:,0]))
+            add(sums[8], index, w * (d3k/d2k)[:,:,0])
+            add(sums[9], index, np.sum(dw * vq, axis=2))
+
+            if self._d1 == 2:
+                add(out[0].real, index, np.sum(dphi[2] * wphi, axis=2))
+            elif self._d1 == 3:
+                # Project the shears to the centroid.  In this frame, p1 = 0, p2 = d3,
+                # and p3 = d2 exp(i phi).
+                p3 = d2k * np.exp(1j * phiq)
+                cen = (d3k + p3) / 3.
+                e1 = np.conj(cen)**2 / np.abs(cen)**2
+                e2 = np.conj(cen-d3k)**2 / np.abs(cen-d3k)**2
+                e3 = np.conj(cen-p3)**2 / np.abs(cen-p3)**2
+                proj = [e1*e2*e3, np.conj(e1)*e2*e3, e1*np.conj(e2)*e3, e1*e2*np.conj(e3)]
+                for q in range(4):
+                    x = np.sum(dphi[q+2] * proj[q] * wphi, axis=2)
+                    add(out[q].real, index, x.real)
+                    add(out[q].imag, index, x.imag)
+
+        self.weight[:] += sums[0].reshape(shape)
+        self.ntri[:] += sums[1].reshape(shape)
+        for a, x in zip([self.meand1, self.meanlogd1, self.meand2, self.meanlogd2,
+                         self.meand3, self.meanlogd3, self.meanu, self.meanv], sums[2:]):
+            a[:] += x.reshape(shape)
+        return [x.reshape(shape) for x in out]
+
+    def _npatches(self):
+        # The number of patches used for each catalog.
+        return (self.npatch1, self.npatch2, self.npatch3)
+
+    def _process_sym(self, c1, c2, c3, metric, num_threads):
+        # Process the triangles among the patches c1, c2, c3, which are all different
+        # catalogs with the same kind of data, in any order.  Each triangle is sorted into its
+        # natural bin, so this does the work of all 6 permutations of process_cross at once.
+        # If c1 is c2, then this does the triangles with two points in c1 and one in c3.
+        self._set_metric(metric, c1.coords, c2.coords, c3.coords)
+        self._check_nreal(c1, c2, c3)
+        self._set_num_threads(num_threads)
+        min_size, max_size = self._get_minmax_size()
+
+        def get_field(cat):
+            get = [cat.getNField, cat.getKField, cat.getGField][self._d1-1]
+            return get(min_size, max_size, self.split_method, bool(self.brute),
+                       self.min_top, self.max_top, self.coords)
+
+        if c1 is c2:
+            f1 = get_field(c1)
+            f2 = get_field(c3)
+            f3 = None
+        else:
+            f1 = get_field(c1)
+            f2 = get_field(c2)
+            f3 = get_field(c3)
+        treecorr._lib.ProcessSym3(self.corr, f1.data, f2.data,
+                                  f3.data if f3 is not None else treecorr._ffi.NULL,
+                                  self.output_dots, f1._d, self._coords, self._bintype,
+                                  self._metric)
+
+    def _add_tot(self, i, j, k, tot):
+        # When storing results from a patch-based run, the triples of patches that are too far
+        # apart to have any triangles are skipped, but NNNCorrelation still needs to accumulate
+        # their tot values.  For the other ones, this is a no op.
+        pass
+
+    def _get_patch_overlap(self, cat1, cat2=None, metric=None):
+        # Return a matrix saying how much each pair of patches could overlap on the scale of
+        # the triangles being measured.  This is 1 when the patch centers coincide, dropping
+        # linearly to 0 at the largest separation where a side of a triangle could possibly
+        # connect them.  Pairs (and triples) of patches with a negative overlap don't need
+        # to be processed.
+        # For now, ignore the metric (other than Periodic, where we don't prune), and just be
+        # conservative about how much space we need.  The longest side of a triangle is
+        # d1 = d2 + v d3 <= (1 + max_u max_v) max_sep.  The 2* is where we are being
+        # conservative, as in BinnedCorr2._trivially_zero.
+        n1 = len(cat1)
+        n2 = n1 if cat2 is None else len(cat2)
+        if metric is None:
+            metric = treecorr.config.get(self.config,'metric',str,'Euclidean')
+        if metric == 'Periodic':
+            return np.ones((n1,n2))
+        p1 = np.array([c._get_center_size() for c in cat1])
+        p2 = p1 if cat2 is None else np.array([c._get_center_size() for c in cat2])
+        dmax = 2. * (1. + self.max_u * self.max_v) * self._max_sep
+        d = np.sqrt(np.sum((p1[:,np.newaxis,:3] - p2[np.newaxis,:,:3])**2, axis=2))
+        reach = p1[:,np.newaxis,3] + p2[np.newaxis,:,3] + dmax
+        return 1. - d / reach
+
+    def _process_patch_triple(self, temp, i, j, k, c1, c2, c3, metric, num_threads, sym=False):
+        # Process a single triple of patches into temp, clearing it first.
+        # c2 = c3 = None means to do the auto-correlation of patch i.
+        # sym = True means to use _process_sym, so all permutations are done at once.
+        temp.clear()
+        if c2 is None:
+            self.logger.info('Process patch %d auto',i)
+            temp.process_auto(c1, metric, num_threads)
+        elif sym:
+            self.logger.info('Process patches %d,%d,%d (all permutations)',i,j,k)
+            temp._process_sym(c1, c2, c3, metric, num_threads)
+        else:
+            self.logger.info('Process patches %d,%d,%d cross',i,j,k)
+            temp.process_cross(c1, c2, c3, metric, num_threads)
+        return temp
+
+    def _add_patch_triple(self, temp, i, j, k, auto):
+        # Accumulate the results of a single triple of patches from temp into self.
+        # Triples with no triangles don't need to be kept in results.
+        if auto or np.sum(temp.ntri) > 0:
+            self.results[(i,j,k)] = temp._copy_for_results()
+        self += temp
+
+    def _assign_patch_triples(self, costs, size, rank):
+        # Decide which of the jobs with the given estimated costs should be done by this rank.
+        # This uses the LPT algorithm, as in BinnedCorr2._assign_patch_jobs: take the jobs in
+        # order of decreasing cost and give each one to the process that currently has the
+        # least total work.  Every rank runs the same deterministic calculation, so they all
+        # agree on the assignment.
+        order = np.argsort(-np.asarray(costs), kind='stable')
+        loads = np.zeros(size)
+        mine = np.zeros(len(costs), dtype=bool)
+        for k in order:
+            p = int(np.argmin(loads))
+            loads[p] += costs[k]
+            mine[k] = (p == rank)
+        self.logger.info("Rank %d: Estimated cost %.3g of total %.3g",
+                         rank, loads[rank], np.sum(loads))
+        return mine
+
+    def _reduce_mpi(self, comm):
+        # Combine the results from all the processes onto rank 0.
+        # As in BinnedCorr2._reduce_mpi, do this as a binary tree, so it takes log2(size) steps
+        # rather than size.  Only the accumulated arrays and the per-triple results are sent,
+        # not the whole correlation object.
+        rank = comm.Get_rank()
+        size = comm.Get_size()
+        step = 1
+        while step < size:
+            if rank % (2*step) == step:
+                sums = self._get_sums() if self.metric is not None else None
+                comm.send((sums, self.metric, self.coords, self.results), dest=rank-step)
+                break
+            elif rank % (2*step) == 0 and rank+step < size:
+                sums, metric, coords, results = comm.recv(source=rank+step)
+                self.logger.info("Rank %d: Received results from rank %d",rank,rank+step)
+                if sums is not None:
+                    self._set_metric(metric, coords)
+                    self._add_sums(sums)
+                self.results.update(results)
+            step *= 2
+
+    def _get_sums(self):
+        # The accumulated values.  This is much more compact to send via MPI than the full
+        # correlation object.
+        return [ np.copy(getattr(self,name)) for name in self._sum_attrs ]
+
+    def _add_sums(self, sums):
+        # Add the values from _get_sums of another process to this one.
+        self._clear_cov_cache()
+        for name, value in zip(self._sum_attrs, sums):
+            current = getattr(self, name)
+            if isinstance(current, np.ndarray):
+                # Add into the existing array, since the C++ layer holds pointers to them.
+                current += value
+            else:
+                setattr(self, name, current + value)
+
+    def _process_patch_triples(self, jobs, costs, metric, num_threads, comm):
+        # Process a list of jobs, each given as a tuple (i, j, k, c1, c2, c3, sym), which are
+        # the arguments to _process_patch_triple.
+        # If using MPI, each rank does some of the jobs, and then the results are all sent back
+        # to rank 0.
+        if comm is not None:
+            rank = comm.Get_rank()
+            size = comm.Get_size()
+            mine = self._assign_patch_triples(costs, size, rank)
+            jobs = [job for job, m in zip(jobs, mine) if m]
+            self.logger.info("Rank %d: Doing %d patch triples",rank,len(jobs))
+
+        num_patch_threads = treecorr.config.get(self.config,'num_patch_threads',int,1)
+        temp = self.copy()
+
+        if num_patch_threads <= 1 or len(jobs) <= 1:
+            for i, j, k, c1, c2, c3, sym in jobs:
+                self._process_patch_triple(temp, i, j, k, c1, c2, c3, metric, num_threads, sym)
+                self._add_patch_triple(temp, i, j, k, c2 is None)
+        else:
+            # Run several patch triples at once in a pool of threads, as in
+            # BinnedCorr2._process_patch_jobs.  The C++ layer releases the GIL, so each thread
+            # is able to run its own OpenMP calculation with its share of the threads.
+            from concurrent.futures import ThreadPoolExecutor
+            from collections import deque
+            self._set_num_threads(num_threads)
+            job_threads = max(1, treecorr.get_omp_threads() // num_patch_threads)
+            self.logger.info('Processing %d patch triples with %d concurrent jobs using %d '
+                             'threads each', len(jobs), num_patch_threads, job_threads)
+
+            # Add the results in the original order, so the sums don't depend on which threads
+            # happen to finish first.  And only keep a limited number of jobs in flight.
+            pending = deque()
+            with ThreadPoolExecutor(max_workers=num_patch_threads) as executor:
+                for i, j, k, c1, c2, c3, sym in jobs:
+                    # Make sure the catalogs are loaded here, rather than in the worker threads.
+                    for c in (c1, c2, c3):
+                        if c is not None: c.load()
+                    future = executor.submit(self._process_patch_triple, temp.copy(),
+                                             i, j, k, c1, c2, c3, metric, job_threads, sym)
+                    pending.append((i, j, k, c2 is None, future))
+                    if len(pending) >= 2*num_patch_threads:
+                        i, j, k, auto, future = pending.popleft()
+                        self._add_patch_triple(future.result(), i, j, k, auto)
+                while pending:
+                    i, j, k, auto, future = pending.popleft()
+                    self._add_patch_triple(future.result(), i, j, k, auto)
+            # Reset the OpenMP threads for this thread.
+            self._set_num_threads(num_threads)
+
+    def _process_all_auto(self, cat1, metric, num_threads, comm=None):
+        if len(cat1) == 1:
+            self.process_auto(cat1[0], metric, num_threads)
+            return
+
+        # When patch processing, keep track of the triple-wise results.
+        if self.npatch1 == 1:
+            self.npatch1 = self.npatch2 = self.npatch3 = len(cat1)
+        index = [c.patch if c.patch is not None else ii for ii,c in enumerate(cat1)]
+        overlap = self._get_patch_overlap(cat1, metric=metric)
+        near = overlap >= 0.
+        overlap = np.maximum(overlap, 0.)
+
+        # Each set of patches is only done once, using _process_sym to get all the
+        # permutations.  The triangles with two points in patch i and one in patch j are
+        # keyed as (i,i,j).  Those with one point in each of three patches are keyed with the
+        # indices in increasing order of position in cat1.
+        # Sets of patches that are not all neighbors of each other are skipped.
+        # The cost estimates are only used for MPI.  They are roughly the number of triangles
+        # to consider, scaled by how much the patches overlap.
+        jobs = []
+        costs = []
+        skipped = []
+        sumw = np.array([c.sumw for c in cat1])
+        nobj = np.array([c.nobj for c in cat1], dtype=float)
+        n = len(cat1)
+        for a in range(n):
+            jobs.append((index[a], index[a], index[a], cat1[a], None, None, False))
+            costs.append(nobj[a]**3 / 6.)
+            for b in range(n):
+                if b == a: continue
+                if near[a,b]:
+                    jobs.append((index[a], index[a], index[b], cat1[a], cat1[a], cat1[b], True))
+                    costs.append(nobj[a]**2 * nobj[b] / 2. * overlap[a,b])
+                else:
+                    skipped.append((index[a], index[a], index[b], 0.5 * sumw[a]**2 * sumw[b]))
+                if b < a: continue
+                for c in range(b+1, n):
+                    if near[a,b] and near[a,c] and near[b,c]:
+                        jobs.append((index[a], index[b], index[c],
+                                     cat1[a], cat1[b], cat1[c], True))
+                        costs.append(nobj[a] * nobj[b] * nobj[c] *
+                                     overlap[a,b] * overlap[a,c] * overlap[b,c])
+                    else:
+                        skipped.append((index[a], index[b], index[c],
+                                        sumw[a] * sumw[b] * sumw[c]))
+        self.logger.info('Processing %d of %d patch triples.  The rest are too far apart '
+                         'for this set of separations.', len(jobs), len(jobs) + len(skipped))
+        self._process_patch_triples(jobs, costs, metric, num_threads, comm)
+
+        # Account for the normalization of the skipped triples.  All together, the triples
+        # add up to the same total as the auto-correlation of the full catalog.
+        # Only one rank needs to do this.
+        if comm is None or comm.Get_rank() == 0:
+            for i, j, k, tot in skipped:
+                self._add_tot(i, j, k, tot)
+        if comm is not None:
+            self._reduce_mpi(comm)
 
     # These are not actually implemented yet.
     def _process_all_cross21(self, cat1, cat2, metric, num_threads): # pragma: no cover
@@ -515,11 +1108,143 @@ class BinnedCorr3(object):
                     self.process_cross(c1,c3,c2, metric, num_threads)
                     self.process_cross(c3,c1,c2, metric, num_threads)
 
-    def _process_all_cross(self, cat1, cat2, cat3, metric, num_threads):
-        for c1 in cat1:
-            for c2 in cat2:
-                for c3 in cat3:
-                    self.process_cross(c1,c2,c3, metric, num_threads)
+    def _process_all_cross(self, cat1, cat2, cat3, metric, num_threads, comm=None):
+        if len(cat1) == 1 and len(cat2) == 1 and len(cat3) == 1:
+            self.process_cross(cat1[0], cat2[0], cat3[0], metric, num_threads)
+            return
+
+        # When patch processing, keep track of the triple-wise results.
+        if self.npatch1 == 1:
+            self.npatch1 = len(cat1)
+        if self.npatch2 == 1:
+            self.npatch2 = len(cat2)
+        if self.npatch3 == 1:
+            self.npatch3 = len(cat3)
+        npatch = max(self._npatches())
+        if any(n != 1 and n != npatch for n in self._npatches()):
+            raise RuntimeError("Cross correlation requires all catalogs use the same "
+                               "number of patches, or 1 for any that do not use patches.")
+        def index(cat):
+            return [c.patch if c.patch is not None else ii for ii,c in enumerate(cat)]
+        o12 = self._get_patch_overlap(cat1, cat2, metric)
+        o13 = self._get_patch_overlap(cat1, cat3, metric)
+        o23 = self._get_patch_overlap(cat2, cat3, metric)
+        # Only one rank needs to account for the normalization of the skipped triples.
+        do_tot = comm is None or comm.Get_rank() == 0
+        jobs = []
+        costs = []
+        index3 = index(cat3)
+        for a,(i,c1) in enumerate(zip(index(cat1), cat1)):
+            for b,(j,c2) in enumerate(zip(index(cat2), cat2)):
+                for c,c3 in enumerate(cat3):
+                    if o12[a,b] >= 0. and o13[a,c] >= 0. and o23[b,c] >= 0.:
+                        jobs.append((i, j, index3[c], c1, c2, c3, False))
+                        costs.append(c1.nobj * c2.nobj * c3.nobj *
+                                     o12[a,b] * o13[a,c] * o23[b,c])
+                    elif do_tot:
+                        self._add_tot(i, j, index3[c], c1.sumw * c2.sumw * c3.sumw / 6.)
+        self._process_patch_triples(jobs, costs, metric, num_threads, comm)
+        if comm is not None:
+            self._reduce_mpi(comm)
+
+    def _getStatLen(self):
+        # The length of the array that will be returned by _getStat.
+        return self.weight.size
+
+    def _getWeight(self):
+        # Override when this is not the right thing.
+        return self.weight.ravel()
+
+    def _stackWeight(self, results):
+        # The values of _getWeight for each triple of patches in results as a 2d array.
+        return results.stack('weight').reshape(len(results), -1)
+
+    def estimate_cov(self, method):
+        """Estimate the covariance matrix based on the data
+
+        This function will calculate an estimate of the covariance matrix according to the
+        given method.
+
+        Options for ``method`` include:
+
+            - 'shot' = The variance based on "shot noise" only.  This includes the Poisson
+              counts of points for N statistics, shape noise for G statistics, and the observed
+              scatter in the values for K statistics.  In this case, the returned covariance
+              matrix will be diagonal, since there is no way to estimate the off-diagonal terms.
+            - 'jackknife' = A jackknife estimate of the covariance matrix based on the scatter
+              in the measurement when excluding one patch at a time.  All triangles with
+              a vertex in the excluded patch are removed.
+            - 'sample' = An estimate based on the sample covariance of a set of samples,
+              taken as the patches of the input catalog.  Each sample uses the triangles
+              whose triple of patches (see below) has that patch first.
+            - 'bootstrap' = A bootstrap covariance estimate. It selects patches at random with
+              replacement and then generates the statistic using each triple of patches once
+              for each combination of the selections of the distinct patches it involves.
+            - 'marked_bootstrap' = An estimate based on a marked-point bootstrap resampling of the
+              patches.  Similar to bootstrap, but only samples the patches of the first catalog and
+              uses all triangles whose triple of patches has each selected patch first.
+
+        Both 'bootstrap' and 'marked_bootstrap' use the num_bootstrap parameter, which can be set on
+        construction.
+
+        Each triangle is assigned to a triple of patches (i,j,k).  For a cross-correlation, these
+        are the patches of the vertices from cat1, cat2 and cat3 respectively.  For an
+        auto-correlation, all the permutations of each set of patches are done at once, so the
+        triples are sorted: triangles with two vertices in patch i and one in patch j are
+        assigned to (i,i,j), and those with one vertex in each of three patches are assigned to
+        the triple with the patch indices sorted by their order in cat1.
+
+        .. note::
+
+            For `GGGCorrelation`, the data vector is the real and imaginary parts of each
+            of the four natural components, in the order gam0r, gam0i, gam1r, gam1i, gam2r,
+            gam2i, gam3r, gam3i.  For `NNNCorrelation`, `calculateZeta` needs to be called
+            first to set up the random triangle counts.
+
+        In all cases, the relevant processing needs to already have been completed and finalized.
+        And for all methods other than 'shot', the processing should have involved an appropriate
+        number of patches -- preferably more patches than the length of the vector for your
+        statistic, although this is not checked.
+
+        The results may also be combined with 2-point statistics using
+        `estimate_multi_cov`, as long as they use the same patches.
+
+        Parameters:
+            method (str):   Which method to use to estimate the covariance matrix.
+
+        Returns:
+            A numpy array with the estimated covariance matrix.
+        """
+        return treecorr.estimate_multi_cov([self], method)
+
+    def _calculate_xi_from_pairs(self, pairs):
+        # The statistic for each realization described by pairs, which is a _PatchPairWeights
+        # instance.  This is the normal calculation.  It needs to be overridden for NNN.
+        index = self.results.indices()
+        n = pairs.sum(index, self._stackStat(self.results), 'stat')
+        d = pairs.sum(index, self._stackWeight(self.results), 'weight')
+        d[d == 0] = 1  # Guard against division by zero.
+        xi = n/d
+        w = np.sum(d, axis=1)
+        return xi,w
+
+    def _clear_cov_cache(self):
+        # Anything that changes the results needs to clear the cached values used for the
+        # covariance estimates.
+        self._cov_cache.clear()
+        self._cov_version += 1
+
+    def _make_cov_design_matrix(self, pairs):
+        # The jackknife and sample design matrices don't involve any random selections, so
+        # they are saved for the next time they are needed.
+        key = ('design', pairs.method, pairs.npatch) if pairs.counts is None else None
+        if key in self._cov_cache:
+            return self._cov_cache[key]
+        x, w = self._calculate_xi_from_pairs(pairs)
+        x = x.reshape(pairs.nreal, self._getStatLen())
+        if key is not None:
+            self._cov_cache[key] = (x, w)
+        return x, w
 
     def _set_num_threads(self, num_threads):
         if num_threads is None:
@@ -570,6 +1295,15 @@ class BinnedCorr3(object):
         self.meand3[mask] /= self._sep_units
         self.meanlogd3[mask] -= self._log_sep_units
 
+    def _check_nreal(self, *cats):
+        # Multiple realizations of the values are not supported for three-point correlations.
+        # Only the first would be used, so don't allow them.  (NNN doesn't use the values.)
+        if self._d1 == 1: return
+        for cat in cats:
+            if cat.nreal is not None:
+                raise ValueError("Catalogs with multiple realizations of k or g can only be "
+                                 "used by GGCorrelation and KKCorrelation.")
+
     def _get_minmax_size(self):
         if self.metric == 'Euclidean':
             # The minimum separation we care about is that of the smallest size, which is
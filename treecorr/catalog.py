@@ -20,6 +20,7 @@ import coord
 import weakref
 import copy
 import os
+import hashlib
 import treecorr
 
 class Catalog(object):
@@ -99,6 +100,8 @@ class Catalog(object):
         g1:     The g1 component of the shear, if defined, as a numpy array. (None otherwise)
         g2:     The g2 component of the shear, if defined, as a numpy array. (None otherwise)
         k:      The convergence, kappa, if defined, as a numpy array. (None otherwise)
+        nreal:  The number of realizations of the g1,g2 and/or k values, if these were given
+                as 2-d arrays. (None otherwise)
         patch:  The patch number of each object, if patches are being used. (None otherwise)
                 If the entire catalog is a single patch, then ``patch`` may be an int.
         ntot:   The total number of objects (including those with zero weight if
@@ -115,6 +118,9 @@ class Catalog(object):
                     value divided by the total weight per bin, so this is the right quantity
                     to use for that.
 
+                    If there are multiple realizations of g1,g2, this is the average over
+                    all of them.
+
         vark:   The kappa variance (0 if k is not defined)
 
                 .. note::
@@ -188,6 +194,12 @@ class Catalog(object):
                             spinor field.) (default: None)
         k (array):          The kappa values to use for scalar correlations. (This may represent
                             any scalar field.) (default: None)
+
+                            g1, g2 and k may also be 2-d arrays with shape (nobj, nreal), giving
+                            nreal different realizations of the field at the same positions.
+                            `GGCorrelation` and `KKCorrelation` then compute the correlation
+                            function for all of them at once.  (See the notes there about the
+                            memory this uses.)  Other correlation classes do not allow this.
         patch (array or int): Optionally, patch numbers to use for each object. (default: None)
 
                             .. note::
@@ -307,6 +319,17 @@ class Catalog(object):
         save_patch_dir (str): If desired, when building patches from this Catalog, save them
                             as FITS files in the given directory for more efficient loading when
                             doing cross-patch correlations with the ``low_mem`` option.
+        save_tree_dir (str): If desired, save the trees of any fields built from this Catalog
+                            in the given directory, and reuse them rather than rebuilding
+                            when the same fields are needed again, even in a different job.
+                            The files are keyed by a hash of the catalog's values along with the
+                            parameters of the field, so stale trees are never reused.
+                            If several processes need the same tree at once, only one builds
+                            it, and the others read it when it is done.  The trees are used
+                            in place from a memory map of the files, so the processes on a
+                            node share a single copy of each tree.  Using a directory in
+                            /dev/shm keeps the files in memory rather than on disk.
+                            (default: None)
 
         hdu (int):          For FITS files, which hdu to read. (default: 1)
         x_hdu (int):        Which hdu to use for the x values. (default: hdu)
@@ -463,6 +486,8 @@ class Catalog(object):
                 'File with patch centers to use to determine patches'),
         'save_patch_dir' : (str, False, None, None,
                 'If desired, save the patches as FITS files in this directory.'),
+        'save_tree_dir' : (str, False, None, None,
+                'If desired, save the built field trees in this directory for reuse.'),
         'verbose' : (int, False, 1, [0, 1, 2, 3],
                 'How verbose the code should be during processing. ',
                 '0 = Errors Only, 1 = Warnings, 2 = Progress, 3 = Debugging'),
@@ -568,6 +593,8 @@ class Catalog(object):
                 self._centers = self.read_patch_centers(patch_centers)
 
         self.save_patch_dir = self.config.get('save_patch_dir',None)
+        self.save_tree_dir = self.config.get('save_tree_dir',None)
+        self._array_hashes = {}
         allow_xyz = self.config.get('allow_xyz', False)
 
         # First style -- read from a file
@@ -625,9 +652,11 @@ class Catalog(object):
             self._w = self.makeArray(w,'w')
             self._wpos = self.makeArray(wpos,'wpos')
             self._flag = self.makeArray(flag,'flag',int)
-            self._g1 = self.makeArray(g1,'g1')
-            self._g2 = self.makeArray(g2,'g2')
-            self._k = self.makeArray(k,'k')
+            # The number of rows before applying start, end, every_nth.
+            nrows = np.size(x) if x is not None else np.size(ra)
+            self._g1 = self.makeArray(g1,'g1',nobj=nrows)
+            self._g2 = self.makeArray(g2,'g2',nobj=nrows)
+            self._k = self.makeArray(k,'k',nobj=nrows)
             self._patch = self.makeArray(patch,'patch',int)
             if self._patch is not None:
                 self._set_npatch()
@@ -658,6 +687,12 @@ class Catalog(object):
                 raise ValueError("g2 has the wrong numbers of elements")
             if self._k is not None and len(self._k) != ntot:
                 raise ValueError("k has the wrong numbers of elements")
+            if self._g1 is not None and self._g1.shape != self._g2.shape:
+                raise ValueError("g1 and g2 have different shapes")
+            if (self._g1 is not None and self._k is not None and
+                    (self._g1.ndim == 2 or self._k.ndim == 2) and
+                    self._g1.shape != self._k.shape):
+                raise ValueError("g1 and k have different numbers of realizations")
             if self._patch is not None and len(self._patch) != ntot:
                 raise ValueError("patch has the wrong numbers of elements")
             if ntot == 0:
@@ -751,6 +786,13 @@ class Catalog(object):
         self.load()
         return self._k
 
+    @property
+    def nreal(self):
+        for col in (self.g1, self.k):
+            if col is not None and col.ndim == 2:
+                return col.shape[1]
+        return None
+
     @property
     def patch(self):
         if self._single_patch is not None:
@@ -773,7 +815,8 @@ class Catalog(object):
             if self.nontrivial_w:
                 if self.g1 is not None:
                     use = self.w != 0
-                    self._varg = np.sum(self.w[use]**2 * (self.g1[use]**2 + self.g2[use]**2))
+                    w = self.w[use] if self.g1.ndim == 1 else self.w[use,np.newaxis]
+                    self._varg = np.sum(w**2 * (self.g1[use]**2 + self.g2[use]**2))
                     # The 2 is because we need the variance _per componenet_.
                     self._varg /= 2.*self.sumw
                 else:
@@ -783,6 +826,8 @@ class Catalog(object):
                     self._varg = np.sum(self.g1**2 + self.g2**2) / (2.*self.nobj)
                 else:
                     self._varg = 0.
+            if self.g1 is not None and self.g1.ndim == 2:
+                self._varg /= self.g1.shape[1]
         return self._varg
 
     @property
@@ -791,7 +836,8 @@ class Catalog(object):
             if self.nontrivial_w:
                 if self.k is not None:
                     use = self.w != 0
-                    self._vark = np.sum(self.w[use]**2 * self.k[use]**2)
+                    w = self.w[use] if self.k.ndim == 1 else self.w[use,np.newaxis]
+                    self._vark = np.sum(w**2 * self.k[use]**2)
                     self._vark /= self.sumw
                 else:
                     self._vark = 0.
@@ -800,6 +846,8 @@ class Catalog(object):
                     self._vark = np.sum(self.k**2) / self.nobj
                 else:
                     self._vark = 0.
+            if self.k is not None and self.k.ndim == 2:
+                self._vark /= self.k.shape[1]
         return self._vark
 
     @property
@@ -1050,8 +1098,9 @@ class Catalog(object):
         self._g2 = self._g2[indx] if self._g2 is not None else None
         self._k = self._k[indx] if self._k is not None else None
         self._patch = self._patch[indx] if self._patch is not None else None
+        self._array_hashes = {}
 
-    def makeArray(self, col, col_str, dtype=float):
+    def makeArray(self, col, col_str, dtype=float, nobj=None):
         """Turn the input column into a numpy array if it wasn't already.
         Also make sure the input is 1-d.
 
@@ -1059,13 +1108,21 @@ class Catalog(object):
             col (array-like):   The input column to be converted into a numpy array.
             col_str (str):      The name of the column.  Used only as information in logging output.
             dtype (type):       The dtype for the returned array.  (default: float)
+            nobj (int):         If given, a 2-d array with shape (nobj, nreal) and nreal > 1 is
+                                allowed, which is kept as is.  Any other shape (including
+                                (nobj, 1) or a row vector (1, nobj)) is reshaped to 1-d.
+                                (default: None)
 
         Returns:
-            The column converted to a 1-d numpy array.
+            The column converted to a 1-d numpy array (or 2-d if allowed).
         """
         if col is not None:
             col = np.array(col,dtype=dtype)
-            if len(col.shape) != 1:
+            # Check the number of rows explicitly, so a single object with several
+            # realizations, (1, nreal), is not confused with a row vector, (1, nobj).
+            is_2d = (nobj is not None and len(col.shape) == 2 and col.shape[0] == nobj and
+                     col.shape[1] > 1)
+            if len(col.shape) != 1 and not is_2d:
                 s = col.shape
                 col = col.reshape(-1)
                 self.logger.warning("Warning: Input %s column was not 1-d.\n"%col_str +
@@ -1082,11 +1139,15 @@ class Catalog(object):
             col_str (str):  The name of the column.  Used only as information in logging output.
         """
         if col is not None and np.any(np.isnan(col)):
-            index = np.where(np.isnan(col))[0]
+            isnan = np.isnan(col)
+            if col.ndim == 2:
+                # Skip the row if any of the realizations has a NaN.
+                isnan = np.any(isnan, axis=1)
+            index = np.where(isnan)[0]
             self.logger.warning("Warning: NaNs found in %s column.  Skipping rows %s."%(
                                 col_str,str(index.tolist())))
             if self._w is None:
-                self._w = np.ones_like(col, dtype=float)
+                self._w = np.ones(len(col), dtype=float)
             self._w[index] = 0
             col[index] = 0  # Don't leave the nans there.
 
@@ -1766,6 +1827,53 @@ class Catalog(object):
         # But if the weakref is alive, this returns the field we want.
         return self._field()
 
+    def _get_tree_file_name(self, field):
+        # The file in save_tree_dir where the tree for this field would be stored, or None
+        # if we are not saving trees.  The name is a hash of the values used to build the
+        # tree along with the field parameters, so any change to either gives a new file.
+        # Since the file holds the cells just as they are in memory, the hash also includes
+        # the TreeCorr version, so a different version never reads a tree it might misread.
+        if self.save_tree_dir is None:
+            return None
+        names = ['x', 'y', 'z', 'w', 'wpos']
+        if field._d == 2:
+            names += ['k']
+        elif field._d == 3:
+            names += ['g1', 'g2']
+        h = hashlib.sha1()
+        h.update(repr((treecorr.__version__, field._d, field.coords, field.min_size,
+                       field.max_size, field._sm, field.brute, field.min_top, field.max_top,
+                       self.ntot)).encode())
+        for name in names:
+            h.update(self._get_array_hash(name).encode())
+        return os.path.join(self.save_tree_dir, 'tree_%s.npy'%h.hexdigest())
+
+    def _get_array_hash(self, name):
+        # A hash of one of the arrays of this catalog, e.g. 'x' or 'w'.
+        # Hashing the arrays is not free for large catalogs, so save these.
+        if name not in self._array_hashes:
+            a = getattr(self, name)
+            if a is None:
+                self._array_hashes[name] = 'None'
+            else:
+                a = np.ascontiguousarray(a, dtype=float)
+                self._array_hashes[name] = hashlib.sha1(a).hexdigest()
+        return self._array_hashes[name]
+
+    def _get_content_hash(self, values=False):
+        # A hash of everything about this catalog that matters for the counts of pairs or
+        # triangles, i.e. the positions, weights, and patches.
+        # If values is True, also include the k and shear values, which matter for the
+        # other correlation functions.
+        names = ['x', 'y', 'z', 'w', 'wpos', 'patch']
+        if values:
+            names += ['k', 'g1', 'g2']
+        h = hashlib.sha1()
+        h.update(repr((self.coords, self.ntot, self._npatch)).encode())
+        for name in names:
+            h.update(self._get_array_hash(name).encode())
+        return h.hexdigest()
+
     def getNField(self, min_size=0, max_size=None, split_method=None, brute=False,
                   min_top=None, max_top=10, coords=None, logger=None):
         """Return an `NField` based on the positions in this catalog.
@@ -2152,6 +2260,8 @@ class Catalog(object):
                 k=self.k[indx] if self.k is not None else None
                 check_wpos = self._wpos if self._wpos is not None else self._w
                 kwargs = dict(keep_zero_weight=np.any(check_wpos==0))
+                if self.save_tree_dir is not None:
+                    kwargs['save_tree_dir'] = self.save_tree_dir
                 if self.ra is not None:
                     kwargs['ra_units'] = 'rad'
                     kwargs['dec_units'] = 'rad'
@@ -2179,6 +2289,8 @@ class Catalog(object):
                 # If low_mem, replace _patches with a version the reads from these files.
                 # This will typically be a lot faster for when the load does happen.
                 kwargs = {c + '_col' : c for c in col_names if c != 'patch'}
+                if self.save_tree_dir is not None:
+                    kwargs['save_tree_dir'] = self.save_tree_dir
                 if 'ra' in col_names:
                     kwargs['ra_units'] = 'rad'
                     kwargs['dec_units'] = 'rad'
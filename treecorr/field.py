@@ -17,6 +17,7 @@
 
 import numpy as np
 import weakref
+import os
 import treecorr
 
 def _parse_split_method(split_method):
@@ -260,6 +261,154 @@ class Field(object):
         treecorr._lib.FieldGetNear(self.data, x, y, z, sep, self._d, self._coords, lp(ind), n)
         return ind
 
+    def _get_cell_values(self, v, shear=False):
+        # Calculate the sum of w*v over the objects in each cell for several different sets
+        # of values at the same positions.  v has shape (ntot, nv).  If shear is True, these
+        # are interpreted as nv/2 complex shear values, which are parallel transported to the
+        # center of each cell for spherical or 3d coordinates.  The cells are in the same order
+        # as write_tree.
+        from treecorr.util import double_ptr as dp
+        from treecorr.util import long_ptr as lp
+        cat = self.cat
+        sizes = np.empty(3, dtype=int)
+        treecorr._lib.FieldGetTreeSize(self.data, self._d, self._coords, lp(sizes))
+        v = np.ascontiguousarray(v, dtype=float)
+        values = np.empty((sizes[0], v.shape[1]), dtype=float)
+        treecorr._lib.FieldGetCellValues(self.data, self._d, self._coords,
+                                         dp(cat.x), dp(cat.y), dp(cat.z), dp(cat.w),
+                                         dp(v), v.shape[1], int(shear), dp(values))
+        return values
+
+    # The number of values at the start of a tree file that describe the field.
+    _tree_header_size = 20
+    _tree_version = 2
+
+    def write_tree(self, file_name):
+        """Write the tree structure of this field to a file.
+
+        The file is a single numpy array, which can be read back much faster than the tree
+        can be built from scratch.  Normally, one would not call this directly, but would
+        instead set ``save_tree_dir`` for the Catalog, which writes the trees there the first
+        time they are built and then reads them back whenever the same field is needed again.
+
+        The file holds the cells of the tree in the same layout as they have in memory,
+        so a field that reads it uses the cells directly from a memory map of the file.
+        This means the file can only be read by a build of TreeCorr that has the same
+        layout for the cells.  Otherwise, the tree is just built again.
+
+        Parameters:
+            file_name (str):    The name of the file to write to.
+        """
+        from treecorr.util import double_ptr as dp
+        from treecorr.util import long_ptr as lp
+        from treecorr.util import int64_ptr as ip
+        from treecorr.util import char_ptr as cp
+        sizes = np.empty(3, dtype=int)
+        treecorr._lib.FieldGetTreeSize(self.data, self._d, self._coords, lp(sizes))
+        ncells, nindices, nbytes = sizes
+        ntop = self.nTopLevelNodes
+        nh = self._tree_header_size
+
+        # Everything goes into one float array.  The rest are just views of it.
+        # The number of nodes and bytes in each top-level block are always 64 bit ints.
+        # The blocks of cells themselves are raw bytes, which start at a multiple of 8 bytes
+        # from the start of the data (which np.save aligns to 64 bytes), so they are aligned
+        # correctly when the file is memory mapped.
+        tree = np.zeros(nh + 2*ntop + (nbytes+7)//8, dtype=float)
+        header = tree[:nh]
+        blocksizes = tree[nh:nh+2*ntop].view(np.int64)
+        blocks = tree[nh+2*ntop:]
+        center = np.empty(4, dtype=float)
+        treecorr._lib.FieldWriteTree(self.data, self._d, self._coords,
+                                     ip(blocksizes), cp(blocks), dp(center))
+        header[:13] = [self._tree_version, self._d, self._coords, ntop,
+                       ncells, nindices, self.ntot, self.min_size, self.max_size, self._sm,
+                       self.brute, self.min_top, self.max_top]
+        header[13:17] = center
+        header[17:19] = [treecorr._lib.CellNodeSize(self._d, self._coords), nbytes]
+
+        # Write to a temporary file first, so other jobs never see a partially written file.
+        tmp_file_name = file_name + '.tmp%d'%os.getpid()
+        with open(tmp_file_name, 'wb') as fid:
+            np.save(fid, tree)
+        treecorr.util.replace_file(tmp_file_name, file_name)
+
+    def _build_tree(self, cat, build, logger):
+        # Set self.data, either by calling build() or by reading it from save_tree_dir.
+        tree_file = cat._get_tree_file_name(self)
+        if tree_file is None:
+            self.data = build()
+            return
+        treecorr.util.ensure_dir(tree_file)
+        # If several processes need the same tree, only the first one builds it.
+        # The others wait here and then read the file it wrote.
+        with treecorr.util.file_lock(tree_file + '.lock'):
+            if not self._read_tree(tree_file, logger):
+                self.data = build()
+                self.write_tree(tree_file)
+                # Switch to using the file too, so this process shares the one copy of the
+                # tree with the others rather than keeping its own copy.
+                data = self.data
+                if self._read_tree(tree_file):
+                    self._destroy(data)
+                else:
+                    self.data = data
+                    if logger:
+                        logger.warning('Unable to read back tree file %s.',tree_file)
+
+    def _read_tree(self, file_name, logger=None):
+        # Read the tree from a file written by write_tree.  Returns whether this succeeded.
+        from treecorr.util import double_ptr as dp
+        from treecorr.util import int64_ptr as ip
+        from treecorr.util import char_ptr as cp
+        if file_name is None or not os.path.isfile(file_name):
+            return False
+        # The file is memory mapped, and the C++ layer uses the cells in place, so all the
+        # processes that read the same file share a single copy of it in memory.
+        # The map is copy-on-write, so nothing a process does can change the file.
+        try:
+            tree = np.load(file_name, mmap_mode='c')
+        except (ValueError, OSError):
+            # e.g. the file is shorter than the array it says it holds.
+            if logger:
+                logger.warning('Unable to read tree file %s.  Rebuilding.',file_name)
+            return False
+        nh = self._tree_header_size
+        header = tree[:nh]
+        expected = [self._tree_version, self._d, self._coords, None, None, None, self.ntot,
+                    self.min_size, self.max_size, self._sm, self.brute, self.min_top, self.max_top,
+                    None, None, None, None, treecorr._lib.CellNodeSize(self._d, self._coords)]
+        if len(header) < nh or any(e is not None and h != e for h, e in zip(header, expected)):
+            if logger:
+                logger.warning('Tree file %s does not match this field.  Rebuilding.',file_name)
+            return False
+        # The C++ layer trusts the block sizes, so make sure the file really has all of them.
+        ntop, node_size, nbytes = int(header[3]), int(header[17]), int(header[18])
+        blocksizes = tree[nh:nh+2*ntop].view(np.int64)
+        blocks = tree[nh+2*ntop:]
+        if (ntop < 1 or len(blocksizes) != 2*ntop or np.any(blocksizes[0::2] < 1) or
+                np.any(blocksizes[0::2] * node_size > blocksizes[1::2]) or
+                np.sum(blocksizes[1::2]) != nbytes or blocks.nbytes < nbytes):
+            if logger:
+                logger.warning('Tree file %s is incomplete.  Rebuilding.',file_name)
+            return False
+        if logger:
+            logger.info('Reading tree from %s',file_name)
+        center = np.array(header[13:17])
+        self.data = treecorr._lib.ReadField(cp(blocks), ip(blocksizes), ntop, self.ntot,
+                                            dp(center), self.min_size, self.max_size, self._sm,
+                                            self.brute, self.min_top, self.max_top,
+                                            self._d, self._coords)
+        # The cells live in the memory map, so keep it for as long as the field.
+        self._tree = tree
+        return True
+
+    def _destroy(self, data):
+        # Free the C++ field data, which may or may not be self.data.
+        destroy = [treecorr._lib.DestroyNField, treecorr._lib.DestroyKField,
+                   treecorr._lib.DestroyGField][self._d-1]
+        destroy(data, self._coords)
+
     def run_kmeans(self, npatch, max_iter=200, tol=1.e-5, init='tree', alt=False):
         r"""Use k-means algorithm to set patch labels for a field.
 
@@ -544,10 +693,12 @@ class NField(Field):
         self.coords = coords if coords is not None else cat.coords
         self._coords = treecorr.util.coord_enum(self.coords)  # These are the C++-layer enums
 
-        self.data = treecorr._lib.BuildNField(dp(cat.x), dp(cat.y), dp(cat.z),
-                                              dp(cat.w), dp(cat.wpos), cat.ntot,
-                                              self.min_size, self.max_size, self._sm,
-                                              self.brute, self.min_top, self.max_top, self._coords)
+        build = lambda: treecorr._lib.BuildNField(dp(cat.x), dp(cat.y), dp(cat.z),
+                                                  dp(cat.w), dp(cat.wpos), cat.ntot,
+                                                  self.min_size, self.max_size, self._sm,
+                                                  self.brute, self.min_top, self.max_top,
+                                                  self._coords)
+        self._build_tree(cat, build, logger)
         if logger:
             logger.debug('Finished building NField (%s)',self.coords)
 
@@ -608,11 +759,16 @@ class KField(Field):
         self.coords = coords if coords is not None else cat.coords
         self._coords = treecorr.util.coord_enum(self.coords)  # These are the C++-layer enums
 
-        self.data = treecorr._lib.BuildKField(dp(cat.x), dp(cat.y), dp(cat.z),
-                                              dp(cat.k),
-                                              dp(cat.w), dp(cat.wpos), cat.ntot,
-                                              self.min_size, self.max_size, self._sm,
-                                              self.brute, self.min_top, self.max_top, self._coords)
+        # With multiple realizations of k, the tree is built using the first one.
+        # The values for the others are calculated from the tree by get_realization_values.
+        k = cat.k if cat.k.ndim == 1 else np.ascontiguousarray(cat.k[:,0])
+        build = lambda: treecorr._lib.BuildKField(dp(cat.x), dp(cat.y), dp(cat.z),
+                                                  dp(k),
+                                                  dp(cat.w), dp(cat.wpos), cat.ntot,
+                                                  self.min_size, self.max_size, self._sm,
+                                                  self.brute, self.min_top, self.max_top,
+                                                  self._coords)
+        self._build_tree(cat, build, logger)
         if logger:
             logger.debug('Finished building KField (%s)',self.coords)
 
@@ -625,6 +781,27 @@ class KField(Field):
             if not treecorr._ffi._lock.locked(): # pragma: no branch
                 treecorr._lib.DestroyKField(self.data, self._coords)
 
+    def get_realization_values(self, start=0, end=None):
+        """Get the kappa values of each cell for several realizations of the catalog's k values.
+
+        This is used when the catalog's k is a 2-d array with one column per realization.
+        The tree is built using the first realization, but since the positions and weights
+        are the same for all of them, the values of each cell for the others can be calculated
+        from the same tree.
+
+        Parameters:
+            start (int):    The first realization to use. (default: 0)
+            end (int):      One past the last realization to use. (default: cat.nreal)
+
+        Returns:
+            An array of shape (ncells, end-start) with the sum of w*k for the objects in
+            each cell, in the same order as the cells are written by `write_tree`.
+        """
+        k = self.cat.k
+        if k.ndim == 1:
+            k = k[:,np.newaxis]
+        return self._get_cell_values(k[:,start:end])
+
 
 class GField(Field):
     r"""This class stores the values of a spinor field (gamma in the weak lensing context) in a
@@ -670,11 +847,20 @@ class GField(Field):
         self.coords = coords if coords is not None else cat.coords
         self._coords = treecorr.util.coord_enum(self.coords)  # These are the C++-layer enums
 
-        self.data = treecorr._lib.BuildGField(dp(cat.x), dp(cat.y), dp(cat.z),
-                                              dp(cat.g1), dp(cat.g2),
-                                              dp(cat.w), dp(cat.wpos), cat.ntot,
-                                              self.min_size, self.max_size, self._sm,
-                                              self.brute, self.min_top, self.max_top, self._coords)
+        # With multiple realizations of g1,g2, the tree is built using the first one.
+        # The values for the others are calculated from the tree by get_realization_values.
+        if cat.g1.ndim == 1:
+            g1, g2 = cat.g1, cat.g2
+        else:
+            g1 = np.ascontiguousarray(cat.g1[:,0])
+            g2 = np.ascontiguousarray(cat.g2[:,0])
+        build = lambda: treecorr._lib.BuildGField(dp(cat.x), dp(cat.y), dp(cat.z),
+                                                  dp(g1), dp(g2),
+                                                  dp(cat.w), dp(cat.wpos), cat.ntot,
+                                                  self.min_size, self.max_size, self._sm,
+                                                  self.brute, self.min_top, self.max_top,
+                                                  self._coords)
+        self._build_tree(cat, build, logger)
         if logger:
             logger.debug('Finished building GField (%s)',self.coords)
 
@@ -687,6 +873,31 @@ class GField(Field):
             if not treecorr._ffi._lock.locked(): # pragma: no branch
                 treecorr._lib.DestroyGField(self.data, self._coords)
 
+    def get_realization_values(self, start=0, end=None):
+        """Get the shear values of each cell for several realizations of the catalog's g1,g2.
+
+        This is used when the catalog's g1,g2 are 2-d arrays with one column per realization.
+        The tree is built using the first realization, but since the positions and weights
+        are the same for all of them, the values of each cell for the others can be calculated
+        from the same tree.  For spherical or 3d coordinates, each shear is parallel
+        transported to the center of the cell, just as when the tree is built.
+
+        Parameters:
+            start (int):    The first realization to use. (default: 0)
+            end (int):      One past the last realization to use. (default: cat.nreal)
+
+        Returns:
+            A complex array of shape (ncells, end-start) with the sum of w*g for the objects
+            in each cell, in the same order as the cells are written by `write_tree`.
+        """
+        g1 = self.cat.g1
+        g2 = self.cat.g2
+        if g1.ndim == 1:
+            g1 = g1[:,np.newaxis]
+            g2 = g2[:,np.newaxis]
+        g = g1[:,start:end] + 1j * g2[:,start:end]
+        return self._get_cell_values(g.view(float), shear=True).view(complex)
+
 
 class SimpleField(object):
     """A SimpleField is like a Field, but only stores the leaves as a list, skipping all the
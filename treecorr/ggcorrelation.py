@@ -54,6 +54,23 @@ class GGCorrelation(treecorr.BinnedCorr2):
         cov:        An estimate of the full covariance matrix for the data vector with
                     :math:`\xi_+` first and then :math:`\xi_-`.
 
+    If the input catalogs have multiple realizations of the shear values (cf. the ``g1``
+    and ``g2`` parameters of `Catalog`), then ``xip``, ``xim``, ``xip_im`` and ``xim_im``
+    have shape (nreal, nbins), with one row for each realization.  All of the realizations
+    are usually computed from a single traversal of the positions (see below).  The other
+    arrays are the same for all realizations, and ``varxip`` and ``varxim`` are the shot
+    noise variances using the shear variance averaged over the realizations.  Only
+    ``var_method = 'shot'`` is allowed in this case.
+
+    To do this, the pairs of cells that contribute to ``xip`` and ``xim`` are recorded during
+    the traversal, and each thread applies them to all of the realizations in batches of
+    65536 pairs.  So the memory used for the pairs doesn't depend on the total number of
+    pairs or on the number of realizations.  The sums of the values in each cell are needed
+    for all of the realizations at once, which takes 16 bytes per cell and realization.
+    If the number of objects times the number of realizations is more than 2**24, the
+    realizations are done in chunks to limit this memory, with one traversal of the
+    positions for each chunk.
+
     .. note::
 
         The default method for estimating the variance and covariance attributes (``varxip``,
@@ -91,6 +108,12 @@ class GGCorrelation(treecorr.BinnedCorr2):
         **kwargs:       See the documentation for `BinnedCorr2` for the list of allowed keyword
                         arguments, which may be passed either directly or in the config dict.
     """
+    # The values accumulated by process_auto/process_cross and combined by __iadd__.
+    _sum_attrs = ('xip', 'xim', 'xip_im', 'xim_im', 'meanr', 'meanlogr', 'weight', 'npairs')
+    # The xi arrays, in the order they are passed to the C++ layer.  When processing multiple
+    # realizations, these have one row per realization.
+    _xi_attrs = ('xip', 'xip_im', 'xim', 'xim_im')
+
     def __init__(self, config=None, logger=None, **kwargs):
         """Initialize `GGCorrelation`.  See class doc for details.
         """
@@ -108,6 +131,7 @@ class GGCorrelation(treecorr.BinnedCorr2):
         self.meanlogr = np.zeros_like(self.rnom, dtype=float)
         self.weight = np.zeros_like(self.rnom, dtype=float)
         self.npairs = np.zeros_like(self.rnom, dtype=float)
+        self._mapsq_cache = {}
         self.logger.debug('Finished building GGCorr')
 
     @property
@@ -175,10 +199,12 @@ class GGCorrelation(treecorr.BinnedCorr2):
         d = self.__dict__.copy()
         d.pop('_corr',None)
         d.pop('logger',None)  # Oh well.  This is just lost in the copy.  Can't be pickled.
+        d.pop('_mapsq_cache',None)  # Easy to rebuild.
         return d
 
     def __setstate__(self, d):
         self.__dict__ = d
+        self._mapsq_cache = {}
         self.logger = treecorr.config.setup_logger(
                 treecorr.config.get(self.config,'verbose',int,1),
                 self.config.get('log_file',None))
@@ -209,6 +235,7 @@ class GGCorrelation(treecorr.BinnedCorr2):
             self.logger.info('Starting process GG auto-correlations for cat %s.',cat.name)
 
         self._set_metric(metric, cat.coords)
+        self._set_nreal(cat.nreal)
 
         self._set_num_threads(num_threads)
 
@@ -218,8 +245,13 @@ class GGCorrelation(treecorr.BinnedCorr2):
                               bool(self.brute), self.min_top, self.max_top, self.coords)
 
         self.logger.info('Starting %d jobs.',field.nTopLevelNodes)
-        treecorr._lib.ProcessAuto2(self.corr, field.data, self.output_dots,
-                                   field._d, self._coords, self._bintype, self._metric)
+        def process():
+            treecorr._lib.ProcessAuto2(self.corr, field.data, self.output_dots,
+                                       field._d, self._coords, self._bintype, self._metric)
+        if cat.nreal is None:
+            process()
+        else:
+            self._process_realizations(field, field, process, True)
 
 
     def process_cross(self, cat1, cat2, metric=None, num_threads=None):
@@ -247,6 +279,9 @@ class GGCorrelation(treecorr.BinnedCorr2):
                              cat1.name, cat2.name)
 
         self._set_metric(metric, cat1.coords, cat2.coords)
+        if cat1.nreal != cat2.nreal:
+            raise ValueError("cat1 and cat2 have different numbers of realizations of g1,g2")
+        self._set_nreal(cat1.nreal)
 
         self._set_num_threads(num_threads)
 
@@ -260,8 +295,13 @@ class GGCorrelation(treecorr.BinnedCorr2):
                             self.min_top, self.max_top, self.coords)
 
         self.logger.info('Starting %d jobs.',f1.nTopLevelNodes)
-        treecorr._lib.ProcessCross2(self.corr, f1.data, f2.data, self.output_dots,
-                                    f1._d, f2._d, self._coords, self._bintype, self._metric)
+        def process():
+            treecorr._lib.ProcessCross2(self.corr, f1.data, f2.data, self.output_dots,
+                                        f1._d, f2._d, self._coords, self._bintype, self._metric)
+        if cat1.nreal is None:
+            process()
+        else:
+            self._process_realizations(f1, f2, process, False)
 
 
     def process_pairwise(self, cat1, cat2, metric=None, num_threads=None):
@@ -301,6 +341,7 @@ class GGCorrelation(treecorr.BinnedCorr2):
                              cat1.name, cat2.name)
 
         self._set_metric(metric, cat1.coords, cat2.coords)
+        self._check_nreal(cat1, cat2)
 
         self._set_num_threads(num_threads)
 
@@ -319,6 +360,14 @@ class GGCorrelation(treecorr.BinnedCorr2):
     def _getWeight(self):
         return np.concatenate([self.weight.ravel(), self.weight.ravel()])
 
+    def _stackStat(self, results):
+        n = len(results)
+        return np.hstack([results.stack('xip').reshape(n,-1), results.stack('xim').reshape(n,-1)])
+
+    def _stackWeight(self, results):
+        w = results.stack('weight').reshape(len(results),-1)
+        return np.hstack([w, w])
+
     def finalize(self, varg1, varg2):
         """Finalize the calculation of the correlation function.
 
@@ -332,11 +381,12 @@ class GGCorrelation(treecorr.BinnedCorr2):
         """
         mask1 = self.weight != 0
         mask2 = self.weight == 0
+        self._mapsq_cache.clear()
 
-        self.xip[mask1] /= self.weight[mask1]
-        self.xim[mask1] /= self.weight[mask1]
-        self.xip_im[mask1] /= self.weight[mask1]
-        self.xim_im[mask1] /= self.weight[mask1]
+        self.xip[...,mask1] /= self.weight[mask1]
+        self.xim[...,mask1] /= self.weight[mask1]
+        self.xip_im[...,mask1] /= self.weight[mask1]
+        self.xim_im[...,mask1] /= self.weight[mask1]
         self.meanr[mask1] /= self.weight[mask1]
         self.meanlogr[mask1] /= self.weight[mask1]
 
@@ -364,6 +414,8 @@ class GGCorrelation(treecorr.BinnedCorr2):
         self.weight.ravel()[:] = 0
         self.npairs.ravel()[:] = 0
         self.results.clear()
+        self._clear_cov_cache()
+        self._mapsq_cache.clear()
 
     def __iadd__(self, other):
         """Add a second `GGCorrelation`'s data to this one.
@@ -382,6 +434,9 @@ class GGCorrelation(treecorr.BinnedCorr2):
             raise ValueError("GGCorrelation to be added is not compatible with this one.")
 
         self._set_metric(other.metric, other.coords)
+        self._set_nreal(other._get_nreal())
+        self._clear_cov_cache()
+        self._mapsq_cache.clear()
         self.xip.ravel()[:] += other.xip.ravel()[:]
         self.xim.ravel()[:] += other.xim.ravel()[:]
         self.xip_im.ravel()[:] += other.xip_im.ravel()[:]
@@ -428,6 +483,7 @@ class GGCorrelation(treecorr.BinnedCorr2):
         if cat2 is not None and not isinstance(cat2,list):
             self.npatch2 = cat2._npatch
             cat2 = cat2.get_patches(low_mem=low_mem)
+        self._set_nreal(cat1[0].nreal)
 
         if cat2 is None:
             varg1 = treecorr.calculateVarG(cat1)
@@ -477,6 +533,8 @@ class GGCorrelation(treecorr.BinnedCorr2):
             precision (int):    For ASCII output catalogs, the desired precision. (default: 4;
                                 this value can also be given in the constructor in the config dict.)
         """
+        if self._get_nreal() is not None:
+            raise ValueError("Cannot write GGCorrelation with multiple realizations")
         self.logger.info('Writing GG correlations to %s',file_name)
 
         if precision is None:
@@ -542,9 +600,43 @@ class GGCorrelation(treecorr.BinnedCorr2):
         self.metric = params['metric'].strip()
         self.sep_units = params['sep_units'].strip()
         self.bin_type = params['bin_type'].strip()
+        self._mapsq_cache.clear()
 
+    def _mapsq_kernels(self, R, m2_uform):
+        # The integrals in calculateMapSq are matrix products of xi+ and xi- with the Tp and Tm
+        # kernels, which only depend on R and meanr.  Build these once and keep them in
+        # self._mapsq_cache, which is cleared whenever the results change.
+        key = (m2_uform, R.tobytes())
+        if key in self._mapsq_cache:
+            return self._mapsq_cache[key]
 
-    def calculateMapSq(self, R=None, m2_uform=None):
+        # Make s a matrix, so we can eventually do the integral by doing a matrix product.
+        s = np.outer(1./R, self.meanr)
+        ssq = s*s
+        if m2_uform == 'Crittenden':
+            exp_factor = np.exp(-ssq/4.)
+            Tp = (32. + ssq*(-16. + ssq)) / 128. * exp_factor
+            Tm = ssq * ssq / 128. * exp_factor
+        else:
+            Tp = np.zeros_like(s)
+            Tm = np.zeros_like(s)
+            sa = s[s<2.]
+            ssqa = ssq[s<2.]
+            Tp[s<2.] = 12./(5.*np.pi) * (2.-15.*ssqa) * np.arccos(sa/2.)
+            Tp[s<2.] += 1./(100.*np.pi) * sa * np.sqrt(4.-ssqa) * (
+                        120. + ssqa*(2320. + ssqa*(-754. + ssqa*(132. - 9.*ssqa))))
+            Tm[s<2.] = 3./(70.*np.pi) * sa * ssqa * (4.-ssqa)**3.5
+        Tp *= ssq
+        Tm *= ssq
+
+        # Keep only the few most recently used kernels.
+        if len(self._mapsq_cache) >= 4:
+            del self._mapsq_cache[next(iter(self._mapsq_cache))]
+        self._mapsq_cache[key] = (Tp, Tm)
+        return Tp, Tm
+
+    def calculateMapSq(self, R=None, m2_uform=None, xip=None, xim=None, xip_im=None,
+                       xim_im=None):
         r"""Calculate the aperture mass statistics from the correlation function.
 
         .. math::
@@ -588,6 +680,11 @@ class GGCorrelation(treecorr.BinnedCorr2):
 
             This function is only implemented for Log binning.
 
+        The :math:`T_\pm` kernels for each R are cached, so repeated calls with the same R
+        only need the matrix products.  To evaluate many realizations of the correlation
+        function at once (e.g. jackknife samples), you may pass stacks of them as xip, xim,
+        xip_im, xim_im, each with shape (nrealizations, nbins).  Any of these not given are taken
+        from the current values of self.xip, etc.
 
         Parameters:
             R (array):      The R values at which to calculate the aperture mass statistics.
@@ -595,6 +692,14 @@ class GGCorrelation(treecorr.BinnedCorr2):
             m2_uform (str): Which form to use for the aperture mass, as described above.
                             (default: 'Crittenden'; this value can also be given in the
                             constructor in the config dict.)
+            xip (array):    If given, the xi+ values to use in place of self.xip.  May have an
+                            extra leading dimension to calculate many realizations at once.
+                            (default: None)
+            xim (array):    If given, the xi- values to use in place of self.xim. (default: None)
+            xip_im (array): If given, the imaginary part of xi+ to use in place of self.xip_im.
+                            (default: None)
+            xim_im (array): If given, the imaginary part of xi- to use in place of self.xim_im.
+                            (default: None)
 
         Returns:
             Tuple containing
@@ -606,6 +711,10 @@ class GGCorrelation(treecorr.BinnedCorr2):
                 - mxsq_im = the imaginary part of mxsq, which is an estimate of
                   :math:`\langle M_{ap} M_\times \rangle(R)`
                 - varmapsq = array of the variance estimate of either mapsq or mxsq
+
+            If any of xip, xim, xip_im, xim_im has a leading realization dimension, the first
+            4 arrays have shape (nrealizations, len(R)).  The variance is always calculated
+            from self.varxip and self.varxim, so it has shape (len(R),).
         """
         if m2_uform is None:
             m2_uform = treecorr.config.get(self.config,'m2_uform',str,'Crittenden')
@@ -615,34 +724,23 @@ class GGCorrelation(treecorr.BinnedCorr2):
             raise ValueError("calculateMapSq requires Log binning.")
         if R is None:
             R = self.rnom
+        R = np.asarray(R, dtype=float)
+        Tp, Tm = self._mapsq_kernels(R, m2_uform)
 
-        # Make s a matrix, so we can eventually do the integral by doing a matrix product.
-        s = np.outer(1./R, self.meanr)
-        ssq = s*s
-        if m2_uform == 'Crittenden':
-            exp_factor = np.exp(-ssq/4.)
-            Tp = (32. + ssq*(-16. + ssq)) / 128. * exp_factor
-            Tm = ssq * ssq / 128. * exp_factor
-        else:
-            Tp = np.zeros_like(s)
-            Tm = np.zeros_like(s)
-            sa = s[s<2.]
-            ssqa = ssq[s<2.]
-            Tp[s<2.] = 12./(5.*np.pi) * (2.-15.*ssqa) * np.arccos(sa/2.)
-            Tp[s<2.] += 1./(100.*np.pi) * sa * np.sqrt(4.-ssqa) * (
-                        120. + ssqa*(2320. + ssqa*(-754. + ssqa*(132. - 9.*ssqa))))
-            Tm[s<2.] = 3./(70.*np.pi) * sa * ssqa * (4.-ssqa)**3.5
-        Tp *= ssq
-        Tm *= ssq
+        if xip is None: xip = self.xip
+        if xim is None: xim = self.xim
+        if xip_im is None: xip_im = self.xip_im
+        if xim_im is None: xim_im = self.xim_im
 
         # Now do the integral by taking the matrix products.
         # Note that dlogr = bin_size
-        Tpxip = Tp.dot(self.xip)
-        Tmxim = Tm.dot(self.xim)
+        # Writing these as xi.dot(T.T) lets xi have a leading realization dimension.
+        Tpxip = np.dot(xip, Tp.T)
+        Tmxim = np.dot(xim, Tm.T)
         mapsq = (Tpxip + Tmxim) * 0.5 * self.bin_size
         mxsq = (Tpxip - Tmxim) * 0.5 * self.bin_size
-        Tpxip_im = Tp.dot(self.xip_im)
-        Tmxim_im = Tm.dot(self.xim_im)
+        Tpxip_im = np.dot(xip_im, Tp.T)
+        Tmxim_im = np.dot(xim_im, Tm.T)
         mapsq_im = (Tpxip_im + Tmxim_im) * 0.5 * self.bin_size
         mxsq_im = (Tpxip_im - Tmxim_im) * 0.5 * self.bin_size
 
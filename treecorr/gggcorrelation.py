@@ -98,6 +98,17 @@ class GGGCorrelation(treecorr.BinnedCorr3):
         weight:     The total weight in each bin.
         ntri:       The number of triangles going into each bin (including those where one or
                     more objects have w=0).
+        cov:        An estimate of the full covariance matrix of the real and imaginary parts
+                    of the four natural components, if ``var_method`` is something other than
+                    'shot'.
+
+    .. note::
+
+        The default method for estimating the variance is 'shot', which only includes the shot
+        noise propagated into the final correlation.  To get better estimates, you need to set
+        ``var_method`` to something else and use patches in the input catalog(s), in which
+        case ``vargam0`` etc. are taken from the diagonal of ``cov``.
+        cf. `Covariance Estimates`.
 
     If ``sep_units`` are given (either in the config dict or as a named kwarg) then the distances
     will all be in these units.
@@ -129,6 +140,12 @@ class GGGCorrelation(treecorr.BinnedCorr3):
         **kwargs:       See the documentation for `BinnedCorr3` for the list of allowed keyword
                         arguments, which may be passed either directly or in the config dict.
     """
+    # The components of the data vector used for the covariance estimates.
+    _stat_names = ('gam0r', 'gam0i', 'gam1r', 'gam1i', 'gam2r', 'gam2i', 'gam3r', 'gam3i')
+    # The accumulated values, which get sent between processes when using MPI.
+    _sum_attrs = _stat_names + ('meand1', 'meanlogd1', 'meand2', 'meanlogd2', 'meand3',
+                                'meanlogd3', 'meanu', 'meanv', 'weight', 'ntri')
+
     def __init__(self, config=None, logger=None, **kwargs):
         """Initialize `GGGCorrelation`.  See class doc for details.
         """
@@ -160,6 +177,7 @@ class GGGCorrelation(treecorr.BinnedCorr3):
         self.meanv = np.zeros(shape, dtype=float)
         self.weight = np.zeros(shape, dtype=float)
         self.ntri = np.zeros(shape, dtype=float)
+        self._map3_cache = {}
         self.logger.debug('Finished building GGGCorr')
 
     @property
@@ -248,14 +266,25 @@ class GGGCorrelation(treecorr.BinnedCorr3):
         import copy
         return copy.deepcopy(self)
 
+    def _copy_for_results(self):
+        # Make a copy of just the things we need to keep in results.
+        ret = GGGCorrelation.__new__(GGGCorrelation)
+        for name in self._stat_names:
+            setattr(ret, name, getattr(self, name).copy())
+        ret.weight = self.weight.copy()
+        ret.config = self.config  # not deep copy, so cheap, but makes repr work
+        return ret
+
     def __getstate__(self):
         d = self.__dict__.copy()
         d.pop('_corr',None)
         d.pop('logger',None)  # Oh well.  This is just lost in the copy.  Can't be pickled.
+        d.pop('_map3_cache',None)  # Potentially large, and easy to rebuild.
         return d
 
     def __setstate__(self, d):
         self.__dict__ = d
+        self._map3_cache = {}
         self.logger = treecorr.config.setup_logger(
                 treecorr.config.get(self.config,'verbose',int,1),
                 self.config.get('log_file',None))
@@ -285,6 +314,7 @@ class GGGCorrelation(treecorr.BinnedCorr3):
             self.logger.info('Starting process GGG auto-correlations for cat %s.', cat.name)
 
         self._set_metric(metric, cat.coords)
+        self._check_nreal(cat)
 
         self._set_num_threads(num_threads)
 
@@ -347,6 +377,7 @@ class GGGCorrelation(treecorr.BinnedCorr3):
                              cat1.name, cat2.name, cat3.name)
 
         self._set_metric(metric, cat1.coords, cat2.coords, cat3.coords)
+        self._check_nreal(cat1, cat2, cat3)
 
         self._set_num_threads(num_threads)
 
@@ -378,6 +409,7 @@ class GGGCorrelation(treecorr.BinnedCorr3):
         """
         mask1 = self.weight != 0
         mask2 = self.weight == 0
+        self._map3_cache.clear()
 
         self.gam0r[mask1] /= self.weight[mask1]
         self.gam0i[mask1] /= self.weight[mask1]
@@ -409,14 +441,25 @@ class GGGCorrelation(treecorr.BinnedCorr3):
         self.meand1[mask2] = self.v[mask2] * self.meand3[mask2] + self.meand2[mask2]
         self.meanlogd1[mask2] = np.log(self.meand1[mask2])
 
-        self.vargam0[mask1] = varg1 * varg2 * varg3 / self.weight[mask1]
-        self.vargam1[mask1] = varg1 * varg2 * varg3 / self.weight[mask1]
-        self.vargam2[mask1] = varg1 * varg2 * varg3 / self.weight[mask1]
-        self.vargam3[mask1] = varg1 * varg2 * varg3 / self.weight[mask1]
-        self.vargam0[mask2] = 0.
-        self.vargam1[mask2] = 0.
-        self.vargam2[mask2] = 0.
-        self.vargam3[mask2] = 0.
+        # The shot noise is split evenly between the real and imaginary parts.
+        self._var_num = 0.5 * varg1 * varg2 * varg3
+        if self.var_method == 'shot':
+            self.vargam0[mask1] = 2. * self._var_num / self.weight[mask1]
+            self.vargam1[mask1] = 2. * self._var_num / self.weight[mask1]
+            self.vargam2[mask1] = 2. * self._var_num / self.weight[mask1]
+            self.vargam3[mask1] = 2. * self._var_num / self.weight[mask1]
+            self.vargam0[mask2] = 0.
+            self.vargam1[mask2] = 0.
+            self.vargam2[mask2] = 0.
+            self.vargam3[mask2] = 0.
+        else:
+            self.cov = self.estimate_cov(self.var_method)
+            # The variance of each complex value is the sum of the real and imaginary variances.
+            var = self.cov.diagonal().reshape(4, 2, -1).sum(axis=1)
+            self.vargam0.ravel()[:] = var[0]
+            self.vargam1.ravel()[:] = var[1]
+            self.vargam2.ravel()[:] = var[2]
+            self.vargam3.ravel()[:] = var[3]
 
     def clear(self):
         """Clear the data vectors
@@ -444,6 +487,8 @@ class GGGCorrelation(treecorr.BinnedCorr3):
         self.weight[:,:,:] = 0.
         self.ntri[:,:,:] = 0.
         self.results.clear()
+        self._clear_cov_cache()
+        self._map3_cache.clear()
 
     def __iadd__(self, other):
         """Add a second `GGGCorrelation`'s data to this one.
@@ -468,6 +513,8 @@ class GGGCorrelation(treecorr.BinnedCorr3):
             raise ValueError("GGGCorrelation to be added is not compatible with this one.")
 
         self._set_metric(other.metric, other.coords)
+        self._clear_cov_cache()
+        self._map3_cache.clear()
         self.gam0r[:] += other.gam0r[:]
         self.gam0i[:] += other.gam0i[:]
         self.gam1r[:] += other.gam1r[:]
@@ -493,7 +540,25 @@ class GGGCorrelation(treecorr.BinnedCorr3):
         return self
 
 
-    def process(self, cat1, cat2=None, cat3=None, metric=None, num_threads=None):
+    def _getStatLen(self):
+        return 8 * self.weight.size
+
+    def _getStat(self):
+        return np.concatenate([getattr(self, name).ravel() for name in self._stat_names])
+
+    def _getWeight(self):
+        return np.concatenate([self.weight.ravel()] * 8)
+
+    def _stackStat(self, results):
+        n = len(results)
+        return np.hstack([results.stack(name).reshape(n,-1) for name in self._stat_names])
+
+    def _stackWeight(self, results):
+        w = results.stack('weight').reshape(len(results),-1)
+        return np.hstack([w] * 8)
+
+    def process(self, cat1, cat2=None, cat3=None, metric=None, num_threads=None,
+                comm=None):
         """Accumulate the number of triangles of points between cat1, cat2, and cat3.
 
         - If only 1 argument is given, then compute an auto-correlation function.
@@ -525,9 +590,26 @@ class GGGCorrelation(treecorr.BinnedCorr3):
             num_threads (int):  How many OpenMP threads to use during the calculation.
                                 (default: use the number of cpu cores; this value can also be given
                                 in the constructor in the config dict.)
+            comm (mpi4py.Comm): If running MPI, an mpi4py Comm object to communicate between
+                                processes.  If used, the rank=0 process will have the final
+                                computation. This only works if using patches. (default: None)
         """
         import math
         self.clear()
+        if self.algo == 'multipole':
+            gam = self._process_multipole(cat1, cat2, cat3, metric, num_threads, comm)
+            self.gam0r += gam[0].real
+            self.gam0i += gam[0].imag
+            self.gam1r += gam[1].real
+            self.gam1i += gam[1].imag
+            self.gam2r += gam[2].real
+            self.gam2i += gam[2].imag
+            self.gam3r += gam[3].real
+            self.gam3i += gam[3].imag
+            varg = treecorr.calculateVarG(cat1)
+            self.logger.info("varg = %f: sig_g = %f",varg,math.sqrt(varg))
+            self.finalize(varg,varg,varg)
+            return
         if not isinstance(cat1,list): cat1 = cat1.get_patches()
         if cat2 is not None and not isinstance(cat2,list): cat2 = cat2.get_patches()
         if cat3 is not None and not isinstance(cat3,list): cat3 = cat3.get_patches()
@@ -537,7 +619,7 @@ class GGGCorrelation(treecorr.BinnedCorr3):
             varg2 = varg1
             varg3 = varg1
             self.logger.info("varg = %f: sig_g = %f",varg1,math.sqrt(varg1))
-            self._process_all_auto(cat1, metric, num_threads)
+            self._process_all_auto(cat1, metric, num_threads, comm)
         elif (cat2 is None) != (cat3 is None):
             raise NotImplementedError("No partial cross GGG yet.")
         else:
@@ -548,7 +630,7 @@ class GGGCorrelation(treecorr.BinnedCorr3):
             self.logger.info("varg1 = %f: sig_g = %f",varg1,math.sqrt(varg1))
             self.logger.info("varg2 = %f: sig_g = %f",varg2,math.sqrt(varg2))
             self.logger.info("varg3 = %f: sig_g = %f",varg3,math.sqrt(varg3))
-            self._process_all_cross(cat1, cat2, cat3, metric, num_threads)
+            self._process_all_cross(cat1, cat2, cat3, metric, num_threads, comm)
         self.finalize(varg1,varg2,varg3)
 
 
@@ -697,6 +779,7 @@ class GGGCorrelation(treecorr.BinnedCorr3):
         self.metric = params['metric'].strip()
         self.sep_units = params['sep_units'].strip()
         self.bin_type = params['bin_type'].strip()
+        self._map3_cache.clear()
 
     @classmethod
     def _calculateT(cls, s, t, k1, k2, k3):
@@ -797,72 +880,16 @@ class GGGCorrelation(treecorr.BinnedCorr3):
         return T0, T1, T2, T3
 
 
-    def calculateMap3(self, R=None, k2=1, k3=1):
-        r"""Calculate the skewness of the aperture mass from the correlation function.
+    def _map3_kernels(self, R, k2, k3):
+        # The integrals in calculateMap3 are matrix products of the Gammas with kernels that
+        # only depend on R, k2, k3 and the mean triangle shapes.  Build these once and keep them
+        # in self._map3_cache, which is cleared whenever the results change.
+        key = (R.tobytes(), k2, k3)
+        if key in self._map3_cache:
+            return self._map3_cache[key]
 
-        The equations for this come from Jarvis, Bernstein & Jain (2004, MNRAS, 352).
-        See their section 3, especially equations 51 and 52 for the :math:`T_i` functions,
-        equations 60 and 61 for the calculation of :math:`\langle \cal M^3 \rangle` and
-        :math:`\langle \cal M^2 M^* \rangle`, and equations 55-58 for how to convert
-        these to the return values.
-
-        If k2 or k3 != 1, then this routine calculates the generalization of the skewness
-        proposed by Schneider, Kilbinger & Lombardi (2005, A&A, 431):
-        :math:`\langle M_{ap}^3(R, k_2 R, k_3 R)\rangle` and related values.
-
-        If k2 = k3 = 1 (the default), then there are only 4 combinations of Map and Mx
-        that are relevant:
-
-        - map3 = :math:`\langle M_{ap}^3(R)\rangle`
-        - map2mx = :math:`\langle M_{ap}^2(R) M_\times(R)\rangle`,
-        - mapmx2 = :math:`\langle M_{ap}(R) M_\times(R)\rangle`
-        - mx3 = :math:`\langle M_{\rm \times}^3(R)\rangle`
-
-        However, if k2 or k3 != 1, then there are 8 combinations:
-
-        - map3 = :math:`\langle M_{ap}(R) M_{ap}(k_2 R) M_{ap}(k_3 R)\rangle`
-        - mapmapmx = :math:`\langle M_{ap}(R) M_{ap}(k_2 R) M_\times(k_3 R)\rangle`
-        - mapmxmap = :math:`\langle M_{ap}(R) M_\times(k_2 R) M_{ap}(k_3 R)\rangle`
-        - mxmapmap = :math:`\langle M_\times(R) M_{ap}(k_2 R) M_{ap}(k_3 R)\rangle`
-        - mxmxmap = :math:`\langle M_\times(R) M_\times(k_2 R) M_{ap}(k_3 R)\rangle`
-        - mxmapmx = :math:`\langle M_\times(R) M_{ap}(k_2 R) M_\times(k_3 R)\rangle`
-        - mapmxmx = :math:`\langle M_{ap}(R) M_\times(k_2 R) M_\times(k_3 R)\rangle`
-        - mx3 = :math:`\langle M_\times(R) M_\times(k_2 R) M_\times(k_3 R)\rangle`
-
-        To accommodate this full generality, we always return all 8 values, along with the
-        estimated variance (which is equal for each), even when k2 = k3 = 1.
-
-        .. note::
-
-            The formulae for the ``m2_uform`` = 'Schneider' definition of the aperture mass,
-            described in the documentation of `calculateMapSq`, are not known, so that is not an
-            option here.  The calculations here use the definition that corresponds to
-            ``m2_uform`` = 'Crittenden'.
-
-        Parameters:
-            R (array):      The R values at which to calculate the aperture mass statistics.
-                            (default: None, which means use self.rnom1d)
-            k2 (float):     If given, the ratio R2/R1 in the SKL formulae. (default: 1)
-            k3 (float):     If given, the ratio R3/R1 in the SKL formulae. (default: 1)
-
-        Returns:
-            Tuple containing
-
-                - map3 = array of :math:`\langle M_{ap}(R) M_{ap}(k_2 R) M_{ap}(k_3 R)\rangle`
-                - mapmapmx = array of :math:`\langle M_{ap}(R) M_{ap}(k_2 R) M_\times(k_3 R)\rangle`
-                - mapmxmap = array of :math:`\langle M_{ap}(R) M_\times(k_2 R) M_{ap}(k_3 R)\rangle`
-                - mxmapmap = array of :math:`\langle M_\times(R) M_{ap}(k_2 R) M_{ap}(k_3 R)\rangle`
-                - mxmxmap = array of :math:`\langle M_\times(R) M_\times(k_2 R) M_{ap}(k_3 R)\rangle`
-                - mxmapmx = array of :math:`\langle M_\times(R) M_{ap}(k_2 R) M_\times(k_3 R)\rangle`
-                - mapmxmx = array of :math:`\langle M_{ap}(R) M_\times(k_2 R) M_\times(k_3 R)\rangle`
-                - mx3 = array of :math:`\langle M_\times(R) M_\times(k_2 R) M_\times(k_3 R)\rangle`
-                - varmap3 = array of variance estimates of the above values
-        """
         # As in the calculateMapSq function, we Make s and t matrices, so we can eventually do the
         # integral by doing a matrix product.
-        if R is None:
-            R = self.rnom1d
-
         # Pick s = d2, so dlogs is bin_size
         s = d2 = np.outer(1./R, self.meand2.ravel())
 
@@ -902,9 +929,6 @@ class GGGCorrelation(treecorr.BinnedCorr3):
         ty[:,self.meanv.ravel() > 0] *= -1.
         t = tx + 1j * ty
 
-        # Next we need to construct the T values.
-        T0, T1, T2, T3 = self._calculateT(s,t,1.,k2,k3)
-
         # Finally, account for the Jacobian in d^2t: jac = |J(tx, ty; u, v)|,
         # since our Gammas are accumulated in s, u, v, not s, tx, ty.
         # u = d3/d2, v = (d1-d2)/d3
@@ -927,58 +951,162 @@ class GGGCorrelation(treecorr.BinnedCorr3):
         sds = s * s * self.bin_size  # Remember bin_size is dln(s)
         # Note: these are really d2t/2piR^2 and sds/R^2, which are what actually show up
         # in JBJ equations 45 and 50.
+        w = sds * d2t
 
-        T0 *= sds * d2t
-        T1 *= sds * d2t
-        T2 *= sds * d2t
-        T3 *= sds * d2t
-
-        # Now do the integral by taking the matrix products.
-        gam0 = self.gam0.ravel()
-        gam1 = self.gam1.ravel()
-        gam2 = self.gam2.ravel()
-        gam3 = self.gam3.ravel()
-        vargam0 = self.vargam0.ravel()
-        vargam1 = self.vargam1.ravel()
-        vargam2 = self.vargam2.ravel()
-        vargam3 = self.vargam3.ravel()
-        mmm = T0.dot(gam0)
-        mcmm = T1.dot(gam1) + T2.dot(gam2) + T3.dot(gam3)
-        varmmm = (np.abs(T0)**2).dot(vargam0)
-        varmcmm = (np.abs(T1)**2).dot(vargam1)
-        varmcmm += (np.abs(T2)**2).dot(vargam2)
-        varmcmm += (np.abs(T3)**2).dot(vargam3)
-
+        # Next we need to construct the T values, summed over the permutations of k1,k2,k3
+        # that contribute to each of mmm, mcmm, mmcm, mmmc.
+        # K0 is the kernel for mmm.  Kc[i] is the kernel for [mcmm, mmcm, mmmc][i], which
+        # multiplies the concatenation of gam1, gam2, gam3.  V is the kernel for the variance,
+        # which multiplies the concatenation of vargam0, vargam1, vargam2, vargam3.
         if k2 == 1 and k3 == 1:
-            mmm *= 6
-            varmmm *= 6
-            mcmm *= 2
-            mmcm = mmmc = mcmm
-            varmcmm *= 2
-            varmmcm = varmmmc = varmcmm
+            # All permutations are equal, so just scale the single one appropriately.
+            # Also, mcmm = mmcm = mmmc, so only one Kc is needed.
+            T0, T1, T2, T3 = self._calculateT(s,t,1.,k2,k3)
+            T0 *= w
+            T1 *= w
+            T2 *= w
+            T3 *= w
+            K0 = 6 * T0
+            Kc = 2 * np.hstack([T1, T2, T3])[np.newaxis,:,:]
+            V = 6 * np.abs(np.hstack([T0, T1, T2, T3]))**2
         else:
-            # Repeat the above for the other permutations
-            mmcm = np.zeros_like(mcmm)
-            mmmc = np.zeros_like(mcmm)
-            varmmcm = np.zeros_like(varmcmm)
-            varmmmc = np.zeros_like(varmcmm)
-            for (_k1, _k2, _k3, _mcmm, _varmcmm) in [ (1,k3,k2,mcmm,varmcmm),
-                                                      (k2,1,k3,mmcm,varmmcm),
-                                                      (k2,k3,1,mmcm,varmmcm),
-                                                      (k3,1,k2,mmmc,varmmmc),
-                                                      (k3,k2,1,mmmc,varmmmc) ]:
+            nr, n = w.shape
+            K0 = np.zeros((nr, n), dtype=complex)
+            Kc = np.zeros((3, nr, 3*n), dtype=complex)
+            V = np.zeros((nr, 4*n), dtype=float)
+            for (_k1, _k2, _k3, i) in [ (1,k2,k3,0), (1,k3,k2,0),
+                                        (k2,1,k3,1), (k2,k3,1,1),
+                                        (k3,1,k2,2), (k3,k2,1,2) ]:
                 T0, T1, T2, T3 = self._calculateT(s,t,_k1,_k2,_k3)
-                T0 *= sds * d2t
-                T1 *= sds * d2t
-                T2 *= sds * d2t
-                T3 *= sds * d2t
-                # Relies on numpy array overloading += to actually update in place.
-                mmm += T0.dot(gam0)
-                _mcmm += T1.dot(gam1) + T2.dot(gam2) + T3.dot(gam3)
-                varmmm += (np.abs(T0)**2).dot(vargam0)
-                _varmcmm += (np.abs(T1)**2).dot(vargam1)
-                _varmcmm += (np.abs(T2)**2).dot(vargam2)
-                _varmcmm += (np.abs(T3)**2).dot(vargam3)
+                T0 *= w
+                T1 *= w
+                T2 *= w
+                T3 *= w
+                K0 += T0
+                Kc[i] += np.hstack([T1, T2, T3])
+                V += np.abs(np.hstack([T0, T1, T2, T3]))**2
+        V /= 16.
+
+        # These can be large, so only keep the few most recently used kernels.
+        if len(self._map3_cache) >= 4:
+            del self._map3_cache[next(iter(self._map3_cache))]
+        self._map3_cache[key] = (K0, Kc, V)
+        return K0, Kc, V
+
+    def calculateMap3(self, R=None, k2=1, k3=1, gam0=None, gam1=None, gam2=None, gam3=None):
+        r"""Calculate the skewness of the aperture mass from the correlation function.
+
+        The equations for this come from Jarvis, Bernstein & Jain (2004, MNRAS, 352).
+        See their section 3, especially equations 51 and 52 for the :math:`T_i` functions,
+        equations 60 and 61 for the calculation of :math:`\langle \cal M^3 \rangle` and
+        :math:`\langle \cal M^2 M^* \rangle`, and equations 55-58 for how to convert
+        these to the return values.
+
+        If k2 or k3 != 1, then this routine calculates the generalization of the skewness
+        proposed by Schneider, Kilbinger & Lombardi (2005, A&A, 431):
+        :math:`\langle M_{ap}^3(R, k_2 R, k_3 R)\rangle` and related values.
+
+        If k2 = k3 = 1 (the default), then there are only 4 combinations of Map and Mx
+        that are relevant:
+
+        - map3 = :math:`\langle M_{ap}^3(R)\rangle`
+        - map2mx = :math:`\langle M_{ap}^2(R) M_\times(R)\rangle`,
+        - mapmx2 = :math:`\langle M_{ap}(R) M_\times(R)\rangle`
+        - mx3 = :math:`\langle M_{\rm \times}^3(R)\rangle`
+
+        However, if k2 or k3 != 1, then there are 8 combinations:
+
+        - map3 = :math:`\langle M_{ap}(R) M_{ap}(k_2 R) M_{ap}(k_3 R)\rangle`
+        - mapmapmx = :math:`\langle M_{ap}(R) M_{ap}(k_2 R) M_\times(k_3 R)\rangle`
+        - mapmxmap = :math:`\langle M_{ap}(R) M_\times(k_2 R) M_{ap}(k_3 R)\rangle`
+        - mxmapmap = :math:`\langle M_\times(R) M_{ap}(k_2 R) M_{ap}(k_3 R)\rangle`
+        - mxmxmap = :math:`\langle M_\times(R) M_\times(k_2 R) M_{ap}(k_3 R)\rangle`
+        - mxmapmx = :math:`\langle M_\times(R) M_{ap}(k_2 R) M_\times(k_3 R)\rangle`
+        - mapmxmx = :math:`\langle M_{ap}(R) M_\times(k_2 R) M_\times(k_3 R)\rangle`
+        - mx3 = :math:`\langle M_\times(R) M_\times(k_2 R) M_\times(k_3 R)\rangle`
+
+        To accommodate this full generality, we always return all 8 values, along with the
+        estimated variance (which is equal for each), even when k2 = k3 = 1.
+
+        .. note::
+
+            The formulae for the ``m2_uform`` = 'Schneider' definition of the aperture mass,
+            described in the documentation of `calculateMapSq`, are not known, so that is not an
+            option here.  The calculations here use the definition that corresponds to
+            ``m2_uform`` = 'Crittenden'.
+
+        The integrals are done as matrix products of the correlation function with kernel
+        matrices that depend only on R, k2, k3 and the mean triangle shapes in each bin.  These
+        kernels are cached, so repeated calls with the same R, k2, k3 (e.g. for many jackknife
+        realizations of the same binning) only need the matrix products.  To evaluate many
+        realizations at once, you may pass stacks of correlation functions as gam0, ... gam3,
+        each with shape (nrealizations,) + self.gam0.shape.  Any of these not given are taken from
+        the current values of self.gam0, etc.
+
+        Parameters:
+            R (array):      The R values at which to calculate the aperture mass statistics.
+                            (default: None, which means use self.rnom1d)
+            k2 (float):     If given, the ratio R2/R1 in the SKL formulae. (default: 1)
+            k3 (float):     If given, the ratio R3/R1 in the SKL formulae. (default: 1)
+            gam0 (array):   If given, the gam0 values to use in place of self.gam0.  May have an
+                            extra leading dimension to calculate many realizations at once.
+                            (default: None)
+            gam1 (array):   If given, the gam1 values to use in place of self.gam1. (default: None)
+            gam2 (array):   If given, the gam2 values to use in place of self.gam2. (default: None)
+            gam3 (array):   If given, the gam3 values to use in place of self.gam3. (default: None)
+
+        Returns:
+            Tuple containing
+
+                - map3 = array of :math:`\langle M_{ap}(R) M_{ap}(k_2 R) M_{ap}(k_3 R)\rangle`
+                - mapmapmx = array of :math:`\langle M_{ap}(R) M_{ap}(k_2 R) M_\times(k_3 R)\rangle`
+                - mapmxmap = array of :math:`\langle M_{ap}(R) M_\times(k_2 R) M_{ap}(k_3 R)\rangle`
+                - mxmapmap = array of :math:`\langle M_\times(R) M_{ap}(k_2 R) M_{ap}(k_3 R)\rangle`
+                - mxmxmap = array of :math:`\langle M_\times(R) M_\times(k_2 R) M_{ap}(k_3 R)\rangle`
+                - mxmapmx = array of :math:`\langle M_\times(R) M_{ap}(k_2 R) M_\times(k_3 R)\rangle`
+                - mapmxmx = array of :math:`\langle M_{ap}(R) M_\times(k_2 R) M_\times(k_3 R)\rangle`
+                - mx3 = array of :math:`\langle M_\times(R) M_\times(k_2 R) M_\times(k_3 R)\rangle`
+                - varmap3 = array of variance estimates of the above values
+
+            If any of gam0, ... gam3 has a leading realization dimension, the first 8 arrays
+            have shape (nrealizations, len(R)).  The variance is always calculated from
+            self.vargam0, etc., so it has shape (len(R),).
+        """
+        if R is None:
+            R = self.rnom1d
+        R = np.asarray(R, dtype=float)
+        K0, Kc, V = self._map3_kernels(R, k2, k3)
+
+        # Flatten each gam to shape (nrealizations, n), and broadcast them to a common number
+        # of realizations.
+        shape = self.gam0.shape
+        n = K0.shape[1]
+        gams = [self.gam0 if gam0 is None else np.asarray(gam0),
+                self.gam1 if gam1 is None else np.asarray(gam1),
+                self.gam2 if gam2 is None else np.asarray(gam2),
+                self.gam3 if gam3 is None else np.asarray(gam3)]
+        batch = False
+        for i, g in enumerate(gams):
+            if g.shape == shape:
+                gams[i] = g.reshape(1, n)
+            elif g.shape[1:] == shape:
+                gams[i] = g.reshape(-1, n)
+                batch = True
+            else:
+                raise ValueError("gam arrays must have shape %s or (nrealizations,)+%s"%(
+                                 shape, shape))
+        gam0, gam1, gam2, gam3 = np.broadcast_arrays(*gams)
+
+        # Now do the integral by taking the matrix products.
+        mmm = gam0.dot(K0.T)
+        mc = np.hstack([gam1, gam2, gam3]).dot(Kc.reshape(-1, 3*n).T)
+        mc = mc.reshape(len(mmm), len(Kc), len(R))
+        if len(Kc) == 1:
+            mcmm = mmcm = mmmc = mc[:,0]
+        else:
+            mcmm = mc[:,0]
+            mmcm = mc[:,1]
+            mmmc = mc[:,2]
 
         map3 = 0.25 * np.real(mcmm + mmcm + mmmc + mmm)
         mapmapmx = 0.25 * np.imag(mcmm + mmcm - mmmc + mmm)
@@ -989,7 +1117,13 @@ class GGGCorrelation(treecorr.BinnedCorr3):
         mapmxmx = 0.25 * np.real(-mcmm + mmcm + mmmc - mmm)
         mx3 = 0.25 * np.imag(mcmm + mmcm + mmmc - mmm)
 
-        var = (varmcmm + varmmcm + varmmmc + varmmm) / 16.
+        var = V.dot(np.concatenate([self.vargam0.ravel(), self.vargam1.ravel(),
+                                    self.vargam2.ravel(), self.vargam3.ravel()]))
+
+        if not batch:
+            map3, mapmapmx, mapmxmap, mxmapmap, mxmxmap, mxmapmx, mapmxmx, mx3 = (
+                map3[0], mapmapmx[0], mapmxmap[0], mxmapmap[0],
+                mxmxmap[0], mxmapmx[0], mapmxmx[0], mx3[0])
 
         return map3, mapmapmx, mapmxmap, mxmapmap, mxmxmap, mxmapmx, mapmxmx, mx3, var
 
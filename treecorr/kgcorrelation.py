@@ -91,6 +91,11 @@ class KGCorrelation(treecorr.BinnedCorr2):
         **kwargs:       See the documentation for `BinnedCorr2` for the list of allowed keyword
                         arguments, which may be passed either directly or in the config dict.
     """
+    # The values accumulated by process_auto/process_cross and combined by __iadd__.
+    _sum_attrs = ('xi', 'xi_im', 'meanr', 'meanlogr', 'weight', 'npairs')
+    # The xi arrays, in the order they are passed to the C++ layer.
+    _xi_attrs = ('xi', 'xi_im')
+
     def __init__(self, config=None, logger=None, **kwargs):
         """Initialize `KGCorrelation`.  See class doc for details.
         """
@@ -204,6 +209,7 @@ class KGCorrelation(treecorr.BinnedCorr2):
                              cat1.name, cat2.name)
 
         self._set_metric(metric, cat1.coords, cat2.coords)
+        self._check_nreal(cat1, cat2)
 
         self._set_num_threads(num_threads)
 
@@ -258,6 +264,7 @@ class KGCorrelation(treecorr.BinnedCorr2):
                              cat1.name, cat2.name)
 
         self._set_metric(metric, cat1.coords, cat2.coords)
+        self._check_nreal(cat1, cat2)
 
         self._set_num_threads(num_threads)
 
@@ -308,6 +315,7 @@ class KGCorrelation(treecorr.BinnedCorr2):
         self.weight.ravel()[:] = 0
         self.npairs.ravel()[:] = 0
         self.results.clear()
+        self._clear_cov_cache()
 
     def __iadd__(self, other):
         """Add a second `KGCorrelation`'s data to this one.
@@ -326,6 +334,7 @@ class KGCorrelation(treecorr.BinnedCorr2):
             raise ValueError("KGCorrelation to be added is not compatible with this one.")
 
         self._set_metric(other.metric, other.coords)
+        self._clear_cov_cache()
         self.xi.ravel()[:] += other.xi.ravel()[:]
         self.xi_im.ravel()[:] += other.xi_im.ravel()[:]
         self.meanr.ravel()[:] += other.meanr.ravel()[:]
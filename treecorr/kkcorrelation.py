@@ -55,6 +55,22 @@ class KKCorrelation(treecorr.BinnedCorr2):
                     both objects have w=0).
         cov:        An estimate of the full covariance matrix.
 
+    If the input catalogs have multiple realizations of the kappa values (cf. the ``k``
+    parameter of `Catalog`), then ``xi`` has shape (nreal, nbins), with one row for each
+    realization.  All of the realizations are usually computed from a single traversal of
+    the positions (see below).  The other arrays are the same for all realizations, and
+    ``varxi`` is the shot noise variance using the kappa variance averaged over the
+    realizations.  Only ``var_method = 'shot'`` is allowed in this case.
+
+    To do this, the pairs of cells that contribute to ``xi`` are recorded during
+    the traversal, and each thread applies them to all of the realizations in batches of
+    65536 pairs.  So the memory used for the pairs doesn't depend on the total number of
+    pairs or on the number of realizations.  The sums of the values in each cell are needed
+    for all of the realizations at once, which takes 8 bytes per cell and realization.
+    If the number of objects times the number of realizations is more than 2**24, the
+    realizations are done in chunks to limit this memory, with one traversal of the
+    positions for each chunk.
+
     .. note::
 
         The default method for estimating the variance and covariance attributes (``varxi``,
@@ -91,6 +107,12 @@ class KKCorrelation(treecorr.BinnedCorr2):
         **kwargs:       See the documentation for `BinnedCorr2` for the list of allowed keyword
                         arguments, which may be passed either directly or in the config dict.
     """
+    # The values accumulated by process_auto/process_cross and combined by __iadd__.
+    _sum_attrs = ('xi', 'meanr', 'meanlogr', 'weight', 'npairs')
+    # The xi arrays, in the order they are passed to the C++ layer.  When processing multiple
+    # realizations, these have one row per realization.
+    _xi_attrs = ('xi',)
+
     def __init__(self, config=None, logger=None, **kwargs):
         """Initialize `KKCorrelation`.  See class doc for details.
         """
@@ -200,6 +222,7 @@ class KKCorrelation(treecorr.BinnedCorr2):
             self.logger.info('Starting process KK auto-correlations for cat %s.', cat.name)
 
         self._set_metric(metric, cat.coords)
+        self._set_nreal(cat.nreal)
 
         self._set_num_threads(num_threads)
 
@@ -209,8 +232,13 @@ class KKCorrelation(treecorr.BinnedCorr2):
                               bool(self.brute), self.min_top, self.max_top, self.coords)
 
         self.logger.info('Starting %d jobs.',field.nTopLevelNodes)
-        treecorr._lib.ProcessAuto2(self.corr, field.data, self.output_dots,
-                                   field._d, self._coords, self._bintype, self._metric)
+        def process():
+            treecorr._lib.ProcessAuto2(self.corr, field.data, self.output_dots,
+                                       field._d, self._coords, self._bintype, self._metric)
+        if cat.nreal is None:
+            process()
+        else:
+            self._process_realizations(field, field, process, True)
 
 
     def process_cross(self, cat1, cat2, metric=None, num_threads=None):
@@ -238,6 +266,9 @@ class KKCorrelation(treecorr.BinnedCorr2):
                              cat1.name, cat2.name)
 
         self._set_metric(metric, cat1.coords, cat2.coords)
+        if cat1.nreal != cat2.nreal:
+            raise ValueError("cat1 and cat2 have different numbers of realizations of k")
+        self._set_nreal(cat1.nreal)
 
         self._set_num_threads(num_threads)
 
@@ -251,8 +282,13 @@ class KKCorrelation(treecorr.BinnedCorr2):
                             self.min_top, self.max_top, self.coords)
 
         self.logger.info('Starting %d jobs.',f1.nTopLevelNodes)
-        treecorr._lib.ProcessCross2(self.corr, f1.data, f2.data, self.output_dots,
-                                    f1._d, f2._d, self._coords, self._bintype, self._metric)
+        def process():
+            treecorr._lib.ProcessCross2(self.corr, f1.data, f2.data, self.output_dots,
+                                        f1._d, f2._d, self._coords, self._bintype, self._metric)
+        if cat1.nreal is None:
+            process()
+        else:
+            self._process_realizations(f1, f2, process, False)
 
 
     def process_pairwise(self, cat1, cat2, metric=None, num_threads=None):
@@ -292,6 +328,7 @@ class KKCorrelation(treecorr.BinnedCorr2):
                              cat1.name, cat2.name)
 
         self._set_metric(metric, cat1.coords, cat2.coords)
+        self._check_nreal(cat1, cat2)
 
         self._set_num_threads(num_threads)
 
@@ -316,7 +353,7 @@ class KKCorrelation(treecorr.BinnedCorr2):
         mask1 = self.weight != 0
         mask2 = self.weight == 0
 
-        self.xi[mask1] /= self.weight[mask1]
+        self.xi[...,mask1] /= self.weight[mask1]
         self.meanr[mask1] /= self.weight[mask1]
         self.meanlogr[mask1] /= self.weight[mask1]
 
@@ -341,6 +378,7 @@ class KKCorrelation(treecorr.BinnedCorr2):
         self.weight.ravel()[:] = 0
         self.npairs.ravel()[:] = 0
         self.results.clear()
+        self._clear_cov_cache()
 
     def __iadd__(self, other):
         """Add a second `KKCorrelation`'s data to this one.
@@ -359,6 +397,8 @@ class KKCorrelation(treecorr.BinnedCorr2):
             raise ValueError("KKCorrelation to be added is not compatible with this one.")
 
         self._set_metric(other.metric, other.coords)
+        self._set_nreal(other._get_nreal())
+        self._clear_cov_cache()
         self.xi.ravel()[:] += other.xi.ravel()[:]
         self.meanr.ravel()[:] += other.meanr.ravel()[:]
         self.meanlogr.ravel()[:] += other.meanlogr.ravel()[:]
@@ -402,6 +442,7 @@ class KKCorrelation(treecorr.BinnedCorr2):
         if cat2 is not None and not isinstance(cat2,list):
             self.npatch2 = cat2._npatch
             cat2 = cat2.get_patches(low_mem=low_mem)
+        self._set_nreal(cat1[0].nreal)
 
         if cat2 is None:
             vark1 = treecorr.calculateVarK(cat1)
@@ -447,6 +488,8 @@ class KKCorrelation(treecorr.BinnedCorr2):
             precision (int):    For ASCII output catalogs, the desired precision. (default: 4;
                                 this value can also be given in the constructor in the config dict.)
         """
+        if self._get_nreal() is not None:
+            raise ValueError("Cannot write KKCorrelation with multiple realizations")
         self.logger.info('Writing KK correlations to %s',file_name)
         if precision is None:
             precision = self.config.get('precision', 4)
@@ -74,6 +74,15 @@ class KKKCorrelation(treecorr.BinnedCorr3):
         weight:     The total weight in each bin.
         ntri:       The number of triangles going into each bin (including those where one or
                     more objects have w=0).
+        cov:        An estimate of the full covariance matrix, if ``var_method`` is something
+                    other than 'shot'.
+
+    .. note::
+
+        The default method for estimating the variance is 'shot', which only includes the shot
+        noise propagated into the final correlation.  To get better estimates, you need to set
+        ``var_method`` to something else and use patches in the input catalog(s), in which
+        case ``varzeta`` is the diagonal of ``cov``.  cf. `Covariance Estimates`.
 
     If ``sep_units`` are given (either in the config dict or as a named kwarg) then the distances
     will all be in these units.
@@ -103,6 +112,10 @@ class KKKCorrelation(treecorr.BinnedCorr3):
         **kwargs:       See the documentation for `BinnedCorr3` for the list of allowed keyword
                         arguments, which may be passed either directly or in the config dict.
     """
+    # The accumulated values, which get sent between processes when using MPI.
+    _sum_attrs = ('zeta', 'meand1', 'meanlogd1', 'meand2', 'meanlogd2', 'meand3', 'meanlogd3',
+                  'meanu', 'meanv', 'weight', 'ntri')
+
     def __init__(self, config=None, logger=None, **kwargs):
         """Initialize `KKKCorrelation`.  See class doc for details.
         """
@@ -193,6 +206,14 @@ class KKKCorrelation(treecorr.BinnedCorr3):
         import copy
         return copy.deepcopy(self)
 
+    def _copy_for_results(self):
+        # Make a copy of just the things we need to keep in results.
+        ret = KKKCorrelation.__new__(KKKCorrelation)
+        ret.zeta = self.zeta.copy()
+        ret.weight = self.weight.copy()
+        ret.config = self.config  # not deep copy, so cheap, but makes repr work
+        return ret
+
     def __getstate__(self):
         d = self.__dict__.copy()
         d.pop('_corr',None)
@@ -230,6 +251,7 @@ class KKKCorrelation(treecorr.BinnedCorr3):
             self.logger.info('Starting process KKK auto-correlations for cat %s.', cat.name)
 
         self._set_metric(metric, cat.coords)
+        self._check_nreal(cat)
 
         self._set_num_threads(num_threads)
 
@@ -292,6 +314,7 @@ class KKKCorrelation(treecorr.BinnedCorr3):
                              cat1.name, cat2.name, cat3.name)
 
         self._set_metric(metric, cat1.coords, cat2.coords, cat3.coords)
+        self._check_nreal(cat1, cat2, cat3)
 
         self._set_num_threads(num_threads)
 
@@ -347,8 +370,13 @@ class KKKCorrelation(treecorr.BinnedCorr3):
         self.meand1[mask2] = self.v[mask2] * self.meand3[mask2] + self.meand2[mask2]
         self.meanlogd1[mask2] = np.log(self.meand1[mask2])
 
-        self.varzeta[mask1] = vark1 * vark2 * vark3 / self.weight[mask1]
-        self.varzeta[mask2] = 0.
+        self._var_num = vark1 * vark2 * vark3
+        if self.var_method == 'shot':
+            self.varzeta[mask1] = self._var_num / self.weight[mask1]
+            self.varzeta[mask2] = 0.
+        else:
+            self.cov = self.estimate_cov(self.var_method)
+            self.varzeta.ravel()[:] = self.cov.diagonal()
 
 
     def clear(self):
@@ -367,6 +395,7 @@ class KKKCorrelation(treecorr.BinnedCorr3):
         self.weight[:,:,:] = 0.
         self.ntri[:,:,:] = 0.
         self.results.clear()
+        self._clear_cov_cache()
 
     def __iadd__(self, other):
         """Add a second `KKKCorrelation`'s data to this one.
@@ -391,6 +420,7 @@ class KKKCorrelation(treecorr.BinnedCorr3):
             raise ValueError("KKKCorrelation to be added is not compatible with this one.")
 
         self._set_metric(other.metric, other.coords)
+        self._clear_cov_cache()
         self.zeta[:] += other.zeta[:]
         self.varzeta[:] += other.varzeta[:]
         self.meand1[:] += other.meand1[:]
@@ -406,7 +436,14 @@ class KKKCorrelation(treecorr.BinnedCorr3):
         return self
 
 
-    def process(self, cat1, cat2=None, cat3=None, metric=None, num_threads=None):
+    def _getStat(self):
+        return self.zeta.ravel()
+
+    def _stackStat(self, results):
+        return results.stack('zeta').reshape(len(results), -1)
+
+    def process(self, cat1, cat2=None, cat3=None, metric=None, num_threads=None,
+                comm=None):
         """Accumulate the number of triangles of points between cat1, cat2, and cat3.
 
         - If only 1 argument is given, then compute an auto-correlation function.
@@ -438,9 +475,19 @@ class KKKCorrelation(treecorr.BinnedCorr3):
             num_threads (int):  How many OpenMP threads to use during the calculation.
                                 (default: use the number of cpu cores; this value can also be given
                                 in the constructor in the config dict.)
+            comm (mpi4py.Comm): If running MPI, an mpi4py Comm object to communicate between
+                                processes.  If used, the rank=0 process will have the final
+                                computation. This only works if using patches. (default: None)
         """
         import math
         self.clear()
+        if self.algo == 'multipole':
+            zeta, = self._process_multipole(cat1, cat2, cat3, metric, num_threads, comm)
+            self.zeta += zeta.real
+            vark = treecorr.calculateVarK(cat1)
+            self.logger.info("vark = %f: sig_k = %f",vark,math.sqrt(vark))
+            self.finalize(vark,vark,vark)
+            return
         if not isinstance(cat1,list): cat1 = cat1.get_patches()
         if cat2 is not None and not isinstance(cat2,list): cat2 = cat2.get_patches()
         if cat3 is not None and not isinstance(cat3,list): cat3 = cat3.get_patches()
@@ -450,7 +497,7 @@ class KKKCorrelation(treecorr.BinnedCorr3):
             vark2 = vark1
             vark3 = vark1
             self.logger.info("vark = %f: sig_k = %f",vark1,math.sqrt(vark1))
-            self._process_all_auto(cat1, metric, num_threads)
+            self._process_all_auto(cat1, metric, num_threads, comm)
         elif (cat2 is None) != (cat3 is None):
             raise NotImplementedError("No partial cross GGG yet.")
         else:
@@ -461,7 +508,7 @@ class KKKCorrelation(treecorr.BinnedCorr3):
             self.logger.info("vark1 = %f: sig_k = %f",vark1,math.sqrt(vark1))
             self.logger.info("vark2 = %f: sig_k = %f",vark2,math.sqrt(vark2))
             self.logger.info("vark3 = %f: sig_k = %f",vark3,math.sqrt(vark3))
-            self._process_all_cross(cat1, cat2, cat3, metric, num_threads)
+            self._process_all_cross(cat1, cat2, cat3, metric, num_threads, comm)
         self.finalize(vark1,vark2,vark3)
 
 
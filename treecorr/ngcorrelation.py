@@ -89,6 +89,11 @@ class NGCorrelation(treecorr.BinnedCorr2):
         **kwargs:       See the documentation for `BinnedCorr2` for the list of allowed keyword
                         arguments, which may be passed either directly or in the config dict.
     """
+    # The values accumulated by process_auto/process_cross and combined by __iadd__.
+    _sum_attrs = ('raw_xi', 'raw_xi_im', 'raw_varxi', 'meanr', 'meanlogr', 'weight', 'npairs')
+    # The xi arrays, in the order they are passed to the C++ layer.
+    _xi_attrs = ('raw_xi', 'raw_xi_im')
+
     def __init__(self, config=None, logger=None, **kwargs):
         """Initialize `NGCorrelation`.  See class doc for details.
         """
@@ -206,6 +211,7 @@ class NGCorrelation(treecorr.BinnedCorr2):
                              cat1.name, cat2.name)
 
         self._set_metric(metric, cat1.coords, cat2.coords)
+        self._check_nreal(cat2)
 
         self._set_num_threads(num_threads)
 
@@ -260,6 +266,7 @@ class NGCorrelation(treecorr.BinnedCorr2):
                              cat1.name, cat2.name)
 
         self._set_metric(metric, cat1.coords, cat2.coords)
+        self._check_nreal(cat2)
 
         self._set_num_threads(num_threads)
 
@@ -316,6 +323,7 @@ class NGCorrelation(treecorr.BinnedCorr2):
         if hasattr(self,'cov'):
             self.cov.ravel()[:] = 0
         self.results.clear()
+        self._clear_cov_cache()
         self._rg = None
         self.xi = self.raw_xi
         self.xi_im = self.raw_xi_im
@@ -338,6 +346,7 @@ class NGCorrelation(treecorr.BinnedCorr2):
             raise ValueError("NGCorrelation to be added is not compatible with this one.")
 
         self._set_metric(other.metric, other.coords)
+        self._clear_cov_cache()
         self.raw_xi.ravel()[:] += other.raw_xi.ravel()[:]
         self.raw_xi_im.ravel()[:] += other.raw_xi_im.ravel()[:]
         self.raw_varxi.ravel()[:] += other.raw_varxi.ravel()[:]
@@ -410,6 +419,7 @@ class NGCorrelation(treecorr.BinnedCorr2):
                 - xi_im = array of the imaginary part of :math:`\xi(R)`
                 - varxi = array of the variance estimates of the above values
         """
+        self._clear_cov_cache()
         if rg is not None:
             self.xi = self.raw_xi - rg.xi
             self.xi_im = self.raw_xi_im - rg.xi_im
@@ -442,17 +452,14 @@ class NGCorrelation(treecorr.BinnedCorr2):
 
         return self.xi, self.xi_im, self.varxi
 
-    def _calculate_xi_from_pairs(self, pairs):
-        okij = set(self.results.keys())
-        n = np.sum([self.results[ij]._getStat() for ij in pairs if ij in okij], axis=0)
-        d = np.sum([self.results[ij]._getWeight() for ij in pairs if ij in okij], axis=0)
-        d[d == 0] = 1  # Guard against division by zero.
-        xi = n/d
-        w = np.sum(d)
+    def _calculate_xi_from_pairs(self, pairs, i=None, j=None, key=''):
+        xi, w = treecorr.BinnedCorr2._calculate_xi_from_pairs(self, pairs, i, j, key)
         if self._rg is not None:
+            i, j = self._rg.results.indices()
             if self._rg.npatch1 == 1:
-                pairs = [(0,ij[1]) for ij in pairs if ij[0] == ij[1]]
-            rg, _ = self._rg._calculate_xi_from_pairs(pairs)
+                # Then the rg pair (0,j) goes with the auto pair (j,j) of this correlation.
+                i = j
+            rg, _ = self._rg._calculate_xi_from_pairs(pairs, i, j, 'rg_')
             xi -= rg
         return xi,w
 
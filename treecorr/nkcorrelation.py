@@ -94,6 +94,11 @@ class NKCorrelation(treecorr.BinnedCorr2):
         **kwargs:       See the documentation for `BinnedCorr2` for the list of allowed keyword
                         arguments, which may be passed either directly or in the config dict.
     """
+    # The values accumulated by process_auto/process_cross and combined by __iadd__.
+    _sum_attrs = ('raw_xi', 'raw_varxi', 'meanr', 'meanlogr', 'weight', 'npairs')
+    # The xi arrays, in the order they are passed to the C++ layer.
+    _xi_attrs = ('raw_xi',)
+
     def __init__(self, config=None, logger=None, **kwargs):
         """Initialize `NKCorrelation`.  See class doc for details.
         """
@@ -208,6 +213,7 @@ class NKCorrelation(treecorr.BinnedCorr2):
                              cat1.name, cat2.name)
 
         self._set_metric(metric, cat1.coords, cat2.coords)
+        self._check_nreal(cat2)
 
         self._set_num_threads(num_threads)
 
@@ -262,6 +268,7 @@ class NKCorrelation(treecorr.BinnedCorr2):
                              cat1.name, cat2.name)
 
         self._set_metric(metric, cat1.coords, cat2.coords)
+        self._check_nreal(cat2)
 
         self._set_num_threads(num_threads)
 
@@ -312,6 +319,7 @@ class NKCorrelation(treecorr.BinnedCorr2):
         if hasattr(self,'cov'):
             self.cov.ravel()[:] = 0
         self.results.clear()
+        self._clear_cov_cache()
         self._rk = None
         self.xi = self.raw_xi
         self.varxi = self.raw_varxi
@@ -333,6 +341,7 @@ class NKCorrelation(treecorr.BinnedCorr2):
             raise ValueError("NKCorrelation to be added is not compatible with this one.")
 
         self._set_metric(other.metric, other.coords)
+        self._clear_cov_cache()
         self.raw_xi.ravel()[:] += other.raw_xi.ravel()[:]
         self.raw_varxi.ravel()[:] += other.raw_varxi.ravel()[:]
         self.meanr.ravel()[:] += other.meanr.ravel()[:]
@@ -403,6 +412,7 @@ class NKCorrelation(treecorr.BinnedCorr2):
                 - xi = array of :math:`\xi(r)`
                 - varxi = array of variance estimates of :math:`\xi(r)`
         """
+        self._clear_cov_cache()
         if rk is not None:
             self.xi = self.raw_xi - rk.xi
             self._rk = rk
@@ -433,17 +443,14 @@ class NKCorrelation(treecorr.BinnedCorr2):
 
         return self.xi, self.varxi
 
-    def _calculate_xi_from_pairs(self, pairs):
-        okij = set(self.results.keys())
-        n = np.sum([self.results[ij]._getStat() for ij in pairs if ij in okij], axis=0)
-        d = np.sum([self.results[ij]._getWeight() for ij in pairs if ij in okij], axis=0)
-        d[d == 0] = 1  # Guard against division by zero.
-        xi = n/d
-        w = np.sum(d)
+    def _calculate_xi_from_pairs(self, pairs, i=None, j=None, key=''):
+        xi, w = treecorr.BinnedCorr2._calculate_xi_from_pairs(self, pairs, i, j, key)
         if self._rk is not None:
+            i, j = self._rk.results.indices()
             if self._rk.npatch1 == 1:
-                pairs = [(0,ij[1]) for ij in pairs if ij[0] == ij[1]]
-            rk, _ = self._rk._calculate_xi_from_pairs(pairs)
+                # Then the rk pair (0,j) goes with the auto pair (j,j) of this correlation.
+                i = j
+            rk, _ = self._rk._calculate_xi_from_pairs(pairs, i, j, 'rk_')
             xi -= rk
         return xi,w
 
@@ -85,6 +85,15 @@ class NNCorrelation(treecorr.BinnedCorr2):
         **kwargs:       See the documentation for `BinnedCorr2` for the list of allowed keyword
                         arguments, which may be passed either directly or in the config dict.
     """
+    # The values accumulated by process_auto/process_cross and combined by __iadd__.
+    _sum_attrs = ('meanr', 'meanlogr', 'weight', 'npairs', 'tot')
+    # The xi arrays, in the order they are passed to the C++ layer.  (NN doesn't have any.)
+    _xi_attrs = ()
+
+    # The attributes that are saved in cache_dir by process.
+    _cache_attrs = ('meanr', 'meanlogr', 'weight', 'npairs', 'tot', 'results',
+                    'npatch1', 'npatch2', 'coords', 'metric', '_coords', '_metric')
+
     def __init__(self, config=None, logger=None, **kwargs):
         """Initialize `NNCorrelation`.  See class doc for details.
         """
@@ -323,6 +332,7 @@ class NNCorrelation(treecorr.BinnedCorr2):
         self.weight.ravel()[:] = 0.
         self.npairs.ravel()[:] = 0.
         self.results.clear()
+        self._clear_cov_cache()
         self.tot = 0.
 
     def __iadd__(self, other):
@@ -342,6 +352,7 @@ class NNCorrelation(treecorr.BinnedCorr2):
             raise ValueError("NNCorrelation to be added is not compatible with this one.")
 
         self._set_metric(other.metric, other.coords)
+        self._clear_cov_cache()
         self.meanr.ravel()[:] += other.meanr.ravel()[:]
         self.meanlogr.ravel()[:] += other.meanlogr.ravel()[:]
         self.weight.ravel()[:] += other.weight.ravel()[:]
@@ -391,6 +402,9 @@ class NNCorrelation(treecorr.BinnedCorr2):
                                 This only works if using patches. (default: False)
         """
         self.clear()
+        cache_file = self._get_cache_file(cat1, cat2, metric)
+        if treecorr.util.read_cache(self, cache_file, self._cache_attrs, self.logger):
+            return
 
         if not isinstance(cat1,list):
             self.npatch1 = cat1._npatch
@@ -405,6 +419,55 @@ class NNCorrelation(treecorr.BinnedCorr2):
         else:
             self._process_all_cross(cat1, cat2, metric, num_threads, comm, low_mem)
         self.finalize()
+        # With MPI, only rank 0 has the full results.
+        if cache_file is not None and (comm is None or comm.Get_rank() == 0):
+            treecorr.util.write_cache(self, cache_file, self._cache_attrs)
+
+    def process_uniform(self, coords='3d'):
+        """Calculate the expected pair counts for uniformly distributed points in a periodic box.
+
+        For the 'Periodic' metric, the pair counts of a uniform random catalog are known
+        analytically from the volume of each bin's shell relative to the volume of the box.
+        This computes them directly from the bin edges and the periods, so the result can be
+        used as rr in `calculateXi` without generating or processing a random catalog.
+
+        The periods are taken from the ``period`` (or ``xperiod``, ``yperiod``, ``zperiod``)
+        parameters, which must be set, and max_sep may be at most half of the smallest period.
+        The normalization corresponds to a very large number of random points, so the randoms
+        do not add any shot noise to varxi.
+
+        Parameters:
+            coords (str):   The coordinate system of the data, either 'flat' or '3d'.
+                            (default: '3d')
+        """
+        self.clear()
+        if self.bin_type == 'TwoD':
+            raise ValueError("process_uniform is not implemented for bin_type=TwoD")
+        if coords not in ['flat', '3d']:
+            raise ValueError("Invalid coords %s for process_uniform"%coords)
+        self._set_metric('Periodic', coords)
+        self.npatch1 = self.npatch2 = 1
+        periods = [self.xperiod, self.yperiod]
+        if coords == '3d':
+            periods.append(self.zperiod)
+        if 2.*self._max_sep > min(periods):
+            raise ValueError("process_uniform requires max_sep <= period/2")
+        ndim = len(periods)
+        volume = np.prod(periods)
+        # 2 pi r dr or 4 pi r^2 dr for the shell of radius r.
+        shell = 2.*np.pi if ndim == 2 else 4.*np.pi
+
+        r1 = self.left_edges * self._sep_units
+        r2 = self.right_edges * self._sep_units
+        w0, w1, wlog = treecorr.util.radial_integrals(r1, r2, ndim)
+        nrand = 1.e10  # Any large number works here.
+        self.tot = 0.5 * nrand**2
+        norm = self.tot * shell / volume
+        self.weight[:] = norm * w0
+        self.npairs[:] = self.weight
+        self.meanr[:] = norm * w1
+        self.meanlogr[:] = norm * wlog
+        self.finalize()
 
     def _mean_weight(self):
         mean_np = np.mean(self.npairs)
@@ -531,6 +594,7 @@ class NNCorrelation(treecorr.BinnedCorr2):
         self._rr = rr
         self._dr = dr
         self._rd = rd
+        self._clear_cov_cache()
 
         if len(self.results) > 0:
             # Check that rr,dr,rd use the same patches as dd
@@ -578,54 +642,67 @@ class NNCorrelation(treecorr.BinnedCorr2):
         self.varxi = self.cov.diagonal()
         return self.xi, self.varxi
 
+    def _make_cov_design_matrix(self, pairs):
+        # The cached values also depend on rr, dr and rd, which may have been processed again
+        # since calculateXi was called.  If any of them have changed, start over.
+        if self._rr_weight is not None:
+            state = [None if c is None else (id(c), c._cov_version)
+                     for c in (self._rr, self._dr, self._rd)]
+            if self._cov_cache.get('randoms') != state:
+                self._cov_cache.clear()
+                self._cov_cache['randoms'] = state
+        return treecorr.BinnedCorr2._make_cov_design_matrix(self, pairs)
+
     def _calculate_xi_from_pairs(self, pairs):
-        okij = set(self.results.keys())
-        dd = np.sum([self.results[ij].weight for ij in pairs if ij in okij], axis=0)
+        def sum_weight(c, i, j, key):
+            n = len(c.results)
+            return (pairs.sum((i, j), c.results.stack('weight').reshape(n,-1), key+'_weight'),
+                    pairs.sum((i, j), c.results.stack('tot'), key+'_tot'))
+
+        i, j = self.results.indices()
+        dd, dd_tot = sum_weight(self, i, j, 'dd')
         if len(self._rr.results) > 0:
-            dd_tot = np.sum([self.results[ij].tot for ij in pairs if ij in okij])
-            okij = set(self._rr.results.keys())
-            rr = np.sum([self._rr.results[ij].weight for ij in pairs if ij in okij], axis=0)
-            rr_tot = np.sum([self._rr.results[ij].tot for ij in pairs if ij in okij])
+            rr, rr_tot = sum_weight(self._rr, *self._rr.results.indices(), key='rr')
             rrf = dd_tot / rr_tot
         else:
-            diag_tot = np.sum([cij.tot**0.5 for ij,cij in self.results.items() if ij[0] == ij[1]])
-            rr_frac = np.sum([self.results[ij].tot**0.5 for ij in pairs if ij[0] == ij[1]]) / diag_tot
-            rr = self._rr.weight * rr_frac
+            diag = i == j
+            tot = self.results.stack('tot')
+            diag_tot = np.sum(tot[diag]**0.5)
+            rr_frac = pairs.sum((i[diag], j[diag]), tot[diag]**0.5, 'dd_diag') / diag_tot
+            rr = self._rr.weight.ravel() * rr_frac[:,np.newaxis]
             rrf = self.tot / self._rr.tot
         if self._dr is not None:
-            okij = set(self._dr.results.keys())
+            i, j = self._dr.results.indices()
             if self._dr.npatch2 > 1:
-                dr = np.sum([self._dr.results[ij].weight for ij in pairs if ij in okij], axis=0)
-                dr_tot = np.sum([self._dr.results[ij].tot for ij in pairs if ij in okij])
+                dr, dr_tot = sum_weight(self._dr, i, j, 'dr')
                 drf = dd_tot / dr_tot
             else:
-                xpairs = [(ij[0],0) for ij in pairs if ij[0] == ij[1]]
-                dr = np.sum([self._dr.results[ij].weight for ij in xpairs if ij in okij], axis=0)
-                dr_tot = np.sum([self._dr.results[ij].tot for ij in xpairs if ij in okij])
+                # The dr pair (i,0) goes with the auto pair (i,i) of dd.
+                dr, dr_tot = sum_weight(self._dr, i, i, 'dr')
                 drf = self.tot / self._dr.tot
         if self._rd is not None:
-            okij = set(self._rd.results.keys())
+            i, j = self._rd.results.indices()
             if self._rd.npatch1 > 1:
-                rd = np.sum([self._rd.results[ij].weight for ij in pairs if ij in okij], axis=0)
-                rd_tot = np.sum([self._rd.results[ij].tot for ij in pairs if ij in okij])
+                rd, rd_tot = sum_weight(self._rd, i, j, 'rd')
                 rdf = dd_tot / rd_tot
             else:
-                xpairs = [(0,ij[0]) for ij in pairs if ij[0] == ij[1]]
-                rd = np.sum([self._rd.results[ij].weight for ij in xpairs if ij in okij], axis=0)
-                rd_tot = np.sum([self._rd.results[ij].tot for ij in xpairs if ij in okij])
+                # The rd pair (0,j) goes with the auto pair (j,j) of dd.
+                rd, rd_tot = sum_weight(self._rd, j, j, 'rd')
                 rdf = self.tot / self._rd.tot
+        # The f factors are either scalars or have one value per realization.
+        rrf = np.reshape(rrf, (-1,1))
         denom = rr * rrf
         if self._dr is None and self._rd is None:
             xi = dd - denom
         elif self._rd is not None and self._dr is None:
-            xi = dd - 2.*rd * rdf + denom
+            xi = dd - 2.*rd * np.reshape(rdf, (-1,1)) + denom
         elif self._dr is not None and self._rd is None:
-            xi = dd - 2.*dr * drf + denom
+            xi = dd - 2.*dr * np.reshape(drf, (-1,1)) + denom
         else:
-            xi = dd - rd * rdf - dr * drf + denom
+            xi = dd - rd * np.reshape(rdf, (-1,1)) - dr * np.reshape(drf, (-1,1)) + denom
         denom[denom == 0] = 1  # Guard against division by zero.
         xi /= denom
-        w = np.sum(denom)
+        w = np.sum(denom, axis=1)
         return xi,w
 
     def write(self, file_name, rr=None, dr=None, rd=None, file_type=None, precision=None):
@@ -66,6 +66,8 @@ class NNNCorrelation(treecorr.BinnedCorr3):
                     more objects have w=0).
         tot:        The total number of triangles processed, which is used to normalize
                     the randoms if they have a different number of triangles.
+        cov:        An estimate of the full covariance matrix of zeta, if ``var_method`` is
+                    something other than 'shot'.  This is set by `calculateZeta`.
 
     If ``sep_units`` are given (either in the config dict or as a named kwarg) then the distances
     will all be in these units.
@@ -102,6 +104,14 @@ class NNNCorrelation(treecorr.BinnedCorr3):
         **kwargs:       See the documentation for `BinnedCorr3` for the list of allowed keyword
                         arguments, which may be passed either directly or in the config dict.
     """
+    # The accumulated values, which get sent between processes when using MPI.
+    _sum_attrs = ('meand1', 'meanlogd1', 'meand2', 'meanlogd2', 'meand3', 'meanlogd3',
+                  'meanu', 'meanv', 'weight', 'ntri', 'tot')
+    # The attributes that are saved in cache_dir by process.
+    _cache_attrs = ('meand1', 'meanlogd1', 'meand2', 'meanlogd2', 'meand3', 'meanlogd3',
+                    'meanu', 'meanv', 'weight', 'ntri', 'tot', 'results',
+                    'npatch1', 'npatch2', 'npatch3', 'coords', 'metric', '_coords', '_metric')
+
     def __init__(self, config=None, logger=None, **kwargs):
         """Initialize `NNNCorrelation`.  See class doc for details.
         """
@@ -122,6 +132,7 @@ class NNNCorrelation(treecorr.BinnedCorr3):
         self.weight = np.zeros(shape, dtype=float)
         self.ntri = np.zeros(shape, dtype=float)
         self.tot = 0.
+        self._rrr_weight = None  # Marker that calculateZeta hasn't been called yet.
         self.logger.debug('Finished building NNNCorr')
 
     @property
@@ -189,6 +200,14 @@ class NNNCorrelation(treecorr.BinnedCorr3):
         import copy
         return copy.deepcopy(self)
 
+    def _copy_for_results(self):
+        # Make a copy of just the things we need to keep in results.
+        ret = NNNCorrelation.__new__(NNNCorrelation)
+        ret.weight = self.weight.copy()
+        ret.tot = self.tot
+        ret.config = self.config  # not deep copy, so cheap, but makes repr work
+        return ret
+
     def __getstate__(self):
         d = self.__dict__.copy()
         d.pop('_corr',None)
@@ -239,6 +258,32 @@ class NNNCorrelation(treecorr.BinnedCorr3):
                                    field._d, self._coords, self._bintype, self._metric)
         self.tot += (1./6.) * cat.sumw**3
 
+    def _process_sym(self, c1, c2, c3, metric, num_threads):
+        treecorr.BinnedCorr3._process_sym(self, c1, c2, c3, metric, num_threads)
+        # All permutations are done at once, so these count each set of points once.
+        if c1 is c2:
+            self.tot += 0.5 * c1.sumw**2 * c3.sumw
+        else:
+            self.tot += c1.sumw * c2.sumw * c3.sumw
+
+    def _add_tot(self, i, j, k, tot):
+        # The tot value of a triple of patches that was skipped, since it couldn't have any
+        # triangles.  As in NNCorrelation._add_tot, these still need to be in the results,
+        # so the covariance estimates get the right normalization.
+        self.tot += tot
+        res = NNNCorrelation.__new__(NNNCorrelation)
+        res.weight = np.zeros_like(self.weight)
+        res.tot = tot
+        res.config = self.config  # not deep copy, so cheap, but makes repr work
+        self.results[(i,j,k)] = res
+
+    def _add_patch_triple(self, temp, i, j, k, auto):
+        # Unlike the other classes, we need to keep all triples in the results, even if they
+        # have no triangles, since the covariance estimates need the tot values of each one.
+        # cf. NNCorrelation._add_tot.
+        self.results[(i,j,k)] = temp._copy_for_results()
+        self += temp
+
     def process_cross21(self, cat1, cat2, metric=None, num_threads=None):
         """Process two catalogs, accumulating the 3pt cross-correlation, where two of the
         points in each triangle come from the first catalog, and one from the second.
@@ -354,6 +399,7 @@ class NNNCorrelation(treecorr.BinnedCorr3):
         self.weight[:,:,:] = 0.
         self.ntri[:,:,:] = 0.
         self.results.clear()
+        self._clear_cov_cache()
         self.tot = 0.
 
     def __iadd__(self, other):
@@ -379,6 +425,7 @@ class NNNCorrelation(treecorr.BinnedCorr3):
             raise ValueError("NNNCorrelation to be added is not compatible with this one.")
 
         self._set_metric(other.metric, other.coords)
+        self._clear_cov_cache()
         self.meand1[:] += other.meand1[:]
         self.meanlogd1[:] += other.meanlogd1[:]
         self.meand2[:] += other.meand2[:]
@@ -393,7 +440,8 @@ class NNNCorrelation(treecorr.BinnedCorr3):
         return self
 
 
-    def process(self, cat1, cat2=None, cat3=None, metric=None, num_threads=None):
+    def process(self, cat1, cat2=None, cat3=None, metric=None, num_threads=None,
+                comm=None):
         """Accumulate the number of triangles of points between cat1, cat2, and cat3.
 
         - If only 1 argument is given, then compute an auto-correlation function.
@@ -425,19 +473,130 @@ class NNNCorrelation(treecorr.BinnedCorr3):
             num_threads (int):  How many OpenMP threads to use during the calculation.
                                 (default: use the number of cpu cores; this value can also be given
                                 in the constructor in the config dict.)
+            comm (mpi4py.Comm): If running MPI, an mpi4py Comm object to communicate between
+                                processes.  If used, the rank=0 process will have the final
+                                computation. This only works if using patches. (default: None)
         """
         self.clear()
+        cache_file = self._get_cache_file(cat1, cat2, cat3, metric)
+        if treecorr.util.read_cache(self, cache_file, self._cache_attrs, self.logger):
+            return
+        if self.algo == 'multipole':
+            self._process_multipole(cat1, cat2, cat3, metric, num_threads, comm)
+            if isinstance(cat1,list): cat1 = cat1[0]
+            self.tot += (1./6.) * cat1.sumw**3
+            self.finalize()
+            if cache_file is not None:
+                treecorr.util.write_cache(self, cache_file, self._cache_attrs)
+            return
         if not isinstance(cat1,list): cat1 = cat1.get_patches()
         if cat2 is not None and not isinstance(cat2,list): cat2 = cat2.get_patches()
         if cat3 is not None and not isinstance(cat3,list): cat3 = cat3.get_patches()
 
         if cat2 is None and cat3 is None:
-            self._process_all_auto(cat1, metric, num_threads)
+            self._process_all_auto(cat1, metric, num_threads, comm)
         elif (cat2 is None) != (cat3 is None):
             raise NotImplementedError("No partial cross NNN yet.")
         else:
             assert cat2 is not None and cat3 is not None
-            self._process_all_cross(cat1, cat2, cat3, metric, num_threads)
+            self._process_all_cross(cat1, cat2, cat3, metric, num_threads, comm)
+        self.finalize()
+        if cache_file is not None and (comm is None or comm.Get_rank() == 0):
+            treecorr.util.write_cache(self, cache_file, self._cache_attrs)
+
+    def process_uniform(self, coords='3d', nquad=8):
+        """Calculate the expected triangle counts for uniformly distributed points in a
+        periodic box.
+
+        This is the three-point analog of `NNCorrelation.process_uniform`.  The result can be
+        used as rrr in `calculateZeta` without generating or processing a random catalog.
+
+        The periods are taken from the ``period`` (or ``xperiod``, ``yperiod``, ``zperiod``)
+        parameters, which must be set.  The largest possible d2+d3, max_sep * (1 + max_u),
+        may be at most half of the smallest period.
+
+        The integrals over r are done analytically.  The integrals over u and v are done
+        numerically with Gauss-Legendre quadrature using nquad points in each dimension
+        for each bin.
+
+        Parameters:
+            coords (str):   The coordinate system of the data, either 'flat' or '3d'.
+                            (default: '3d')
+            nquad (int):    The number of quadrature points to use per bin for each of u and v.
+                            (default: 8)
+        """
+        self.clear()
+        if coords not in ['flat', '3d']:
+            raise ValueError("Invalid coords %s for process_uniform"%coords)
+        self._set_metric('Periodic', coords)
+        periods = [self.xperiod, self.yperiod]
+        if coords == '3d':
+            periods.append(self.zperiod)
+        if 2.*self._max_sep * (1.+self.max_u) > min(periods):
+            raise ValueError("process_uniform requires max_sep * (1+max_u) <= period/2")
+        ndim = len(periods)
+        volume = np.prod(periods)
+
+        # Parametrize the triangles by r = d2, u = d3/d2, and the angle theta between the
+        # d2 and d3 sides.  For a given orientation (i.e. sign of v), the number of (x2,x3)
+        # positions relative to x1 per unit r, u, theta is
+        #   2D: 2 pi r^3 u
+        #   3D: 4 pi^2 r^5 u^2 sin(theta)
+        # which is separable into a part depending only on r and a part depending on u, theta.
+        r1 = np.exp(self.logr1d - 0.5*self.bin_size) * self._sep_units
+        r2 = np.exp(self.logr1d + 0.5*self.bin_size) * self._sep_units
+        r0, rr, rlog = treecorr.util.radial_integrals(r1, r2, 2*ndim)
+
+        xq, wq = np.polynomial.legendre.leggauss(nquad)
+        u1 = self.u1d - 0.5*self.ubin_size
+        u = u1[:,None] + 0.5*self.ubin_size * (xq+1)        # (nubins, nquad)
+        wu = 0.5*self.ubin_size * wq
+        vpos = self.v1d[self.nvbins:]
+        v_edges = np.array([vpos - 0.5*self.vbin_size, vpos + 0.5*self.vbin_size])
+        # cos(theta) = (d2^2 + d3^2 - d1^2) / (2 d2 d3) with d1 = d2 (1 + u v)
+        uu = u[:,:,None,None]
+        costh = (uu * (1.-v_edges**2) - 2.*v_edges) / 2.       # (nubins, nquad, 2, nvbins)
+        th = np.arccos(np.clip(costh, -1., 1.))
+        th1 = th[:,:,0,:,None]
+        th2 = th[:,:,1,:,None]
+        theta = th1 + 0.5*(th2-th1) * (xq+1)                  # (nubins, nquad, nvbins, nquad)
+        wtheta = 0.5*(th2-th1) * wq
+        # v = (d1/d2 - 1)/u, written in a form that is stable as u -> 0.
+        v = (uu - 2.*np.cos(theta)) / (np.sqrt(1. + uu**2 - 2.*uu*np.cos(theta)) + 1.)
+        if ndim == 2:
+            f = 2.*np.pi * uu
+        else:
+            f = 4.*np.pi**2 * uu**2 * np.sin(theta)
+        f = f * wu[None,:,None,None] * wtheta
+        def usum(g):
+            return np.sum(f * g, axis=(1,3))                # (nubins, nvbins)
+        q = 1. + uu*v
+        uw = usum(1.)
+        uu_sum = usum(uu)
+        ulogu = usum(np.log(uu))
+        uq = usum(q)
+        ulogq = usum(np.log(q))
+        uv = usum(v)
+
+        nrand = 1.e10  # Any large number works here.
+        self.tot = nrand**3 / 6.
+        # Each triangle with d1 > d2 > d3 corresponds to exactly one ordered triple of points.
+        norm = 6. * self.tot / volume**2
+        def set_values(target, rpart, upart, sign=1.):
+            full = np.concatenate([sign * upart[:,::-1], upart], axis=1)
+            target[:] = norm * rpart[:,None,None] * full[None,:,:]
+        set_values(self.weight, r0, uw)
+        set_values(self.meand2, rr, uw)
+        set_values(self.meanlogd2, rlog, uw)
+        set_values(self.meand3, rr, uu_sum)
+        set_values(self.meanlogd3, r0, ulogu)
+        self.meanlogd3 += self.meanlogd2
+        set_values(self.meand1, rr, uq)
+        set_values(self.meanlogd1, r0, ulogq)
+        self.meanlogd1 += self.meanlogd2
+        set_values(self.meanu, r0, uu_sum)
+        set_values(self.meanv, r0, uv, sign=-1.)
+        self.ntri[:] = self.weight
         self.finalize()
 
     def calculateZeta(self, rrr, drr=None, rdr=None, rrd=None,
@@ -469,6 +628,11 @@ class NNNCorrelation(treecorr.BinnedCorr3):
         - If only rrr is provided, the first formula will be used.
         - If all of rrr, drr, rdr, rrd, ddr, drd, rdd are provided then the second will be used.
 
+        If ``var_method`` is something other than 'shot', the returned varzeta is the diagonal
+        of the covariance matrix estimated from the patches, which is also saved as ``cov``.
+        In this case, the random correlations need to have been processed using the same
+        patches as the data.
+
         Parameters:
             rrr (NNNCorrelation):   The auto-correlation of the random field (RRR)
             drr (NNNCorrelation):   DRR if desired. (default: None)
@@ -528,8 +692,92 @@ class NNNCorrelation(treecorr.BinnedCorr3):
         varzeta = np.zeros_like(rrr.weight)
         varzeta[mask1] = 1./ (rrr.weight[mask1] * rrrw)
 
+        # Set up necessary info for estimate_cov
+        self._var_num = 1.
+        self._rrr_weight = rrr.weight * rrrw
+        self._rrr = rrr
+        if drr is None:
+            self._nnn_terms = []
+        else:
+            self._nnn_terms = [('drr', drr, 1.), ('rdr', rdr, 1.), ('rrd', rrd, 1.),
+                               ('ddr', ddr, -1.), ('drd', drd, -1.), ('rdd', rdd, -1.)]
+        self._clear_cov_cache()
+
+        if self.var_method != 'shot':
+            # Check that the randoms use the same patches as ddd.
+            if len(self.results) > 0:
+                for name, c in [('rrr', rrr)] + [(t[0], t[1]) for t in self._nnn_terms]:
+                    if len(c.results) == 0 or c._npatches() != self._npatches():
+                        raise RuntimeError("If using patches, %s must be run with the same "
+                                           "patches as DDD"%name.upper())
+
+                # If there are any triples in the random correlations that aren't in results
+                # (because the data catalog has some patches with no items, or the data triple
+                # had no triangles), add some empty results so they are included in the sums.
+                add_ijk = set()
+                for c in [rrr] + [t[1] for t in self._nnn_terms]:
+                    for ijk in c.results:
+                        if ijk not in self.results:
+                            add_ijk.add(ijk)
+                if len(add_ijk) > 0:
+                    template = next(iter(self.results.values()))
+                    for ijk in add_ijk:
+                        new_cijk = template.copy()
+                        new_cijk.weight.ravel()[:] = 0
+                        new_cijk.tot = 0
+                        self.results[ijk] = new_cijk
+
+            self.cov = self.estimate_cov(self.var_method)
+            varzeta.ravel()[:] = self.cov.diagonal()
+
         return zeta, varzeta
 
+    def _getStatLen(self):
+        # This doesn't need to be anything different than the default, but it is useful
+        # here to include the check that calculateZeta has been run, since _rrr, etc.
+        # will need to be set.
+        if self._rrr_weight is None:
+            raise RuntimeError("You need to call calculateZeta before calling estimate_cov.")
+        else:
+            return self.weight.size
+
+    def _getWeight(self):
+        return self._rrr_weight.ravel()
+
+    def _make_cov_design_matrix(self, pairs):
+        # The cached values also depend on rrr and the other random terms, which may have been
+        # processed again since calculateZeta was called.  If any of them have changed, start over.
+        if self._rrr_weight is not None:
+            state = [(id(c), c._cov_version) for c in [self._rrr] + [t[1] for t in self._nnn_terms]]
+            if self._cov_cache.get('randoms') != state:
+                self._cov_cache.clear()
+                self._cov_cache['randoms'] = state
+        return treecorr.BinnedCorr3._make_cov_design_matrix(self, pairs)
+
+    def _calculate_xi_from_pairs(self, pairs):
+        def sum_weight(c, key):
+            n = len(c.results)
+            index = c.results.indices()
+            return (pairs.sum(index, c.results.stack('weight').reshape(n,-1), key+'_weight'),
+                    pairs.sum(index, c.results.stack('tot'), key+'_tot'))
+
+        def scale(ddd_tot, tot):
+            # The factor to normalize a random correlation, one value per realization.
+            tot = np.where(tot == 0, 1., tot)
+            return (ddd_tot / tot)[:,np.newaxis]
+
+        ddd, ddd_tot = sum_weight(self, 'ddd')
+        rrr, rrr_tot = sum_weight(self._rrr, 'rrr')
+        denom = rrr * scale(ddd_tot, rrr_tot)
+        zeta = ddd - denom
+        for key, c, sign in self._nnn_terms:
+            w, tot = sum_weight(c, key)
+            zeta += sign * w * scale(ddd_tot, tot)
+        denom[denom == 0] = 1  # Guard against division by zero.
+        zeta /= denom
+        w = np.sum(denom, axis=1)
+        return zeta, w
+
 
     def write(self, file_name, rrr=None, drr=None, rdr=None, rrd=None,
               ddr=None, drd=None, rdd=None, file_type=None, precision=None):
@@ -19,6 +19,10 @@ import treecorr
 import numpy as np
 import os
 import warnings
+import threading
+import contextlib
+import hashlib
+import pickle
 import coord
 
 def ensure_dir(target):
@@ -27,6 +31,126 @@ def ensure_dir(target):
         if not os.path.exists(d):
             os.makedirs(d)
 
+def replace_file(src, dst):
+    """Move the file src to dst, replacing dst if it already exists.
+
+    On POSIX systems, this is atomic, so other jobs see either the old file or the new one.
+    This is os.replace on Python 3.  Python 2 doesn't have os.replace, but os.rename does
+    the same thing on POSIX.  On Windows, it can't replace an existing file, so remove the
+    old one first.
+
+    :param src:         The name of the file to move.
+    :param dst:         The new name for the file.
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:  # pragma: no cover  (Python 2)
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+@contextlib.contextmanager
+def file_lock(file_name):
+    """A context manager that holds an exclusive lock on a file for the duration of the block.
+
+    This is used to make sure only one process at a time builds a given tree in
+    ``save_tree_dir``.  The others wait for the lock and then read the tree that the first
+    one wrote.  On systems without fcntl, this does nothing.
+
+    :param file_name:   The name of the file to use as the lock.  It is created if necessary.
+    """
+    try:
+        import fcntl
+    except ImportError:  # pragma: no cover  (e.g. Windows)
+        yield
+        return
+    with open(file_name, 'a') as fid:
+        fcntl.flock(fid, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fid, fcntl.LOCK_UN)
+
+def get_cache_file(cache_dir, params, cats):
+    """Get the name of the file in cache_dir where the results of a calculation are stored.
+
+    The name is a hash of the parameters of the calculation along with the positions,
+    weights and patches of the catalogs, so any change to either gives a new file.
+
+    :param cache_dir:   The directory in which to store the results.
+    :param params:      A tuple of the parameters that affect the results.
+    :param cats:        A list of the catalogs being used.  Each item may also be a list of
+                        catalogs or None.
+
+    :returns: the name of the file.
+    """
+    h = hashlib.sha1()
+    h.update(repr((treecorr.__version__,) + tuple(params)).encode())
+    for cat in cats:
+        if cat is None:
+            h.update(b'None')
+        elif isinstance(cat, list):
+            h.update(repr([c._get_content_hash() for c in cat]).encode())
+        else:
+            h.update(cat._get_content_hash().encode())
+    return os.path.join(cache_dir, 'corr_%s.pkl'%h.hexdigest())
+
+def write_cache(obj, file_name, attrs):
+    """Write the given attributes of a correlation object to a cache file.
+
+    :param obj:         The correlation object.
+    :param file_name:   The name of the file to write to.
+    :param attrs:       A list of the names of the attributes to write.
+    """
+    state = { name : getattr(obj, name) for name in attrs }
+    write_pickle(file_name, state)
+
+def write_pickle(file_name, state):
+    """Pickle an object to a file, replacing the file atomically.
+
+    The object is first written to a temporary file, which is then moved into place,
+    so other jobs (or a later run after a crash) never see a partially written file.
+
+    :param file_name:   The name of the file to write to.
+    :param state:       The object to write.
+    """
+    ensure_dir(file_name)
+    tmp_file_name = file_name + '.tmp%d'%os.getpid()
+    with open(tmp_file_name, 'wb') as fid:
+        pickle.dump(state, fid, protocol=pickle.HIGHEST_PROTOCOL)
+    replace_file(tmp_file_name, file_name)
+
+def read_cache(obj, file_name, attrs, logger=None):
+    """Read the attributes of a correlation object written by `write_cache`.
+
+    :param obj:         The correlation object.
+    :param file_name:   The name of the file to read, or None.
+    :param attrs:       A list of the names of the attributes to read.
+    :param logger:      A logger, if desired. (default: None)
+
+    :returns: whether the file was read successfully.
+    """
+    if file_name is None or not os.path.isfile(file_name):
+        return False
+    try:
+        with open(file_name, 'rb') as fid:
+            state = pickle.load(fid)
+        values = [ state[name] for name in attrs ]
+    except Exception as e:
+        if logger:
+            logger.warning('Unable to read cache file %s: %r.  Recomputing.',file_name,e)
+        return False
+    if logger:
+        logger.info('Reading cached results from %s',file_name)
+    for name, value in zip(attrs, values):
+        current = getattr(obj, name, None)
+        if isinstance(current, np.ndarray):
+            # The C++ layer has pointers to these arrays, so update them in place.
+            current[...] = value
+        else:
+            setattr(obj, name, value)
+    return True
+
 def set_omp_threads(num_threads, logger=None):
     """Set the number of OpenMP threads to use in the C++ layer.
 
@@ -259,8 +383,15 @@ class LRU_Cache:
             self.cache[key] = last[1] = last = [last, self.root, key, None]
         self.root[0] = last
         self.count = 0
+        # Guard against several threads building or reordering the cache at the same time.
+        # (Reentrant, since user_function may itself use other caches.)
+        self._lock = threading.RLock()
 
     def __call__(self, *key, **kwargs):
+        with self._lock:
+            return self._call(*key, **kwargs)
+
+    def _call(self, *key, **kwargs):
         link = self.cache.get(key)
         if link is not None:
             # Cache hit: move link to last position
@@ -303,6 +434,10 @@ class LRU_Cache:
 
         :param maxsize: The new maximum number of inputs to cache.
         """
+        with self._lock:
+            self._resize(maxsize)
+
+    def _resize(self, maxsize):
         oldsize = len(self.cache)
         if maxsize == oldsize:
             return
@@ -328,6 +463,10 @@ class LRU_Cache:
     def clear(self):
         """ Clear all items from the cache.
         """
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
         maxsize = len(self.cache)
         self.cache.clear()
         last = self.root
@@ -343,6 +482,154 @@ class LRU_Cache:
         return len(self.cache)
 
 
+class PatchPairResults(object):
+    """A compact store of the results for each pair of patches in a patch-based correlation.
+
+    This acts like a dict mapping (i,j) to a stripped down correlation object that holds just
+    the values needed for the covariance estimates (cf. ``_copy_for_results``).  But rather
+    than keep a separate Python object for each pair, the values are stored in contiguous
+    arrays with one row per pair.  The objects returned when indexing are built on the fly,
+    and their attributes are views into these arrays.
+
+    The arrays of all the rows for a given attribute are available via `stack`.
+
+    3-point correlations use the same structure for the results of each triple of patches,
+    keyed by (i,j,k).
+    """
+    def __init__(self):
+        self._index = {}            # (i,j) -> row
+        self._keys = []             # The keys in the order they were added
+        self._arrays = None         # name -> array of shape (capacity,) + shape of value
+        self._cls = None            # The correlation class to use for the returned objects
+        self._nbins = None
+        self.config = None
+
+    def _init_arrays(self, obj, capacity):
+        self._cls = obj.__class__
+        self._nbins = getattr(obj, '_nbins', None)
+        self.config = obj.config
+        self._arrays = {}
+        for name, value in vars(obj).items():
+            if name in ('_nbins', 'config', 'logger'): continue
+            value = np.asarray(value)
+            # Things like tot might start out as an int, but they are really floats.
+            dtype = float if value.dtype.kind in 'biu' else value.dtype
+            self._arrays[name] = np.zeros((capacity,) + value.shape, dtype=dtype)
+
+    def _capacity(self):
+        return 0 if self._arrays is None else len(next(iter(self._arrays.values())))
+
+    def _reserve(self, n):
+        # Make sure there is room for at least n rows.  Grow geometrically so appending a
+        # row at a time is amortized O(1).
+        cap = self._capacity()
+        if n > cap:
+            new_cap = max(n, 2*cap, 16)
+            for name, a in self._arrays.items():
+                new_a = np.zeros((new_cap,) + a.shape[1:], dtype=a.dtype)
+                new_a[:len(self._keys)] = a[:len(self._keys)]
+                self._arrays[name] = new_a
+
+    def _get_rows(self, keys):
+        # Return the rows for the given keys, adding new rows as needed.
+        rows = []
+        new_keys = []
+        for ij in keys:
+            row = self._index.get(ij)
+            if row is None:
+                row = len(self._keys) + len(new_keys)
+                new_keys.append(ij)
+            rows.append(row)
+        if new_keys:
+            self._reserve(len(self._keys) + len(new_keys))
+            for ij in new_keys:
+                self._index[ij] = len(self._keys)
+                self._keys.append(ij)
+        return rows
+
+    def __setitem__(self, ij, obj):
+        if self._arrays is None:
+            self._init_arrays(obj, 16)
+        row = self._get_rows([ij])[0]
+        for name, a in self._arrays.items():
+            a[row] = getattr(obj, name)
+
+    def __getitem__(self, ij):
+        row = self._index[ij]
+        obj = self._cls.__new__(self._cls)
+        obj._nbins = self._nbins
+        obj.config = self.config
+        for name, a in self._arrays.items():
+            setattr(obj, name, a[row])
+        return obj
+
+    def __contains__(self, ij):
+        return ij in self._index
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __repr__(self):
+        return 'PatchPairResults(%r)'%self._keys
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return [self[ij] for ij in self._keys]
+
+    def items(self):
+        return [(ij, self[ij]) for ij in self._keys]
+
+    def stack(self, name):
+        """Return an array of the given attribute for all the pairs, in the order of `keys`.
+        """
+        if self._arrays is None:
+            raise KeyError(name)
+        return self._arrays[name][:len(self._keys)]
+
+    def indices(self):
+        """Return the patch indices (i,j) of all the pairs as two integer arrays, in the order
+        of `keys`.  For the patch triples (i,j,k) of a 3-point correlation, this returns three
+        arrays.
+        """
+        n = len(self._keys[0]) if len(self._keys) > 0 else 2
+        ij = np.array(self._keys, dtype=int).reshape(-1,n)
+        return tuple(ij[:,a] for a in range(n))
+
+    def clear(self):
+        self._index.clear()
+        del self._keys[:]
+
+    def update(self, other):
+        if isinstance(other, PatchPairResults):
+            if len(other) == 0:
+                return
+            if self._arrays is None:
+                self._init_arrays(other[other._keys[0]], len(other))
+            rows = self._get_rows(other._keys)
+            n = len(other._keys)
+            for name, a in self._arrays.items():
+                a[rows] = other._arrays[name][:n]
+        else:
+            for ij, obj in other.items():
+                self[ij] = obj
+
+    def __getstate__(self):
+        # Don't bother pickling the unused capacity.
+        d = self.__dict__.copy()
+        if self._arrays is not None:
+            n = len(self._keys)
+            d['_arrays'] = { name : a[:n].copy() for name, a in self._arrays.items() }
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__ = d
+
+
 def double_ptr(x):
     """
     Cast x as a double* to pass to library C functions
@@ -372,6 +659,49 @@ def long_ptr(x):
     else:
         return treecorr._ffi.cast('long*', x.ctypes.data)
 
+def int64_ptr(x):
+    """
+    Cast x as an int64_t* to pass to library C functions
+
+    :param x:   A numpy array assumed to have dtype = np.int64.
+
+    :returns:   A version of the array that can be passed to cffi C functions.
+    """
+    return treecorr._ffi.cast('int64_t*', x.ctypes.data)
+
+def char_ptr(x):
+    """
+    Cast x as a char* to pass to library C functions
+
+    :param x:   A numpy array, whose raw bytes are to be passed.
+
+    :returns:   A version of the array that can be passed to cffi C functions.
+    """
+    return treecorr._ffi.cast('char*', x.ctypes.data)
+
+def radial_integrals(r1, r2, p):
+    """
+    Calculate the integrals of r^(p-1), r^p, and r^(p-1) log(r) from r1 to r2.
+
+    These are the integrals needed for the weight, meanr, and meanlogr of a bin from r1 to r2
+    when the number of pairs per unit r is proportional to r^(p-1).
+
+    :param r1:  An array of the lower edges of the bins.
+    :param r2:  An array of the upper edges of the bins.
+    :param p:   The power of r in the integrals.
+
+    :returns:   A tuple of arrays (int r^(p-1) dr, int r^p dr, int r^(p-1) log(r) dr)
+    """
+    def log_integral(r):
+        # r^p (log(r)/p - 1/p^2), which goes to 0 as r -> 0.
+        r = np.asarray(r, dtype=float)
+        safe_r = np.where(r > 0, r, 1.)
+        return np.where(r > 0, safe_r**p * (np.log(safe_r)/p - 1./p**2), 0.)
+    w0 = (r2**p - r1**p) / p
+    w1 = (r2**(p+1) - r1**(p+1)) / (p+1)
+    wlog = log_integral(r2) - log_integral(r1)
+    return w0, w1, wlog
+
 def parse_metric(metric, coords, coords2=None, coords3=None):
     """
     Convert a string metric into the corresponding enum to pass to the C code.